@@ -41,6 +41,7 @@ import math
 import operator
 import scipy
 import tempfile
+import unittest
 
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core.utils import append_to_dict_of_lists
@@ -82,21 +83,39 @@ class EigenBase(object):
     def init_vertex_similarity(self):
         num_verts_p1 = len(self._p1.graph.vertices)
         num_verts_p2 = len(self._p2.graph.vertices)
-        m_i = mzeros((num_verts_p1, num_verts_p2))
-        m_o = mzeros((num_verts_p1, num_verts_p2))
         def get_vertex_map(g):
             return Bidict([(v, k) for (k, v)
                            in enumerate(g.iter_vertices())])
         # vertex_maps: vertex_id to matrix index
         self._g1_vertex_map = get_vertex_map(self._p1.graph)
         self._g2_vertex_map = get_vertex_map(self._p2.graph)
-        for i in xrange(num_verts_p1):
-            for j in xrange(num_verts_p2):
-                v1_id = self._g1_vertex_map.inverse[i]
-                v2_id = self._g2_vertex_map.inverse[j]
-                (in_s8y, out_s8y) = self.compare_modules(v1_id, v2_id)
-                m_i[i,j] = in_s8y
-                m_o[i,j] = out_s8y
+        # the ports of each module are only looked up once
+        modules1 = [self._p1.modules[self._g1_vertex_map.inverse[i]]
+                    for i in xrange(num_verts_p1)]
+        modules2 = [self._p2.modules[self._g2_vertex_map.inverse[j]]
+                    for j in xrange(num_verts_p2)]
+        ports1 = [self.get_ports(m) for m in modules1]
+        ports2 = [self.get_ports(m) for m in modules2]
+        names = {}
+        names1 = scipy.array([names.setdefault(m.name, len(names))
+                              for m in modules1], dtype=int)
+        names2 = scipy.array([names.setdefault(m.name, len(names))
+                              for m in modules2], dtype=int)
+        name_factor = scipy.where(names1[:, None] == names2[None, :],
+                                  1.0, 0.99)
+
+        # see compare_modules: an output port counts its descriptors found
+        # in the other module, which for an identical port are all of
+        # them, while an identical input port only counts once
+        (hits, exact, exact_descs, totals) = \
+            self.compare_port_sets([p[0] for p in ports1],
+                                   [p[0] for p in ports2])
+        m_i = self.port_similarity(exact + (hits - exact_descs), totals,
+                                   name_factor)
+        (hits, exact, exact_descs, totals) = \
+            self.compare_port_sets([p[1] for p in ports1],
+                                   [p[1] for p in ports2])
+        m_o = self.port_similarity(hits, totals, name_factor)
         # print m_i
         # print m_o
         self._input_vertex_s8y = m_i
@@ -113,16 +132,101 @@ class EigenBase(object):
         self._g1_edge_map = get_edge_map(self._p1.graph)
         self._g2_edge_map = get_edge_map(self._p2.graph)
 
-        m_e = mzeros((len(self._g1_edge_map),
-                      len(self._g2_edge_map)))
+        # see compare_connections
+        port_names = {}
+        def connection_features(pipeline, edge_map, vertex_map):
+            conns = [pipeline.connections[edge_map.inverse[k]]
+                     for k in xrange(len(edge_map))]
+            def column(values):
+                return scipy.array(list(values), dtype=int)
+            return (column(vertex_map[c.sourceId] for c in conns),
+                    column(vertex_map[c.destinationId] for c in conns),
+                    column(port_names.setdefault(c.source.name,
+                                                 len(port_names))
+                           for c in conns),
+                    column(port_names.setdefault(c.destination.name,
+                                                 len(port_names))
+                           for c in conns))
+        (src1, dst1, src_names1, dst_names1) = \
+            connection_features(self._p1, self._g1_edge_map,
+                                self._g1_vertex_map)
+        (src2, dst2, src_names2, dst_names2) = \
+            connection_features(self._p2, self._g2_edge_map,
+                                self._g2_vertex_map)
+
+        m_o = scipy.asarray(self._output_vertex_s8y)
+        m_i = scipy.asarray(self._input_vertex_s8y)
+        m_e = (m_o[scipy.ix_(src1, src2)] + m_i[scipy.ix_(dst1, dst2)]) / 2.0
+        m_e[(src_names1[:, None] != src_names2[None, :]) |
+            (dst_names1[:, None] != dst_names2[None, :])] = 0.0
+        self._edge_s8y = scipy.matrix(m_e)
 
-        for i in xrange(len(self._g1_edge_map)):
-            for j in xrange(len(self._g2_edge_map)):
-                c1_id = self._g1_edge_map.inverse[i]
-                c2_id = self._g2_edge_map.inverse[j]
-                s8y = self.compare_connections(c1_id, c2_id)
-                m_e[i, j] = s8y
-        self._edge_s8y = m_e
+    @staticmethod
+    def compare_port_sets(ports1, ports2):
+        """compare_port_sets(ports1: list, ports2: list) -> tuple
+
+        Takes the port dicts (as returned by get_ports) of the modules of
+        each pipeline and returns, as arrays indexed by pairs of modules,
+        the number of descriptors of the first module's ports that appear
+        on some port of the second, the number of ports of the first
+        module that the second has too, with the same descriptors, and the
+        number of descriptors of those ports. The last value is the array
+        of the number of descriptors of each module of the first
+        pipeline."""
+        signatures = {}
+        descriptors = {}
+        def incidence(ports_list):
+            sigs = []
+            descs = []
+            for i, ports in enumerate(ports_list):
+                for (port_name, port_descs) in ports.iteritems():
+                    k = signatures.setdefault((port_name, tuple(port_descs)),
+                                              len(signatures))
+                    sigs.append((i, k, len(port_descs)))
+                    for port_desc in port_descs:
+                        k = descriptors.setdefault(port_desc,
+                                                   len(descriptors))
+                        descs.append((i, k))
+            return sigs, descs
+        (sigs1, descs1) = incidence(ports1)
+        (sigs2, descs2) = incidence(ports2)
+
+        def fill(shape, entries, value=None):
+            m = scipy.zeros(shape, dtype=float)
+            if entries:
+                ix = scipy.array(entries, dtype=int)
+                if value is None:
+                    m[ix[:, 0], ix[:, 1]] = 1.0
+                else:
+                    scipy.add.at(m, (ix[:, 0], ix[:, 1]), ix[:, value])
+            return m
+        n1 = len(ports1)
+        n2 = len(ports2)
+        sig_shape = len(signatures)
+        desc_shape = len(descriptors)
+        # descriptors may be repeated on the first module, but are only
+        # looked up on the second one
+        d1 = fill((n1, desc_shape), [(i, k, 1) for (i, k) in descs1], 2)
+        d2 = fill((n2, desc_shape), descs2)
+        s1 = fill((n1, sig_shape), sigs1)
+        s1_descs = fill((n1, sig_shape), sigs1, 2)
+        s2 = fill((n2, sig_shape), sigs2)
+        return (d1.dot(d2.T), s1.dot(s2.T), s1_descs.dot(s2.T),
+                s1_descs.sum(1))
+
+    @staticmethod
+    def port_similarity(matches, totals, name_factor):
+        """port_similarity(matches: array, totals: array,
+                           name_factor: array) -> matrix
+
+        Turns match counts into similarities as compare_modules does:
+        modules without ports get 0.2, and modules with different names
+        are scaled by name_factor."""
+        has_ports = (totals > 0)[:, None]
+        s8y = scipy.where(has_ports,
+                          matches / scipy.maximum(totals, 1)[:, None],
+                          0.2)
+        return scipy.matrix(s8y * name_factor)
 
     ##########################################################################
     # Atomic comparisons for modules and connections
@@ -332,33 +436,41 @@ class EigenPipelineSimilarity2(EigenBase):
         num_verts_p2 = len(self._p2.graph.vertices)
         n = num_verts_p1 * num_verts_p2
         def ix(a,b): return num_verts_p2 * a + b
-        # h is the raw substochastic matrix
-        from scipy import sparse
-        h = sparse.lil_matrix((n, n))
+        def incidences(pip, vertex_map, edge_map):
+            # (vertex, neighbor, edge) matrix indices, grouped by vertex
+            result = [(i, vertex_map[v], edge_map[e])
+                      for i in xrange(len(vertex_map))
+                      for (v, e) in edges(pip, vertex_map.inverse[i])]
+            return scipy.array(result, dtype=scipy.int64).reshape(-1, 3)
+        inc1 = incidences(self._p1, self._g1_vertex_map, self._g1_edge_map)
+        inc2 = incidences(self._p2, self._g2_vertex_map, self._g2_edge_map)
+        # every pair of edges incident to a pair of vertices (i, j) links
+        # it to the pair of their other ends; the indices are 64-bit since
+        # rows * n below overflows a 32-bit int (the default int on Windows)
+        # for pipelines of a few hundred modules
+        a_ix = scipy.repeat(scipy.arange(len(inc1)), len(inc2))
+        b_ix = scipy.tile(scipy.arange(len(inc2)), len(inc1))
+        rows = ix(inc1[a_ix, 0], inc2[b_ix, 0])
+        cols = ix(inc1[a_ix, 1], inc2[b_ix, 1])
+        values = scipy.asarray(self._edge_s8y)[inc1[a_ix, 2], inc2[b_ix, 2]]
+        running_sum = scipy.bincount(rows, weights=values, minlength=n)
+
         # a is the dangling node vector
         a = mzeros(n)
-        for i in xrange(num_verts_p1):
-            v1_id = self._g1_vertex_map.inverse[i]
-            for j in xrange(num_verts_p2):
-                ix_ij = ix(i,j)
-                v2_id = self._g2_vertex_map.inverse[j]
-                running_sum = 0.0
-                for (_, p1_edge) in edges(self._p1, v1_id):
-                    for (_, p2_edge) in edges(self._p2, v2_id):
-                        e1_id = self._g1_edge_map[p1_edge]
-                        e2_id = self._g2_edge_map[p2_edge]
-                        running_sum += self._edge_s8y[e1_id, e2_id]
-                if running_sum == 0.0:
-                    a[0, ix_ij] = 1.0
-                    continue
-                for (p1_v, p1_edge_id) in edges(self._p1, v1_id):
-                    for (p2_v, p2_edge_id) in edges(self._p2, v2_id):
-                        e1_id = self._g1_edge_map[p1_edge_id]
-                        e2_id = self._g2_edge_map[p2_edge_id]
-                        p1_v_id = self._g1_vertex_map[p1_v]
-                        p2_v_id = self._g2_vertex_map[p2_v]
-                        value = self._edge_s8y[e1_id, e2_id] / running_sum
-                        h[ix_ij, ix(p1_v_id, p2_v_id)] = value
+        a[0, running_sum == 0.0] = 1.0
+        keep = running_sum[rows] != 0.0
+        rows = rows[keep]
+        cols = cols[keep]
+        values = values[keep] / running_sum[rows]
+        # parallel edges give the same cell more than once: keep the last
+        # value, like the cell-by-cell construction did
+        keys = (rows * n + cols)[::-1]
+        (_, last) = scipy.unique(keys, return_index=True)
+        last = len(keys) - 1 - last
+        # h is the raw substochastic matrix
+        from scipy import sparse
+        h = sparse.csr_matrix((values[last], (rows[last], cols[last])),
+                              shape=(n, n))
 
         self._alpha = alpha
         self._n = n
@@ -476,4 +588,72 @@ class EigenPipelineSimilarity2(EigenBase):
         return inputmap, outputmap, combinedmap
 
 
-    
+
+##############################################################################
+
+class TestEigen(unittest.TestCase):
+    def make_pipelines(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        s1 = controller.add_module(basic_pkg, 'String')
+        s2 = controller.add_module(basic_pkg, 'String')
+        c = controller.add_module(basic_pkg, 'ConcatenateString')
+        controller.add_connection(s1.id, 'value', c.id, 'str1')
+        controller.add_connection(s2.id, 'value', c.id, 'str2')
+        controller.add_connection(s2.id, 'value', c.id, 'str2')
+        controller.add_connection(c.id, 'value', s1.id, 'value')
+        p1 = controller.current_pipeline
+        controller.add_module(basic_pkg, 'Integer')
+        f = controller.add_module(basic_pkg, 'Float')
+        controller.add_connection(s1.id, 'value_as_string', c.id, 'str3')
+        controller.add_connection(f.id, 'value_as_string', c.id, 'str4')
+        controller.delete_module(s2.id)
+        p2 = controller.current_pipeline
+        return p1, p2
+
+    def test_similarity(self):
+        (p1, p2) = self.make_pipelines()
+        e = EigenPipelineSimilarity2(p1, p2, alpha=0.15)
+        for i in xrange(len(p1.modules)):
+            for j in xrange(len(p2.modules)):
+                (in_s8y, out_s8y) = e.compare_modules(
+                    e._g1_vertex_map.inverse[i], e._g2_vertex_map.inverse[j])
+                self.assertEqual(e._input_vertex_s8y[i, j], in_s8y)
+                self.assertEqual(e._output_vertex_s8y[i, j], out_s8y)
+        for i in xrange(len(p1.connections)):
+            for j in xrange(len(p2.connections)):
+                self.assertEqual(e._edge_s8y[i, j], e.compare_connections(
+                    e._g1_edge_map.inverse[i], e._g2_edge_map.inverse[j]))
+
+    def test_operator(self):
+        (p1, p2) = self.make_pipelines()
+        e = EigenPipelineSimilarity2(p1, p2, alpha=0.15)
+        def edges(pip, v_id):
+            return ([(x[1], x[2]) for x in pip.graph.iter_edges_from(v_id)] +
+                    [(x[0], x[2]) for x in pip.graph.iter_edges_to(v_id)])
+        n2 = len(p2.modules)
+        h = scipy.zeros((e._n, e._n))
+        a = scipy.zeros(e._n)
+        for i in xrange(len(p1.modules)):
+            edges1 = edges(p1, e._g1_vertex_map.inverse[i])
+            for j in xrange(n2):
+                edges2 = edges(p2, e._g2_vertex_map.inverse[j])
+                s8ys = [[e._edge_s8y[e._g1_edge_map[e1], e._g2_edge_map[e2]]
+                         for (_, e2) in edges2] for (_, e1) in edges1]
+                total = sum(sum(row) for row in s8ys)
+                if total == 0.0:
+                    a[i * n2 + j] = 1.0
+                    continue
+                for (k, (v1, _)) in enumerate(edges1):
+                    for (l, (v2, _)) in enumerate(edges2):
+                        col = (e._g1_vertex_map[v1] * n2 +
+                               e._g2_vertex_map[v2])
+                        h[i * n2 + j, col] = s8ys[k][l] / total
+        self.assertTrue(scipy.allclose(e._h.toarray(), h))
+        self.assertTrue((scipy.asarray(e._a)[0] == a).all())
+        (inputmap, outputmap, combinedmap) = e.solve()
+        self.assertEqual(sorted(combinedmap), sorted(p1.modules))
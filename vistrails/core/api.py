@@ -260,6 +260,30 @@ class Vistrail(object):
         """
         return self.current_pipeline.execute(*args, **kwargs)
 
+    def execute_parameter_exploration(self, pe, processes=None):
+        """Executes a parameter exploration, from its name or the version.
+
+        If a version number is given, the latest exploration of that version
+        is used.
+
+        This returns an iterator of ExplorationCellResult objects, one per
+        cell, as they finish. The cells are run on `processes` worker
+        processes, defaulting to the explorationProcesses setting.
+        """
+        vistrail = self.controller.vistrail
+        if isinstance(pe, (int, long)):
+            pe = vistrail.get_paramexp(pe)
+        elif isinstance(pe, basestring):
+            pe = vistrail.get_named_paramexp(pe)
+        if pe is None:
+            raise KeyError("Vistrail doesn't have this parameter "
+                           "exploration")
+        results = self.controller.execute_parameter_exploration(
+                pe, processes=processes)
+        self._current_pipeline = None
+        self._html = None
+        return results
+
     @property
     def changed(self):
         return self.controller.changed
@@ -0,0 +1,428 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Content hashes of files and directories, cached on disk.
+
+Hashing a file means reading all of it, so the digests are kept in a
+database keyed on the file's path, size, modification time and inode. A
+file that didn't change is not read again, even across sessions.
+"""
+from __future__ import division
+
+import os
+import Queue
+import sqlite3
+import stat
+import threading
+import time
+
+from vistrails.core import debug
+
+try:
+    import hashlib
+    sha_hash = hashlib.sha1
+except ImportError:
+    import sha
+    sha_hash = sha.new
+
+##############################################################################
+
+BLOCK_SIZE = 1 << 16
+
+# Size of the blocks read from a file when hashing it partially
+PARTIAL_BLOCK_SIZE = 1 << 20
+
+
+def _read_blocks(f, hasher, size=None):
+    while size is None or size > 0:
+        if size is None:
+            block = f.read(BLOCK_SIZE)
+        else:
+            block = f.read(min(BLOCK_SIZE, size))
+            size -= len(block)
+        if not block:
+            break
+        hasher.update(block)
+
+
+def sha1_hasher(filename, size):
+    """Plain SHA-1 of the file's contents.
+    """
+    hasher = sha_hash()
+    with open(filename, 'rb') as f:
+        _read_blocks(f, hasher)
+    return hasher.hexdigest()
+
+
+def git_blob_hasher(filename, size):
+    """SHA-1 of the file as a git blob, i.e. what 'git hash-object' returns.
+    """
+    hasher = sha_hash()
+    hasher.update('blob %d\0' % size)
+    with open(filename, 'rb') as f:
+        _read_blocks(f, hasher)
+    return hasher.hexdigest()
+
+
+def partial_hasher(filename, size):
+    """Hash of the file's size and of blocks at its start, middle and end.
+
+    This only reads a few megabytes of huge files; it is not a real content
+    hash, as a change that doesn't touch those blocks goes unnoticed.
+    """
+    if size <= 3 * PARTIAL_BLOCK_SIZE:
+        return sha1_hasher(filename, size)
+    hasher = sha_hash()
+    hasher.update('partial %d\0' % size)
+    with open(filename, 'rb') as f:
+        for offset in (0,
+                       (size - PARTIAL_BLOCK_SIZE) // 2,
+                       size - PARTIAL_BLOCK_SIZE):
+            f.seek(offset)
+            _read_blocks(f, hasher, PARTIAL_BLOCK_SIZE)
+    return hasher.hexdigest()
+
+
+HASHERS = {'sha1': sha1_hasher,
+           'git-blob': git_blob_hasher,
+           'partial': partial_hasher}
+
+
+class FileHashCache(object):
+    """Cache of (path, size, mtime, inode) -> content hash.
+
+    Digests are kept for each algorithm in HASHERS. If `filename` is None,
+    the cache only lives in memory.
+    """
+    # Files modified this recently might change again without their mtime
+    # changing, so their digests are not recorded
+    RACY_DELAY = 2.0
+
+    def __init__(self, filename=None, threads=4):
+        self.filename = filename
+        self.threads = threads
+        self._lock = threading.RLock()
+        self._conn = None
+        if filename is not None:
+            try:
+                self._conn = sqlite3.connect(filename,
+                                             check_same_thread=False)
+                self._conn.execute('''
+                        CREATE TABLE IF NOT EXISTS file_hashes(
+                            path TEXT NOT NULL,
+                            algorithm TEXT NOT NULL,
+                            size INTEGER NOT NULL,
+                            mtime REAL NOT NULL,
+                            inode INTEGER NOT NULL,
+                            digest TEXT NOT NULL,
+                            PRIMARY KEY (path, algorithm))
+                        ''')
+                self._conn.commit()
+            except sqlite3.Error, e:
+                debug.warning("Couldn't open file hash cache %s" % filename,
+                              e)
+                self._conn = None
+        self._memory = {}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _get(self, path, algorithm, st):
+        key = (path, algorithm)
+        value = (st.st_size, st.st_mtime, st.st_ino)
+        with self._lock:
+            try:
+                cached_value, digest = self._memory[key]
+            except KeyError:
+                if self._conn is None:
+                    return None
+                row = self._conn.execute(
+                        'SELECT size, mtime, inode, digest FROM file_hashes '
+                        'WHERE path=? AND algorithm=?', key).fetchone()
+                if row is None:
+                    return None
+                cached_value, digest = tuple(row[:3]), str(row[3])
+                self._memory[key] = cached_value, digest
+        if cached_value == value:
+            return digest
+        return None
+
+    def _put(self, entries):
+        """Records digests, as a list of (path, algorithm, stat, digest).
+        """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for path, algorithm, st, digest in entries:
+                if now - st.st_mtime < self.RACY_DELAY:
+                    continue
+                self._memory[(path, algorithm)] = (
+                        (st.st_size, st.st_mtime, st.st_ino), digest)
+                rows.append((path, algorithm, st.st_size, st.st_mtime,
+                             st.st_ino, digest))
+            if self._conn is not None and rows:
+                try:
+                    self._conn.executemany(
+                            'INSERT OR REPLACE INTO file_hashes(path, '
+                            'algorithm, size, mtime, inode, digest) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                    self._conn.commit()
+                except sqlite3.Error, e:
+                    debug.warning("Couldn't update file hash cache", e)
+
+    def file_hash(self, path, algorithm='sha1', partial_threshold=None):
+        """Returns the hex digest of a file, reading it if it changed.
+        """
+        return self.hash_files([path], algorithm, partial_threshold)[path]
+
+    def hash_files(self, paths, algorithm='sha1', partial_threshold=None):
+        """Returns a dict of path -> hex digest for a list of files.
+
+        Files bigger than `partial_threshold` bytes are only hashed
+        partially, see partial_hasher(). The files that are not in the cache
+        are hashed in parallel.
+        """
+        digests = {}
+        to_hash = []
+        for path in paths:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            if not stat.S_ISREG(st.st_mode):
+                raise IOError("Not a file: %r" % path)
+            if partial_threshold and st.st_size > partial_threshold:
+                file_algorithm = 'partial'
+            else:
+                file_algorithm = algorithm
+            digest = self._get(path, file_algorithm, st)
+            if digest is not None:
+                digests[path] = digest
+            else:
+                to_hash.append((path, file_algorithm, st))
+
+        if len(to_hash) <= 1 or self.threads <= 1:
+            computed = [(path, alg, st, HASHERS[alg](path, st.st_size))
+                        for path, alg, st in to_hash]
+        else:
+            computed = []
+            errors = []
+            queue = Queue.Queue()
+            for item in to_hash:
+                queue.put(item)
+
+            def worker():
+                while True:
+                    try:
+                        path, alg, st = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        digest = HASHERS[alg](path, st.st_size)
+                    except (IOError, OSError), e:
+                        errors.append(e)
+                    else:
+                        computed.append((path, alg, st, digest))
+
+            workers = [threading.Thread(target=worker)
+                       for i in xrange(min(self.threads, len(to_hash)))]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            if errors:
+                raise errors[0]
+
+        self._put(computed)
+        for path, alg, st, digest in computed:
+            digests[path] = digest
+
+        # Return the paths the way they were given
+        return dict((path, digests[os.path.abspath(path)]) for path in paths)
+
+    def tree_hash(self, dirname, algorithm='sha1', partial_threshold=None):
+        """Returns a digest of a directory's structure and file contents.
+
+        The digest covers the relative name of each file and the digest of
+        its contents.
+        """
+        files = list_files(dirname)
+        digests = self.hash_files([os.path.join(dirname, name)
+                                   for name in files],
+                                  algorithm, partial_threshold)
+        hasher = sha_hash()
+        for name in files:
+            hasher.update(name.replace(os.sep, '/'))
+            hasher.update('\0')
+            hasher.update(digests[os.path.join(dirname, name)])
+        return hasher.hexdigest()
+
+    def path_hash(self, path, algorithm='sha1', partial_threshold=None):
+        """Returns the digest of a file or directory.
+        """
+        if os.path.isdir(path):
+            return self.tree_hash(path, algorithm, partial_threshold)
+        else:
+            return self.file_hash(path, algorithm, partial_threshold)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM file_hashes')
+                self._conn.commit()
+
+
+def list_files(dirname):
+    """Returns the sorted relative names of the files under a directory.
+    """
+    files = []
+    for root, dirs, filenames in os.walk(dirname):
+        dirs.sort()
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(root, filename),
+                                         dirname))
+    files.sort()
+    return files
+
+
+_file_hash_cache = None
+
+def get_file_hash_cache():
+    """Returns the shared FileHashCache, stored in the .vistrails directory.
+    """
+    global _file_hash_cache
+    if _file_hash_cache is None:
+        filename = None
+        try:
+            from vistrails.core.system import current_dot_vistrails
+            dot_vistrails = current_dot_vistrails()
+            if dot_vistrails and os.path.isdir(dot_vistrails):
+                filename = os.path.join(dot_vistrails, 'file_hashes.sqlite')
+        except Exception:
+            pass
+        _file_hash_cache = FileHashCache(filename)
+    return _file_hash_cache
+
+##############################################################################
+
+import unittest
+
+
+class TestFileHashCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp(prefix='vt_hashes_')
+        self.db = os.path.join(self.tmpdir, 'hashes.sqlite')
+        self.files = os.path.join(self.tmpdir, 'files')
+        os.mkdir(self.files)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents, age=60):
+        filename = os.path.join(self.files, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        t = time.time() - age
+        os.utime(filename, (t, t))
+        return filename
+
+    def test_hashers(self):
+        filename = self.write('a', 'hello\n')
+        cache = FileHashCache()
+        self.assertEqual(cache.file_hash(filename),
+                         sha_hash('hello\n').hexdigest())
+        # git hash-object
+        self.assertEqual(cache.file_hash(filename, 'git-blob'),
+                         'ce013625030ba8dba906f756967f9e9ca394464a')
+
+    def test_cached(self):
+        filename = self.write('a', 'hello\n')
+        cache = FileHashCache(self.db)
+        digest = cache.file_hash(filename)
+        cache.close()
+
+        calls = []
+        orig = HASHERS['sha1']
+        HASHERS['sha1'] = lambda f, s: calls.append(f) or orig(f, s)
+        try:
+            cache = FileHashCache(self.db)
+            self.assertEqual(cache.file_hash(filename), digest)
+            self.assertEqual(calls, [])
+            # Changing the file invalidates the entry
+            self.write('a', 'world\n')
+            self.assertNotEqual(cache.file_hash(filename), digest)
+            self.assertEqual(calls, [os.path.abspath(filename)])
+            cache.close()
+        finally:
+            HASHERS['sha1'] = orig
+
+    def test_racy(self):
+        filename = self.write('a', 'hello\n', age=0)
+        cache = FileHashCache()
+        cache.file_hash(filename)
+        self.assertEqual(cache._memory, {})
+
+    def test_tree(self):
+        self.write('a', 'one')
+        self.write('sub/b', 'two')
+        self.write('sub/c', 'three')
+        cache = FileHashCache(threads=2)
+        digest = cache.tree_hash(self.files)
+        self.assertEqual(cache.path_hash(self.files), digest)
+        self.write('sub/c', 'four')
+        self.assertNotEqual(cache.tree_hash(self.files), digest)
+        os.rename(os.path.join(self.files, 'sub', 'c'),
+                  os.path.join(self.files, 'sub', 'd'))
+        self.assertNotEqual(cache.tree_hash(self.files), digest)
+
+    def test_partial(self):
+        size = 4 * PARTIAL_BLOCK_SIZE
+        filename = self.write('big', 'a' * size)
+        cache = FileHashCache()
+        digest = cache.file_hash(filename, partial_threshold=size - 1)
+        self.assertEqual(digest, cache.file_hash(filename, 'partial'))
+        self.assertNotEqual(digest, cache.file_hash(filename))
+        self.assertEqual(cache.file_hash(filename, partial_threshold=size),
+                         cache.file_hash(filename))
+        # Changing the size changes the partial hash
+        self.write('big', 'a' * (size + 1))
+        self.assertNotEqual(cache.file_hash(filename, 'partial'), digest)
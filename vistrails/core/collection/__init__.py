@@ -47,9 +47,11 @@ from workflow_exec import WorkflowExecEntity
 from thumbnail import ThumbnailEntity
 from mashup import MashupEntity
 from parameter_exploration import ParameterExplorationEntity
+from search import sql_regexp
 
 from vistrails.core.db.locator import FileLocator, BaseLocator
 from vistrails.core.db.io import load_vistrail
+from vistrails.core.query import extract_text
 import vistrails.core.system
 import vistrails.db.services.io
 from vistrails.core import debug
@@ -62,6 +64,26 @@ schema = ["create table entity(id integer primary key, type integer, "
           "create table workspaces(id text primary key)",
           "insert into workspaces values ('Default')"]
 
+# Added to existing databases when they are opened
+index_schema = [
+        "create index if not exists entity_type_idx on entity(type)",
+        "create index if not exists entity_mod_time_idx on entity(mod_time)",
+        "create index if not exists entity_create_time_idx "
+        "on entity(create_time)",
+        "create index if not exists entity_url_idx on entity(url)",
+        "create index if not exists entity_children_parent_idx "
+        "on entity_children(parent)",
+        "create index if not exists entity_children_child_idx "
+        "on entity_children(child)",
+        "create index if not exists entity_workspace_idx "
+        "on entity_workspace(workspace, entity)",
+        "create index if not exists entity_workspace_entity_idx "
+        "on entity_workspace(entity)"]
+
+# Searchable text of the entities, the docid is the entity id
+text_schema = ("create table entity_text(docid integer primary key, "
+               "name text, description text, user text, modules text)")
+
 class Collection(object):
     entity_types = dict((x.type_id, x)
                         for x in [VistrailEntity, WorkflowEntity, 
@@ -77,9 +99,14 @@ class Collection(object):
         self.deleted_entities = {}
         self.temp_entities = {}
         self.workspaces = {}
+        # changes to write on the next save
+        self.added_workspaces = set()
+        self.deleted_workspaces = set()
+        self.workspace_changes = {} # (entity_id, workspace) -> added: bool
         self.currentWorkspace = 'Default'
         self.listeners = [] # listens for entity creation removal
         self.max_id = 0
+        self.has_text_index = False
         
         if not os.path.exists(self.database):
             debug.log("'%s' does not exist. Trying to create" % self.database)
@@ -93,6 +120,8 @@ class Collection(object):
                 debug.critical("Could not create vistrail index schema", e)
         else:
             self.conn = sqlite3.connect(self.database)
+        self.conn.create_function('regexp', 2, sql_regexp)
+        self.update_schema()
         self.load_entities()
 
     #Singleton technique
@@ -118,6 +147,37 @@ class Collection(object):
             Collection._instance.conn.close()
         Collection._instance = False
 
+    def update_schema(self):
+        """Adds the indexes to databases created by older versions.
+        """
+        cur = self.conn.cursor()
+        try:
+            for s in index_schema:
+                cur.execute(s)
+            cur.execute("select name from sqlite_master "
+                        "where name='entity_text'")
+            if cur.fetchone() is None:
+                cur.execute(text_schema)
+                cur.execute("select id, name, description, user "
+                            "from entity")
+                cur.executemany(
+                        "insert into entity_text(docid, name, description, "
+                        "user, modules) values (?, ?, ?, ?, '')",
+                        [(e_id, name, self.plain_text(description), user)
+                         for e_id, name, description, user in cur.fetchall()])
+            self.conn.commit()
+        except sqlite3.Error, e:
+            debug.warning("Could not create vistrail index search indexes; "
+                          "searches will be slower", e)
+        else:
+            self.has_text_index = True
+
+    @staticmethod
+    def plain_text(description):
+        if not description:
+            return ''
+        return extract_text(description)
+
     def add_listener(self, c):
         """ Add objects that listen to entity creation/removal
             Object may implement the following method
@@ -131,6 +191,11 @@ class Collection(object):
         cur.execute('delete from entity_children;')
         cur.execute('delete from workspaces;')
         cur.execute('delete from entity_workspace;')
+        if self.has_text_index:
+            cur.execute('delete from entity_text;')
+        self.added_workspaces.clear()
+        self.deleted_workspaces.clear()
+        self.workspace_changes.clear()
 
     def get_current_entities(self):
         """NOTE: returns an iterator"""
@@ -170,6 +235,27 @@ class Collection(object):
                 self.workspaces[workspace].append(self.entities[e_id])
 
     def save_entities(self):
+        # only write the workspace changes
+        cur = self.conn.cursor()
+        cur.executemany("delete from workspaces where id=?",
+                        [(w,) for w in self.deleted_workspaces])
+        cur.executemany("delete from entity_workspace where workspace=?",
+                        [(w,) for w in self.deleted_workspaces])
+        cur.executemany("insert or ignore into workspaces values (?)",
+                        [(w,) for w in self.added_workspaces])
+        cur.executemany("delete from entity_workspace "
+                        "where entity=? and workspace=?",
+                        [key for key, added in
+                         self.workspace_changes.iteritems() if not added])
+        cur.executemany("insert into entity_workspace select ?, ? "
+                        "where not exists (select 1 from entity_workspace "
+                        "where entity=? and workspace=?)",
+                        [key + key for key, added in
+                         self.workspace_changes.iteritems() if added])
+        self.added_workspaces.clear()
+        self.deleted_workspaces.clear()
+        self.workspace_changes.clear()
+
         # TODO delete entities with no workspace
         for entity in self.deleted_entities.itervalues():
             self.db_delete_entity(entity)
@@ -178,15 +264,6 @@ class Collection(object):
         for entity in self.entities.itervalues():
             if entity.was_updated:
                 self.save_entity(entity)
-                
-        cur = self.conn.cursor()
-        cur.execute('delete from workspaces;')
-        cur.executemany("insert into workspaces values (?)", 
-                        [(i,) for i in self.workspaces])
-
-        cur.execute('delete from entity_workspace;')
-        cur.executemany("insert into entity_workspace values (?, ?)", 
-            ((k.id, i) for i,j in self.workspaces.iteritems() for k in j))
 
     def load_entity(self, *args):
         if args[1] in Collection.entity_types:
@@ -230,6 +307,23 @@ class Collection(object):
         cur.execute('delete from entity_children where parent=?', (entity.id,))
         cur.executemany("insert into entity_children values (?, ?)",
                         ((entity.id, child.id) for child in entity.children))
+        if self.has_text_index:
+            modules = entity.module_names()
+            if modules is None:
+                # keep what was recorded when the workflow was available
+                cur.execute("select modules from entity_text where docid=?",
+                            (entity.id,))
+                row = cur.fetchone()
+                modules = row[0] if row is not None else ''
+            else:
+                # one name per line, so that regular expressions only
+                # match within a name
+                modules = '\n'.join(modules)
+            cur.execute("insert or replace into entity_text(docid, name, "
+                        "description, user, modules) values (?, ?, ?, ?, ?)",
+                        (entity.id, entity.name,
+                         self.plain_text(entity.description), entity.user,
+                         modules))
 
     def commit(self):
         self.save_entities()
@@ -252,6 +346,7 @@ class Collection(object):
     def add_workspace(self, workspace):
         if workspace not in self.workspaces:
             self.workspaces[workspace] = []
+            self.added_workspaces.add(workspace)
 
     def add_to_workspace(self, entity, workspace=None):
         if not entity:
@@ -261,6 +356,7 @@ class Collection(object):
         self.add_workspace(workspace)
         if entity not in self.workspaces[workspace]:
             self.workspaces[workspace].append(entity)
+            self.workspace_changes[(entity.id, workspace)] = True
         
     def del_from_workspace(self, entity, workspace=None):
         if not workspace:
@@ -268,10 +364,16 @@ class Collection(object):
         if workspace in self.workspaces:
             if entity in self.workspaces[workspace]:
                 self.workspaces[workspace].remove(entity)
+                self.workspace_changes[(entity.id, workspace)] = False
 
     def delete_workspace(self, workspace):
         if workspace in self.workspaces:
             del self.workspaces[workspace]
+            self.added_workspaces.discard(workspace)
+            self.deleted_workspaces.add(workspace)
+            for key in self.workspace_changes.keys():
+                if key[1] == workspace:
+                    del self.workspace_changes[key]
 
     def db_delete_entity(self, entity):
         """ Delete entity from database """
@@ -280,6 +382,41 @@ class Collection(object):
             cur.execute("delete from entity where id=?", (entity.id,))
             cur.execute("delete from entity_children where parent=?", (entity.id,))
             cur.execute("delete from entity_children where child=?", (entity.id,))
+            cur.execute("delete from entity_workspace where entity=?",
+                        (entity.id,))
+            if self.has_text_index:
+                cur.execute("delete from entity_text where docid=?",
+                            (entity.id,))
+
+    def search(self, search, workspace=None, type_ids=None):
+        """Returns the entities matching a search statement.
+
+        The statement is compiled to SQL (see SearchStmt.sql()) and run on
+        the index, optionally restricted to a workspace and to some entity
+        types. Unsaved changes are written first.
+        """
+        if not self.has_text_index:
+            entities = (self.workspaces.get(workspace, [])
+                        if workspace is not None
+                        else self.entities.itervalues())
+            return [e for e in entities
+                    if (type_ids is None or e.type_id in type_ids) and
+                        search.match(e)]
+
+        self.save_entities()
+        clause, params = search.sql()
+        query = "select id from entity where %s" % clause
+        if type_ids is not None:
+            query += " and type in (%s)" % ','.join('?' * len(type_ids))
+            params = params + list(type_ids)
+        if workspace is not None:
+            query += (" and id in (select entity from entity_workspace "
+                      "where workspace=?)")
+            params = params + [workspace]
+        cur = self.conn.cursor()
+        cur.execute(query, params)
+        return [self.entities[row[0]] for row in cur.fetchall()
+                if row[0] in self.entities]
 
     def create_workflow_entity(self, workflow):
         entity = WorkflowEntity(workflow)
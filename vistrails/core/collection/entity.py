@@ -133,6 +133,10 @@ class Entity(object):
 #     def get_image_fnames(self):
 #         raise RuntimeError("Method is abstract")
     
+    # returns list of module names, or None if unknown
+    def module_names(self):
+        return None
+
     # returns boolean, True if search input is satisfied else False
     def match(self, search):
         raise RuntimeError("Method is abstract")
@@ -35,4 +35,15 @@
 --#############################################################################
 create table entity(id integer primary key, type integer, name text, user integer, mod_time text, create_time text, size integer, description text, url text);
 create table entity_children(parent integer, child integer);
-create table type_map(id integer, type string);
\ No newline at end of file
+create table type_map(id integer, type string);
+create table entity_workspace(entity integer, workspace text);
+create table workspaces(id text primary key);
+create index entity_type_idx on entity(type);
+create index entity_mod_time_idx on entity(mod_time);
+create index entity_create_time_idx on entity(create_time);
+create index entity_url_idx on entity(url);
+create index entity_children_parent_idx on entity_children(parent);
+create index entity_children_child_idx on entity_children(child);
+create index entity_workspace_idx on entity_workspace(workspace, entity);
+create index entity_workspace_entity_idx on entity_workspace(entity);
+create table entity_text(docid integer primary key, name text, description text, user text, modules text);
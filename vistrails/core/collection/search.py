@@ -50,6 +50,18 @@ class SearchParseError(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
+def sql_regexp(pattern, value):
+    """Implements the regexp() SQL function used by text searches.
+    """
+    if value is None:
+        return False
+    return re.search(pattern, value,
+                     re.MULTILINE | re.IGNORECASE) is not None
+
+# ASCII words, for which LIKE is the same case-insensitive substring test
+# as the regular expression
+_word_re = re.compile(r'^[A-Za-z0-9_]+$')
+
 class SearchStmt(object):
     def __init__(self, content):
         self.text = content
@@ -58,6 +70,24 @@ class SearchStmt(object):
     def match(self, entity):
         return True
 
+    def sql(self):
+        """Returns a condition on the entity table as (SQL, parameters).
+
+        Text is matched against the entity_text table the same way match()
+        does: anywhere in the text, ignoring case. Plain words use LIKE,
+        other searches the regexp() function.
+        """
+        return '1', []
+
+    def text_sql(self, column):
+        if _word_re.match(self.text):
+            return ('id IN (SELECT docid FROM entity_text '
+                    "WHERE %s LIKE ? ESCAPE '\\')" % column,
+                    ['%%%s%%' % self.text.replace('_', '\\_')])
+        return ('id IN (SELECT docid FROM entity_text '
+                'WHERE regexp(?, %s))' % column,
+                [self.text])
+
     def matchModule(self, v, m):
         return True
 
@@ -395,26 +425,46 @@ class TimeSearchStmt(SearchStmt):
             raise SearchParseError("Expected a date, got '%s'" % dateStr)
         return time.mktime(this)
         
+    def entity_time(self, entity):
+        mod_time = entity.mod_time
+        if isinstance(mod_time, datetime.datetime):
+            mod_time = mod_time.timetuple()
+        return time.mktime(mod_time)
+
+    def date_string(self):
+        # Same format as Entity.DATE_FORMAT, which sorts chronologically
+        return datetime.datetime.fromtimestamp(self.date).strftime(
+                '%Y-%m-%d %H:%M:%S.%f')
+
 class BeforeSearchStmt(TimeSearchStmt):
     def match(self, entity):
         if not entity.mod_time:
             return False
-        t = time.mktime(entity.mod_time)
+        t = self.entity_time(entity)
         return t <= self.date
 
+    def sql(self):
+        return 'mod_time <= ?', [self.date_string()]
+
 class AfterSearchStmt(TimeSearchStmt):
     def match(self, entity):
         if not entity.mod_time:
             return False
-        t = time.mktime(entity.mod_time)
+        t = self.entity_time(entity)
         return t >= self.date
 
+    def sql(self):
+        return 'mod_time >= ?', [self.date_string()]
+
 class UserSearchStmt(SearchStmt):
     def match(self, entity):
         if not entity.user:
             return False
         return self.content.match(entity.user)
 
+    def sql(self):
+        return self.text_sql('user')
+
 class NotesSearchStmt(SearchStmt):
     def match(self, entity):
         if entity.description:
@@ -422,10 +472,26 @@ class NotesSearchStmt(SearchStmt):
             return self.content.search(plainNotes)
         return False
 
+    def sql(self):
+        return self.text_sql('description')
+
 class NameSearchStmt(SearchStmt):
     def match(self, entity):
         return self.content.match(entity.name)
 
+    def sql(self):
+        return self.text_sql('name')
+
+class ModuleSearchStmt(SearchStmt):
+    def match(self, entity):
+        for name in entity.module_names() or []:
+            if self.content.match(name):
+                return True
+        return False
+
+    def sql(self):
+        return self.text_sql('modules')
+
 class AndSearchStmt(SearchStmt):
     def __init__(self, lst):
         self.matchList = lst
@@ -435,6 +501,13 @@ class AndSearchStmt(SearchStmt):
                 return False
         return True
 
+    def sql(self):
+        if not self.matchList:
+            return '1', []
+        clauses, params = zip(*[s.sql() for s in self.matchList])
+        return ('(%s)' % ' AND '.join(clauses),
+                [p for lst in params for p in lst])
+
 class OrSearchStmt(SearchStmt):
     def __init__(self, lst):
         self.matchList = lst
@@ -444,12 +517,23 @@ class OrSearchStmt(SearchStmt):
                 return True
         return False
 
+    def sql(self):
+        if not self.matchList:
+            return '0', []
+        clauses, params = zip(*[s.sql() for s in self.matchList])
+        return ('(%s)' % ' OR '.join(clauses),
+                [p for lst in params for p in lst])
+
 class NotSearchStmt(SearchStmt):
     def __init__(self, stmt):
         self.stmt = stmt
     def match(self, entity):
         return not self.stmt.match(entity)
 
+    def sql(self):
+        clause, params = self.stmt.sql()
+        return 'NOT %s' % clause, params
+
 class TrueSearch(SearchStmt):
     def __init__(self):
         pass
@@ -512,6 +596,17 @@ class SearchCompiler(object):
             lst.append(NameSearchStmt(tok))
             tokStream = tokStream[1:]
         return (AndSearchStmt(lst), [])
+    def parseModule(self, tokStream):
+        if len(tokStream) == 0:
+            raise SearchParseError('Expected token, got end of search')
+        lst = []
+        while len(tokStream):
+            tok = tokStream[0]
+            if ':' in tok:
+                return (AndSearchStmt(lst), tokStream)
+            lst.append(ModuleSearchStmt(tok))
+            tokStream = tokStream[1:]
+        return (AndSearchStmt(lst), [])
     def parseBefore(self, tokStream):
         old_tokstream = tokStream
         try:
@@ -568,6 +663,7 @@ class SearchCompiler(object):
                 'before': parseBefore,
                 'after': parseAfter,
                 'name': parseName,
+                'module': parseModule,
                 'any': parseAny}
                 
             
@@ -667,5 +763,74 @@ class TestSearch(unittest.TestCase):
         SearchCompiler('before')
         SearchCompiler('after')
 
+    def test_sql(self):
+        from vistrails.core.collection import Collection
+        from vistrails.core.collection.workflow import WorkflowEntity
+
+        class FakeModule(object):
+            def __init__(self, name):
+                self.name = name
+        class FakeWorkflow(object):
+            def __init__(self, id, name, modules):
+                self.id = id
+                self.name = name
+                self.modules = dict(enumerate(FakeModule(m)
+                                              for m in modules))
+
+        collection = Collection()
+        self.assertTrue(collection.has_text_index)
+        entities = []
+        for i, (name, user, notes, modules) in enumerate([
+                ('terminator', 'alice', 'isosurface of the head',
+                 ['vtkContourFilter', 'vtkRenderer']),
+                ('histogram', 'bob', '<p>plot with <b>matplotlib</b></p>',
+                 ['MplFigure', 'PythonSource']),
+                ('head volume', 'alice', '', ['vtkVolume'])]):
+            entity = WorkflowEntity(FakeWorkflow(i, name, modules))
+            entity.user = user
+            entity.description = notes
+            entity.mod_time = datetime.datetime(2014, 1, 1 + i)
+            collection.add_entity(entity)
+            collection.add_to_workspace(entity)
+            entities.append(entity)
+        collection.commit()
+
+        def search(s, **kwargs):
+            stmt = SearchCompiler(s).searchStmt
+            return sorted(e.name for e in collection.search(stmt, **kwargs))
+
+        self.assertEqual(search('head'), ['head volume', 'terminator'])
+        self.assertEqual(search('user:bob'), ['histogram'])
+        self.assertEqual(search('notes:matplot'), ['histogram'])
+        self.assertEqual(search('module:vtk'), ['head volume', 'terminator'])
+        self.assertEqual(search('module:python user:alice'), [])
+        self.assertEqual(search('name:hist.*m'), ['histogram'])
+        self.assertEqual(search('after:2 jan 2014'),
+                         ['head volume', 'histogram'])
+        self.assertEqual(search('head before:2 jan 2014'), ['terminator'])
+        self.assertEqual(search('alice', workspace='Default',
+                                type_ids=[WorkflowEntity.type_id]),
+                         ['head volume', 'terminator'])
+
+        # The SQL and match() agree
+        for s in ['module:Contour', 'module:ontour', 'module:^vtkR',
+                  'module:Filter.*Render', 'module:Filter$', 'name:^head',
+                  'name:OGRAM', 'notes:MatPlot', 'notes:with.*lib',
+                  'user:LIC', 'user:a_i', 'vtk_volume', 'volume']:
+            stmt = SearchCompiler(s).searchStmt
+            self.assertEqual(search(s),
+                             sorted(e.name for e in entities
+                                    if stmt.match(e)), s)
+
+        # Workspace and entity changes are written incrementally
+        collection.del_from_workspace(entities[0])
+        collection.delete_entity(entities[2])
+        collection.commit()
+        self.assertEqual(search('alice', workspace='Default'), [])
+        self.assertEqual(search('alice'), ['terminator'])
+        cur = collection.conn.cursor()
+        cur.execute("select entity from entity_workspace")
+        self.assertEqual([r[0] for r in cur.fetchall()], [entities[1].id])
+
 if __name__ == '__main__':
     unittest.main()
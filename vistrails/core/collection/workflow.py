@@ -106,6 +106,12 @@ class WorkflowEntity(Entity):
 #     def get_image_fnames(self):
 #         raise RuntimeError("Method is abstract")
     
+    def module_names(self):
+        if self.workflow is None:
+            return None
+        return sorted(set(module.name
+                          for module in self.workflow.modules.itervalues()))
+
     # returns boolean, True if search input is satisfied else False
     def match(self, search):
         raise RuntimeError("Not implemented")
@@ -70,12 +70,14 @@ db: The name for the database to load the vistrail from
 dbDefault: Save vistrails in a database by default
 debugLevel: How much information should VisTrails log
 defaultFileType: Default file type/extension for vistrails (.vt or .xml)
+deferPackageLoading: Only load packages when their modules are first used
 detachHistoryView: Show the version tree in a separate window
 dotVistrails: User configuration directory
 enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 NoExecute: Do not execute specified workflows
 executionLog: Track execution provenance when running workflows
+explorationProcesses: Number of processes running parameter explorations
 fileDir: Default vistrail directory
 fixedCustomVersionColorSaturation: Don't vary custom color with age
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
@@ -92,6 +94,8 @@ jobList: List running workflows
 jobInfo: List jobs in running workflow
 loadPackages: Whether to load the packages enabled in the configuration file
 logDir: Log files directory
+maxConcurrentProcesses: Number of background processes to run at once
+maxProcessesMemory: Memory available to background processes (MB)
 maxRecentVistrails: Number of recent vistrails
 maximizeWindows: VisTrails windows should be maximized
 migrateTags: Move tags to upgraded versions
@@ -102,6 +106,7 @@ outputPipelineGraph: Output the workflow graph as an image
 outputVersionTree: Output the version tree as an image
 parameterExploration: Run parameter exploration instead of workflow
 parameters: List of parameters to use when running workflow
+partialFileHashThreshold: Size above which files are only partially hashed (MB)
 port: The port for the database to load the vistrail from
 remoteShutdown: If connecting to single instance, make that instance exit
 reportUsage: Report anonymous usage statistics to the developers
@@ -194,6 +199,14 @@ defaultFileType: String
 
     Defaults to .vt but could be .xml.
 
+deferPackageLoading: Boolean
+
+    Only load the enabled packages when one of their modules is first used,
+    or when another package asks for them. The packages are identified
+    using an index stored in the .vistrails directory, which is updated
+    whenever all the packages get loaded. Speeds up starting VisTrails in
+    batch mode.
+
 detachHistoryView: Boolean
 
     Show the version tree in a separate window.
@@ -220,6 +233,13 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+explorationProcesses: Integer
+
+    How many worker processes run the cells of a parameter exploration
+    when it is executed without the GUI. 0 means the number of
+    processors. Cells running in worker processes are not recorded in the
+    execution log.
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -291,6 +311,16 @@ logger: ConfigurationObject
 
     *Deprecated*
 
+maxConcurrentProcesses: Integer
+
+    How many CPUs modules running in the background (such as command-line
+    tools) can use at the same time. 0 means the number of processors.
+
+maxProcessesMemory: Integer
+
+    How much memory (in MB) modules running in the background can use at the
+    same time, according to what they declare. 0 means no limit.
+
 maximizeWindows: Boolean
 
     Whether the VisTrails windows should take up the entire screen space.
@@ -356,6 +386,13 @@ parameters: String
 
     List of parameters to use when running workflow.
 
+partialFileHashThreshold: Integer
+
+    File and Directory parameters are identified by the content of the files
+    for caching. Files bigger than this size (in MB) are only hashed
+    partially, using their size and a few blocks of data; 0 means all files
+    are hashed entirely.
+
 port: Integer
 
     The port for the database to load the vistrail from.
@@ -697,6 +734,10 @@ base_config = {
      ConfigField('dbDefault', False, bool, ConfigType.ON_OFF),
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
+     ConfigField('maxConcurrentProcesses', 0, int),
+     ConfigField('maxProcessesMemory', 0, int),
+     ConfigField('partialFileHashThreshold', 0, int),
+     ConfigField('explorationProcesses', 1, int),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
@@ -764,6 +805,7 @@ base_config = {
     "Packages":
     [ConfigField('enablePackagesSilently', False, bool, ConfigType.ON_OFF),
      ConfigField('loadPackages', True, bool, ConfigType.ON_OFF),
+     ConfigField('deferPackageLoading', False, bool, ConfigType.ON_OFF),
      ConfigField('installBundles', True, bool, ConfigType.ON_OFF),
      ConfigField('installBundlesWithPip', False, bool, ConfigType.ON_OFF,
                  depends_on="installBundles"),
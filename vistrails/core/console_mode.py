@@ -298,6 +298,27 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
         except Exception, e:
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
+    else:
+        try:
+            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups)
+            try:
+                pe_id = int(pe_id)
+                pe = controller.vistrail.get_paramexp(pe_id)
+            except ValueError:
+                pe = controller.vistrail.get_named_paramexp(pe_id)
+            errors = []
+            for cell in controller.execute_parameter_exploration(
+                    pe, extra_info=extra_info, reason=reason):
+                for module_id, error in sorted(cell.errors.iteritems()):
+                    errors.append("cell %s_%s_%s, module %s: %s" % (
+                                  cell.position + (module_id, error)))
+            if errors:
+                return (locator, pe_id, "\n".join(errors), "")
+        except Exception, e:
+            return (locator, pe_id,
+                    debug.format_exception(e), debug.format_exc())
 
 def run_parameter_explorations(w_list, extra_info = {},
                        reason="Console Mode Parameter Exploration Execution"):
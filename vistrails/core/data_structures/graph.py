@@ -617,6 +617,140 @@ class Graph(object):
                     result.append((v, v_to, e_id))
         return result
 
+    def iter_subgraph_matches(self, pattern, candidates=None,
+                              match_vertex=None):
+        """iter_subgraph_matches(pattern: Graph, candidates: dict,
+                                 match_vertex: callable) -> iterable
+
+        Finds the embeddings of pattern into self, that is the injective
+        mappings of pattern vertices to vertices of self such that every
+        edge of pattern maps to an edge of self (with at least the same
+        multiplicity). Yields each mapping as a dict from pattern vertex
+        to vertex of self, so callers only interested in one match can
+        stop after the first.
+
+        candidates optionally maps pattern vertices to the vertices of
+        self they may be mapped to, and match_vertex(pattern_vertex,
+        vertex) further filters them.
+
+        This is a VF2-style state space search: pattern vertices are
+        ordered so that each one is adjacent to already mapped vertices
+        whenever possible, and candidates for a vertex are only taken
+        from the neighbors of its mapped neighbors. Candidates are first
+        filtered by degree, then checked against every edge to mapped
+        vertices, and only then passed to match_vertex.
+
+        """
+        def neighbor_counts(adjacency_list):
+            # Counts edges to each neighbor, only for the vertices visited
+            cache = {}
+            def get(v):
+                try:
+                    return cache[v]
+                except KeyError:
+                    counts = {}
+                    for (w, _) in adjacency_list[v]:
+                        counts[w] = counts.get(w, 0) + 1
+                    cache[v] = counts
+                    return counts
+            return get
+        pattern_out = neighbor_counts(pattern.adjacency_list)
+        pattern_in = neighbor_counts(pattern.inverse_adjacency_list)
+        p_out = dict((v, pattern_out(v)) for v in pattern.vertices)
+        p_in = dict((v, pattern_in(v)) for v in pattern.vertices)
+        t_out = neighbor_counts(self.adjacency_list)
+        t_in = neighbor_counts(self.inverse_adjacency_list)
+
+        # Filter the candidates of each pattern vertex
+        domains = {}
+        for p in pattern.vertices:
+            if candidates is not None and p in candidates:
+                pool = candidates[p]
+            else:
+                pool = self.vertices
+            n_out = len(p_out[p])
+            n_in = len(p_in[p])
+            n_loops = p_out[p].get(p, 0)
+            domain = set(t for t in pool
+                         if t in self.vertices and
+                         len(t_out(t)) >= n_out and
+                         len(t_in(t)) >= n_in and
+                         t_out(t).get(t, 0) >= n_loops)
+            if not domain:
+                return
+            domains[p] = domain
+
+        # Order pattern vertices, most connected to the already ordered
+        # ones first, then most constrained
+        order = []
+        constraints = []
+        connected = dict((p, 0) for p in pattern.vertices)
+        remaining = set(pattern.vertices)
+        while remaining:
+            p = max(remaining, key=lambda v: (connected[v],
+                                              -len(domains[v]),
+                                              len(p_out[v]) + len(p_in[v])))
+            remaining.remove(p)
+            constraints.append([(q, p_out[p].get(q, 0), p_in[p].get(q, 0))
+                                for q in order
+                                if q in p_out[p] or q in p_in[p]])
+            order.append(p)
+            for q in chain(p_out[p], p_in[p]):
+                if q in remaining:
+                    connected[q] += 1
+
+        # match_vertex may be expensive, so it is only called on the
+        # candidates that are structurally compatible
+        matched_vertices = {}
+        def is_match(p, t):
+            try:
+                return matched_vertices[(p, t)]
+            except KeyError:
+                result = matched_vertices[(p, t)] = bool(match_vertex(p, t))
+                return result
+
+        mapping = {}
+        used = set()
+        def candidates_at(i):
+            p = order[i]
+            domain = domains[p]
+            edges = constraints[i]
+            if edges:
+                (q, n_out, n_in) = edges[0]
+                if n_out:
+                    pool = t_in(mapping[q])
+                else:
+                    pool = t_out(mapping[q])
+            else:
+                pool = domain
+            for t in pool:
+                if t in used or t not in domain:
+                    continue
+                if all(t_out(t).get(mapping[q], 0) >= n_out and
+                       t_in(t).get(mapping[q], 0) >= n_in
+                       for (q, n_out, n_in) in edges) and \
+                        (match_vertex is None or is_match(p, t)):
+                    yield t
+
+        if not order:
+            return
+        done = object()
+        stack = [candidates_at(0)]
+        while stack:
+            p = order[len(stack) - 1]
+            if p in mapping:
+                used.discard(mapping.pop(p))
+            t = next(stack[-1], done)
+            if t is done:
+                stack.pop()
+                continue
+            mapping[p] = t
+            used.add(t)
+            if len(stack) == len(order):
+                yield dict(mapping)
+            else:
+                stack.append(candidates_at(len(stack)))
+
     ##########################################################################
     # Iterators
 
@@ -1066,6 +1200,61 @@ class TestGraph(unittest.TestCase):
         g2.add_vertex(10)
         assert g2 <> g
 
+    def test_subgraph_matches(self):
+        g = self.make_linear(5)
+        pattern = Graph()
+        pattern.add_edge('a', 'b')
+        pattern.add_edge('b', 'c')
+        matches = list(g.iter_subgraph_matches(pattern))
+        self.assertEqual(sorted((m['a'], m['b'], m['c']) for m in matches),
+                         [(0, 1, 2), (1, 2, 3), (2, 3, 4)])
+        # a diamond does not fit in a chain
+        pattern.add_edge('a', 'd')
+        pattern.add_edge('d', 'c')
+        self.assertEqual(list(g.iter_subgraph_matches(pattern)), [])
+        diamond = copy.copy(pattern)
+        diamond.add_edge('c', 'e')
+        self.assertEqual(len(list(diamond.iter_subgraph_matches(pattern))),
+                         2)
+        # multiple edges need as many edges in the target
+        pattern = Graph()
+        pattern.add_edge(0, 1, 'x')
+        pattern.add_edge(0, 1, 'y')
+        self.assertEqual(list(g.iter_subgraph_matches(pattern)), [])
+
+    def test_subgraph_matches_candidates(self):
+        g = self.make_linear(5)
+        pattern = Graph()
+        pattern.add_edge('a', 'b')
+        matches = list(g.iter_subgraph_matches(pattern,
+                                               candidates={'a': [1, 3]}))
+        self.assertEqual(sorted(m['b'] for m in matches), [2, 4])
+        matches = list(g.iter_subgraph_matches(
+                pattern, match_vertex=lambda p, v: p != 'b' or v % 2 == 0))
+        self.assertEqual(sorted(m['a'] for m in matches), [1, 3])
+        # disconnected patterns map to distinct vertices
+        pattern = Graph()
+        pattern.add_vertex('a')
+        pattern.add_vertex('b')
+        self.assertEqual(len(list(g.iter_subgraph_matches(pattern))), 20)
+
+    def test_subgraph_matches_large(self):
+        # A long chain of branches, only the last one closes a cycle
+        g = Graph()
+        for i in xrange(1000):
+            g.add_edge(('a', i), ('b', i))
+            g.add_edge(('a', i), ('c', i))
+            if i > 0:
+                g.add_edge(('b', i - 1), ('a', i))
+        g.add_edge(('b', 999), ('c', 999))
+        pattern = Graph()
+        pattern.add_edge(0, 1)
+        pattern.add_edge(0, 2)
+        pattern.add_edge(1, 2)
+        matches = list(g.iter_subgraph_matches(pattern))
+        self.assertEqual(matches, [{0: ('a', 999), 1: ('b', 999),
+                                    2: ('c', 999)}])
+
     def test_map_vertices(self):
         g = self.make_linear(5)
         m = {0: 0, 1: 1, 2: 2, 3: 3, 4: 4}
@@ -0,0 +1,202 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+from __future__ import division
+
+import math
+import unittest
+
+################################################################################
+# SpatialIndex
+
+class SpatialIndex(object):
+    """ SpatialIndex is a uniform grid over axis-aligned boxes. It answers
+    which boxes intersect a query box in time proportional to the number of
+    cells the query covers, whatever the number of boxes.
+
+    Boxes are given as (x0, y0, x1, y1) with x0 <= x1 and y0 <= y1. A box
+    covering more than max_cells cells is kept aside and tested on every
+    query, so that a few very long boxes do not fill the grid.
+
+    """
+
+    def __init__(self, cell_size=256.0, max_cells=256):
+        """ SpatialIndex(cell_size: float, max_cells: int) -> SpatialIndex
+        Creates an empty index
+
+        """
+        self.cell_size = float(cell_size)
+        self.max_cells = max_cells
+        self.clear()
+
+    def clear(self):
+        """ clear() -> None
+        Removes all the boxes
+
+        """
+        self._boxes = {}
+        self._cells = {}
+        self._large = set()
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __contains__(self, key):
+        return key in self._boxes
+
+    def _cell_range(self, x0, y0, x1, y1):
+        s = self.cell_size
+        return (int(math.floor(x0 / s)), int(math.floor(y0 / s)),
+                int(math.floor(x1 / s)), int(math.floor(y1 / s)))
+
+    def box(self, key):
+        """ box(key: hashable) -> tuple
+        Returns the box stored for key
+
+        """
+        return self._boxes[key]
+
+    def add(self, key, x0, y0, x1, y1):
+        """ add(key: hashable, x0, y0, x1, y1: float) -> None
+        Stores the box of key, replacing any previous one
+
+        """
+        if key in self._boxes:
+            self.remove(key)
+        self._boxes[key] = (x0, y0, x1, y1)
+        (i0, j0, i1, j1) = self._cell_range(x0, y0, x1, y1)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > self.max_cells:
+            self._large.add(key)
+            return
+        cells = self._cells
+        for i in xrange(i0, i1 + 1):
+            for j in xrange(j0, j1 + 1):
+                cell = cells.get((i, j))
+                if cell is None:
+                    cells[(i, j)] = set([key])
+                else:
+                    cell.add(key)
+
+    def remove(self, key):
+        """ remove(key: hashable) -> None
+        Removes the box of key
+
+        """
+        (x0, y0, x1, y1) = self._boxes.pop(key)
+        if key in self._large:
+            self._large.remove(key)
+            return
+        (i0, j0, i1, j1) = self._cell_range(x0, y0, x1, y1)
+        cells = self._cells
+        for i in xrange(i0, i1 + 1):
+            for j in xrange(j0, j1 + 1):
+                cell = cells[(i, j)]
+                cell.discard(key)
+                if not cell:
+                    del cells[(i, j)]
+
+    def query(self, x0, y0, x1, y1):
+        """ query(x0, y0, x1, y1: float) -> set
+        Returns the keys of the boxes intersecting the given box
+
+        """
+        result = set()
+        (i0, j0, i1, j1) = self._cell_range(x0, y0, x1, y1)
+        cells = self._cells
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(cells):
+            # the query covers more cells than there are in use
+            candidates = set()
+            for ((i, j), cell) in cells.iteritems():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    candidates.update(cell)
+        else:
+            candidates = set()
+            for i in xrange(i0, i1 + 1):
+                for j in xrange(j0, j1 + 1):
+                    cell = cells.get((i, j))
+                    if cell is not None:
+                        candidates.update(cell)
+        candidates.update(self._large)
+        boxes = self._boxes
+        for key in candidates:
+            (bx0, by0, bx1, by1) = boxes[key]
+            if bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+                result.add(key)
+        return result
+
+################################################################################
+# Unit tests
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def test_query(self):
+        """Compares queries against a linear scan"""
+        import random
+        random.seed(1)
+        index = SpatialIndex(cell_size=10.0, max_cells=16)
+        boxes = {}
+        for key in xrange(500):
+            x = random.uniform(-500.0, 500.0)
+            y = random.uniform(-500.0, 500.0)
+            w = random.expovariate(1.0 / 20.0)
+            h = random.uniform(0.0, 15.0)
+            boxes[key] = (x, y, x + w, y + h)
+            index.add(key, *boxes[key])
+        for key in xrange(0, 500, 3):
+            index.remove(key)
+            del boxes[key]
+        self.assertEqual(len(index), len(boxes))
+        for i in xrange(50):
+            x = random.uniform(-600.0, 600.0)
+            y = random.uniform(-600.0, 600.0)
+            s = random.choice([1.0, 50.0, 2000.0])
+            expected = set(key for key, (x0, y0, x1, y1) in boxes.iteritems()
+                           if x0 <= x + s and x <= x1 and
+                              y0 <= y + s and y <= y1)
+            self.assertEqual(index.query(x, y, x + s, y + s), expected)
+
+    def test_replace(self):
+        index = SpatialIndex(cell_size=10.0)
+        index.add('a', 0.0, 0.0, 5.0, 5.0)
+        index.add('a', 100.0, 100.0, 105.0, 105.0)
+        self.assertEqual(index.query(0.0, 0.0, 10.0, 10.0), set())
+        self.assertEqual(index.query(90.0, 90.0, 100.0, 100.0), set(['a']))
+        self.assertEqual(index.box('a'), (100.0, 100.0, 105.0, 105.0))
+        index.remove('a')
+        self.assertNotIn('a', index)
+        self.assertEqual(index._cells, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -119,19 +119,23 @@ def merge_logs(new_log, log_fname):
     Log.convert(log)
     return log
 
-def get_workflow_diff(vt_pair_1, vt_pair_2):
-    """get_workflow_diff( tuple(Vistrail, id), tuple(Vistrail, id) ) ->
+def get_workflow_diff(vt_pair_1, vt_pair_2, pipeline_1=None, pipeline_2=None):
+    """get_workflow_diff( tuple(Vistrail, id), tuple(Vistrail, id),
+                          Pipeline, Pipeline ) ->
             Pipeline, Pipeline, [tuple(id, id)], [tuple(id, id)], 
             [id], [id], [tuple(id, id, list)]
 
     Return a difference between two workflows referenced as vistrails.
+    pipeline_1 and pipeline_2 can be passed if the versions have already
+    been materialized, they will be used in the result.
     """
 
     from vistrails.core.vistrail.pipeline import Pipeline
     (v1, v2, pairs, heuristic_pairs, v1_only, v2_only, param_changes,
      cparam_changes, annot_changes, _, _, _, _) = \
          vistrails.db.services.vistrail.getWorkflowDiff(vt_pair_1, vt_pair_2,
-                                                        True)
+                                                        True, pipeline_1,
+                                                        pipeline_2)
     Pipeline.convert(v1)
     Pipeline.convert(v2)
     return (v1, v2, pairs, heuristic_pairs, v1_only, v2_only, param_changes,
@@ -39,6 +39,7 @@ from __future__ import division
 import base64
 import copy
 import gc
+import math
 import cPickle as pickle
 
 import time
@@ -48,6 +49,8 @@ from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.launcher import get_launcher, \
+    launch_modules, finish_launches
 import vistrails.core.interpreter.utils
 from vistrails.core.log.controller import DummyLogController
 from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
@@ -214,6 +217,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._file_pool = FilePool()
         self._persistent_pipeline = vistrails.core.vistrail.pipeline.Pipeline()
         self._objects = {}
+        self._pinned = set()
+        self._last_used = {}
+        self._use_clock = 0
         self.filePool = self._file_pool
         self._streams = []
 
@@ -223,6 +229,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for obj in self._objects.itervalues():
             obj.clear()
         self._objects = {}
+        self._pinned = set()
+        self._last_used = {}
 
     def __del__(self):
         self.clear()
@@ -241,6 +249,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for v in dependencies:
             self._persistent_pipeline.delete_module(v)
             del self._objects[v]
+            self._pinned.discard(v)
+            self._last_used.pop(v, None)
 
     def clean_non_cacheable_modules(self):
         """clean_non_cacheable_modules() -> None
@@ -250,9 +260,51 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         """
         non_cacheable_modules = [i for
                                  (i, mod) in self._objects.iteritems()
-                                 if not mod.is_cacheable()]
+                                 if not mod.is_cacheable() and
+                                     i not in self._pinned]
         self.clean_modules(non_cacheable_modules)
 
+    def pin_modules(self, pipeline, module_ids):
+        """pin_modules(pipeline: Pipeline, module_ids: list) -> set
+
+        Keeps the persistent modules matching the given modules of an
+        executed pipeline, so that they get reused by the next executions
+        even if they are not cacheable. The given modules should include
+        their upstream modules.
+
+        Returns the set of persistent ids to pass to unpin_modules().
+        """
+        _, module_id_map, _ = self.find_persistent_entities(pipeline)
+        pinned = set(module_id_map[i] for i in module_ids
+                     if module_id_map.get(i) is not None)
+        pinned -= self._pinned
+        self._pinned.update(pinned)
+        return pinned
+
+    def unpin_modules(self, persistent_ids):
+        """unpin_modules(persistent_ids: set) -> None
+
+        Lets the interpreter clean modules pinned by pin_modules() again.
+        """
+        self._pinned.difference_update(persistent_ids)
+
+    def evict_lru(self, fraction=0.5):
+        """evict_lru(fraction: float) -> int
+
+        Removes the least recently used fraction of the cached modules that
+        are not pinned, and the modules that depend on them.
+
+        Returns the number of modules removed.
+        """
+        candidates = [i for i in self._objects if i not in self._pinned]
+        if not candidates:
+            return 0
+        candidates.sort(key=lambda i: self._last_used.get(i, 0))
+        count = int(math.ceil(len(candidates) * fraction))
+        before = len(self._objects)
+        self.clean_modules(candidates[:count])
+        return before - len(self._objects)
+
     def _clear_package(self, identifier):
         """clear_package(identifier: str) -> None
 
@@ -357,6 +409,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
          conn_map,
          module_added_set,
          conn_added_set) = self.add_to_persistent_pipeline(pipeline)
+        self._use_clock += 1
+        for persistent_id in tmp_to_persistent_module_map.itervalues():
+            self._last_used[persistent_id] = self._use_clock
 
         # Create the new objects
         for i in module_added_set:
@@ -524,37 +579,48 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._streams.append(Generator.generators)
         Generator.generators = []
 
-        # Update new sinks
-        for obj in persistent_sinks:
-            abort = False
-            try:
-                obj.update()
-                continue
-            except ModuleWasSuspended:
-                continue
-            except ModuleHadError:
-                pass
-            except AbortExecution:
-                break
-            except ModuleSuspended, ms:
-                ms.module.logging.end_update(ms.module, ms,
-                                             was_suspended=True)
-                continue
-            except ModuleErrors, mes:
-                for me in mes.module_errors:
-                    me.module.logging.end_update(me.module, me)
+        launcher = get_launcher()
+        try:
+            # Update new sinks
+            for obj in persistent_sinks:
+                abort = False
+                try:
+                    # Start the modules this sink needs that can run in the
+                    # background, so that independent ones run concurrently;
+                    # update() waits for them. This is done one sink at a
+                    # time so that nothing runs for the sinks after an error
+                    launch_modules([obj], launcher)
+                    obj.update()
+                    continue
+                except ModuleWasSuspended:
+                    continue
+                except ModuleHadError:
+                    pass
+                except AbortExecution:
+                    break
+                except ModuleSuspended, ms:
+                    ms.module.logging.end_update(ms.module, ms,
+                                                 was_suspended=True)
+                    continue
+                except ModuleErrors, mes:
+                    for me in mes.module_errors:
+                        me.module.logging.end_update(me.module, me)
+                        logging_obj.signalError(me.module, me)
+                        abort = abort or me.abort
+                except ModuleError, me:
+                    me.module.logging.end_update(me.module, me, me.errorTrace)
                     logging_obj.signalError(me.module, me)
-                    abort = abort or me.abort
-            except ModuleError, me:
-                me.module.logging.end_update(me.module, me, me.errorTrace)
-                logging_obj.signalError(me.module, me)
-                abort = me.abort
-            except ModuleBreakpoint, mb:
-                mb.module.logging.end_update(mb.module)
-                logging_obj.signalError(mb.module, mb)
-                abort = True
-            if stop_on_error or abort:
-                break
+                    abort = me.abort
+                except ModuleBreakpoint, mb:
+                    mb.module.logging.end_update(mb.module)
+                    logging_obj.signalError(mb.module, mb)
+                    abort = True
+                if stop_on_error or abort:
+                    break
+        finally:
+            # Don't leave background computations running after an error
+            # or an abort
+            finish_launches(tmp_id_to_module_map.itervalues())
 
         if Generator.generators:
             record_usage(generators=len(Generator.generators))
@@ -900,6 +966,14 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             CachedInterpreter.__instance.create()
         objs = gc.collect()
 
+    @staticmethod
+    def evict(fraction=0.5):
+        evicted = 0
+        if CachedInterpreter.__instance:
+            evicted = CachedInterpreter.__instance.evict_lru(fraction)
+        gc.collect()
+        return evicted
+
     @staticmethod
     def clear_package(identifier):
         if CachedInterpreter.__instance:
@@ -958,6 +1032,93 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_evict_lru(self):
+        from vistrails.core.modules.basic_modules import identifier, version
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        def make_pipeline(value):
+            pipeline = Pipeline()
+            param = ModuleParam(id=1, pos=0, type='String', val=value)
+            function = ModuleFunction(id=1, pos=0, name='value',
+                                      parameters=[param])
+            pipeline.add_module(Module(id=1, name='String',
+                                       package=identifier, version=version,
+                                       functions=[function]))
+            return pipeline
+
+        interpreter = CachedInterpreter()
+        try:
+            pipelines = [make_pipeline(v) for v in ('a', 'b', 'c')]
+            for pipeline in pipelines:
+                interpreter.execute(pipeline)
+            # 'a' is used again and 'b' is pinned, so 'c' goes first
+            interpreter.execute(pipelines[0])
+            self.assertEqual(len(interpreter._objects), 3)
+            pinned = interpreter.pin_modules(pipelines[1], [1])
+
+            self.assertEqual(interpreter.evict_lru(0.5), 1)
+            objects, _, _ = interpreter.find_persistent_entities(pipelines[0])
+            self.assertIsNotNone(objects[1])
+            objects, _, _ = interpreter.find_persistent_entities(pipelines[1])
+            self.assertIsNotNone(objects[1])
+            objects, _, _ = interpreter.find_persistent_entities(pipelines[2])
+            self.assertIsNone(objects[1])
+
+            interpreter.unpin_modules(pinned)
+            self.assertEqual(interpreter.evict_lru(1.0), 2)
+            self.assertEqual(interpreter._objects, {})
+        finally:
+            interpreter.clear()
+
+    def test_launch_per_sink(self):
+        from vistrails.core.interpreter.launcher import Future
+        from vistrails.core.modules.basic_modules import StandardOutput
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        launched = []
+        def start_compute(module):
+            value = module.get_input('value')
+            launched.append(value)
+            future = Future()
+            future.set_result(value)
+            return future
+        def compute(module):
+            if module.launched.result() == 'fail':
+                raise ModuleError(module, "expected")
+
+        basic_pkg = get_vistrails_basic_pkg_id()
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        sinks = []
+        for value in ('fail', 'ok'):
+            string = controller.add_module(basic_pkg, 'String')
+            controller.update_function(string, 'value', [value])
+            output = controller.add_module(basic_pkg, 'StandardOutput')
+            controller.add_connection(string.id, 'value', output.id, 'value')
+            sinks.append((string.id, output.id))
+        pipeline = controller.current_pipeline
+
+        StandardOutput.start_compute = start_compute
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = compute
+        interpreter = CachedInterpreter()
+        try:
+            result = interpreter.execute(pipeline,
+                                         sinks=[s[1] for s in sinks])
+        finally:
+            del StandardOutput.start_compute
+            StandardOutput.compute = old_compute
+            interpreter.clear()
+        self.assertEqual(set(result.errors), set([sinks[0][1]]))
+        # the first sink failed, nothing upstream of the second one ran
+        self.assertEqual(launched, ['fail'])
+        self.assertFalse(result.executed[sinks[1][0]])
+        self.assertFalse(result.executed[sinks[1][1]])
+
 
 if __name__ == '__main__':
     unittest.main()
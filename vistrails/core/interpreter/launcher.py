@@ -0,0 +1,445 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Background execution of module computations.
+
+Some modules spend their compute() waiting on something external, typically
+a command-line process. Such modules can implement
+Module.start_compute() to start the work and return a Future; the
+interpreter then starts all of them that are ready before waiting on any, so
+that independent ones run concurrently. The Launcher bounds how much runs at
+the same time, according to the 'maxConcurrentProcesses' and
+'maxProcessesMemory' configuration settings.
+"""
+
+from __future__ import division
+
+from collections import deque
+import multiprocessing
+import sys
+import threading
+
+from vistrails.core import debug
+
+
+class CancelledError(Exception):
+    """Raised by Future.result() if the computation was cancelled.
+    """
+
+
+class Future(object):
+    """The result of a computation that might not be finished yet.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._launcher = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancels the computation if it didn't start yet.
+
+        Returns True if it was cancelled; result() then raises
+        CancelledError.
+        """
+        return (self._launcher is not None and
+                self._launcher._cancel(self))
+
+    def wait(self):
+        """Waits for the computation to be done, without raising.
+        """
+        while not self._event.is_set():
+            # Waiting with a timeout allows KeyboardInterrupt through
+            self._event.wait(0.5)
+
+    def result(self):
+        """Waits for the computation and returns its result.
+
+        If the computation raised an exception, it is raised again here.
+        """
+        self.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._event.set()
+
+
+class Launcher(object):
+    """Runs functions on background threads under resource limits.
+
+    Each task declares how many CPUs and how much memory (in MB) it needs;
+    tasks are started in order as long as the totals stay under the limits.
+    A task asking for more than a limit is capped to it, so that it can
+    still run on its own.
+    """
+    def __init__(self, cpus=None, memory=None):
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._cpus_used = 0
+        self._memory_used = 0
+        self.set_limits(cpus, memory)
+
+    def set_limits(self, cpus=None, memory=None):
+        """Sets the number of CPU slots and the memory budget.
+
+        cpus defaults to the number of processors; memory of None means no
+        limit.
+        """
+        if not cpus:
+            try:
+                cpus = multiprocessing.cpu_count()
+            except NotImplementedError: # pragma: no cover
+                cpus = 1
+        with self._condition:
+            self.cpus = cpus
+            self.memory = memory or None
+            self._dispatch()
+
+    def submit(self, function, cpus=1, memory=None):
+        """Queues function to be called on a background thread.
+
+        Returns a Future for its result.
+        """
+        future = Future()
+        future._launcher = self
+        cpus = max(1, min(cpus or 1, self.cpus))
+        if self.memory is not None and memory:
+            memory = min(memory, self.memory)
+        with self._condition:
+            self._queue.append((function, cpus, memory or 0, future))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        # Must be called with the lock held
+        while self._queue:
+            function, cpus, memory, future = self._queue[0]
+            if self._cpus_used and self._cpus_used + cpus > self.cpus:
+                break
+            if (self.memory is not None and self._memory_used and
+                    self._memory_used + memory > self.memory):
+                break
+            self._queue.popleft()
+            self._cpus_used += cpus
+            self._memory_used += memory
+            thread = threading.Thread(target=self._run,
+                                      args=(function, cpus, memory, future))
+            thread.daemon = True
+            thread.start()
+
+    def _cancel(self, future):
+        with self._condition:
+            for i, task in enumerate(self._queue):
+                if task[3] is future:
+                    del self._queue[i]
+                    break
+            else:
+                return False
+        try:
+            raise CancelledError("Computation was cancelled")
+        except CancelledError:
+            future.set_exception(sys.exc_info())
+        return True
+
+    def _run(self, function, cpus, memory, future):
+        try:
+            result = function()
+        except Exception:
+            exc_info = sys.exc_info()
+            result = None
+        else:
+            exc_info = None
+        with self._condition:
+            self._cpus_used -= cpus
+            self._memory_used -= memory
+            if exc_info is not None:
+                future.set_exception(exc_info)
+            else:
+                future.set_result(result)
+            self._dispatch()
+            self._condition.notify_all()
+
+    def wait_any(self, futures):
+        """Blocks until at least one of the futures is done.
+        """
+        with self._condition:
+            while not any(f.done() for f in futures):
+                self._condition.wait(0.5)
+
+
+_launcher = None
+_launcher_settings = None
+
+def get_launcher():
+    """Returns the process-wide Launcher, configured from the settings.
+    """
+    global _launcher, _launcher_settings
+    from vistrails.core.configuration import get_vistrails_configuration
+    conf = get_vistrails_configuration()
+    settings = (getattr(conf, 'maxConcurrentProcesses', None),
+                getattr(conf, 'maxProcessesMemory', None))
+    if _launcher is None:
+        _launcher = Launcher(*settings)
+    elif settings != _launcher_settings:
+        _launcher.set_limits(*settings)
+    _launcher_settings = settings
+    return _launcher
+
+
+def _upstream_modules(module):
+    for connector_list in getattr(module, 'inputPorts', {}).itervalues():
+        for connector in connector_list:
+            yield connector.obj
+
+
+def launch_modules(sinks, launcher):
+    """Starts the modules upstream of sinks that can run in the background.
+
+    A module is started (with Module.launch()) once all the background
+    modules it depends on are done, so modules that don't depend on each
+    other run concurrently. Nothing is raised here; errors are raised by
+    Module.update() like for a normal execution.
+    """
+    # Post-order traversal, so that modules come after their dependencies
+    order = []
+    launchable = set()
+    async_upstream = {} # module -> set of launchable modules it depends on
+    visited = set()
+    stack = [(m, False) for m in reversed(sinks)]
+    while stack:
+        module, expanded = stack.pop()
+        if expanded:
+            deps = set()
+            for up in _upstream_modules(module):
+                deps.update(async_upstream.get(up, ()))
+                if up in launchable:
+                    deps.add(up)
+            async_upstream[module] = deps
+            if getattr(module, 'can_launch', None) and module.can_launch():
+                launchable.add(module)
+                order.append(module)
+            continue
+        if module in visited:
+            continue
+        visited.add(module)
+        stack.append((module, True))
+        for up in _upstream_modules(module):
+            if up not in visited:
+                stack.append((up, False))
+
+    pending = order
+    while pending:
+        # Modules launched during this pass count as running, so that their
+        # dependents are considered on the next pass
+        pending_set = set(pending)
+        def is_done(m):
+            return (m not in pending_set and
+                    (m.launched is None or m.launched.done()))
+        remaining = []
+        started = False
+        for module in pending:
+            if all(is_done(up) for up in async_upstream[module]):
+                module.launch()
+                started = True
+            else:
+                remaining.append(module)
+        pending = remaining
+        if pending and not started:
+            pending_set = set(pending)
+            running = [m.launched for m in launchable
+                       if m not in pending_set and m.launched is not None and
+                       not m.launched.done()]
+            if running:
+                launcher.wait_any(running)
+            else: # pragma: no cover
+                debug.warning("Couldn't schedule background modules")
+                break
+
+
+def finish_launches(modules):
+    """Drops the background computations of modules after an execution.
+
+    Computations that were started but whose result wasn't used, because the
+    execution stopped on an error or was aborted, are cancelled if they are
+    still queued and waited for otherwise, so that nothing is left running.
+    The launch state of the modules is cleared for the next execution.
+    """
+    for module in modules:
+        future = getattr(module, 'launched', None)
+        if future is not None and not future.cancel():
+            future.wait()
+        if hasattr(module, 'reset_launch'):
+            module.reset_launch()
+
+
+##############################################################################
+
+import unittest
+
+
+class TestLauncher(unittest.TestCase):
+    def test_result(self):
+        launcher = Launcher(2)
+        futures = [launcher.submit(lambda i=i: i * 2) for i in xrange(5)]
+        self.assertEqual([f.result() for f in futures], [0, 2, 4, 6, 8])
+
+    def test_exception(self):
+        def fail():
+            raise ValueError("expected")
+        future = Launcher(1).submit(fail)
+        with self.assertRaises(ValueError):
+            future.result()
+
+    def test_limits(self):
+        import time
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+        def task():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+        launcher = Launcher(3)
+        futures = [launcher.submit(task) for i in xrange(9)]
+        for future in futures:
+            future.result()
+        self.assertEqual(state['max'], 3)
+
+        # Each task needs 2 of the 3 CPUs: one at a time
+        state['max'] = 0
+        futures = [launcher.submit(task, cpus=2) for i in xrange(4)]
+        for future in futures:
+            future.result()
+        self.assertEqual(state['max'], 1)
+
+        # Memory budget allows 2 tasks
+        launcher = Launcher(8, memory=1000)
+        state['max'] = 0
+        futures = [launcher.submit(task, memory=400) for i in xrange(6)]
+        for future in futures:
+            future.result()
+        self.assertEqual(state['max'], 2)
+
+    def test_launch_order(self):
+        """Independent modules are started before any is waited on.
+        """
+        events = []
+
+        class FakeConnector(object):
+            def __init__(self, obj):
+                self.obj = obj
+
+        class FakeModule(object):
+            def __init__(self, name, upstream=(), launchable=True):
+                self.name = name
+                self.inputPorts = {'in': [FakeConnector(m)
+                                          for m in upstream]}
+                self.launchable = launchable
+                self.launched = None
+            def can_launch(self):
+                return self.launchable
+            def launch(self):
+                events.append(self.name)
+                self.launched = Future()
+                self.launched.set_result(None)
+
+        a1 = FakeModule('a1')
+        a2 = FakeModule('a2')
+        b1 = FakeModule('b1', [a1])
+        b2 = FakeModule('b2', [a2])
+        sync = FakeModule('sync', [b1, b2], launchable=False)
+        launch_modules([sync], Launcher(4))
+        self.assertEqual(set(events[:2]), set(['a1', 'a2']))
+        self.assertEqual(set(events[2:]), set(['b1', 'b2']))
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+            return 1
+        launcher = Launcher(1)
+        running = launcher.submit(block)
+        queued = launcher.submit(lambda: 2)
+        started.wait()
+        self.assertFalse(running.cancel())
+        self.assertTrue(queued.cancel())
+        self.assertTrue(queued.done())
+        with self.assertRaises(CancelledError):
+            queued.result()
+        release.set()
+        self.assertEqual(running.result(), 1)
+        self.assertFalse(running.cancel())
+
+    def test_finish_launches(self):
+        """Unused computations are cancelled or waited for.
+        """
+        release = threading.Event()
+        finished = []
+        def block():
+            release.wait()
+            finished.append(True)
+
+        class FakeModule(object):
+            def __init__(self, future):
+                self.launched = future
+            def reset_launch(self):
+                self.launched = None
+
+        launcher = Launcher(1)
+        running = FakeModule(launcher.submit(block))
+        queued = FakeModule(launcher.submit(lambda: finished.append(False)))
+        queued_future = queued.launched
+        threading.Timer(0.1, release.set).start()
+        finish_launches([queued, running, FakeModule(None)])
+        self.assertEqual(finished, [True])
+        self.assertIsNone(running.launched)
+        self.assertIsNone(queued.launched)
+        with self.assertRaises(CancelledError):
+            queued_future.result()
@@ -90,6 +90,22 @@ class TreeLW(object):
         # update max level
         self.maxLevel = max(self.maxLevel, maxLevel)
 
+    def setChildren(self, node, children):
+        """
+        Replaces the children of node. A child that has
+        been attached to another parent in the meantime
+        is left alone. Levels are not updated below the
+        new children.
+
+        """
+        for child in node.children:
+            if child.parent is node:
+                child.parent = None
+        node.children = []
+        for child in children:
+            node.addChild(child)
+            self.maxLevel = max(self.maxLevel, child.level)
+
     def __dfsUpdateLevel(self, node):
         if node.parent is None:
             node.level = 0
@@ -191,6 +207,13 @@ class NodeLW(object):
         # final center position
         self.x = 0
         self.y = 0
+
+        # state kept by IncrementalTreeLayoutLW
+        self.dirty = True
+        self.walked = False
+        self.stamp = -1
+        self.log = []
+        self.offset = None
         
     def getNumChilds(self):
         return len(self.children)
@@ -434,6 +457,216 @@ class TreeLayoutLW(object):
         for w in v.children:
             self.secondWalk(w, m + v.mod)
 
+class IncrementalTreeLayoutLW(TreeLayoutLW):
+
+    """
+    TreeLayoutLW that keeps its state between layouts of
+    a tree that is edited, so that only the changed
+    nodes and their ancestors are walked again.
+
+    Walker's algorithm draws a subtree the same way
+    wherever it is placed: the offsets of the nodes of a
+    subtree relative to its root, and so its contours,
+    only depend on the subtree. The first walk of a node
+    places its children and links their contours with
+    threads; every thread, mod and ancestor it writes
+    below its children is logged on the node. Undoing
+    the logs of the changed nodes and of their ancestors
+    brings the untouched subtrees back to the state their
+    own first walk left them in, so they can be merged
+    again without being walked. The second walk then only
+    descends into subtrees whose offset or level changed,
+    moving untouched subtrees as a block.
+
+    Usage: call invalidate() with the nodes about to be
+    edited or removed, edit the tree, then call update()
+    with the edited and added nodes.
+
+    """
+
+    def __init__(self, tree, vertical_alignment=1, xdistance=10, ydistance=10):
+        self.clock = 0
+        self.moved = []
+        self.levelHeights = None
+        TreeLayoutLW.__init__(self, tree, vertical_alignment, xdistance,
+                              ydistance)
+
+    def treeLayout(self):
+        for v in self.tree.nodes:
+            v.dirty = True
+            v.log = []
+            v.offset = None
+        self.update([])
+
+    def invalidate(self, nodes):
+        """
+        Undoes the changes the first walks of nodes and
+        of their ancestors made to the rest of the tree.
+        Must be called before the tree is edited.
+
+        """
+        invalid = set()
+        for v in nodes:
+            while v is not None and v not in invalid:
+                invalid.add(v)
+                v = v.parent
+        for v in sorted(invalid, key=lambda v: v.stamp, reverse=True):
+            for (w, thread, mod, ancestor) in reversed(v.log):
+                w.thread = thread
+                w.mod = mod
+                w.ancestor = ancestor
+            v.log = []
+            v.dirty = True
+
+    def update(self, nodes):
+        """
+        Lays out the tree again after nodes were edited or
+        added. self.moved lists the nodes whose position
+        may have changed.
+
+        """
+        marked = set()
+        for v in nodes:
+            while v is not None and v not in marked:
+                marked.add(v)
+                v.dirty = True
+                v = v.parent
+        r = self.tree.root()
+        if r.dirty:
+            self.firstWalk(r)
+        self.moved = []
+        self.secondWalk(r, -r.prelim)
+
+        self.tree.maxLevel = max(v.level for v in self.tree.nodes)
+        levelHeights = self.tree.getMaxNodeHeightPerLevel()
+        if levelHeights != self.levelHeights:
+            self.levelHeights = levelHeights
+            self.moved = self.tree.nodes
+            self.setVerticalPositions()
+        else:
+            self.setVerticalPositions(self.moved)
+
+    def setVerticalPositions(self, nodes=None):
+        if nodes is None:
+            TreeLayoutLW.setVerticalPositions(self)
+            return
+        # same as TreeLayoutLW.setVerticalPositions for the given nodes
+        info_level = []
+        position_level = 0
+        for height_level in self.levelHeights:
+            info_level.append((position_level,height_level))
+            position_level += self.ydistance + height_level
+        for w in nodes:
+            position_level, height_level = info_level[w.level]
+            if self.vertical_alignment == TreeLayoutLW.TOP:
+                w.y = position_level + w.height/2.0
+            elif self.vertical_alignment == TreeLayoutLW.MIDDLE:
+                w.y = position_level + height_level/2.0
+            else: # bottom
+                w.y = position_level + height_level - w.height/2.0
+
+    def firstWalk(self, v):
+        # state of v before its own walk in TreeLayoutLW
+        v.mod = 0
+        v.thread = None
+        v.ancestor = v
+        v.change = 0
+        v.shift = 0
+        v.walked = True
+
+        if v.dirty:
+            v.dirty = False
+            v.log = []
+            if v.hasChild():
+                defaultAncestor = v.leftChild()
+                for w in v.children:
+                    self.firstWalk(w)
+                    defaultAncestor = self.apportion(w, defaultAncestor)
+                self.executeShifts(v)
+            v.stamp = self.clock
+            self.clock += 1
+
+        # the subtree of v is placed, now place v next
+        # to its left sibling
+        if v.isLeaf():
+            v.prelim = 0
+            w = v.leftSibling()
+            if w is not None:
+                v.prelim = w.prelim + self.gap(w,v)
+
+        else:
+            midpoint = (v.leftChild().prelim + v.rightChild().prelim) / 2.0
+
+            w = v.leftSibling()
+            if w is not None:
+                v.prelim = w.prelim + self.gap(w,v)
+                v.mod = v.prelim - midpoint
+            else:
+                v.prelim = midpoint
+
+    def apportion(self,  v,  defaultAncestor):
+        """
+        Same as TreeLayoutLW.apportion, logging on the
+        parent of v the nodes it modifies.
+
+        """
+        log = v.parent.log
+        w = v.leftSibling()
+        if w is not None:
+            vip = vop = v
+            vim = w
+            vom = vip.leftMostSibling()
+            sip = vip.mod
+            sop = vop.mod
+            sim = vim.mod
+            som = vom.mod
+            while self.nextRight(vim) is not None and self.nextLeft(vip) is not None:
+                
+                vim = self.nextRight(vim)
+                vip = self.nextLeft(vip)
+                vom = self.nextLeft(vom)
+                vop = self.nextRight(vop)
+
+                log.append((vop, vop.thread, vop.mod, vop.ancestor))
+                vop.ancestor = v
+                
+                shift = (vim.prelim + sim) - (vip.prelim + sip) + self.gap(vim,vip)
+                
+                if shift > 0:
+                    self.moveSubtree(self.ancestor(vim,v,defaultAncestor),v,shift)
+                    sip += shift
+                    sop += shift
+
+                sim += vim.mod
+                sip += vip.mod
+                som += vom.mod
+                sop += vop.mod
+
+            if self.nextRight(vim) is not None and self.nextRight(vop) is None:
+                log.append((vop, vop.thread, vop.mod, vop.ancestor))
+                vop.thread = self.nextRight(vim)
+                vop.mod += sim - sop
+
+            if self.nextLeft(vip) is not None and self.nextLeft(vom) is None:
+                log.append((vom, vom.thread, vom.mod, vom.ancestor))
+                vom.thread = self.nextLeft(vip)
+                vom.mod += sip - som
+                defaultAncestor = v
+            
+        return defaultAncestor
+
+    def secondWalk(self,  v, m, level=0):
+        if not v.walked and v.offset == m and v.level == level:
+            # neither the subtree nor its position changed
+            return
+        v.walked = False
+        v.offset = m
+        v.level = level
+        v.x = v.prelim + m
+        self.moved.append(v)
+        for w in v.children:
+            self.secondWalk(w, m + v.mod, level + 1)
+
 # graph
 if __name__ == "__main__":
 
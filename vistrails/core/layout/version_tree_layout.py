@@ -40,9 +40,11 @@ Originally written by Lauro D. Lins.
 """
 from __future__ import division
 
-from tree_layout import TreeLW, NodeLW, TreeLayoutLW
+from tree_layout import TreeLW, NodeLW, TreeLayoutLW, IncrementalTreeLayoutLW
 from vistrails.core.data_structures.point import Point
 
+import unittest
+
 ################################################################################
 
 class NodeVistrailsTreeLayoutLW(object):
@@ -89,9 +91,15 @@ class VistrailsTreeLayoutLW(object):
         self.scale = 0.0
         self.width = 0.0
 
-    def generateTreeLW(self, vistrail, graph):
-        """ output_vistrail_graph(f: str) -> None
-        Using vistrail and graph to generate layout
+        # tree and layout state kept between calls to layout_from
+        self._tree = None
+        self._tree_nodes = {}
+        self._layout = None
+
+    def collect_nodes(self, vistrail, graph):
+        """ collect_nodes(vistrail: Vistrail, graph: Graph) -> (list, list)
+        Returns the (id, label) pairs of the nodes to lay out, root
+        first, and the (parent, child) edges between them
         
         """
         
@@ -125,10 +133,24 @@ class VistrailsTreeLayoutLW(object):
 #                    nodes.append((first," "))
                     nodes.append((first, vistrail.get_description(first)))
                     X.add(first)
+        return nodes, edges
 
-        # get widths and heights for the nodes
+    def node_width(self, tag):
+        """ node_width(tag: str) -> float
+        Width of the node showing tag
+        
+        """
         empty_width = self.text_horizontal_margin + self.text_width_f(" " * 5)
+        width = self.text_horizontal_margin + self.text_width_f(tag)
+        return max(width, empty_width)
+
+    def generateTreeLW(self, vistrail, graph):
+        """ generateTreeLW(vistrail: Vistrail, graph: Graph) -> TreeLW
+        Using vistrail and graph to generate the tree to lay out
         
+        """
+        nodes, edges = self.collect_nodes(vistrail, graph)
+
         # default height for all nodes
         height = self.text_height + self.text_vertical_margin
 
@@ -140,8 +162,7 @@ class VistrailsTreeLayoutLW(object):
 
         # add the remaining nodes
         for id, tag in nodes:
-            width = self.text_horizontal_margin + self.text_width_f(tag)
-            width = max(width, empty_width)
+            width = self.node_width(tag)
             # print "add node to the tree %d %s" % (id, tag)
             mapTreeNodes[id] = tree.addNode(None,width,height,(id,tag))
 
@@ -161,22 +182,77 @@ class VistrailsTreeLayoutLW(object):
 
     def layout_from(self, vistrail, graph):
         """ layout_from(vistrail: VisTrail, graph: Graph) -> None
-        Take a graph from VisTrail version and use Dotty to lay it out
+        Take a graph from VisTrail version and lay it out
+
+        The tree and its layout are kept between calls: only the nodes
+        whose label or children changed, and their ancestors, are laid
+        out again, the other subtrees are moved as a block.
         
         """
+        nodes, edges = self.collect_nodes(vistrail, graph)
+        children = {}
+        for (parentId, childId) in edges:
+            children.setdefault(parentId, []).append(childId)
+
+        # default height for all nodes
+        height = self.text_height + self.text_vertical_margin
+
+        # reuse the tree nodes whose label did not change
+        old_nodes = self._tree_nodes
+        tree_nodes = {}
+        changed = []
+        for id, tag in nodes:
+            v = old_nodes.get(id)
+            if v is None or v.object[1] != tag:
+                width = self.node_width(tag)
+                if v is None:
+                    v = NodeLW(width, height, (id, tag))
+                else:
+                    v.width = width
+                    v.object = (id, tag)
+                changed.append(v)
+            tree_nodes[id] = v
+        removed = [v for id, v in old_nodes.iteritems()
+                   if id not in tree_nodes]
+
+        # nodes whose children changed, preserving the order of the edges
+        new_children = {}
+        for id, v in tree_nodes.iteritems():
+            v_children = [tree_nodes[c] for c in children.get(id, [])]
+            if v_children != v.children:
+                new_children[v] = v_children
+        edited = set(changed)
+        changed.extend(v for v in new_children if v not in edited)
 
-        tree = self.generateTreeLW(vistrail, graph)
+        if self._layout is None:
+            tree = TreeLW()
+        elif not changed and not removed:
+            return
+        else:
+            tree = self._tree
+            self._layout.invalidate(changed + removed)
+        for v, v_children in new_children.iteritems():
+            tree.setChildren(v, v_children)
+        tree.nodes = [tree_nodes[id] for id, tag in nodes]
+        self._tree = tree
+        self._tree_nodes = tree_nodes
 
         min_horizontal_separation = 20
         min_vertical_separation = 50
 
-        layout = TreeLayoutLW(tree, TreeLayoutLW.TOP,
-                              min_horizontal_separation,
-                              min_vertical_separation)
+        if self._layout is None:
+            self._layout = IncrementalTreeLayoutLW(tree, TreeLayoutLW.TOP,
+                                                   min_horizontal_separation,
+                                                   min_vertical_separation)
+            moved = tree.nodes
+        else:
+            self._layout.update(changed)
+            moved = self._layout.moved
 
         # prepare the result
-        self.nodes = {}
-        for v in tree.nodes:
+        for v in removed:
+            del self.nodes[v.object[0]]
+        for v in moved:
             id, tag = v.object
             newNode = NodeVistrailsTreeLayoutLW()
             newNode.p = Point(v.x, v.y)
@@ -204,3 +280,103 @@ class VistrailsTreeLayoutLW(object):
         
         """
         self.nodes[id] = node
+
+################################################################################
+
+class TestVistrailsTreeLayoutLW(unittest.TestCase):
+    class Vistrail(object):
+        def __init__(self):
+            self.tags = {}
+            self.descriptions = {}
+        def get_tagMap(self):
+            return self.tags
+        def get_description(self, id):
+            return self.descriptions.get(id, '')
+
+    def create_layout(self):
+        return VistrailsTreeLayoutLW(lambda text: 7 * len(text), 12, 8, 4)
+
+    def check_layout(self, vistrail, graph, layout):
+        tree = self.create_layout().generateTreeLW(vistrail, graph)
+        TreeLayoutLW(tree, TreeLayoutLW.TOP, 20, 50)
+        self.assertEqual(sorted(layout.nodes),
+                         sorted(v.object[0] for v in tree.nodes))
+        for v in tree.nodes:
+            node = layout.nodes[v.object[0]]
+            self.assertAlmostEqual(node.p.x, v.x)
+            self.assertAlmostEqual(node.p.y, v.y)
+            self.assertEqual(node.width, v.width)
+        (minx, miny, width, height) = tree.boundingBox()
+        self.assertAlmostEqual(layout.width, width)
+        self.assertAlmostEqual(layout.height, height)
+
+    def test_incremental(self):
+        import random
+        from vistrails.core.data_structures.graph import Graph
+        random.seed(4)
+
+        vistrail = self.Vistrail()
+        graph = Graph()
+        graph.add_vertex(0)
+        parent = {}
+        for i in xrange(1, 300):
+            parent[i] = random.randint(max(0, i - 20), i - 1)
+            graph.add_vertex(i)
+            graph.add_edge(parent[i], i, i)
+            vistrail.descriptions[i] = 'x' * random.randint(0, 12)
+        layout = self.create_layout()
+        layout.layout_from(vistrail, graph)
+        self.check_layout(vistrail, graph, layout)
+
+        next_id = 300
+        for step in xrange(40):
+            for edit in xrange(random.randint(1, 3)):
+                op = random.random()
+                ids = sorted(parent)
+                i = random.choice(ids)
+                if op < 0.4:
+                    # new version
+                    parent[next_id] = i
+                    graph.add_vertex(next_id)
+                    graph.add_edge(i, next_id, next_id)
+                    next_id += 1
+                elif op < 0.6:
+                    # relabel
+                    if i in vistrail.tags:
+                        del vistrail.tags[i]
+                    else:
+                        vistrail.tags[i] = 'tag%d' % step
+                elif op < 0.8:
+                    # remove a leaf
+                    if not graph.edges_from(i):
+                        graph.delete_vertex(i)
+                        del parent[i]
+                        vistrail.tags.pop(i, None)
+                else:
+                    # move a subtree to another parent
+                    j = random.choice(ids + [0])
+                    k = j
+                    while k != 0 and k != i:
+                        k = parent[k]
+                    if k != i:
+                        graph.delete_edge(parent[i], i, i)
+                        graph.add_edge(j, i, i)
+                        parent[i] = j
+            layout.layout_from(vistrail, graph)
+            self.check_layout(vistrail, graph, layout)
+
+        # adding a version only walks it and its ancestors again
+        i = random.choice(sorted(parent))
+        graph.add_edge(i, next_id, next_id)
+        parent[next_id] = i
+        clock = layout._layout.clock
+        layout.layout_from(vistrail, graph)
+        self.check_layout(vistrail, graph, layout)
+        walked = set(v.object[0] for v in layout._tree.nodes
+                     if v.stamp >= clock)
+        path = set([0])
+        i = next_id
+        while i != 0:
+            path.add(i)
+            i = parent[i]
+        self.assertEqual(walked, path)
@@ -42,22 +42,7 @@ Originally written by Lauro D. Lins.
 
 from __future__ import division
 
-def uniquify(seq, idfun=None): 
-    # order preserving
-    if idfun is None:
-        def idfun(x): return x
-    seen = {}
-    result = []
-    for item in seq:
-        marker = idfun(item)
-        # in old Python versions:
-        # if seen.has_key(marker)
-        # but in new ones:
-        if marker in seen: continue
-        seen[marker] = 1
-        result.append(item)
-    return result
-
+import unittest
 
 class Defaults(object):
     u            = 10.0
@@ -126,10 +111,6 @@ class Pipeline(object):
 
         return conn
 
-    # def updateCache(self):
-    #     self.cached_num_modules      = len(self.modules)
-    #     self.cached_num_connections  = len(self.connections)
-
 
 
 class Module(object):
@@ -147,59 +128,11 @@ class Module(object):
         self.layout_layer_number = UNDEFINED_LAYER
         self.layout_layer_index  = 0
 
-        self.cached              = False
-        self.cached_in_degree    = 0
-        self.cached_out_degree   = 0
-
-        self.cached_connections_succ  = [] # successor modules
-        self.cached_connections_pred  = [] # predecessor modules
-
-        self.cached_succ         = [] # successor modules
-        self.cached_pred         = [] # predecessor modules
-
-        self.cached_num_succ     = 0
-        self.cached_num_pred     = 0
-
-        self.flags               = 0
-
         self.layout_pos          = Vec2(0,0)
         self.layout_dim          = Vec2(1,1)
         
         self.prev_x = prev_x
 
-    def clearFlags(self):
-        self.flags = 0
-
-    def updateCache(self):
-        self.cached_in_degree = self.getInDegree()
-        self.cached_out_degree = self.getOutDegree()
-
-        self.cached_connections_succ  = [] # successor modules
-        self.cached_connections_pred  = [] # predecessor modules
-
-        # cached succ
-        self.cached_succ = []
-        for p in self.output_ports:
-            p.collectOppositeModules(self.cached_succ)
-            self.cached_connections_succ.extend([c for c in p.connections])
-
-        uniquify(self.cached_succ)
-        # print "%s's of cached_succ: " % (self.shortname),
-        # print [m.name for m in self.cached_succ]
-
-
-        # cached pred
-        self.cached_pred = []
-        for p in self.input_ports:
-            p.collectOppositeModules(self.cached_pred)
-            self.cached_connections_pred.extend([c for c in p.connections])
-        uniquify(self.cached_pred)
-
-        self.cached_num_succ     = len(self.cached_succ)
-        self.cached_num_pred     = len(self.cached_pred)
-
-        self.cached = True
-
     def getInputPort(self, idx):
         return self.input_ports[idx]
                               
@@ -253,69 +186,12 @@ class Port(object):
     def addConnection(self, connection):
         self.connections.append(connection)
 
-        # module is not cached
-        self.module.cached = False
-
     def collectOppositeModules(self, lst):
         for c in self.connections:
             lst.append(c.getOppositePort(self).module)
 
 
 
-class ItemDFS(object):
-    def __init__(self, module, index, max_index):
-        self.module    = module
-        self.index     = index
-        self.max_index = max_index
-
-        # the creation of ItemDFS implies
-        # that it will be stacked on the DFSIterator
-        # and the module flag goes from 0 to 1
-        self.module.flags = 1
-
-
-
-class DFSIterator(object):
-
-    def __init__(self, workflow, update_module_cache=False):
-        self.stack = []
-
-        # stack source modules
-        for m in workflow.modules:
-
-            m.clearFlags()
-
-            if not m.cached:
-                m.updateCache()
-
-            if m.cached_in_degree == 0: # source modules
-                m.flags = 1
-                self.stack.append(ItemDFS(m,-1,m.cached_num_succ))
-
-
-    def next(self):
-        
-        while len(self.stack) > 0:
-
-            top = self.stack[-1]
-            top.index += 1
-            mod = top.module
-            
-            #DEBUG
-            #print "pop %s index %d max_index %d" % (mod.shortname, top.index, top.max_index)
-
-            if top.index >= top.max_index:
-                self.stack.pop()
-                return mod
-            else:
-                next_mod = mod.cached_succ[top.index]
-                if next_mod.flags > 0:
-                    continue
-                next_mod.flags = 1
-                self.stack.append(ItemDFS(next_mod, -1, next_mod.cached_num_succ))
-
-        return None
-
 class Layer(object):
 
     def __init__(self, index):
@@ -410,15 +286,15 @@ class WorkflowLayout(object):
         # port_interspace     = 0.15 * u
         # port_size           = 0.75 * u
 
+        # port offsets along the module edge only depend on the port's
+        # rank, not on the module
+        port_step = self.port_size[0] + self.port_interspace
+        port_x0 = self.module_margin[0] + 0.5 * self.port_size[0]
+        port_y0 = self.module_margin[1] + self.port_size[1]
+
         for module in wf.modules:
             module_width, module_height = self.module_size_f(module)
 
-            # [DK] why do we have to do this here?
-            if not module.cached:
-                module.updateCache()
-
-            max_num_ports = max(len(module.input_ports), len(module.output_ports))
-
             # ports_width = 2*module_ports_margin + max_num_ports * u + (max_num_ports-1) * module_ports_margin 
             # text_width  = 2*module_text_margin  + len(module.name) * u * 0.6
 
@@ -434,14 +310,10 @@ class WorkflowLayout(object):
                 else:
                     port_iter = port_list
 
+                x0 = d * (module_width/2.0 - port_x0)
+                y = d * (module_height/2.0 - port_y0)
                 for i, p in enumerate(port_iter):
-                    p.layout_pos.set(d * module_width/2.0 -
-                                     d * self.module_margin[0] -
-                                     d * (i + 0.5) * self.port_size[0] -
-                                     d * self.port_interspace * i,
-                                     d * (module_height/2.0 -
-                                          self.module_margin[1] - 
-                                          self.port_size[1]))
+                    p.layout_pos.set(x0 - d * i * port_step, y)
                     p.layout_dim.set(*self.port_size)
                                      
             # for p in module.input_ports:
@@ -464,130 +336,174 @@ class WorkflowLayout(object):
             #                       +module_height/2.0 - row_height / 2.0 )
             #     p.layout_dim.set(port_size, port_size)
 
+    def build_index(self):
+        """Builds compact adjacency lists over module indices, so the
+        layout steps do not have to walk ports and connections.
+
+        self.succ[i] and self.pred[i] list (module index, port index)
+        pairs for the modules connected to the output and input ports of
+        module i, in port order.
+        """
+        modules = self.wf.modules
+        index = dict((module, i) for i, module in enumerate(modules))
+        self.succ = []
+        self.pred = []
+        for module in modules:
+            self.succ.append([(index[c.target_port.module], c.target_port.index)
+                              for p in module.output_ports
+                              for c in p.connections])
+            self.pred.append([(index[c.source_port.module], c.source_port.index)
+                              for p in module.input_ports
+                              for c in p.connections])
+
     def assign_modules_to_layers(self):
         wf = self.wf
-
-        iterator = DFSIterator(wf)
-
-        # topologically sorted permulation of the modules
-        permutation = []
-        while True:
-            mod = iterator.next()
-            if mod is None:
-                break
-            permutation.append(mod)
-        permutation.reverse()
-
-        # define layers
-        i = 0
-        for module in permutation:
-            if module.cached_num_pred == 0:
-                module.layout_layer_number = 0
-            else:
-                module.layout_layer_number = 1 + max([pred.layout_layer_number for pred in module.cached_pred])
-
-            # use permutation index as a the sort key to define
-            # the initial permutation of the modules in each layer
-            module.layout_layer_index = i
-            i += 1
-
-
-        # log
-        # for module in permutation:
-        #     print "layer of %s = %d" % (module.shortname, module.layout_layer_number)
+        succ = self.succ
+        pred = self.pred
+        n = len(wf.modules)
+
+        # topologically sorted permutation of the modules: reversed
+        # postorder of a depth-first traversal that starts with all the
+        # source modules stacked, then from any module left unvisited
+        # (only possible on a cycle)
+        visited = [False] * n
+        postorder = []
+        stack = []
+        for i in xrange(n):
+            if not pred[i]:
+                visited[i] = True
+                stack.append([i, -1])
+        # root -1 drains the stacked sources first
+        for root in xrange(-1, n):
+            if root >= 0:
+                if visited[root]:
+                    continue
+                visited[root] = True
+                stack.append([root, -1])
+            while stack:
+                top = stack[-1]
+                top[1] += 1
+                if top[1] >= len(succ[top[0]]):
+                    stack.pop()
+                    postorder.append(top[0])
+                    continue
+                next_i = succ[top[0]][top[1]][0]
+                if not visited[next_i]:
+                    visited[next_i] = True
+                    stack.append([next_i, -1])
+        permutation = postorder[::-1]
+
+        # define layers (longest path from a source)
+        layer = [0] * n
+        for i in permutation:
+            if pred[i]:
+                layer[i] = 1 + max(layer[j] for (j, _) in pred[i])
 
         # adjust free modules (a free module in this context is
-        # a module whose minimum successor layer and maximum predecessor layer
-        # have more than one intermediate layer in between
-
-        #
-        # TODO: adjust layer
-        for module in permutation:
-            if module.cached_num_pred == 0 and module.cached_num_succ > 0:
-                module.layout_layer_number = min([succ.layout_layer_number for succ in module.cached_succ]) - 1
-            # else:
-            #     a = min([succ.layout_layer_number for succ in module.cached_succ]) - 1
-            # print "layer of %s = %d" % (module.shortname, module.layout_layer_number)
+        # a source module whose minimum successor layer has more than
+        # one intermediate layer in between)
+        for i in permutation:
+            if not pred[i] and succ[i]:
+                layer[i] = min(layer[j] for (j, _) in succ[i]) - 1
+
+        # use permutation index as a the sort key to define
+        # the initial permutation of the modules in each layer
+        for position, i in enumerate(permutation):
+            module = wf.modules[i]
+            module.layout_layer_number = layer[i]
+            module.layout_layer_index = position
 
     def assign_module_to_layers_no_gaps(self):
-        if len(self.wf.modules) == 0:
-            return
-        
-        visited = set()
-        min_layer = [0]
-        def set_module_layer_number(module, layer_number):
-            module.layout_layer_number = layer_number
-            visited.add(module)
-            min_layer[0] = min(min_layer[0], layer_number)
-            for port in module.input_ports:
-                for conn in port.connections:
-                    if conn.source_port.module not in visited:
-                        set_module_layer_number(conn.source_port.module, layer_number-1)
-            for port in module.output_ports:
-                for conn in port.connections:
-                    if conn.target_port.module not in visited:
-                        set_module_layer_number(conn.target_port.module, layer_number+1)
-               
-        set_module_layer_number(self.wf.modules[0], 0)
-                        
-        #adjust all layers numbers so that the min is 0
-        if min_layer[0] < 0:
-            for module in self.wf.modules:
-                module.layout_layer_number -= min_layer[0]
-
-    def assign_module_permutation_to_each_layer(self, preserve_order=False):
         wf = self.wf
+        n = len(wf.modules)
+        if n == 0:
+            return
 
-        # create layers
-        layers = Layers()
-        for module in wf.modules:
-            layers.addModule(module, module.layout_layer_number)
+        # depth-first traversal from each unvisited module, going one
+        # layer up to predecessors and one layer down to successors
+        layer = [None] * n
+        min_layer = 0
+        for root in xrange(n):
+            if layer[root] is not None:
+                continue
+            layer[root] = 0
+            stack = [(root, self.neighbors_up_and_down(root))]
+            while stack:
+                (i, neighbors) = stack[-1]
+                for (j, delta) in neighbors:
+                    if layer[j] is None:
+                        layer[j] = layer[i] + delta
+                        min_layer = min(min_layer, layer[j])
+                        stack.append((j, self.neighbors_up_and_down(j)))
+                        break
+                else:
+                    stack.pop()
 
-        # sort modules by the current value of layout_layer_index
-        for layer in layers.layers:
-            layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
-            for i in xrange(len(layer.modules)):
-                layer.modules[i].layout_layer_index = i
+        #adjust all layers numbers so that the min is 0
+        for i, module in enumerate(wf.modules):
+            module.layout_layer_number = layer[i] - min_layer
+
+    def neighbors_up_and_down(self, i):
+        for (j, _) in self.pred[i]:
+            yield (j, -1)
+        for (j, _) in self.succ[i]:
+            yield (j, 1)
+
+    def assign_module_permutation_to_each_layer(self, preserve_order=False,
+                                                max_sweeps=1):
+        """Orders the modules in each layer, reducing crossings with the
+        barycentric method: each sweep goes down then up the layers,
+        sorting every layer on the mean position of the modules it is
+        connected to in the previous layer. At most max_sweeps sweeps are
+        done, fewer if a sweep changes nothing.
+        """
+        wf = self.wf
+        modules = wf.modules
+
+        # create layers, as lists of module indices sorted by the
+        # current value of layout_layer_index
+        layers = []
+        for i, module in enumerate(modules):
+            number = module.layout_layer_number
+            if number >= len(layers):
+                layers.extend([] for _ in xrange(len(layers), number + 1))
+            layers[number].append(i)
+        position = [0] * len(modules)
+        for layer in layers:
+            layer.sort(key=lambda i: modules[i].layout_layer_index)
+            for j, i in enumerate(layer):
+                position[i] = j
 
         #
-        num_layers = len(layers.layers)
+        num_layers = len(layers)
 
-        lastModified = [-1 for i in xrange(num_layers)]
+        lastModified = [-1] * num_layers
 
         #
         # sweep down and up reducing the number of crossings
         # using the barycentric method (heuristic)
         #
         iteration = 0
-        updates = len(wf.modules)
-        while updates > 0 and iteration < 100:
-
-            # print "iteration: ", iteration
-
+        updates = len(modules)
+        while updates > 0 and iteration < max_sweeps:
             updates = 0
 
             DOWN, UP = 1, -1
             for direction in [DOWN, UP]:
-
-                # print "   direction:", direction
-
-                delta = 1 if direction == DOWN else -1
-
-                i0, i1 = (0,num_layers) if direction == DOWN else (num_layers-1,-1)
+                if direction == DOWN:
+                    i0, i1 = 0, num_layers
+                    neighbors = self.pred
+                else:
+                    i0, i1 = num_layers - 1, -1
+                    neighbors = self.succ
 
                 # sweep "direction"
-                for i in xrange(i0+delta,i1,direction):
-                # for i in xrange(2,4):
-
-
-                    i_prev = i-delta
-                    # print "      layer:"        , i
-                    # print "         layer_prev:", i_prev
-
-                    layer = layers.layers[i]
+                for i in xrange(i0 + direction, i1, direction):
+                    i_prev = i - direction
+                    layer = layers[i]
 
                     # if one module on layer then continue
-                    num_modules = len(layer.modules)
+                    num_modules = len(layer)
                     if num_modules == 1:
                         continue
 
@@ -597,87 +513,50 @@ class WorkflowLayout(object):
                            iteration - lastModified[i] > 1:
                         continue
 
-                    # apply barycentric permutation to layer "i" using neighbors on layer "i + delta"
+                    # apply barycentric permutation to layer "i" using
+                    # neighbors on layer "i - direction"
                     barycenters = [-1] * num_modules
-                    for j in xrange(num_modules):
-
-                        module      = layer.modules[j]
-                        connections = \
-                            module.cached_connections_pred  \
-                            if direction == DOWN else       \
-                            module.cached_connections_succ
-
-                        value = 0.0
-                        for c in connections:
-                            opposite_port = c.source_port if direction == DOWN else c.target_port
-                            value += opposite_port.module.layout_layer_index + opposite_port.index/100.0
-                        if len(connections) > 0:
-                            value /= 1.0 * len(connections)
-                            barycenters[j] = value
-
-                    for j in xrange(1,num_modules):
+                    for j, m in enumerate(layer):
+                        connections = neighbors[m]
+                        if connections:
+                            value = 0.0
+                            for (k, port_index) in connections:
+                                value += position[k] + port_index / 100.0
+                            barycenters[j] = value / len(connections)
+
+                    for j in xrange(1, num_modules):
                         if barycenters[j] < 0:
                             barycenters[j] = barycenters[j-1] + 1e-5
 
-                    # print "         barycenters: ", barycenters
-
-
-                    new_order = [(barycenters[j], layer.modules[j]) for j in xrange(num_modules)]
-                    new_order.sort()
-
-                    # print "            indices before: ", [u.layout_layer_index for u in layer.modules]
-                    # print "            indices after:  ", [aux[0] for aux in new_order]
-                    # print "            names before =  ",[mod.name for mod in layer.modules]
-
-                    for j in xrange(num_modules):
-                        module = new_order[j][1]
-                        if module.layout_layer_index != j:
-                            # print "            module indexed %d goes to index %d" % (module.layout_layer_index,j)
-                            lastModified[i] = iteration
-                            updates += 1
-
-                    if lastModified[i] == iteration:
-                        for j in xrange(num_modules):
-                            module = new_order[j][1]
-                            module.layout_layer_index = j
-
-
-                    # sort using the last layout_layer_index
-                    layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
-                    # print "            names after =",[mod.name for mod in layer.modules]
-
-
-                # print "      updates: ", updates
+                    new_order = sorted(xrange(num_modules),
+                                       key=lambda j: (barycenters[j], j))
+                    if new_order != range(num_modules):
+                        lastModified[i] = iteration
+                        updates += sum(1 for j, k in enumerate(new_order)
+                                       if j != k)
+                        layer[:] = [layer[k] for k in new_order]
+                        for j, m in enumerate(layer):
+                            position[m] = j
 
             # iteration
             iteration += 1
 
-            # break
-            break
-        
         if preserve_order:
-            for layer in layers.layers:                
-
-                # sort using the last layout_layer_index
-                layer.modules.sort(key=lambda x: x.layout_layer_index)
-            
-                #separate modules that have no previous x value
-                temp = []
-                for i in reversed(range(len(layer.modules))):
-                    if layer.modules[i].prev_x is None:
-                        temp.append((i,layer.modules.pop(i)))
-                
-                #sort on previous x
-                layer.modules.sort(key=lambda x: x.prev_x)
-                
-                #put separated modules back in their original slot
-                for item in reversed(temp):
-                    layer.modules.insert(item[0],item[1])
-                    
-                #reassign index
-                for i in range(len(layer.modules)):
-                    layer.modules[i].layout_layer_index = i
-            
+            for layer in layers:
+                # modules with a previous x value are sorted on it, the
+                # others keep their slot
+                slots = [j for j, m in enumerate(layer)
+                         if modules[m].prev_x is not None]
+                placed = sorted((layer[j] for j in slots),
+                                key=lambda m: modules[m].prev_x)
+                for j, m in zip(slots, placed):
+                    layer[j] = m
+                for j, m in enumerate(layer):
+                    position[m] = j
+
+        for i, module in enumerate(modules):
+            module.layout_layer_index = position[i]
+
     #
     # this method is "friend" of the classes above in the C++ sense:
     # it can access and modify
@@ -691,7 +570,7 @@ class WorkflowLayout(object):
             layers.addModule(module, module.layout_layer_number)
 
         for layer in layers.layers:# sort using the last layout_layer_index
-            layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
+            layer.modules.sort(key=lambda m: m.layout_layer_index)
 
         # spread layers
         min_x = max_x = 0.0
@@ -767,11 +646,88 @@ class WorkflowLayout(object):
 
         return page
 
-    def run_all(self, layer_x_separation=50, layer_y_separation=50, preserve_order=False, no_gaps=False):
+    def run_all(self, layer_x_separation=50, layer_y_separation=50, preserve_order=False, no_gaps=False,
+                max_sweeps=1):
         self.compute_module_sizes()
+        self.build_index()
         if no_gaps:
             self.assign_module_to_layers_no_gaps()
         else:
             self.assign_modules_to_layers()
-        self.assign_module_permutation_to_each_layer(preserve_order)
-        self.compute_layout(layer_x_separation, layer_y_separation)
\ No newline at end of file
+        self.assign_module_permutation_to_each_layer(preserve_order,
+                                                     max_sweeps)
+        self.compute_layout(layer_x_separation, layer_y_separation)
+
+################################################################################
+
+class TestWorkflowLayout(unittest.TestCase):
+    def make_layout(self, num_modules, connections):
+        wf = Pipeline()
+        modules = [wf.createModule(i, 'M%d' % i, 2, 2)
+                   for i in xrange(num_modules)]
+        for (i, j) in connections:
+            wf.createConnection(modules[i], 0, modules[j], 0)
+        layout = WorkflowLayout(wf, lambda m: (100, 50), (5, 5), (10, 10), 3)
+        return wf, layout
+
+    def test_layers(self):
+        # 0 -> 2 -> 3, 1 -> 3: the source 1 is moved next to 3
+        wf, layout = self.make_layout(4, [(0, 2), (2, 3), (1, 3)])
+        layout.run_all()
+        self.assertEqual([m.layout_layer_number for m in wf.modules],
+                         [0, 1, 1, 2])
+        self.assertEqual(len(set((m.layout_pos.x, m.layout_pos.y)
+                                 for m in wf.modules)), 4)
+        self.assertTrue(wf.modules[0].layout_pos.y <
+                        wf.modules[2].layout_pos.y <
+                        wf.modules[3].layout_pos.y)
+
+    def test_no_gaps(self):
+        # two components, each with a gap-free layering
+        wf, layout = self.make_layout(5, [(1, 0), (0, 2), (3, 4)])
+        layout.run_all(no_gaps=True)
+        self.assertEqual([m.layout_layer_number for m in wf.modules],
+                         [1, 0, 2, 1, 2])
+
+    def test_long_chain(self):
+        n = 5000
+        chain = [(i, i + 1) for i in xrange(n - 1)]
+        for no_gaps in (False, True):
+            wf, layout = self.make_layout(n, chain)
+            layout.run_all(no_gaps=no_gaps)
+            self.assertEqual([m.layout_layer_number for m in wf.modules],
+                             range(n))
+
+    def test_preserve_order(self):
+        wf, layout = self.make_layout(4, [(0, 1), (0, 2), (0, 3)])
+        for m, x in zip(wf.modules[1:], [30, None, 10]):
+            m.prev_x = x
+        layout.run_all(preserve_order=True)
+        self.assertEqual([m.layout_layer_index for m in wf.modules[1:]],
+                         [2, 1, 0])
+
+    def test_large_dags(self):
+        """Lays out random DAGs of 1k, 5k and 10k modules.
+        """
+        import random
+        for n in (1000, 5000, 10000):
+            rng = random.Random(n)
+            connections = []
+            for j in xrange(1, n):
+                # mostly local connections, so that there are many layers,
+                # plus some long ones
+                for k in xrange(rng.randint(1, 2)):
+                    if rng.random() < 0.9:
+                        connections.append((rng.randint(max(0, j - 50),
+                                                        j - 1), j))
+                    else:
+                        connections.append((rng.randint(0, j - 1), j))
+            for no_gaps in (False, True):
+                wf, layout = self.make_layout(n, connections)
+                layout.run_all(no_gaps=no_gaps)
+                layers = [m.layout_layer_number for m in wf.modules]
+                self.assertEqual(min(layers), 0)
+                if not no_gaps:
+                    # no_gaps only spaces the edges of a spanning tree
+                    for (i, j) in connections:
+                        self.assertLess(layers[i], layers[j])
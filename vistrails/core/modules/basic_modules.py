@@ -38,6 +38,8 @@ pipelines."""
 from __future__ import division
 
 import vistrails.core.cache.hasher
+from vistrails.core.cache.file_hash import get_file_hash_cache
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.debug import format_exception
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.modules.vistrails_module import Module, new_module, \
@@ -399,24 +401,26 @@ class Path(Constant):
 Path.default_value = PathObject('')
 
 def path_parameter_hasher(p):
-    def get_mtime(path):
-        t = int(os.path.getmtime(path))
-        if os.path.isdir(path):
-            for subpath in os.listdir(path):
-                subpath = os.path.join(path, subpath)
-                if os.path.isdir(subpath):
-                    t = max(t, get_mtime(subpath))
-        return t
+    """Signs a File or Directory constant using the content of the path.
 
+    Digests come from the FileHashCache, so files are only read again when
+    their size, modification time or inode changes.
+    """
     h = vistrails.core.cache.hasher.Hasher.parameter_signature(p)
+    configuration = get_vistrails_configuration()
+    threshold = None
+    if (configuration is not None and
+            configuration.check('partialFileHashThreshold')):
+        threshold = configuration.partialFileHashThreshold * 1024 * 1024
     try:
         # FIXME: This will break with aliases - I don't really care that much
-        t = get_mtime(p.strValue)
-    except OSError:
+        digest = get_file_hash_cache().path_hash(p.strValue,
+                                                 partial_threshold=threshold)
+    except (IOError, OSError):
         return h
     hasher = sha_hash()
     hasher.update(h)
-    hasher.update(str(t))
+    hasher.update(digest)
     return hasher.digest()
 
 class File(Path):
@@ -1715,6 +1719,40 @@ class TestUnzip(unittest.TestCase):
                  ([], ['file2.txt'])])
 
 
+class TestPathSignature(unittest.TestCase):
+    def test_content_signature(self):
+        import tempfile
+        import time
+        from vistrails.core.vistrail.module_param import ModuleParam
+
+        tmpdir = tempfile.mkdtemp(prefix='vt_signature_')
+        try:
+            filename = os.path.join(tmpdir, 'file.txt')
+            def write(contents, age):
+                with open(filename, 'wb') as f:
+                    f.write(contents)
+                t = time.time() - age
+                os.utime(filename, (t, t))
+
+            def sign(path):
+                return path_parameter_hasher(ModuleParam(
+                        type='File', val=path,
+                        identifier='org.vistrails.vistrails.basic'))
+
+            write('some data', 120)
+            file_sig, dir_sig = sign(filename), sign(tmpdir)
+            # Touching the file doesn't change the signatures
+            write('some data', 60)
+            self.assertEqual(sign(filename), file_sig)
+            self.assertEqual(sign(tmpdir), dir_sig)
+            # Changing the content does
+            write('other data', 60)
+            self.assertNotEqual(sign(filename), file_sig)
+            self.assertNotEqual(sign(tmpdir), dir_sig)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 from vistrails.core.configuration import get_vistrails_configuration
 
 class TestTypechecking(unittest.TestCase):
@@ -520,7 +520,6 @@ class ModuleRegistry(DBRegistry):
             kwargs['root_descriptor_id'] = -1
         DBRegistry.__init__(self, *args, **kwargs)
 
-        self._conversions = dict()
         self._converters = set()
 
         self.set_defaults()
@@ -530,6 +529,9 @@ class ModuleRegistry(DBRegistry):
 
     def set_defaults(self, other=None):
         self._root_descriptor = None
+        # Set by the PackageManager to load packages on demand, see
+        # PackageManager.require_package()
+        self.package_loader = None
         self.signals = ModuleRegistrySignals()
         self.setup_indices()
         if other is None:
@@ -550,7 +552,20 @@ class ModuleRegistry(DBRegistry):
             self._default_package = \
                 self.packages[other._default_package.identifier]
 
+    def clear_compatibility_cache(self):
+        """Forgets the memoized subclass, port matching and converter
+        lookups.
+
+        Called whenever a descriptor or package is added or removed.
+        """
+        self._conversions = {}
+        self._subclass_checks = {}
+        self._subclasses = {}
+        self._spec_matches = {}
+        self._upgrade_sigstrings = {}
+
     def setup_indices(self):
+        self.clear_compatibility_cache()
         self.descriptors_by_id = {}
         self.package_versions = self.db_packages_identifier_index
         self.packages = {}
@@ -632,6 +647,7 @@ class ModuleRegistry(DBRegistry):
         # self.descriptors[(desc.package, desc.name, desc.namespace)] = desc
         self.descriptors_by_id[desc.id] = desc
         package.add_descriptor(desc)
+        self.clear_compatibility_cache()
     def delete_descriptor(self, desc, package=None):
         if package is None:
             try:
@@ -643,8 +659,10 @@ class ModuleRegistry(DBRegistry):
         # del self.descriptors[(desc.package, desc.name, desc.namespace)]
         del self.descriptors_by_id[desc.id]
         package.delete_descriptor(desc)
+        self.clear_compatibility_cache()
     def add_package(self, package):
         DBRegistry.db_add_package(self, package)
+        self.clear_compatibility_cache()
         for key in chain(package.old_identifiers, [package.identifier]):
             if key in self.packages:
                 old_pkg = self.packages[key]
@@ -688,6 +706,16 @@ class ModuleRegistry(DBRegistry):
     ##########################################################################
     # Per-module registry functions
 
+    def _load_deferred_package(self, identifier):
+        """Asks the package manager to load a package it deferred.
+
+        Returns True if the identifier is now registered.
+        """
+        return (self.package_loader is not None and
+                identifier not in self.packages and
+                self.package_loader(identifier) and
+                identifier in self.packages)
+
     def get_package_by_name(self, identifier, package_version=''):
         package_version = package_version or ''
         package_version_key = (identifier, package_version)
@@ -699,6 +727,8 @@ class ModuleRegistry(DBRegistry):
             else:
                 return self.package_versions[package_version_key]
         except KeyError:
+            if self._load_deferred_package(identifier):
+                return self.get_package_by_name(identifier, package_version)
             if identifier not in self.packages:
                 raise MissingPackage(identifier)
             elif package_version and \
@@ -733,6 +763,11 @@ class ModuleRegistry(DBRegistry):
                 descriptor = \
                     package.descriptor_versions[descriptor_version_key]
         except KeyError:
+            if self._load_deferred_package(identifier):
+                return self.has_descriptor_with_name(identifier, name,
+                                                     namespace,
+                                                     package_version,
+                                                     module_version)
             return False
         return True
     has_module = has_descriptor_with_name
@@ -759,7 +794,9 @@ class ModuleRegistry(DBRegistry):
         try:
             package = self.packages[identifier]
         except KeyError:
-            raise MissingPackage(identifier)
+            if not self._load_deferred_package(identifier):
+                raise MissingPackage(identifier)
+            package = self.packages[identifier]
         if package_version:
             try:
                 package = self.package_versions[(identifier, package_version)]
@@ -938,10 +975,8 @@ class ModuleRegistry(DBRegistry):
                                       )
         self.add_descriptor(descriptor, package)
 
-        # invalidate the map of converters
         if issubclass(module,
                 vistrails.core.modules.vistrails_module.Converter):
-            self._conversions = dict()
             self._converters.add(descriptor)
 
         if module is not None:
@@ -1502,6 +1537,7 @@ class ModuleRegistry(DBRegistry):
             raise InvalidPortSpec(descriptor, spec.name, spec.type, e)
 
         descriptor.add_port_spec(spec)
+        self._upgrade_sigstrings = {}
         if spec.type == 'input':
             self.signals.emit_new_input_port(descriptor.identifier,
                                              descriptor.name, spec.name, spec)
@@ -1630,6 +1666,11 @@ class ModuleRegistry(DBRegistry):
         debug.log("Initializing " + package.codepath)
         if (package.identifier, package.version) not in self.package_versions:
             self.add_package(package)
+        # Deferred packages get initialized while another package is, if it
+        # uses them
+        outer_package = self._current_package
+        if outer_package is not None and outer_package.initialized():
+            outer_package = None
         self.set_current_package(package)
         try:
             package.initialize()
@@ -1678,13 +1719,15 @@ class ModuleRegistry(DBRegistry):
                         self.auto_add_ports(descriptor.module)
                         added_descriptors.add(descriptor)
         except MissingRequirement:
+            self.set_current_package(outer_package)
             raise
         except Exception, e:
+            self.set_current_package(outer_package)
             raise package.InitializationFailed(package, 
                                                [traceback.format_exc()])
 
         # The package might have decided to rename itself, let's store that
-        self.set_current_package(None)
+        self.set_current_package(outer_package)
         debug.splashMessage("Initializing " + package.codepath + '... done.')
         package._initialized = True 
 
@@ -1694,11 +1737,9 @@ class ModuleRegistry(DBRegistry):
                                                  namespace)
         assert len(descriptor.children) == 0
 
-        # invalidate the map of converters
         converter_desc = self.get_descriptor(
                 vistrails.core.modules.vistrails_module.Converter)
         if self.is_descriptor_subclass(descriptor, converter_desc):
-            self._conversions = dict()
             self._converters.remove(descriptor)
 
         self.signals.emit_deleted_module(descriptor)
@@ -1748,10 +1789,55 @@ class ModuleRegistry(DBRegistry):
     def delete_input_port(self, descriptor, port_name):
         """ Just remove a name input port with all of its specs """
         descriptor.delete_input_port(port_name)
+        self._upgrade_sigstrings = {}
 
     def delete_output_port(self, descriptor, port_name):
         """ Just remove a name output port with all of its specs """
         descriptor.delete_output_port(port_name)
+        self._upgrade_sigstrings = {}
+
+    def get_upgrade_sigstrings(self, descriptor, port_name, port_type,
+                               sigstring):
+        """get_upgrade_sigstrings(descriptor: ModuleDescriptor,
+                                  port_name: str, port_type: str,
+                                  sigstring: str) -> (str, str) or None
+
+        Looks up the port a module being upgraded to descriptor would
+        use, and returns the sigstring of that port along with the given
+        sigstring, with old package identifiers replaced by current ones.
+        Returns None if the descriptor has no such port.
+
+        Results are memoized, since the same ports are checked for every
+        version that uses an outdated module. Only this check is shared:
+        the upgrade actions themselves refer to the ids of each version's
+        pipeline and are computed for every version. The cache is cleared
+        when a descriptor, package or port is added or removed, which
+        includes reloading a package.
+        """
+        key = (descriptor, port_name, port_type, sigstring)
+        try:
+            return self._upgrade_sigstrings[key]
+        except KeyError:
+            pass
+        try:
+            spec = self.get_port_spec_from_descriptor(descriptor, port_name,
+                                                      port_type)
+        except MissingPort:
+            result = None
+        else:
+            spec_tuples = vistrails.core.modules.utils.parse_port_spec_string(
+                sigstring, get_vistrails_basic_pkg_id())
+            for i in xrange(len(spec_tuples)):
+                spec_tuple = spec_tuples[i]
+                port_pkg = self.get_package_by_name(spec_tuple[0])
+                if port_pkg.identifier != spec_tuple[0]:
+                    # we have an old identifier
+                    spec_tuples[i] = (port_pkg.identifier,) + spec_tuple[1:]
+            result = (spec.sigstring,
+                      vistrails.core.modules.utils.create_port_spec_string(
+                          spec_tuples))
+        self._upgrade_sigstrings[key] = result
+        return result
 
     def source_ports_from_descriptor(self, descriptor, sorted=True):
         ports = [p[1] for p in self.module_ports('output', descriptor)]
@@ -1941,18 +2027,22 @@ class ModuleRegistry(DBRegistry):
         #    # List is handled as Variant with depth 1
         #    return True
 
-        if (len(sub_descs) == len(super_descs) and
-                self.is_descriptor_list_subclass(sub_descs, super_descs)):
-            return True
-
-        if allow_conversion:
-            converters = self.get_converters(sub_descs, super_descs)
-            if converters:
-                if out_converters is not None:
-                    out_converters.extend(converters)
-                return True
-
-        return False
+        key = (tuple(sub_descs), tuple(super_descs), allow_conversion)
+        try:
+            matched, converters = self._spec_matches[key]
+        except KeyError:
+            matched, converters = False, []
+            if (len(sub_descs) == len(super_descs) and
+                    self.is_descriptor_list_subclass(sub_descs, super_descs)):
+                matched = True
+            elif allow_conversion:
+                converters = self.get_converters(sub_descs, super_descs)
+                matched = bool(converters)
+            self._spec_matches[key] = matched, converters
+
+        if converters and out_converters is not None:
+            out_converters.extend(converters)
+        return matched
 
     def get_module_hierarchy(self, descriptor):
         """get_module_hierarchy(descriptor) -> [klass].
@@ -1972,12 +2062,17 @@ class ModuleRegistry(DBRegistry):
 
     def get_descriptor_subclasses(self, descriptor):
         # need to find all descriptors that are subdescriptors of descriptor
+        try:
+            return list(self._subclasses[descriptor])
+        except KeyError:
+            pass
         sub_list = []
         for pkg in self.package_versions.itervalues():
             for d in pkg.descriptor_list:
                 if self.is_descriptor_subclass(d, descriptor):
                     sub_list.append(d)
-        return sub_list
+        self._subclasses[descriptor] = sub_list
+        return list(sub_list)
         
     def get_input_port_spec(self, module, portName):
         """ get_input_port_spec(module: Module, portName: str) ->
@@ -2094,14 +2189,22 @@ class ModuleRegistry(DBRegistry):
             return issubclass(sub.module, super.module)
         
         # otherwise, use descriptors themselves
+        key = (sub, super)
+        try:
+            return self._subclass_checks[key]
+        except KeyError:
+            pass
+        result = False
         if sub == super:
-            return True
-        while sub != self.root_descriptor:
-            sub = sub.base_descriptor
-            if sub == super:
-                return True
-
-        return False
+            result = True
+        else:
+            while sub != self.root_descriptor:
+                sub = sub.base_descriptor
+                if sub == super:
+                    result = True
+                    break
+        self._subclass_checks[key] = result
+        return result
 
     def find_descriptor_subclass(self, d1, d2):
         if self.is_descriptor_subclass(d1, d2):
@@ -2190,3 +2293,81 @@ class TestModuleRegistry(unittest.TestCase):
         t1 = PortSpec(signature=[Float, Integer])
         t2 = PortSpec(signature=[Integer, Float])
         self.assertNotEquals(t1, t2)
+
+    def test_compatibility_cache(self):
+        from vistrails.core.modules.basic_modules import Float, Integer, \
+            String
+        reg = get_module_registry()
+        integer = PortSpec(signature=Integer)
+        float_ = PortSpec(signature=Float)
+        string = PortSpec(signature=String)
+        self.assertTrue(reg.are_specs_matched(integer, float_))
+        self.assertFalse(reg.are_specs_matched(string, float_))
+        self.assertEqual(
+                reg._spec_matches[(tuple(string.descriptors()),
+                                   tuple(float_.descriptors()),
+                                   False)],
+                (False, []))
+
+        # Adding or removing a module invalidates the cache
+        class TestCacheFloat(Float):
+            pass
+        basic_pkg = reg.get_package_by_name(get_vistrails_basic_pkg_id())
+        reg.add_module(TestCacheFloat, package=basic_pkg.identifier,
+                       package_version=basic_pkg.version)
+        try:
+            self.assertFalse(reg._spec_matches)
+            sub = PortSpec(signature=TestCacheFloat)
+            self.assertTrue(reg.are_specs_matched(sub, float_))
+            self.assertFalse(reg.are_specs_matched(float_, sub))
+            float_desc = reg.get_descriptor(Float)
+            self.assertIn(reg.get_descriptor(TestCacheFloat),
+                          reg.get_descriptor_subclasses(float_desc))
+        finally:
+            reg.delete_module(basic_pkg.identifier, 'TestCacheFloat')
+        self.assertFalse(reg._spec_matches)
+        self.assertNotIn('TestCacheFloat',
+                         [d.name for d in
+                          reg.get_descriptor_subclasses(float_desc)])
+
+    def test_upgrade_sigstrings_cache(self):
+        from vistrails.core.packagemanager import get_package_manager
+        pm = get_package_manager()
+        reg = get_module_registry()
+        identifier = 'org.vistrails.vistrails.tests.upgrade'
+        basic_pkg = get_vistrails_basic_pkg_id()
+        prefixes = {'upgrades': 'vistrails.tests.resources.'}
+        pm.late_enable_package('upgrades', prefixes)
+        try:
+            desc = reg.get_descriptor_by_name(identifier, 'TestUpgradeA')
+            expected = ('(%s:String)' % basic_pkg,) * 2
+            self.assertEqual(reg.get_upgrade_sigstrings(desc, 'aaa', 'input',
+                                                        '(basic:String)'),
+                             expected)
+            self.assertIsNone(reg.get_upgrade_sigstrings(desc, 'aa', 'input',
+                                                         '(basic:String)'))
+            self.assertEqual(len(reg._upgrade_sigstrings), 2)
+
+            # Reloading the package invalidates the cache
+            pm.late_disable_package('upgrades')
+            self.assertFalse(reg._upgrade_sigstrings)
+            pm.late_enable_package('upgrades', prefixes)
+            self.assertFalse(reg._upgrade_sigstrings)
+            new_desc = reg.get_descriptor_by_name(identifier, 'TestUpgradeA')
+            self.assertIsNot(new_desc, desc)
+            self.assertEqual(reg.get_upgrade_sigstrings(new_desc, 'aaa',
+                                                        'input',
+                                                        '(basic:String)'),
+                             expected)
+
+            # So does changing the ports
+            reg.delete_input_port(new_desc, 'aaa')
+            self.assertFalse(reg._upgrade_sigstrings)
+            self.assertIsNone(reg.get_upgrade_sigstrings(new_desc, 'aaa',
+                                                         'input',
+                                                         '(basic:String)'))
+        finally:
+            try:
+                pm.late_disable_package('upgrades')
+            except MissingPackage:
+                pass
@@ -40,6 +40,7 @@ from base64 import b16encode, b16decode
 import copy
 from itertools import izip, product, chain
 import json
+import sys
 import time
 import traceback
 import warnings
@@ -322,6 +323,13 @@ class Module(object):
         # execution log
         self.annotate_output = False
 
+        # Future for a computation started in the background by launch()
+        self.launched = None
+        # exc_info of an upstream error that happened during launch()
+        self._launch_error = None
+        # whether launch() already reported the update to the logger
+        self._launch_begun = False
+
     def transfer_attrs(self, module):
         if module.cache != 1:
             self.is_cacheable = lambda *args: False
@@ -540,6 +548,76 @@ class Module(object):
                 if isinstance(value, Generator):
                     self.streamed_ports[iport] = value
 
+    def start_compute(self):
+        """start_compute() -> Future or None
+
+        Modules whose computation mostly waits on something external (for
+        instance a subprocess) can override this to start that work in the
+        background and return a Future (see
+        vistrails.core.interpreter.launcher); compute() should then use
+        self.launched to get the result. The interpreter starts all such
+        modules that are ready before waiting on any of them.
+
+        This is only called with the upstream modules updated. Returning
+        None means the module will be computed normally.
+        """
+        return None
+
+    def can_launch(self):
+        """can_launch() -> bool
+        Whether launch() would try to start this module in the background.
+
+        """
+        return (type(self).start_compute is not Module.start_compute and
+                not (self.computed or self.upToDate or self.had_error or
+                     self.was_suspended or self.is_breakpoint or
+                     self.launched is not None or
+                     self._launch_error is not None) and
+                self.list_depth == 0 and
+                ModuleControlParam.WHILE_COND_KEY not in self.control_params and
+                ModuleControlParam.WHILE_MAX_KEY not in self.control_params and
+                not self.useJobCache())
+
+    def launch(self):
+        """launch() -> None
+        Updates the upstream modules and starts computing in the background,
+        if the module supports it (see start_compute()). update() then
+        waits for the result.
+
+        Nothing is raised here: errors from upstream modules are raised
+        again by update(), and errors from start_compute() by
+        self.launched.result() in compute().
+
+        """
+        if not self.can_launch():
+            return
+        self._launch_begun = True
+        try:
+            self.logging.begin_update(self)
+            self.update_upstream()
+        except Exception:
+            self._launch_error = sys.exc_info()
+            return
+        self.set_iterated_ports()
+        self.set_streamed_ports()
+        if self.iterated_ports or self.streamed_ports:
+            return
+        try:
+            self.launched = self.start_compute()
+        except Exception:
+            from vistrails.core.interpreter.launcher import Future
+            self.launched = Future()
+            self.launched.set_exception(sys.exc_info())
+
+    def reset_launch(self):
+        """reset_launch() -> None
+        Clears the state left by launch(), once the execution is over.
+
+        """
+        self.launched = None
+        self._launch_error = None
+        self._launch_begun = False
+
     def update(self):
         """ update() -> None
         Check if the module is up-to-date then update the
@@ -552,8 +630,13 @@ class Module(object):
             raise ModuleWasSuspended(self)
         elif self.computed:
             return
-        self.logging.begin_update(self)
-        if not self.setJobCache():
+        if self._launch_error is not None:
+            # launch() already tried updating the upstream modules
+            exc_info, self._launch_error = self._launch_error, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if not self._launch_begun:
+            self.logging.begin_update(self)
+        if self.launched is None and not self.setJobCache():
             self.update_upstream()
         if self.upToDate:
             if not self.computed:
@@ -1881,3 +1964,73 @@ class TestImplicitLooping(unittest.TestCase):
 
     def test_list_custom(self):
         self.run_vt("test-list-custom.vt")
+
+
+class TestLaunch(unittest.TestCase):
+    class Recorder(object):
+        def __init__(self):
+            self.events = []
+        def __getattr__(self, name):
+            def record(module, *args, **kwargs):
+                self.events.append((name, module.name))
+            return record
+
+    class Source(Module):
+        def compute(self):
+            if self.fail:
+                raise ModuleError(self, "expected")
+            self.set_output('value', 42)
+
+    class Background(Module):
+        def start_compute(self):
+            from vistrails.core.interpreter.launcher import Future
+            future = Future()
+            future.set_result(self.get_input('value') + 1)
+            return future
+
+        def compute(self):
+            self.set_output('value', self.launched.result())
+
+    def make_modules(self, fail=False):
+        from vistrails.core.vistrail.port_spec import PortSpec
+        logging = self.Recorder()
+        source = self.Source()
+        source.name, source.fail = 'source', fail
+        background = self.Background()
+        background.name = 'background'
+        for module in (source, background):
+            module.logging = logging
+        spec = PortSpec(signature=Module)
+        background.set_input_port('value',
+                                  ModuleConnector(source, 'value', spec))
+        return (source, background, logging)
+
+    def test_launch(self):
+        (source, background, logging) = self.make_modules()
+        background.launch()
+        self.assertIsNotNone(background.launched)
+        # The update of the module begins before its upstream's
+        self.assertEqual(logging.events[:2], [('begin_update', 'background'),
+                                              ('begin_update', 'source')])
+        background.update()
+        self.assertEqual(background.get_output('value'), 43)
+        self.assertEqual(
+                [e for e in logging.events if e[1] == 'background'],
+                [('begin_update', 'background'),
+                 ('begin_compute', 'background'),
+                 ('end_update', 'background'),
+                 ('signalSuccess', 'background')])
+        background.reset_launch()
+        self.assertIsNone(background.launched)
+
+    def test_launch_upstream_error(self):
+        (source, background, logging) = self.make_modules(fail=True)
+        background.launch()
+        self.assertIsNone(background.launched)
+        self.assertFalse(background.can_launch())
+        with self.assertRaises(ModuleError):
+            background.update()
+        self.assertEqual(logging.events.count(('begin_update', 'background')),
+                         1)
+        background.reset_launch()
+        self.assertTrue(background.can_launch())
@@ -0,0 +1,231 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Persisted index of the enabled packages.
+
+The index records, for each package codepath, what the package manager needs
+to know about a package to resolve it without importing it: its identifier,
+version, old identifiers and dependencies. Entries are invalidated when the
+package's source files change, which is checked using the file hash cache so
+that unchanged files are not read again.
+"""
+
+from __future__ import division
+
+import hashlib
+import json
+import os
+
+from vistrails.core import debug
+from vistrails.core.cache.file_hash import get_file_hash_cache
+from vistrails.core.system import vistrails_version
+
+
+def package_path(package):
+    """Returns the source file or directory of a loaded package.
+    """
+    filename = package.module.__file__
+    if os.path.basename(filename).startswith('__init__.'):
+        return os.path.dirname(os.path.abspath(filename))
+    else:
+        return os.path.splitext(os.path.abspath(filename))[0] + '.py'
+
+
+def source_digest(path):
+    """Returns a digest of the Python sources of a package.
+
+    Compiled files are not included, since they are written when the package
+    is first imported.
+    """
+    if os.path.isfile(path):
+        return get_file_hash_cache().file_hash(path)
+    files = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(('.pyc', '.pyo')):
+                files.append(os.path.join(root, filename))
+    digests = get_file_hash_cache().hash_files(files)
+    hasher = hashlib.sha1()
+    for filename in files:
+        hasher.update(os.path.relpath(filename, path).replace(os.sep, '/'))
+        hasher.update('\0')
+        hasher.update(digests[filename])
+    return hasher.hexdigest()
+
+
+class PackageIndex(object):
+    """Summaries of the packages, keyed by codepath.
+
+    If `filename` is None, the index only lives in memory.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = {}
+        self._changed = False
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as fp:
+                    index = json.load(fp)
+                if index['vistrails_version'] == vistrails_version():
+                    self._entries = index['packages']
+            except (IOError, ValueError, KeyError, TypeError), e:
+                debug.warning("Couldn't read package index %s" % filename,
+                              e)
+
+    def lookup(self, codepath, prefix=None):
+        """Returns the entry for a package if it is still valid, else None.
+        """
+        try:
+            entry = self._entries[codepath]
+        except KeyError:
+            return None
+        if prefix is not None and entry['prefix'] != prefix:
+            return None
+        try:
+            if source_digest(entry['path']) != entry['digest']:
+                return None
+        except (IOError, OSError):
+            return None
+        return entry
+
+    def record(self, package, dependencies):
+        """Records a loaded package with the identifiers of its dependencies.
+        """
+        path = package_path(package)
+        entry = {'prefix': package.prefix,
+                 'path': path,
+                 'digest': source_digest(path),
+                 'identifier': package.identifier,
+                 'version': package.version,
+                 'name': package.name,
+                 'old_identifiers': list(package.old_identifiers),
+                 'dependencies': sorted(dependencies)}
+        if self._entries.get(package.codepath) != entry:
+            self._entries[package.codepath] = entry
+            self._changed = True
+
+    def remove(self, codepath):
+        if self._entries.pop(codepath, None) is not None:
+            self._changed = True
+
+    def save(self):
+        """Writes the index if it was changed.
+        """
+        if self.filename is None or not self._changed:
+            return
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as fp:
+                json.dump({'vistrails_version': vistrails_version(),
+                           'packages': self._entries},
+                          fp, indent=1, sort_keys=True)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError), e:
+            debug.warning("Couldn't write package index %s" % self.filename,
+                          e)
+        else:
+            self._changed = False
+
+##############################################################################
+
+import unittest
+
+
+class TestPackageIndex(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_pkgindex_')
+        self.pkgdir = os.path.join(self.directory, 'mypkg')
+        os.mkdir(self.pkgdir)
+        self.write('__init__.py', 'identifier = "org.example.mypkg"\n')
+        self.write('init.py', '_modules = []\n')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.pkgdir, name)
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+        # Old enough for the file hash cache to trust the mtime
+        os.utime(filename, (0, 0))
+
+    def make_package(self):
+        class FakeModule(object):
+            __file__ = os.path.join(self.pkgdir, '__init__.pyc')
+        class FakePackage(object):
+            codepath = 'mypkg'
+            prefix = 'userpackages.'
+            module = FakeModule
+            identifier = 'org.example.mypkg'
+            version = '1.0'
+            name = 'My package'
+            old_identifiers = ['edu.example.mypkg']
+        return FakePackage
+
+    def test_persist(self):
+        filename = os.path.join(self.directory, 'index.json')
+        index = PackageIndex(filename)
+        self.assertIsNone(index.lookup('mypkg'))
+        index.record(self.make_package(), ['org.vistrails.vistrails.basic'])
+        index.save()
+
+        index = PackageIndex(filename)
+        entry = index.lookup('mypkg', 'userpackages.')
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry['identifier'], 'org.example.mypkg')
+        self.assertEqual(entry['old_identifiers'], ['edu.example.mypkg'])
+        self.assertEqual(entry['dependencies'],
+                         ['org.vistrails.vistrails.basic'])
+        self.assertIsNone(index.lookup('mypkg', 'vistrails.packages.'))
+
+    def test_invalidated(self):
+        index = PackageIndex()
+        index.record(self.make_package(), [])
+        # Compiled files don't matter
+        self.write('init.pyc', 'compiled')
+        self.assertIsNotNone(index.lookup('mypkg'))
+        # Sources do
+        self.write('init.py', '_modules = [Module]\n')
+        self.assertIsNone(index.lookup('mypkg'))
+        index.record(self.make_package(), [])
+        self.assertIsNotNone(index.lookup('mypkg'))
+        self.write('helper.py', '')
+        self.assertIsNone(index.lookup('mypkg'))
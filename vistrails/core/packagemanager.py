@@ -54,6 +54,7 @@ import vistrails.core.data_structures.graph
 from vistrails.core.modules.module_registry import MissingPackage, \
     MissingPackageVersion
 from vistrails.core.modules.package import Package
+from vistrails.core.packageindex import PackageIndex
 from vistrails.core.requirements import MissingRequirement
 from vistrails.core.utils import VistrailsInternalError, \
     versions_increasing, VistrailsDeprecation
@@ -163,6 +164,10 @@ class PackageManager(object):
         self._package_versions = {} # identifier: str -> version -> Package
         self._old_identifier_map = {} # old_id: str -> new_id: str
         self._dependency_graph = vistrails.core.data_structures.graph.Graph()
+        # Enabled packages that will only be loaded when first needed
+        self._deferred_packages = {} # codepath: str -> (Package, dict)
+        self._deferred_identifiers = {} # identifier: str -> codepath: str
+        self._package_index = None
         self._default_prefix_dict = \
                                 {'basic_modules': 'vistrails.core.modules.',
                                  'abstraction': 'vistrails.core.modules.'}
@@ -178,6 +183,9 @@ class PackageManager(object):
         self._orig_import = __builtin__.__import__
         __builtin__.__import__ = self._import_override
 
+        # Lookups of unknown packages in the registry load deferred packages
+        self._registry.package_loader = self.require_package
+
         # Compute the list of available packages, _available_packages
         self.build_available_package_names_list()
 
@@ -274,6 +282,9 @@ class PackageManager(object):
         self._package_list = {}
         self._package_versions = {}
         self._old_identifier_map = {}
+        self._deferred_packages = {}
+        self._deferred_identifiers = {}
+        self._registry.package_loader = None
         global _package_manager
         _package_manager = None
 
@@ -339,6 +350,8 @@ class PackageManager(object):
     def has_package(self, identifier, version=None):
         """Returns true if given package identifier is present.
         """
+        if identifier in self._deferred_identifiers:
+            self.require_package(identifier)
 
         # check if it's an old identifier
         identifier = self._old_identifier_map.get(identifier, identifier)
@@ -355,6 +368,9 @@ class PackageManager(object):
         return self.get_available_package(codepath)
 
     def get_package(self, identifier, version=None):
+        if identifier in self._deferred_identifiers:
+            self.require_package(identifier)
+
         # check if it's an old identifier
         identifier = self._old_identifier_map.get(identifier, identifier)
         try:
@@ -564,13 +580,21 @@ class PackageManager(object):
             self.late_enable_package(dep_pkg.codepath, prefix_dictionary)
 
     def initialize_packages(self, prefix_dictionary={},
-                            report_missing_dependencies=True):
+                            report_missing_dependencies=True, lazy=None):
         """Initializes all installed packages.
 
         :param prefix_dictionary: dictionary from package names to the prefix
         such that prefix + package_name is a valid python import.
         :type prefix_dictionary: dict
+        :param lazy: whether to defer loading the packages recorded in the
+        package index until they are needed; defaults to the
+        deferPackageLoading configuration setting.
         """
+        if lazy is None:
+            lazy = get_vistrails_configuration().check('deferPackageLoading')
+        if lazy:
+            self.defer_packages(prefix_dictionary)
+
         failed = []
         # import the modules
         app = get_vistrails_application()
@@ -693,8 +717,94 @@ class PackageManager(object):
                     app = get_vistrails_application()
                     app.send_notification("package_added", pkg.codepath)
 
+        self.update_package_index()
         self._startup.save_persisted_startup()
 
+    def get_package_index(self):
+        """Returns the PackageIndex, stored in the .vistrails directory.
+        """
+        if self._package_index is None:
+            filename = None
+            dot_vistrails = system.current_dot_vistrails()
+            if dot_vistrails and os.path.isdir(dot_vistrails):
+                filename = os.path.join(dot_vistrails, 'package_index.json')
+            self._package_index = PackageIndex(filename)
+        return self._package_index
+
+    def update_package_index(self):
+        """Records the initialized packages in the package index.
+        """
+        index = self.get_package_index()
+        for codepath, package in self._package_list.iteritems():
+            if (not package.initialized() or
+                    index.lookup(codepath, package.prefix) is not None):
+                continue
+            dependencies = [
+                    dep for dep, edge in
+                    self._dependency_graph.adjacency_list[package.identifier]]
+            try:
+                index.record(package, dependencies)
+            except Exception, e:
+                debug.warning("Couldn't add package <codepath %s> to the "
+                              "package index" % codepath, e)
+                index.remove(codepath)
+        index.save()
+
+    def defer_packages(self, prefix_dictionary={}):
+        """Takes the packages recorded in the index out of the package list.
+
+        They will be loaded by require_package(), when one of their modules
+        is looked up or when they are explicitly requested. If any enabled
+        package is not in the index or changed since it was recorded, nothing
+        is deferred and all the packages get loaded, which updates the index.
+        """
+        index = self.get_package_index()
+        deferred = {}
+        for codepath, package in self._package_list.iteritems():
+            if package.initialized() or codepath in ('basic_modules',
+                                                     'abstraction'):
+                continue
+            prefix = prefix_dictionary.get(codepath)
+            if prefix is None:
+                prefix = self._default_prefix_dict.get(codepath)
+            entry = index.lookup(codepath, prefix)
+            if entry is None:
+                debug.log("Package <codepath %s> is not in the package "
+                          "index, loading all packages" % codepath)
+                return
+            deferred[codepath] = package, entry
+        for codepath, (package, entry) in deferred.iteritems():
+            del self._package_list[codepath]
+            self._deferred_packages[codepath] = package, entry
+            self._deferred_identifiers[entry['identifier']] = codepath
+            for old_id in entry['old_identifiers']:
+                self._deferred_identifiers.setdefault(old_id, codepath)
+
+    def require_package(self, identifier):
+        """Loads a deferred package and its dependencies.
+
+        Returns True if a package was loaded.
+        """
+        codepath = self._deferred_identifiers.get(identifier)
+        if codepath is None:
+            return False
+        package, entry = self._deferred_packages.pop(codepath)
+        for key in [key for key, value in
+                    self._deferred_identifiers.iteritems()
+                    if value == codepath]:
+            del self._deferred_identifiers[key]
+
+        for dep in entry['dependencies']:
+            self.require_package(dep)
+        debug.log("Loading deferred package <codepath %s>" % codepath)
+        try:
+            self.late_enable_package(codepath, {codepath: entry['prefix']})
+        except Exception, e:
+            debug.critical("Deferred package <codepath %s> failed to load" %
+                           codepath, e)
+            return False
+        return True
+
     def add_menu_items(self, pkg):
         """Emit the appropriate signal if the package has menu items.
 
@@ -989,3 +1099,41 @@ class TestImports(unittest.TestCase):
                     'vistrails.tests.resources.import_targets.test5',
                     'vistrails.tests.resources.import_targets.test6']:
             self.assertIn(dep, deps)
+
+
+class TestDeferredPackages(unittest.TestCase):
+    def test_load_on_lookup(self):
+        from vistrails.core.modules.module_registry import get_module_registry
+
+        pm = get_package_manager()
+        registry = get_module_registry()
+        identifier = 'org.vistrails.test.upgrades_layout'
+        codepath = 'test_upgrades_layout'
+        prefix = 'vistrails.tests.resources.'
+        if pm.has_package(identifier):
+            self.skipTest("test package is already enabled")
+
+        old_index = pm._package_index
+        pm._package_index = PackageIndex()
+        try:
+            pm.late_enable_package(codepath, {codepath: prefix})
+            pm.update_package_index()
+            self.assertIsNotNone(pm.get_package_index().lookup(codepath,
+                                                               prefix))
+            pm.late_disable_package(codepath)
+
+            # Enabled again, but deferred since it is in the index
+            pm.add_package(codepath, prefix=prefix)
+            pm.defer_packages()
+            self.assertNotIn(codepath, pm._package_list)
+            self.assertNotIn(identifier, registry.packages)
+
+            # Looking up one of its modules loads it
+            descriptor = registry.get_descriptor_by_name(identifier, 'Mod')
+            self.assertEqual(descriptor.identifier, identifier)
+            self.assertIn(codepath, pm._package_list)
+            self.assertFalse(pm._deferred_identifiers)
+        finally:
+            pm._package_index = old_index
+            if pm.has_package(identifier):
+                pm.late_disable_package(codepath)
@@ -39,9 +39,13 @@ This module handles Parameter Exploration in VisTrails
 from __future__ import division
 
 from vistrails.core import debug
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 import copy
+import itertools
+import multiprocessing
+import os
 
 import unittest
 
@@ -209,22 +213,37 @@ class ActionBasedParameterExploration(object):
         """
         results = []
         resultActions = []
-        
+        for pipeline, performedActions in self.iter_explore(pipeline, actions,
+                                                            pre_actions):
+            results.append(pipeline)
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def iter_explore(self, pipeline, actions, pre_actions=[]):
+        """ iter_explore(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set]) -> iterator
+        Same as explore() but yields the (pipeline, actions) tuples one
+        at a time, in the same order. Only one partially-explored pipeline
+        per dimension is kept alive, so large explorations don't need all
+        the pipelines in memory at once.
+
+        """
         def exploreDimension(pipeline, performedActions, dim):
             """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
+                                 dim: int) -> iterator
             Start applying actions to the pipeline at dimension
             dim. 'pipeline' will not be modified in the function
             
             """
             if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
+                yield (pipeline, performedActions)
                 return
             currentActions = actions[dim]
             if len(currentActions)==0:
                 # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
+                for result in exploreDimension(pipeline, performedActions,
+                                               dim-1):
+                    yield result
                 return
             for actionSet in currentActions:
                 currentPipeline = copy.copy(pipeline)
@@ -232,15 +251,16 @@ class ActionBasedParameterExploration(object):
                 for action in actionSet:
                     currentPipeline.perform_action(action)
                     currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
+                for result in exploreDimension(currentPipeline,
+                                               currentPeformedActions, dim-1):
+                    yield result
         
         # perform pre_actions
         currentPipeline = copy.copy(pipeline)
         for action in pre_actions:
             currentPipeline.perform_action(action)
         
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+        return exploreDimension(currentPipeline, pre_actions, len(actions)-1)
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -262,6 +282,317 @@ def _pipelinePositions(sheetCount, rowCount, colCount,
         pipelinePositions.append((row, col, sheet))
     return pipelinePositions
 
+class ExplorationCell(object):
+    """
+    ExplorationCell is one combination of parameters of an exploration:
+    its index in the exploration, its (row, col, sheet) position, the
+    modified pipeline and the actions leading to it
+
+    """
+    def __init__(self, index, position, pipeline, actions):
+        self.index = index
+        self.position = position
+        self.pipeline = pipeline
+        self.actions = actions
+
+class ExplorationCellResult(object):
+    """
+    ExplorationCellResult is what the execution of an ExplorationCell
+    returned. errors and suspended map module ids to messages; if the
+    cell couldn't be executed at all, the message is under the None key.
+    result is the interpreter's result if the cell was executed in this
+    process, None if it was executed by a worker process
+
+    """
+    def __init__(self, index, position, errors, executed, suspended,
+                 result=None):
+        self.index = index
+        self.position = position
+        self.errors = errors
+        self.executed = executed
+        self.suspended = suspended
+        self.result = result
+
+    @staticmethod
+    def from_result(cell, result, keep_result=True):
+        def message(error):
+            return unicode(getattr(error, 'msg', None) or error)
+        return ExplorationCellResult(
+                cell.index, cell.position,
+                dict((m_id, message(e))
+                     for m_id, e in result.errors.iteritems()),
+                sorted(result.executed),
+                dict((m_id, message(e))
+                     for m_id, e in result.suspended.iteritems()),
+                result if keep_result else None)
+
+# Executor and interpreter arguments, set in the parent process before the
+# worker processes are forked
+_worker_state = None
+
+def _execute_cells_in_worker(indexes):
+    """ _execute_cells_in_worker(indexes: [int]) -> [ExplorationCellResult]
+    Builds and executes a chunk of cells in a worker process
+
+    """
+    from vistrails.core.interpreter.default import get_default_interpreter
+    executor, make_kwargs = _worker_state
+    interpreter = get_default_interpreter()
+    results = []
+    for index in indexes:
+        try:
+            cell = executor.cell(index)
+            result = interpreter.execute(cell.pipeline, **make_kwargs(cell))
+        except Exception, e:
+            results.append(ExplorationCellResult(
+                    index, executor.position(index),
+                    {None: debug.format_exception(e)}, [], {}))
+        else:
+            results.append(ExplorationCellResult.from_result(cell, result,
+                                                             False))
+    return results
+
+class ExplorationPlan(object):
+    """
+    ExplorationPlan finds which modules of the pipeline each dimension of
+    an exploration affects, by comparing the subpipeline signatures of
+    cells along that dimension. Modules that no dimension affects are the
+    invariant upstream part of the exploration: they only need to run
+    once per sweep.
+
+    It then orders the cells so that the dimensions affecting the fewest
+    modules vary fastest, i.e. cells sharing the same upstream results
+    follow each other.
+
+    """
+    def __init__(self, executor):
+        """ ExplorationPlan(executor: ParameterExplorationExecutor)
+        Builds one cell per step of each dimension to compare them
+
+        """
+        self.sizes = [max(1, len(a)) for a in executor.actions]
+        self.cell_count = executor.cell_count
+        base = self._signatures(executor.cell(0).pipeline)
+        self.varying = []
+        stride = 1
+        for size in self.sizes:
+            varying = set()
+            for step in xrange(1, size):
+                other = self._signatures(
+                        executor.cell(step * stride).pipeline)
+                varying.update(m_id for m_id, sig in base.iteritems()
+                               if other.get(m_id) != sig)
+            self.varying.append(varying)
+            stride *= size
+        self.invariant = set(base)
+        for varying in self.varying:
+            self.invariant -= varying
+        # from the fastest-varying dimension to the slowest one
+        self.dimension_order = sorted(xrange(len(self.sizes)),
+                                      key=lambda d: (len(self.varying[d]), d))
+
+    @staticmethod
+    def _signatures(pipeline):
+        pipeline.refresh_signatures()
+        return dict((m_id, pipeline.subpipeline_signature(m_id))
+                    for m_id in pipeline.modules)
+
+    def order(self):
+        """ order() -> iterator of int
+        Yields the index of every cell, in execution order
+
+        """
+        strides = []
+        stride = 1
+        for size in self.sizes:
+            strides.append(stride)
+            stride *= size
+        slowest_first = self.dimension_order[::-1]
+        for steps in itertools.product(*[xrange(self.sizes[d])
+                                         for d in slowest_first]):
+            yield sum(step * strides[d]
+                      for step, d in itertools.izip(steps, slowest_first))
+
+    def chunks(self, processes):
+        """ chunks(processes: int) -> list of [int]
+        Splits the cells in at least 'processes' chunks, made of whole
+        fast-varying dimensions when possible, so that a worker computes
+        each upstream variant only once
+
+        """
+        chunk_size = 1
+        for d in self.dimension_order:
+            if self.cell_count // (chunk_size * self.sizes[d]) < processes:
+                break
+            chunk_size *= self.sizes[d]
+        chunks = []
+        chunk = []
+        for index in self.order():
+            chunk.append(index)
+            if len(chunk) == chunk_size:
+                chunks.append(chunk)
+                chunk = []
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+class ParameterExplorationExecutor(object):
+    """
+    ParameterExplorationExecutor runs all the cells of an action-based
+    parameter exploration, without depending on the GUI.
+
+    The cells are generated lazily, either in order by cells() or directly
+    by cell(index), and can be executed on a pool of worker processes.
+
+    """
+    def __init__(self, pipeline, actions, pre_actions=[]):
+        """ ParameterExplorationExecutor(pipeline: Pipeline,
+                                         actions: [action set],
+                                         pre_actions: [action set])
+        actions and pre_actions are the same as for
+        ActionBasedParameterExploration.explore()
+
+        """
+        self.pipeline = pipeline
+        self.actions = actions
+        self.pre_actions = pre_actions
+        self.dims = [max(1, len(a)) for a in actions]
+        while len(self.dims) < 3:
+            self.dims.append(1)
+        self.cell_count = 1
+        for d in self.dims:
+            self.cell_count *= d
+        self._base_pipeline = None
+
+    def position(self, index):
+        """ position(index: int) -> (row, col, sheet)
+        Same as _pipelinePositions() for a single cell
+
+        """
+        col = index % self.dims[0]
+        row = (index // self.dims[0]) % self.dims[1]
+        sheet = (index // (self.dims[0] * self.dims[1])) % self.dims[2]
+        return (row, col, sheet)
+
+    def cells(self):
+        """ cells() -> iterator of ExplorationCell
+        Generates all the cells in order
+
+        """
+        explorer = ActionBasedParameterExploration()
+        cells = explorer.iter_explore(self.pipeline, self.actions,
+                                      self.pre_actions)
+        for index, (pipeline, actions) in enumerate(cells):
+            yield ExplorationCell(index, self.position(index),
+                                  pipeline, actions)
+
+    def cell(self, index):
+        """ cell(index: int) -> ExplorationCell
+        Builds a single cell, without generating the ones before it
+
+        """
+        if self._base_pipeline is None:
+            pipeline = copy.copy(self.pipeline)
+            for action in self.pre_actions:
+                pipeline.perform_action(action)
+            self._base_pipeline = pipeline
+        steps = []
+        rest = index
+        for dim_actions in self.actions:
+            steps.append(rest % max(1, len(dim_actions)))
+            rest //= max(1, len(dim_actions))
+
+        pipeline = copy.copy(self._base_pipeline)
+        performedActions = list(self.pre_actions)
+        # apply dimensions in the same order as explore()
+        for dim in xrange(len(self.actions) - 1, -1, -1):
+            if self.actions[dim]:
+                for action in self.actions[dim][steps[dim]]:
+                    pipeline.perform_action(action)
+                    performedActions.append(action)
+        return ExplorationCell(index, self.position(index),
+                               pipeline, performedActions)
+
+    def execute(self, make_kwargs=None, processes=None):
+        """ execute(make_kwargs: ExplorationCell -> dict,
+                    processes: int) -> iterator of ExplorationCellResult
+        Executes all the cells, yielding results as cells finish.
+
+        Cells are executed in the order given by plan(): the modules that
+        no dimension affects are computed by the first cell and kept by
+        the interpreter until the end of the sweep, and cells sharing the
+        same upstream results are executed together.
+
+        make_kwargs returns the keyword arguments to pass to the
+        interpreter for a cell. processes is the number of worker
+        processes to use, defaulting to the explorationProcesses setting;
+        0 means the number of processors. With more than one process, the
+        cells run in processes forked from this one and finish in any
+        order; their results don't hold the interpreter's result objects.
+
+        """
+        from vistrails.core.interpreter.default import get_default_interpreter
+
+        if make_kwargs is None:
+            make_kwargs = lambda cell: {}
+        if processes is None:
+            configuration = get_vistrails_configuration()
+            processes = 1
+            if configuration is not None and \
+                    configuration.has('explorationProcesses'):
+                processes = configuration.explorationProcesses
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, self.cell_count)
+        # Workers need to be forked to get the loaded packages
+        if not hasattr(os, 'fork'):
+            processes = 1
+
+        plan = self.plan()
+        chunks = plan.chunks(processes)
+        interpreter = get_default_interpreter()
+
+        # The first cell runs here, computing the invariant modules once;
+        # they are then kept for the whole sweep (and inherited by the
+        # workers)
+        cell = self.cell(chunks[0].pop(0))
+        result = interpreter.execute(cell.pipeline, **make_kwargs(cell))
+        pinned = interpreter.pin_modules(cell.pipeline, plan.invariant)
+        try:
+            yield ExplorationCellResult.from_result(cell, result)
+
+            if processes <= 1:
+                for chunk in chunks:
+                    for index in chunk:
+                        cell = self.cell(index)
+                        result = interpreter.execute(cell.pipeline,
+                                                     **make_kwargs(cell))
+                        yield ExplorationCellResult.from_result(cell, result)
+                return
+
+            global _worker_state
+            _worker_state = (self, make_kwargs)
+            pool = multiprocessing.Pool(processes)
+            try:
+                for cell_results in pool.imap_unordered(
+                        _execute_cells_in_worker,
+                        [chunk for chunk in chunks if chunk]):
+                    for cell_result in cell_results:
+                        yield cell_result
+            finally:
+                pool.terminate()
+                pool.join()
+                _worker_state = None
+        finally:
+            interpreter.unpin_modules(pinned)
+
+    def plan(self):
+        """ plan() -> ExplorationPlan
+        Analyzes which modules each dimension affects
+
+        """
+        return ExplorationPlan(self)
+
 
 ################################################################################
         
@@ -283,5 +614,148 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+class TestParameterExplorationExecutor(unittest.TestCase):
+    """
+    Test the lazy generation and the execution of exploration cells
+
+    """
+    def make_executor(self):
+        from vistrails.core.db.action import create_action
+        from vistrails.core.modules.basic_modules import identifier, version
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        pipeline = Pipeline()
+        actions = []
+        for m_id, values in ((1, ['1', '2', '3']), (2, ['10', '20'])):
+            param = ModuleParam(id=m_id, pos=0, type='Integer', val='0')
+            function = ModuleFunction(id=m_id, pos=0, name='value',
+                                      parameters=[param])
+            pipeline.add_module(Module(id=m_id, name='Integer',
+                                       package=identifier, version=version,
+                                       functions=[function]))
+            dim_actions = []
+            for i, value in enumerate(values):
+                new_param = ModuleParam(id=-10 * m_id - i, pos=0,
+                                        type='Integer', val=value)
+                dim_actions.append((create_action([
+                        ('change', param, new_param,
+                         function.vtType, function.real_id)]),))
+            actions.append(dim_actions)
+        return ParameterExplorationExecutor(pipeline, actions)
+
+    def values(self, pipeline):
+        return tuple(pipeline.modules[m_id].functions[0].params[0].strValue
+                     for m_id in (1, 2))
+
+    def test_cells(self):
+        executor = self.make_executor()
+        self.assertEqual(executor.cell_count, 6)
+        expected = [('1', '10'), ('2', '10'), ('3', '10'),
+                    ('1', '20'), ('2', '20'), ('3', '20')]
+        cells = list(executor.cells())
+        self.assertEqual([self.values(c.pipeline) for c in cells], expected)
+        self.assertEqual([c.position for c in cells],
+                         _pipelinePositions(1, 2, 3, cells))
+        # Random access builds the same cells
+        for i in xrange(6):
+            cell = executor.cell(i)
+            self.assertEqual(self.values(cell.pipeline), expected[i])
+            self.assertEqual(cell.position, cells[i].position)
+        # The original pipeline is untouched
+        self.assertEqual(self.values(executor.pipeline), ('0', '0'))
+
+    def test_execute(self):
+        executor = self.make_executor()
+        for processes in (1, 2):
+            results = list(executor.execute(processes=processes))
+            self.assertEqual(sorted(r.index for r in results), range(6))
+            for r in results:
+                self.assertEqual(r.errors, {})
+                # Unchanged modules might come from the cache
+                self.assertTrue(set(r.executed) <= set([1, 2]))
+            # The first cell always runs in this process
+            self.assertEqual(sum(r.result is not None for r in results),
+                             6 if processes == 1 else 1)
+
+    def make_chain_executor(self):
+        """String(1) -> Concatenate(5) -> Concatenate(3) <- String(2)
+                                                        <- String(4)
+        Dimension 0 changes String 1, dimension 1 changes String 2
+        """
+        from vistrails.core.db.action import create_action
+        from vistrails.core.modules.basic_modules import identifier, version
+        from vistrails.core.vistrail.connection import Connection
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.core.vistrail.port import Port
+
+        pipeline = Pipeline()
+        params = {}
+        for m_id, value in ((1, 'a'), (2, 'x'), (4, 'const')):
+            param = ModuleParam(id=m_id, pos=0, type='String', val=value)
+            function = ModuleFunction(id=m_id, pos=0, name='value',
+                                      parameters=[param])
+            params[m_id] = param, function
+            pipeline.add_module(Module(id=m_id, name='String',
+                                       package=identifier, version=version,
+                                       functions=[function]))
+        for m_id in (3, 5):
+            pipeline.add_module(Module(id=m_id, name='ConcatenateString',
+                                       package=identifier, version=version))
+        sig = '(%s:String)' % identifier
+        for c_id, (src, dst, port) in enumerate([(1, 5, 'str1'),
+                                                 (5, 3, 'str1'),
+                                                 (2, 3, 'str2'),
+                                                 (4, 3, 'str3')]):
+            pipeline.add_connection(Connection(id=c_id, ports=[
+                    Port(id=c_id * 2, type='source', moduleId=src,
+                         name='value', signature=sig),
+                    Port(id=c_id * 2 + 1, type='destination', moduleId=dst,
+                         name=port, signature=sig)]))
+
+        actions = []
+        for m_id, values in ((1, ['a', 'b']), (2, ['x', 'y', 'z'])):
+            param, function = params[m_id]
+            dim_actions = []
+            for i, value in enumerate(values):
+                new_param = ModuleParam(id=-10 * m_id - i, pos=0,
+                                        type='String', val=value)
+                dim_actions.append((create_action([
+                        ('change', param, new_param,
+                         function.vtType, function.real_id)]),))
+            actions.append(dim_actions)
+        return ParameterExplorationExecutor(pipeline, actions)
+
+    def test_plan(self):
+        plan = self.make_chain_executor().plan()
+        self.assertEqual(plan.varying, [set([1, 5, 3]), set([2, 3])])
+        self.assertEqual(plan.invariant, set([4]))
+        # The dimension affecting upstream modules varies slowest
+        self.assertEqual(list(plan.order()), [0, 2, 4, 1, 3, 5])
+        self.assertEqual(plan.chunks(2), [[0, 2, 4], [1, 3, 5]])
+        self.assertEqual(plan.chunks(4), [[0], [2], [4], [1], [3], [5]])
+
+    def test_pinned(self):
+        from vistrails.core.modules.basic_modules import String
+        executor = self.make_chain_executor()
+        values = []
+        orig_compute = String.compute
+        def compute(module):
+            values.append(module.get_input('value'))
+            orig_compute(module)
+        String.compute = compute
+        String.is_cacheable = lambda module: False
+        try:
+            results = list(executor.execute(processes=1))
+        finally:
+            String.compute = orig_compute
+            del String.is_cacheable
+        self.assertEqual([r.index for r in results], [0, 2, 4, 1, 3, 5])
+        self.assertTrue(all(not r.errors for r in results))
+        # The invariant module was kept for the whole sweep
+        self.assertEqual(values.count('const'), 1)
+        self.assertEqual(values.count('a'), 3)
+
 if __name__ == '__main__':
     unittest.main()
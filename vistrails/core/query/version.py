@@ -450,18 +450,34 @@ class NameSearchStmt(RegexEnabledSearchStmt):
         return bool(m)
 
 class ModuleSearchStmt(RegexEnabledSearchStmt):
+    def __init__(self, content, use_regex):
+        RegexEnabledSearchStmt.__init__(self, content, use_regex)
+        self._versions = None
+
+    def matching_versions(self, vistrail):
+        """matching_versions(vistrail: Vistrail) -> set
+        Returns the versions containing a module whose name matches, as
+        given by the vistrail's version index.
+
+        """
+        index = vistrail.get_version_index()
+        if (self._versions is None or self._versions[0] is not index or
+                self._versions[1] != len(index)):
+            terms = [term for term in index.terms('module')
+                     if term[1] is not None and self._content_matches(term[1])]
+            self._versions = (index, len(index),
+                              index.versions_with_any(terms))
+        return self._versions[2]
+
     def match(self, controller, action):
         version = action.timestep
         from vistrails.core.configuration import get_vistrails_configuration
         hide_upgrades = getattr(get_vistrails_configuration(),
                                 'hideUpgrades', True)
         if hide_upgrades:
-            version = controller.create_upgrade(version, delay_update=True)
-        p = controller.get_pipeline(version, do_validate=False)
-        for module in p.modules.itervalues():
-            if self._content_matches(module.name):
-                return True
-        return False
+            # Match on the upgraded version if it has been created already
+            version = controller.vistrail.get_upgrade(version, False)
+        return version in self.matching_versions(controller.vistrail)
     def matchModule(self, v, m):
         return self._content_matches(m.name)
 
@@ -736,6 +752,20 @@ class TestSearch(unittest.TestCase):
         # Test compiling these searches
         SearchCompiler('before')
         SearchCompiler('after')
+    def test25(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        import vistrails.core.system
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/dummy.xml')
+        v = locator.load()
+        controller = VistrailController(v, locator, auto_save=False)
+        stmt = SearchCompiler('module:Float').searchStmt.matchList[0]
+        for version, action in v.actionMap.iteritems():
+            version = v.get_upgrade(version, False)
+            p = v.getPipeline(version)
+            expected = any('Float' in m.name for m in p.modules.itervalues())
+            self.assertEqual(stmt.match(controller, action), expected)
 
 if __name__ == '__main__':
     unittest.main()
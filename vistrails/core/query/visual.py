@@ -41,6 +41,7 @@ from vistrails.core import reportusage
 from vistrails.core.utils import append_to_dict_of_lists
 import copy
 import re
+import unittest
 
 ################################################################################
 
@@ -50,88 +51,102 @@ class VisualQuery(query.Query):
         self.queryPipeline = copy.copy(pipeline)
         self.versions_to_check = versions_to_check
 
-    def heuristicDAGIsomorphism(self,
-                                target, template,
-                                target_ids, template_ids):
-        resultIds = set()
-        while 1:
-            templateNames = set((i, template.modules[i].name)
-                                for i in template_ids)
-            targetNames = {}
-            for i in target_ids:
-                append_to_dict_of_lists(targetNames, target.modules[i].name, i)
-
-            nextTargetIds = set()
-            nextTemplateIds = set()
-
-            for (i, templateName) in templateNames:
-                if templateName not in targetNames:
-                    return (False, resultIds)
-                else:
-                    templateModule = template.modules[i]
-                    matched = [tId
-                               for tId in targetNames[templateName]
-                               if self.matchQueryModule(target.modules[tId],
-                                                        templateModule)]
-                    resultIds.update(matched)
-                    for matchedTargetId in matched:
-                        nextTargetIds.update([moduleId for
-                                              (moduleId, edgeId) in
-                                              target.graph.edges_from(matchedTargetId)])
-                    nextTemplateIds.update([moduleId for
-                                            (moduleId, edgeId) in
-                                            template.graph.edges_from(i)])
-
-            if not len(nextTemplateIds):
-                return (True, resultIds)
-
-            target_ids = nextTargetIds
-            template_ids = nextTemplateIds
+    def match_pipeline(self, pipeline, first_only=False):
+        """ match_pipeline(pipeline: Pipeline, first_only: bool) -> set
+        Returns the ids of the modules of pipeline that are part of a match
+        of the query pipeline, or an empty set if it does not match.
+
+        Every query module must map to a distinct module with the same
+        name and matching functions, and every query connection to a
+        connection between the mapped modules. If first_only is True, the
+        search stops at the first match.
+
+        Rather than enumerating every match, whose number can grow
+        exponentially with the size of the query, this looks for one
+        match containing each candidate module that is not already known
+        to be part of a match.
+
+        """
+        moduleNameIndex = {}
+        for moduleId, module in pipeline.modules.iteritems():
+            append_to_dict_of_lists(moduleNameIndex, module.name, moduleId)
+        candidates = {}
+        for queryId, queryModule in self.queryPipeline.modules.iteritems():
+            if queryModule.name not in moduleNameIndex:
+                return set()
+            candidates[queryId] = moduleNameIndex[queryModule.name]
+        matchedModules = {}
+        def matchModule(queryId, moduleId):
+            try:
+                return matchedModules[(queryId, moduleId)]
+            except KeyError:
+                result = matchedModules[(queryId, moduleId)] = \
+                    self.matchQueryModule(pipeline.modules[moduleId],
+                                          self.queryPipeline.modules[queryId])
+                return result
+        def firstMatch(candidates):
+            for mapping in pipeline.graph.iter_subgraph_matches(
+                    self.queryPipeline.graph, candidates, matchModule):
+                return mapping
+            return None
+
+        mapping = firstMatch(candidates)
+        if mapping is None:
+            return set()
+        matches = set(mapping.itervalues())
+        if first_only:
+            return matches
+        for queryId, moduleIds in candidates.iteritems():
+            for moduleId in moduleIds:
+                if moduleId in matches:
+                    continue
+                pinned = dict(candidates)
+                pinned[queryId] = [moduleId]
+                mapping = firstMatch(pinned)
+                if mapping is not None:
+                    matches.update(mapping.itervalues())
+        return matches
+
+    def required_module_names(self):
+        """required_module_names() -> set
+        Returns the names of the modules a pipeline must contain for the
+        query to match it.
+
+        """
+        return set(module.name
+                   for module in self.queryPipeline.modules.itervalues())
 
     def run(self, controller, name):
         reportusage.record_feature('visualquery', controller)
         result = []
         self.tupleLength = 2
+        # Use the version index to skip versions that miss modules before
+        # materializing their pipelines
+        index = controller.vistrail.get_version_index()
+        candidates = index.versions_with_all(
+            ('module', module_name)
+            for module_name in self.required_module_names())
+        from vistrails.core.configuration import get_vistrails_configuration
+        hide_upgrades = getattr(get_vistrails_configuration(),
+                                'hideUpgrades', True)
+        versions = []
         for version in self.versions_to_check:
-            from vistrails.core.configuration import get_vistrails_configuration
-            hide_upgrades = getattr(get_vistrails_configuration(),
-                                    'hideUpgrades', True)
+            if candidates is not None:
+                indexed_version = version
+                if hide_upgrades:
+                    indexed_version = controller.vistrail.get_upgrade(version,
+                                                                      False)
+                if indexed_version not in candidates:
+                    continue
+            versions.append(version)
+        if hide_upgrades:
+            upgrades = controller.create_upgrades(versions, delay_update=True)
+        for version in versions:
             if hide_upgrades:
-                version = controller.create_upgrade(version, delay_update=True)
+                version = upgrades.get(version, version)
             p = controller.get_pipeline(version, do_validate=False)
 
-            matches = set()
-            queryModuleNameIndex = {}
-            for moduleId, module in p.modules.iteritems():
-                append_to_dict_of_lists(queryModuleNameIndex, module.name, moduleId)
-            for querySourceId in self.queryPipeline.graph.sources():
-                querySourceName = self.queryPipeline.modules[querySourceId].name
-                if not queryModuleNameIndex.has_key(querySourceName):
-                    # need to reset matches here!
-                    matches = set()
-                    continue
-                candidates = queryModuleNameIndex[querySourceName]
-                atLeastOneMatch = False
-                for candidateSourceId in candidates:
-                    querySource = self.queryPipeline.modules[querySourceId]
-                    candidateSource = p.modules[candidateSourceId]
-                    if not self.matchQueryModule(candidateSource,
-                                                 querySource):
-                        continue
-                    (match, targetIds) = self.heuristicDAGIsomorphism \
-                                             (template = self.queryPipeline, 
-                                              target = p,
-                                              template_ids = [querySourceId],
-                                              target_ids = [candidateSourceId])
-                    if match:
-                        atLeastOneMatch = True
-                        matches.update(targetIds)
-                        
-                # We always perform AND operation
-                if not atLeastOneMatch:
-                    matches = set()
-                    break
-                
+            matches = self.match_pipeline(p)
             for m in matches:
                 result.append((version, m))
 
@@ -249,3 +264,73 @@ class VisualQuery(query.Query):
         #             except:
         #                 print 'Invalid query "%s".' % template.strValue
         #                 return False
+
+################################################################################
+
+class TestVisualQuery(unittest.TestCase):
+    def make_pipeline(self, names, edges):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.connection import Connection
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.core.vistrail.port import Port
+        basic_pkg = get_vistrails_basic_pkg_id()
+        modules = [Module(id=i, package=basic_pkg, name=name)
+                   for i, name in enumerate(names)]
+        connections = []
+        for i, (source_id, dest_id) in enumerate(edges):
+            source = Port(id=2 * i, type='source', moduleId=source_id,
+                          moduleName=names[source_id], name='value')
+            destination = Port(id=2 * i + 1, type='destination',
+                               moduleId=dest_id,
+                               moduleName=names[dest_id], name='value')
+            connections.append(Connection(id=i,
+                                          ports=[source, destination]))
+        return Pipeline(modules=modules, connections=connections)
+
+    def test_match_pipeline(self):
+        target = self.make_pipeline(['String', 'Integer', 'Float', 'Integer'],
+                                    [(0, 1), (1, 2), (0, 3)])
+        query = VisualQuery(self.make_pipeline(['String', 'Integer'],
+                                               [(0, 1)]), [])
+        self.assertEqual(query.match_pipeline(target), set([0, 1, 3]))
+        self.assertEqual(len(query.match_pipeline(target, True)), 2)
+        query = VisualQuery(self.make_pipeline(['Integer', 'String'],
+                                               [(0, 1)]), [])
+        self.assertEqual(query.match_pipeline(target), set())
+
+    def test_match_consistent(self):
+        # Both query sources have to feed the same module
+        query = VisualQuery(self.make_pipeline(['String', 'Integer', 'Float'],
+                                               [(0, 2), (1, 2)]), [])
+        target = self.make_pipeline(['String', 'Integer', 'Float', 'Float'],
+                                    [(0, 2), (1, 3)])
+        self.assertEqual(query.match_pipeline(target), set())
+        target = self.make_pipeline(['String', 'Integer', 'Float', 'Float'],
+                                    [(0, 2), (1, 3), (1, 2)])
+        self.assertEqual(query.match_pipeline(target), set([0, 1, 2]))
+
+    def test_match_many_embeddings(self):
+        # The query has 1620000 embeddings into this pipeline, and the
+        # last String module is a candidate that is never part of one
+        names = ['String'] * 10 + ['Integer'] * 10 + ['Float'] * 200 + \
+                ['String']
+        edges = [(i, 10 + j) for i in xrange(10) for j in xrange(10)]
+        target = self.make_pipeline(names, edges)
+        query = VisualQuery(self.make_pipeline(
+                ['String', 'Integer', 'String', 'Integer', 'Float'],
+                [(0, 1), (2, 3)]), [])
+
+        # count the modules the search tries to map
+        steps = []
+        graph = target.graph
+        iter_subgraph_matches = graph.iter_subgraph_matches
+        def counting_matches(pattern, candidates, match_vertex):
+            def match(query_id, module_id):
+                steps.append((query_id, module_id))
+                return match_vertex(query_id, module_id)
+            return iter_subgraph_matches(pattern, candidates, match)
+        graph.iter_subgraph_matches = counting_matches
+
+        self.assertEqual(query.match_pipeline(target), set(xrange(220)))
+        self.assertLess(len(steps), 10 * len(names))
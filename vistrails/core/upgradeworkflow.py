@@ -267,33 +267,21 @@ class UpgradeWorkflowHandler(object):
     @staticmethod
     def check_port_spec(module, port_name, port_type, descriptor=None, 
                         sigstring=None):
-        basic_pkg = get_vistrails_basic_pkg_id()
-
         reg = get_module_registry()
         found = False
-        try:
-            if descriptor is not None:
-                s = reg.get_port_spec_from_descriptor(descriptor, port_name,
-                                                      port_type)
+        if descriptor is not None:
+            sigstrings = reg.get_upgrade_sigstrings(descriptor, port_name,
+                                                    port_type, sigstring)
+            if sigstrings is not None:
                 found = True
-
-                spec_tuples = parse_port_spec_string(sigstring, basic_pkg)
-                for i in xrange(len(spec_tuples)):
-                    spec_tuple = spec_tuples[i]
-                    port_pkg = reg.get_package_by_name(spec_tuple[0])
-                    if port_pkg.identifier != spec_tuple[0]:
-                        # we have an old identifier
-                        spec_tuples[i] = (port_pkg.identifier,) + spec_tuple[1:]
-                sigstring = create_port_spec_string(spec_tuples)
+                (spec_sigstring, sigstring) = sigstrings
                 # sigstring = expand_port_spec_string(sigstring, basic_pkg)
-                if s.sigstring != sigstring:
+                if spec_sigstring != sigstring:
                     msg = ('%s port "%s" of module "%s" exists, but '
                            'signatures differ "%s" != "%s"') % \
                            (port_type.capitalize(), port_name, module.name,
-                            s.sigstring, sigstring)
+                            spec_sigstring, sigstring)
                     raise UpgradeWorkflowError(msg, module, port_name, port_type)
-        except MissingPort:
-            pass
 
         if not found and \
                 not module.has_portSpec_with_name((port_name, port_type)):
@@ -1023,6 +1011,51 @@ class TestUpgradePackageRemap(unittest.TestCase):
             app.temp_configuration.upgrades = default_upgrades
             app.temp_configuration.upgradeDelay = default_upgrade_delay
 
+    def test_create_upgrades(self):
+        from vistrails.core.application import get_vistrails_application
+
+        app = get_vistrails_application()
+        default_upgrades = app.temp_configuration.upgrades
+        default_upgrade_delay = app.temp_configuration.upgradeDelay
+        app.temp_configuration.upgrades = True
+        app.temp_configuration.upgradeDelay = False
+
+        created_vistrail = False
+        pm = get_package_manager()
+        try:
+            pm.late_enable_package('upgrades',
+                                   {'upgrades':
+                                    'vistrails.tests.resources.'})
+            app.new_vistrail()
+            created_vistrail = True
+            c = app.get_controller()
+            self.create_workflow(c)
+            versions = c.vistrail.actionMap.keys()
+            c.recompute_terse_graph()
+
+            upgrades = c.create_upgrades(versions)
+            self.assertEqual(sorted(upgrades), sorted(versions))
+            for version, upgrade in upgrades.iteritems():
+                self.assertNotEqual(upgrade, version)
+                self.assertEqual(c.vistrail.get_upgrade(version), upgrade)
+                pipeline = c.get_pipeline(upgrade)
+                for m in pipeline.modules.itervalues():
+                    self.assertEqual(m.version, '1.0')
+
+            # existing upgrades are reused
+            num_actions = len(c.vistrail.actionMap)
+            self.assertEqual(c.create_upgrades(versions), upgrades)
+            self.assertEqual(len(c.vistrail.actionMap), num_actions)
+        finally:
+            if created_vistrail:
+                app.close_vistrail()
+            try:
+                pm.late_disable_package('upgrades')
+            except MissingPackage:
+                pass
+            app.temp_configuration.upgrades = default_upgrades
+            app.temp_configuration.upgradeDelay = default_upgrade_delay
+
     def test_looping_pipeline_fix(self):
         """Chains upgrades and automatic package initialization."""
         # Expected actions are as follow:
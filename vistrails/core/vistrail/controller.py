@@ -50,7 +50,8 @@ import vistrails.core.db.locator
 from vistrails.core import debug
 from vistrails.core.data_structures.graph import Graph
 from vistrails.core.interpreter.default import get_default_interpreter
-from vistrails.core.vistrail.job import JobMonitor
+from vistrails.core.param_explore import ParameterExplorationExecutor
+from vistrails.core.vistrail.job import JobMonitor, get_job_store
 from vistrails.core.layout.workflow_layout import WorkflowLayout, \
     Pipeline as LayoutPipeline, Defaults as LayoutDefaults
 from vistrails.core.log.controller import LogController, DummyLogController
@@ -159,6 +160,8 @@ class VistrailController(object):
         # version switching
         self._cache_pipelines = True
         self.flush_pipeline_cache()
+        # what changed in the last version switch, see get_pipeline_delta
+        self.current_pipeline_delta = None
         self._current_full_graph = None
         self._current_terse_graph = None
         self.show_upgrades = False
@@ -237,6 +240,16 @@ class VistrailController(object):
         
     def get_locator(self):
         return self.locator
+
+    def get_job_store_key(self, locator):
+        """Returns the key of the vistrail's jobs in the job store.
+
+        Untitled vistrails keep their jobs in memory only.
+        """
+        if locator is None or isinstance(
+                locator, vistrails.core.db.locator.UntitledLocator):
+            return None
+        return locator.to_url()
     
     def set_vistrail(self, vistrail, locator, abstractions=None, 
                      thumbnails=None, mashups=None, id_scope=None,
@@ -260,7 +273,9 @@ class VistrailController(object):
             if mashups is not None:
                 self._mashups = mashups
             job_annotation = vistrail.get_annotation('__jobs__')
-            self.jobMonitor = JobMonitor(job_annotation and job_annotation.value)
+            self.jobMonitor = JobMonitor(job_annotation and job_annotation.value,
+                                         get_job_store(),
+                                         self.get_job_store_key(locator))
         else:
             self.jobMonitor = JobMonitor()
 
@@ -2752,6 +2767,56 @@ class VistrailController(object):
                 debug.unexpected_exception(e)
                 raise
 
+    def execute_parameter_exploration(self, pe, processes=None,
+                                      extra_info=None,
+                                      reason='Parameter Exploration'):
+        """ execute_parameter_exploration(pe: ParameterExploration,
+                                          processes: int,
+                                          extra_info: dict) -> iterator
+        Execute a parameter exploration without the GUI, yielding an
+        ExplorationCellResult for each cell as it finishes.
+        The combinations are generated lazily and are run by
+        ParameterExplorationExecutor, on 'processes' worker processes
+        (defaults to the explorationProcesses setting)
+
+        """
+        if pe.action_id != self.current_version:
+            self.change_selected_version(pe.action_id)
+        collected = pe.collectParameterActions(self.current_pipeline)
+        if not self.current_pipeline or not collected or not collected[0]:
+            return
+        actions, pre_actions, vistrail_vars = collected
+
+        executor = ParameterExplorationExecutor(self.current_pipeline,
+                                                actions, pre_actions)
+        pe_log_id = uuid.uuid1()
+        variables = None
+        if self.get_vistrail_variables():
+            # remove vars used in pe
+            variables = dict((v.uuid, v)
+                             for v in self.get_vistrail_variables()
+                             if v.uuid not in vistrail_vars)
+        version = self.current_version
+
+        def make_kwargs(cell):
+            kwargs = {'locator': self.locator,
+                      'current_version': version,
+                      'view': DummyView(),
+                      'logger': self.get_logger(),
+                      'reason': '%s %s %s_%s_%s' % (
+                                ((reason, pe_log_id) + cell.position)),
+                      'actions': cell.actions,
+                      'extra_info': extra_info or {},
+                      }
+            if variables is not None:
+                kwargs['vistrail_variables'] = lambda x: variables.get(x)
+            return kwargs
+
+        for cell_result in executor.execute(make_kwargs, processes):
+            yield cell_result
+        if self.logging_on():
+            self.set_changed(True)
+
     def prune_versions(self, versions):
         """ prune_versions(versions: list of version numbers) -> None
         Prune all versions in 'versions' out of the view
@@ -3719,6 +3784,12 @@ class VistrailController(object):
 
         """
         new_error = None
+        old_version = self.current_version
+        old_pipeline = self.current_pipeline
+        if self._delayed_actions:
+            # the current pipeline is not the one of current_version
+            old_pipeline = None
+        self.current_pipeline_delta = None
         try:
             self.current_pipeline = self.get_pipeline(new_version,
                                                       do_validate=do_validate,
@@ -3738,11 +3809,38 @@ class VistrailController(object):
                 self.current_version = e._version
                 new_error = e
 
+        self.current_pipeline_delta = self.get_pipeline_delta(old_version,
+                                                              old_pipeline)
         if new_version != self.current_version:
             self.invalidate_version_tree(False)
         if new_error is not None:
             raise new_error
 
+    def get_pipeline_delta(self, old_version, old_pipeline):
+        """ get_pipeline_delta(old_version: int, old_pipeline: Pipeline)
+              -> tuple or None
+        Returns (old_version, old_pipeline, new_pipeline, module_ids,
+        connection_ids), where module_ids and connection_ids are the
+        modules and connections that differ between old_pipeline, the
+        pipeline of old_version, and the current pipeline. Views showing
+        old_pipeline only need to update these when switching to the
+        current pipeline. Returns None if the differences are not known.
+
+        """
+        new_pipeline = self.current_pipeline
+        if (old_version < 0 or old_pipeline is None or
+                new_pipeline is None or old_pipeline is new_pipeline or
+                not old_pipeline.is_valid):
+            return None
+        if old_version == self.current_version:
+            return (old_version, old_pipeline, new_pipeline, set(), set())
+        action = self.vistrail.general_action_chain(old_version,
+                                                    self.current_version)
+        changes = new_pipeline.get_action_changes(action, old_pipeline)
+        if changes is None:
+            return None
+        return (old_version, old_pipeline, new_pipeline) + changes
+
     def validate_version(self, version, report_all_errors=False,
                          from_root=False, delay_update=False, use_current=True):
         """ validates a pipeline version and returns the updated version
@@ -3926,7 +4024,7 @@ class VistrailController(object):
         result = False 
         if self.vistrail and (self.changed or self.locator != locator):
             # Save jobs as annotation
-            if self.jobMonitor.workflows:
+            if self.jobMonitor.hasWorkflows():
                 self.vistrail.set_annotation('__jobs__',
                                              self.jobMonitor.serialize())
             else:
@@ -4000,6 +4098,8 @@ class VistrailController(object):
                     self.ensure_abstractions_loaded(new_vistrail, 
                                                     save_bundle.abstractions) 
                     self.set_file_name(locator.name)
+                    self.jobMonitor.moveStore(self.get_job_store_key(locator),
+                                              get_job_store())
                     if old_locator and not export:
                         old_locator.clean_temporaries()
                         old_locator.close()
@@ -4435,6 +4535,59 @@ class VistrailController(object):
                 version = e._version
         return version
 
+    def create_upgrades(self, versions, delay_update=False):
+        """create_upgrades(versions: iterable, delay_update: bool) -> dict
+        Upgrades several versions at once, as create_upgrade does, and
+        returns a dict mapping each version to its upgraded version.
+
+        Versions are processed in version tree order, and the pipelines of
+        the ancestors of the version being processed are kept so that each
+        pipeline is built from its closest ancestor instead of from the
+        root. The version tree is only recomputed once, at the end.
+
+        """
+        versions = set(versions)
+        children = {}
+        for action in self.vistrail.actionMap.itervalues():
+            children.setdefault(action.prevId, []).append(action.id)
+        # preorder number of each version and last number in its subtree
+        first = {}
+        last = {}
+        order = []
+        stack = [(0, False)]
+        while stack:
+            version, done = stack.pop()
+            if done:
+                last[version] = len(first) - 1
+                continue
+            first[version] = len(first)
+            if version in versions:
+                order.append(version)
+            stack.append((version, True))
+            for child in sorted(children.get(version, ()), reverse=True):
+                stack.append((child, False))
+
+        result = {}
+        ancestors = []
+        try:
+            for version in order:
+                while ancestors and last[ancestors[-1]] < first[version]:
+                    self._pipelines.pop(ancestors.pop(), None)
+                if version not in self._pipelines:
+                    pipeline = self.get_pipeline(version, do_validate=False)
+                    # get_pipeline may have cached it already
+                    if version not in self._pipelines:
+                        self._pipelines[version] = pipeline
+                        ancestors.append(version)
+                result[version] = self.create_upgrade(version,
+                                                      delay_update=True)
+        finally:
+            for version in ancestors:
+                self._pipelines.pop(version, None)
+        if not delay_update:
+            self.check_delayed_update()
+        return result
+
 
 import unittest
 
@@ -4570,3 +4723,39 @@ class TestTerseGraph(unittest.TestCase):
             13L: [(14L, (False, False)), (17L, (False, False))],
             4L: [], 6L: [], 10L: [], 14L: [], 17L: [],
         })
+
+
+class TestPipelineDelta(unittest.TestCase):
+    def test_version_switch(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        m1 = controller.add_module(basic_pkg, 'String')
+        m2 = controller.add_module(basic_pkg, 'String')
+        m3 = controller.add_module(basic_pkg, 'Integer')
+        c1 = controller.add_connection(m1.id, 'value', m2.id, 'value')
+        controller.update_function(m1, 'value', ['abc'])
+        v1 = controller.current_version
+        m1 = controller.current_pipeline.modules[m1.id]
+        controller.update_function(m1, 'value', ['def'])
+        v2 = controller.current_version
+
+        old_pipeline = controller.current_pipeline
+        controller.change_selected_version(v1)
+        delta = controller.current_pipeline_delta
+        self.assertEqual(delta[:3], (v2, old_pipeline,
+                                     controller.current_pipeline))
+        self.assertEqual(delta[3:], (set([m1.id]), set()))
+
+        controller.change_selected_version(v2)
+        self.assertEqual(controller.current_pipeline_delta[3:],
+                         (set([m1.id]), set()))
+
+        # going back to before the connection and the functions
+        controller.change_selected_version(v1 - 2)
+        self.assertEqual(controller.current_pipeline_delta[3:],
+                         (set([m1.id]), set([c1.id])))
+        controller.change_selected_version(v1 - 3)
+        self.assertEqual(controller.current_pipeline_delta[3:],
+                         (set([m3.id]), set()))
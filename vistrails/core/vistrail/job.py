@@ -48,7 +48,11 @@ from uuid import uuid1
 
 import datetime
 import getpass
+import hashlib
 import json
+import os
+import sqlite3
+import threading
 import time
 import unittest
 import weakref
@@ -342,21 +346,593 @@ class Job(object):
         return True
 
 
+def handle_is_done(handle):
+    """ handle_is_done(handle: JobHandle) -> bool
+
+        A job is done when it reaches finished or failed state
+        val() is used by stable batchq branch
+    """
+    finished = handle.finished()
+    if hasattr(finished, 'val'):
+        finished = finished.val()
+    if finished:
+        return True
+
+    # FIXME : deprecate this, remove from RemoteQ
+    # finished should just return True here too
+    if hasattr(handle, 'failed'):
+        failed = handle.failed()
+        if hasattr(failed, 'val'):
+            failed = failed.val()
+        if failed:
+            return True
+    return False
+
+
+def handle_batch_key(handle):
+    """ handle_batch_key(handle: JobHandle) -> tuple
+
+        Jobs with the same key can be checked with a single call to their
+        class' finished_many(), e.g. jobs on the same remote host.
+    """
+    host = getattr(handle, 'host', None)
+    try:
+        hash(host)
+    except TypeError:
+        host = id(host)
+    return type(handle), host
+
+
+class PolledJob(object):
+    """A job watched by a JobPoller.
+    """
+    def __init__(self, id, handle, interval):
+        self.id = id
+        self.handle = handle
+        self.interval = interval
+        self.next_check = time.time() + interval
+        self.done = threading.Event()
+
+
+class JobPoller(object):
+    """Checks running jobs from a background thread.
+
+    Each job is checked with its own exponential backoff, starting at
+    `min_interval` seconds and multiplied by `backoff` after each check, up
+    to `max_interval` (the jobCheckInterval setting if not given; 0 disables
+    automatic checks).
+
+    Jobs that are due at the same time are checked in batches: handles are
+    grouped by type and host, and if the handle class has a
+    `finished_many(handles)` classmethod, a group is checked with a single
+    call to it.
+
+    Listeners are called with the job id when a job completes, from the
+    thread that checked it; they are not called while jobs keep running.
+    """
+    def __init__(self, min_interval=5, max_interval=None, backoff=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._jobs = {}
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def get_max_interval(self):
+        if self.max_interval is not None:
+            return self.max_interval
+        conf = get_vistrails_configuration()
+        if conf is None or not conf.has('jobCheckInterval'):
+            return 600
+        return conf.jobCheckInterval
+
+    def add_listener(self, listener):
+        """ add_listener(listener: callable) -> None
+            listener(id) is called when a watched job completes
+        """
+        with self._condition:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._condition:
+            self._listeners.remove(listener)
+
+    def watch(self, id, handle):
+        """ watch(id: str, handle: JobHandle) -> None
+            Starts checking the job in the background
+            Watching an already watched job restarts its backoff
+        """
+        interval = self.min_interval
+        max_interval = self.get_max_interval()
+        if max_interval:
+            interval = min(interval, max_interval)
+        with self._condition:
+            self._jobs[id] = PolledJob(id, handle, interval)
+            self._stopping = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='JobPoller')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+
+    def unwatch(self, id):
+        with self._condition:
+            self._jobs.pop(id, None)
+
+    def watching(self, id):
+        return id in self._jobs
+
+    def is_done(self, id):
+        """ is_done(id: str) -> bool
+            Returns the last known state of a watched job
+        """
+        job = self._jobs.get(id)
+        return job is not None and job.done.is_set()
+
+    def wait(self, id, timeout=None):
+        """ wait(id: str, timeout: float) -> bool
+            Waits until the poller sees the job complete
+        """
+        job = self._jobs.get(id)
+        if job is None:
+            return False
+        # Event.wait() only returns the flag from Python 2.7 on
+        job.done.wait(timeout)
+        return job.done.is_set()
+
+    def wake(self):
+        """ wake() -> None
+            Makes the thread reschedule, e.g. after jobCheckInterval changed
+        """
+        with self._condition:
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def check(self, ids=None):
+        """ check(ids: [str]) -> [str]
+            Checks the given jobs (or all running jobs) now and returns the
+            ones that completed
+        """
+        with self._condition:
+            if ids is None:
+                jobs = [job for job in self._jobs.itervalues()
+                        if not job.done.is_set()]
+            else:
+                jobs = [self._jobs[id] for id in ids
+                        if id in self._jobs and
+                            not self._jobs[id].done.is_set()]
+        return self._check(jobs)
+
+    def poll(self, now=None):
+        """ poll(now: float) -> [str]
+            Checks the jobs that are due and returns the ones that completed
+        """
+        if now is None:
+            now = time.time()
+        with self._condition:
+            jobs = [job for job in self._jobs.itervalues()
+                    if not job.done.is_set() and job.next_check <= now]
+        return self._check(jobs)
+
+    def _check(self, jobs):
+        groups = {}
+        for job in jobs:
+            groups.setdefault(handle_batch_key(job.handle), []).append(job)
+
+        finished = []
+        for (handle_type, host), group in groups.iteritems():
+            try:
+                finished_many = getattr(handle_type, 'finished_many', None)
+                if finished_many is not None and len(group) > 1:
+                    states = finished_many([job.handle for job in group])
+                    states = [s.val() if hasattr(s, 'val') else s
+                              for s in states]
+                else:
+                    states = [handle_is_done(job.handle) for job in group]
+            except Exception, e:
+                debug.warning("Error checking jobs on %s" % (host or
+                                                       handle_type.__name__),
+                              e)
+                states = [False] * len(group)
+            finished.extend(job for job, done in zip(group, states) if done)
+
+        max_interval = self.get_max_interval()
+        now = time.time()
+        with self._condition:
+            for job in jobs:
+                job.interval *= self.backoff
+                if max_interval:
+                    job.interval = min(job.interval, max_interval)
+                job.next_check = now + job.interval
+            finished = [job for job in finished
+                        if self._jobs.get(job.id) is job]
+            for job in finished:
+                job.done.set()
+            listeners = list(self._listeners)
+
+        for job in finished:
+            for listener in listeners:
+                try:
+                    listener(job.id)
+                except Exception, e:
+                    debug.unexpected_exception(e)
+                    debug.warning("Error in job listener", e)
+        return [job.id for job in finished]
+
+    def _next_delay(self):
+        if not self.get_max_interval():
+            return None
+        times = [job.next_check for job in self._jobs.itervalues()
+                 if not job.done.is_set()]
+        if not times:
+            return None
+        return max(0, min(times) - time.time())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    delay = self._next_delay()
+                    if delay == 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopping:
+                    self._thread = None
+                    return
+            self.poll()
+
+
+class JobStore(object):
+    """ Keeps jobs and workflows in an SQLite database.
+
+    Rows are scoped by a key identifying the vistrail (its URL) and are
+    updated one job at a time, so that a state change doesn't rewrite the
+    whole registry. Workflows and jobs are indexed by status and start time,
+    which allows loading only the running ones.
+    If `filename` is None, the store only lives in memory.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # sqlite connections can't be shared with forked processes
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        filename = self.filename
+        try:
+            self._conn = sqlite3.connect(filename or ':memory:',
+                                         check_same_thread=False)
+            self._create_tables()
+        except sqlite3.Error, e:
+            debug.warning("Couldn't open job store %s" % filename, e)
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._create_tables()
+        self._pid = os.getpid()
+        return self._conn
+
+    def _create_tables(self):
+        self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs(
+                    key TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    name TEXT,
+                    start TEXT,
+                    finished INTEGER NOT NULL,
+                    parameters TEXT,
+                    PRIMARY KEY (key, id));
+                CREATE INDEX IF NOT EXISTS jobs_status
+                    ON jobs(key, finished, start);
+                CREATE TABLE IF NOT EXISTS workflows(
+                    key TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    version TEXT,
+                    name TEXT,
+                    user TEXT,
+                    start TEXT,
+                    finished INTEGER NOT NULL,
+                    PRIMARY KEY (key, id));
+                CREATE INDEX IF NOT EXISTS workflows_status
+                    ON workflows(key, finished, start);
+                CREATE TABLE IF NOT EXISTS workflow_jobs(
+                    key TEXT NOT NULL,
+                    workflow TEXT NOT NULL,
+                    job TEXT NOT NULL,
+                    PRIMARY KEY (key, workflow, job));
+                CREATE INDEX IF NOT EXISTS workflow_jobs_job
+                    ON workflow_jobs(key, job);
+                CREATE TABLE IF NOT EXISTS digests(
+                    key TEXT NOT NULL PRIMARY KEY,
+                    digest TEXT);
+                ''')
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def _write(self, statements):
+        with self._lock:
+            conn = self._connect()
+            try:
+                for sql, args in statements:
+                    conn.executemany(sql, args)
+                conn.commit()
+            except sqlite3.Error, e:
+                conn.rollback()
+                debug.warning("Couldn't update job store", e)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    @staticmethod
+    def _job_row(key, job):
+        return (key, job.id, job.name, job.start, int(bool(job.finished)),
+                json.dumps(job.parameters))
+
+    @staticmethod
+    def _workflow_row(key, workflow):
+        return (key, workflow.id, json.dumps(workflow.version), workflow.name,
+                workflow.user, workflow.start, int(workflow.completed()))
+
+    @staticmethod
+    def _make_job(row):
+        id, name, start, finished, parameters = row
+        return Job(id, json.loads(parameters), name, start, bool(finished))
+
+    def _workflow_statements(self, key, workflows, jobs=True):
+        statements = [
+            ('INSERT OR REPLACE INTO workflows VALUES (?, ?, ?, ?, ?, ?, ?)',
+             [self._workflow_row(key, wf) for wf in workflows]),
+            ('INSERT OR IGNORE INTO workflow_jobs VALUES (?, ?, ?)',
+             [(key, wf.id, job_id)
+              for wf in workflows for job_id in wf.jobs])]
+        if jobs:
+            statements.append(
+                ('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                 [self._job_row(key, job)
+                  for wf in workflows for job in wf.jobs.itervalues()]))
+        return statements
+
+    def save_job(self, key, job, workflow=None):
+        """ save_job(key: str, job: Job, workflow: Workflow) -> None
+            Updates a job, and the workflow it was added to
+        """
+        statements = [('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                       [self._job_row(key, job)])]
+        if workflow is not None:
+            statements.extend(self._workflow_statements(key, [workflow],
+                                                        jobs=False))
+        self._write(statements)
+
+    def save_workflow(self, key, workflow):
+        """ save_workflow(key: str, workflow: Workflow) -> None
+            Updates a workflow and all its jobs
+        """
+        self._write(self._workflow_statements(key, [workflow]))
+
+    def delete_job(self, key, id):
+        self._write([('DELETE FROM jobs WHERE key=? AND id=?', [(key, id)]),
+                     ('DELETE FROM workflow_jobs WHERE key=? AND job=?',
+                      [(key, id)])])
+
+    def delete_workflow(self, key, id):
+        """ delete_workflow(key: str, id: str) -> None
+            Deletes a workflow, and the jobs that are only used by it
+        """
+        self._write([
+            ('DELETE FROM workflows WHERE key=? AND id=?', [(key, id)]),
+            ('DELETE FROM workflow_jobs WHERE key=? AND workflow=?',
+             [(key, id)]),
+            ('DELETE FROM jobs WHERE key=? AND id NOT IN '
+             '(SELECT job FROM workflow_jobs WHERE key=?)', [(key, key)])])
+
+    def replace(self, key, jobs, workflows, digest=None):
+        """ replace(key: str, jobs: dict, workflows: dict, digest: str)
+            Replaces everything stored for a vistrail
+        """
+        statements = [
+            ('DELETE FROM %s WHERE key=?' % table, [(key,)])
+            for table in ('jobs', 'workflows', 'workflow_jobs', 'digests')]
+        statements.extend(self._workflow_statements(key,
+                                                    workflows.values(),
+                                                    jobs=False))
+        statements.append(
+            ('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+             [self._job_row(key, job) for job in jobs.itervalues()]))
+        statements.append(('INSERT INTO digests VALUES (?, ?)',
+                           [(key, digest)]))
+        self._write(statements)
+
+    def rename(self, old_key, new_key):
+        """ rename(old_key: str, new_key: str) -> None
+            Moves the jobs of a vistrail that was saved under a new name
+        """
+        self._write(
+            [('DELETE FROM %s WHERE key=?' % table, [(new_key,)])
+             for table in ('jobs', 'workflows', 'workflow_jobs', 'digests')] +
+            [('UPDATE %s SET key=? WHERE key=?' % table, [(new_key, old_key)])
+             for table in ('jobs', 'workflows', 'workflow_jobs', 'digests')])
+
+    def get_digest(self, key):
+        rows = self._query('SELECT digest FROM digests WHERE key=?', (key,))
+        return rows[0][0] if rows else None
+
+    def set_digest(self, key, digest):
+        self._write([('INSERT OR REPLACE INTO digests VALUES (?, ?)',
+                      [(key, digest)])])
+
+    def get_job(self, key, id):
+        """ get_job(key: str, id: str) -> Job
+        """
+        rows = self._query('SELECT id, name, start, finished, parameters '
+                           'FROM jobs WHERE key=? AND id=?', (key, id))
+        return self._make_job(rows[0]) if rows else None
+
+    def find_jobs(self, key, finished=None, since=None):
+        """ find_jobs(key: str, finished: bool, since: str) -> [Job]
+            Lists jobs by status, or started after an ISO date
+        """
+        sql = ('SELECT id, name, start, finished, parameters FROM jobs '
+               'WHERE key=?')
+        args = [key]
+        if finished is not None:
+            sql += ' AND finished=?'
+            args.append(int(bool(finished)))
+        if since is not None:
+            sql += ' AND start>=?'
+            args.append(since)
+        return [self._make_job(row)
+                for row in self._query(sql + ' ORDER BY start', args)]
+
+    def find_workflows(self, key, finished=None, since=None):
+        """ find_workflows(key: str, finished: bool, since: str) -> dict
+            Loads workflows by status, or started after an ISO date, with
+            their jobs
+        """
+        sql = ('SELECT id, version, name, user, start FROM workflows '
+               'WHERE key=?')
+        args = [key]
+        if finished is not None:
+            sql += ' AND finished=?'
+            args.append(int(bool(finished)))
+        if since is not None:
+            sql += ' AND start>=?'
+            args.append(since)
+        workflows = {}
+        for id, version, name, user, start in self._query(sql, args):
+            workflow = Workflow(json.loads(version), name, id, None, start)
+            workflow.user = user
+            workflows[id] = workflow
+        if not workflows:
+            return workflows
+        # fetch the jobs of the selected workflows with a single query
+        sql = sql.replace('SELECT id, version, name, user, start',
+                          'SELECT id', 1)
+        rows = self._query(
+                'SELECT workflow_jobs.workflow, jobs.id, jobs.name, '
+                'jobs.start, jobs.finished, jobs.parameters '
+                'FROM workflow_jobs JOIN jobs '
+                'ON workflow_jobs.key=jobs.key AND workflow_jobs.job=jobs.id '
+                'WHERE workflow_jobs.key=? AND workflow_jobs.workflow IN '
+                '(%s)' % sql,
+                [key] + args)
+        jobs = {}
+        for row in rows:
+            job = jobs.get(row[1])
+            if job is None:
+                job = jobs[row[1]] = self._make_job(row[1:])
+            workflows[row[0]].jobs[job.id] = job
+        return workflows
+
+
+_job_store = None
+
+def get_job_store():
+    """Returns the shared JobStore, stored in the .vistrails directory.
+    """
+    global _job_store
+    if _job_store is None:
+        filename = None
+        try:
+            from vistrails.core.system import current_dot_vistrails
+            dot_vistrails = current_dot_vistrails()
+            if dot_vistrails and os.path.isdir(dot_vistrails):
+                filename = os.path.join(dot_vistrails, 'jobs.sqlite')
+        except Exception:
+            pass
+        _job_store = JobStore(filename)
+    return _job_store
+
+
 class JobMonitor(object):
     """ Keeps a list of running jobs and the current job for a vistrail.
 
     Jobs are added by the interpreter are saved with the vistrail.
     A callback mechanism is used to interact with the associated GUI component.
+    Running jobs are checked in the background by a JobPoller.
+
+    If a JobStore is attached, each change is written to it as it happens
+    and only the running workflows are kept in memory; finished jobs are
+    fetched from the store when they are requested.
     """
 
-    def __init__(self, json_string=None):
+    def __init__(self, json_string=None, store=None, key=None):
         self._current_workflow = None
         self.workflows = {}
         self.jobs = {}
         self.callback = None
-        if json_string is not None:
+        self.store = None
+        self.key = None
+        self.poller = JobPoller()
+        self.poller.add_listener(self.jobFinished)
+        if store is not None and key is not None:
+            self.setStore(store, key, json_string)
+        elif json_string is not None:
             self.unserialize(json_string)
 
+    def setStore(self, store, key, json_string=None):
+        """ setStore(store: JobStore, key: str, json_string: str) -> None
+            Attaches a store and loads the running workflows from it
+
+            json_string is the registry saved with the vistrail; it replaces
+            the stored jobs if the vistrail was last saved from somewhere else
+        """
+        self.store = store
+        self.key = key
+        if isinstance(json_string, unicode):
+            json_string = json_string.encode('utf-8')
+        digest = hashlib.sha1(json_string or '').hexdigest()
+        if store.get_digest(key) != digest:
+            if json_string:
+                self.unserialize(json_string)
+            else:
+                self.jobs, self.workflows = {}, {}
+            store.replace(key, self.jobs, self.workflows, digest)
+            self.workflows = dict((id, wf)
+                                  for id, wf in self.workflows.iteritems()
+                                  if not wf.completed())
+        else:
+            self.workflows = store.find_workflows(key, finished=False)
+        self.jobs = {}
+        for workflow in self.workflows.itervalues():
+            self.jobs.update(workflow.jobs)
+
+    def moveStore(self, key, store=None):
+        """ moveStore(key: str, store: JobStore) -> None
+            Moves the stored jobs when the vistrail is saved under a new name
+            The jobs of an untitled vistrail are added to `store`
+        """
+        if key is None or key == self.key:
+            return
+        if self.store is not None:
+            self.store.rename(self.key, key)
+        elif store is not None:
+            self.store = store
+            store.replace(key, self.jobs, self.workflows)
+        self.key = key
+
+    def hasWorkflows(self):
+        """ hasWorkflows() -> bool
+            Checks if there are workflows, running or finished
+        """
+        if self.workflows:
+            return True
+        return (self.store is not None and
+                bool(self.store.find_workflows(self.key)))
+
     def setCallback(self, callback=None):
         """ setCallback(callback: class) -> None
             Sets a callback when receiving commands
@@ -374,17 +950,30 @@ class JobMonitor(object):
         """
         _dict = {}
 
+        all_jobs = dict(self.jobs)
+        all_workflows = dict(self.workflows)
+        if self.store is not None:
+            for job in self.store.find_jobs(self.key):
+                all_jobs.setdefault(job.id, job)
+            for id, workflow in self.store.find_workflows(
+                                                     self.key).iteritems():
+                all_workflows.setdefault(id, workflow)
+
         jobs = dict()
-        for id, job in self.jobs.items():
+        for id, job in all_jobs.items():
             jobs[id] = job.to_dict()
         _dict['jobs'] = jobs
 
         workflows = dict()
-        for id, workflow in self.workflows.items():
+        for id, workflow in all_workflows.items():
             workflows[id] = workflow.to_dict()
         _dict['workflows'] = workflows
 
-        return json.dumps(_dict)
+        s = json.dumps(_dict)
+        if self.store is not None:
+            # the saved vistrail matches the store
+            self.store.set_digest(self.key, hashlib.sha1(s).hexdigest())
+        return s
 
     def unserialize(self, s):
         """ unserialize(s: str) -> None
@@ -416,6 +1005,8 @@ class JobMonitor(object):
         self.workflows[workflow.id] = workflow
         for id, job in workflow.jobs.iteritems():
             self.jobs[id] = job
+        if self.store is not None:
+            self.store.save_workflow(self.key, workflow)
 
     def getWorkflow(self, id):
         """ getWorkflow(id: str) -> Workflow
@@ -430,6 +1021,10 @@ class JobMonitor(object):
             deletes a workflow
 
         """
+        if id not in self.workflows and self.store is not None:
+            # a finished workflow that was not loaded
+            self.store.delete_workflow(self.key, id)
+            return
         workflow = self.workflows[id]
         del self.workflows[id]
         # delete jobs that only occur in this workflow
@@ -439,7 +1034,10 @@ class JobMonitor(object):
                 if job_id in wf.jobs:
                     delete = False
             if delete:
-                del self.jobs[job_id]
+                self.jobs.pop(job_id, None)
+                self.poller.unwatch(job_id)
+        if self.store is not None:
+            self.store.delete_workflow(self.key, id)
         if self.callback is not None and self.callback() is not None:
             self.callback().deleteWorkflow(id)
 
@@ -447,7 +1045,10 @@ class JobMonitor(object):
         """ deleteJob(id: str, parent_id: str) -> None
             deletes a job from all workflows
         """
-        del self.jobs[id]
+        self.jobs.pop(id, None)
+        self.poller.unwatch(id)
+        if self.store is not None:
+            self.store.delete_job(self.key, id)
         for wf in self.workflows.itervalues():
             if id in wf.jobs:
                 del wf.jobs[id]
@@ -516,6 +1117,8 @@ class JobMonitor(object):
             for job in workflow.jobs.values():
                 if not job.finished and not job.updated:
                     job.finish()
+            if self.store is not None and workflow.id in self.workflows:
+                self.store.save_workflow(self.key, workflow)
             if self.callback is not None and self.callback() is not None:
                 self.callback().finishWorkflow(workflow)
         finally:
@@ -546,6 +1149,8 @@ class JobMonitor(object):
             workflow.jobs[id] = job
             # we add workflows permanently if they have at least one job
             self.workflows[workflow.id] = workflow
+        if self.store is not None:
+            self.store.save_job(self.key, job, workflow)
         if self.callback is not None and self.callback() is not None:
             self.callback().addJob(self.getJob(id))
 
@@ -577,6 +1182,8 @@ class JobMonitor(object):
                 raise ModuleSuspended(module, 'Job is running',
                                       handle=handle)
         job = self.getJob(id)
+        if handle:
+            self.poller.watch(id, handle)
         if self.callback is not None and self.callback() is not None:
             self.callback().checkJob(module, id, handle)
             return
@@ -584,32 +1191,38 @@ class JobMonitor(object):
         conf = get_vistrails_configuration()
         interval = conf.jobCheckInterval
         if interval and not conf.jobAutorun:
-            if handle:
-                # wait for module to complete
+            if handle and not self.isDone(handle):
+                # wait for the poller to see the module complete
                 try:
-                    while not self.isDone(handle):
-                        time.sleep(interval)
+                    while not self.poller.wait(id, interval):
                         print ("Waiting for job: %s,"
                                "press Ctrl+C to suspend") % job.name
                 except KeyboardInterrupt:
                     raise ModuleSuspended(module, 'Interrupted by user, job'
                                           ' is still running', handle=handle)
+            self.poller.unwatch(id)
         else:
             if not handle or not self.isDone(handle):
                 raise ModuleSuspended(module, 'Job is running',
                                       handle=handle)
+            self.poller.unwatch(id)
 
     def getJob(self, id):
         """ getJob(id: str) -> Job
 
         """
-        return self.jobs.get(id, None)
+        job = self.jobs.get(id, None)
+        if job is None and self.store is not None:
+            job = self.store.get_job(self.key, id)
+            if job is not None:
+                self.jobs[id] = job
+        return job
 
     def getCache(self, id):
         """ getCache(id: str) -> Job
             Checks if a completed module exists using its id and returns it
         """
-        job = self.jobs.get(id, None)
+        job = self.getJob(id)
         return job if job and job.finished else None
 
     def hasJob(self, id):
@@ -618,7 +1231,23 @@ class JobMonitor(object):
             Checks if a job exists
 
         """
-        return id in self.jobs
+        return self.getJob(id) is not None
+
+    def findWorkflows(self, finished=None, since=None):
+        """ findWorkflows(finished: bool, since: str) -> dict
+            Queries workflows by status or start date, including the
+            finished ones that are not loaded
+        """
+        if self.store is not None:
+            workflows = self.store.find_workflows(self.key, finished, since)
+            workflows.update((id, wf)
+                             for id, wf in self.workflows.iteritems()
+                             if id in workflows)
+        else:
+            workflows = self.workflows
+        return dict((id, wf) for id, wf in workflows.iteritems()
+                    if (finished is None or wf.completed() == finished) and
+                        (since is None or wf.start >= since))
 
     def updateUrl(self, new, old):
         for workflow in self.workflows.values():
@@ -629,23 +1258,16 @@ class JobMonitor(object):
         """ isDone(self, monitor) -> bool
 
             A job is done when it reaches finished or failed state
-            val() is used by stable batchq branch
         """
-        finished = handle.finished()
-        if hasattr(finished, 'val'):
-            finished = finished.val()
-        if finished:
-            return True
+        return handle_is_done(handle)
 
-        # FIXME : deprecate this, remove from RemoteQ
-        # finished should just return True here too
-        if hasattr(handle, 'failed'):
-            failed = handle.failed()
-            if hasattr(failed, 'val'):
-                failed = failed.val()
-            if failed:
-                return True
-        return False
+    def jobFinished(self, id):
+        """ jobFinished(id: str) -> None
+            Called by the poller when a running job completes
+        """
+        job = self.jobs.get(id)
+        if job is not None and not job.finished:
+            job.ready = True
 
 
 ###############################################################################
@@ -688,3 +1310,184 @@ class TestJob(unittest.TestCase):
         self.assertIn(workflow2.id, jm.workflows)
         self.assertEqual(workflow1, jm.workflows[workflow1.id])
         self.assertEqual(workflow2, jm.workflows[workflow2.id])
+
+
+class TestJobPoller(unittest.TestCase):
+    class Handle(object):
+        def __init__(self, host='localhost'):
+            self.host = host
+            self.done = False
+            self.checks = 0
+
+        def finished(self):
+            self.checks += 1
+            return self.done
+
+    class BatchHandle(Handle):
+        batches = 0
+
+        @classmethod
+        def finished_many(cls, handles):
+            cls.batches += 1
+            return [h.done for h in handles]
+
+    def test_backoff(self):
+        poller = JobPoller(min_interval=1, max_interval=4)
+        poller._run = lambda: None
+        handle = self.Handle()
+        poller.watch('a', handle)
+        job = poller._jobs['a']
+        self.assertEqual(poller.poll(job.next_check - 0.5), [])
+        self.assertEqual(handle.checks, 0)
+        intervals = []
+        for i in xrange(4):
+            poller.poll(job.next_check)
+            intervals.append(job.interval)
+        self.assertEqual(intervals, [2, 4, 4, 4])
+        self.assertEqual(handle.checks, 4)
+
+    def test_notify(self):
+        poller = JobPoller(min_interval=1, max_interval=4)
+        poller._run = lambda: None
+        notified = []
+        poller.add_listener(notified.append)
+        handles = dict((id, self.Handle()) for id in 'ab')
+        for id, handle in handles.iteritems():
+            poller.watch(id, handle)
+        self.assertEqual(poller.check(), [])
+        self.assertEqual(notified, [])
+        handles['b'].done = True
+        self.assertEqual(poller.check(), ['b'])
+        self.assertEqual(notified, ['b'])
+        self.assertTrue(poller.is_done('b'))
+        self.assertTrue(poller.wait('b', 0))
+        self.assertFalse(poller.is_done('a'))
+        # finished jobs are not checked or notified again
+        self.assertEqual(poller.check(), [])
+        self.assertEqual(handles['b'].checks, 2)
+        self.assertEqual(notified, ['b'])
+
+    def test_batch(self):
+        poller = JobPoller(min_interval=1, max_interval=4)
+        poller._run = lambda: None
+        self.BatchHandle.batches = 0
+        handles = [self.BatchHandle('host1'), self.BatchHandle('host1'),
+                   self.BatchHandle('host2')]
+        for i, handle in enumerate(handles):
+            poller.watch(i, handle)
+        handles[0].done = handles[2].done = True
+        self.assertEqual(sorted(poller.check()), [0, 2])
+        # host1 was checked as a batch, host2 had a single job
+        self.assertEqual(self.BatchHandle.batches, 1)
+        self.assertEqual([h.checks for h in handles], [0, 0, 1])
+
+    def test_thread(self):
+        poller = JobPoller(min_interval=0.01, max_interval=0.05)
+        handle = self.Handle()
+        poller.watch('a', handle)
+        self.assertFalse(poller.wait('a', 0.1))
+        self.assertGreater(handle.checks, 0)
+        handle.done = True
+        self.assertTrue(poller.wait('a', 5))
+        poller.stop()
+
+    def test_monitor(self):
+        jm = JobMonitor()
+        jm.poller.max_interval = 0
+        workflow = Workflow(1)
+        jm.startWorkflow(workflow)
+        jm.addJob('job', {})
+        handle = self.Handle()
+        jm.poller.watch('job', handle)
+        jm.poller.check()
+        self.assertFalse(jm.getJob('job').ready)
+        handle.done = True
+        jm.poller.check()
+        self.assertTrue(jm.getJob('job').ready)
+        jm.deleteJob('job')
+        self.assertFalse(jm.poller.watching('job'))
+
+
+class TestJobStore(unittest.TestCase):
+    def make_monitor(self, store, key='file:///test.vt', json_string=None):
+        return JobMonitor(json_string, store, key)
+
+    def run_workflow(self, jm, version, job_ids, finished=False):
+        workflow = Workflow(version)
+        jm.startWorkflow(workflow)
+        for id in job_ids:
+            jm.addJob(id, {'id': id}, finished=finished)
+        jm.finishWorkflow()
+        return workflow
+
+    def test_incremental(self):
+        store = JobStore()
+        jm = self.make_monitor(store)
+        running = self.run_workflow(jm, 1, ['a', 'b'])
+        done = self.run_workflow(jm, 2, ['c'], finished=True)
+
+        # a new monitor only loads the running workflow
+        jm2 = self.make_monitor(store, json_string=jm.serialize())
+        self.assertEqual(set(jm2.workflows), set([running.id]))
+        self.assertEqual(set(jm2.jobs), set(['a', 'b']))
+        # finished jobs are fetched on demand
+        self.assertEqual(jm2.getCache('c').parameters, {'id': 'c'})
+        self.assertIsNone(jm2.getCache('a'))
+        self.assertEqual(set(jm2.findWorkflows(finished=True)),
+                         set([done.id]))
+        self.assertEqual(set(jm2.findWorkflows()), set([running.id, done.id]))
+        self.assertEqual(set(job.id for job in
+                             store.find_jobs(jm2.key, finished=False)),
+                         set(['a', 'b']))
+        self.assertTrue(jm2.hasWorkflows())
+
+        # the serialized registry still contains everything
+        _dict = json.loads(jm2.serialize())
+        self.assertEqual(set(_dict['jobs']), set(['a', 'b', 'c']))
+        self.assertEqual(set(_dict['workflows']), set([running.id, done.id]))
+
+        # deleting a workflow deletes the jobs only it uses
+        jm2.deleteWorkflow(done.id)
+        self.assertIsNone(store.get_job(jm2.key, 'c'))
+        jm2.deleteJob('a')
+        self.assertEqual([job.id for job in store.find_jobs(jm2.key)], ['b'])
+
+    def test_annotation(self):
+        # a registry saved from somewhere else replaces the store's content
+        jm = JobMonitor()
+        workflow = self.run_workflow(jm, 1, ['a'])
+        json_string = jm.serialize()
+
+        store = JobStore()
+        self.run_workflow(self.make_monitor(store), 3, ['x'])
+        jm2 = self.make_monitor(store, json_string=json_string)
+        self.assertEqual(set(jm2.workflows), set([workflow.id]))
+        self.assertIsNone(jm2.getJob('x'))
+        self.assertEqual(jm2.workflows[workflow.id].version, 1)
+
+    def test_unicode_annotation(self):
+        # annotations are read back as unicode and may not be escaped
+        jm = JobMonitor()
+        jm.startWorkflow(Workflow(1))
+        jm.addJob('a', {'name': u'caf\xe9'})
+        jm.finishWorkflow()
+        json_string = json.dumps(json.loads(jm.serialize()),
+                                 ensure_ascii=False)
+        self.assertIsInstance(json_string, unicode)
+
+        store = JobStore()
+        jm2 = self.make_monitor(store, json_string=json_string)
+        self.assertEqual(jm2.getJob('a').parameters, {'name': u'caf\xe9'})
+        # the same annotation doesn't replace the store's content again
+        jm3 = self.make_monitor(store, json_string=json_string)
+        self.assertEqual(set(jm3.workflows), set(jm2.workflows))
+
+    def test_move(self):
+        store = JobStore()
+        jm = JobMonitor()
+        self.run_workflow(jm, 1, ['a'])
+        jm.moveStore('file:///new.vt', store)
+        self.assertEqual(store.get_job('file:///new.vt', 'a').id, 'a')
+        jm.moveStore('file:///other.vt')
+        self.assertIsNone(store.get_job('file:///new.vt', 'a'))
+        self.assertEqual(store.get_job('file:///other.vt', 'a').id, 'a')
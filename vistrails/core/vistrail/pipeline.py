@@ -326,6 +326,54 @@ class Pipeline(DBWorkflow):
         for operation in action.operations:
             self.perform_operation(operation)
 
+    def get_action_changes(self, action, *pipelines):
+        """ get_action_changes(action: Action, *pipelines: Pipeline)
+              -> (set, set) or None
+        Returns the ids of the modules and connections that are added,
+        deleted or modified by the operations of action. The objects
+        referenced by the operations are looked up in this pipeline and
+        the given ones, typically the pipeline action was applied to.
+        Returns None if an operation cannot be traced to a module or a
+        connection.
+
+        """
+        modules = set()
+        connections = set()
+        function_modules = None
+        for op in action.operations:
+            what = op.db_what
+            if op.vtType == 'change':
+                obj_ids = (op.db_oldObjId, op.db_newObjId)
+            else:
+                obj_ids = (op.db_objectId,)
+            if what in ('module', 'abstraction', 'group'):
+                modules.update(obj_ids)
+                continue
+            elif what == 'connection':
+                connections.update(obj_ids)
+                continue
+            parent_type = op.db_parentObjType
+            parent_id = op.db_parentObjId
+            if parent_type in ('module', 'abstraction', 'group'):
+                modules.add(parent_id)
+            elif parent_type == 'connection':
+                connections.add(parent_id)
+            elif parent_type == 'function':
+                if function_modules is None:
+                    # functions do not know their module
+                    function_modules = {}
+                    for pipeline in (self,) + pipelines:
+                        for module in pipeline.modules.itervalues():
+                            for function in module.functions:
+                                function_modules[function.real_id] = \
+                                    module.id
+                if parent_id not in function_modules:
+                    return None
+                modules.add(function_modules[parent_id])
+            elif parent_type is not None and parent_type != 'workflow':
+                return None
+        return (modules, connections)
+
     def perform_operation_chain(self, opChain):
         for op in opChain:
             self.perform_operation(op)
@@ -1593,6 +1641,21 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(p1.module_signature(3),
                              p2.module_signature(3))
 
+    def test_action_changes(self):
+        from vistrails.core.db.io import create_action
+        id_scope = IdScope()
+        p = self.create_default_pipeline(id_scope)
+        old_param = p.modules[0].functions[0].params[0]
+        new_param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                                type='String', val='-')
+        action = create_action([('change', old_param, new_param, 'function',
+                                 p.modules[0].functions[0].real_id),
+                                ('delete', p.connections[1])])
+        self.assertEqual(p.get_action_changes(action), (set([0]), set([1])))
+        action = create_action([('change', old_param, new_param, 'function',
+                                 -1)])
+        self.assertIsNone(p.get_action_changes(action))
+
     def test_find_method(self):
         p1 = Pipeline()
         p1_functions = [ModuleFunction(name='i1',
@@ -0,0 +1,354 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Inverted index from workflow contents to the versions of a vistrail.
+
+The index maps terms to the set of versions whose pipeline contains them,
+without materializing any pipeline. Terms are tuples:
+
+  ('module', name)
+  ('descriptor', package, name, namespace)
+  ('parameter', value)
+  ('annotation', key, value)
+
+Only the versions where a term appears or disappears are stored, so a
+term that is added once near the root costs a single entry no matter how
+many versions descend from it.
+
+"""
+from __future__ import division
+
+from vistrails.db.services.action_chain import getActionChain
+
+import unittest
+
+################################################################################
+
+def operation_terms(what, data):
+    """operation_terms(what: str, data: DBObject) -> tuple
+    Returns the index terms contributed by the object added by an
+    operation.
+
+    """
+    if data is None:
+        return ()
+    if what == 'module' or what == 'abstraction':
+        return (('module', data.db_name),
+                ('descriptor', data.db_package, data.db_name,
+                 data.db_namespace))
+    elif what == 'group':
+        # Groups always show up as 'Group' in a pipeline
+        return (('module', 'Group'),
+                ('descriptor', data.db_package, 'Group', data.db_namespace))
+    elif what == 'parameter':
+        return (('parameter', data.db_val),)
+    elif what == 'annotation':
+        return (('annotation', data.db_key, data.db_value),)
+    return ()
+
+
+class VersionIndex(object):
+    """Inverted index over the versions of a vistrail.
+
+    The index is built by replaying the operations of every action along
+    a single traversal of the version tree, and is kept up to date by
+    update(), which only replays the actions added since the last call.
+
+    """
+
+    def __init__(self, vistrail):
+        self.vistrail = vistrail
+        self.clear()
+
+    def clear(self):
+        self._children = {0: []}
+        self._postings = {}
+        self._state = None
+
+    def __len__(self):
+        """Number of indexed versions, including the root."""
+        return len(self._children)
+
+    def __contains__(self, version):
+        return version in self._children
+
+    def apply_action(self, action, objects, counts, undo=None):
+        """apply_action(action, objects, counts, undo) -> set
+        Replays the operations of an action on a running state and
+        returns the terms whose presence changed.
+
+        objects maps (what, id) to the terms of that object and counts
+        maps each term to the number of objects carrying it. If undo is a
+        list, the previous value of each modified key is appended to it.
+
+        """
+        touched = {}
+        def remove(key):
+            terms = objects.pop(key, None)
+            if undo is not None:
+                undo.append((key, terms))
+            for term in terms or ():
+                if term not in touched:
+                    touched[term] = counts.get(term, 0) > 0
+                n = counts[term] - 1
+                if n:
+                    counts[term] = n
+                else:
+                    del counts[term]
+        def add(key, data):
+            if undo is not None:
+                undo.append((key, objects.get(key)))
+            terms = operation_terms(key[0], data)
+            objects[key] = terms
+            for term in terms:
+                if term not in touched:
+                    touched[term] = counts.get(term, 0) > 0
+                counts[term] = counts.get(term, 0) + 1
+
+        for op in action.db_operations:
+            if op.vtType == 'add':
+                add((op.db_what, op.db_objectId), op.db_data)
+            elif op.vtType == 'change':
+                remove((op.db_what, op.db_oldObjId))
+                add((op.db_what, op.db_newObjId), op.db_data)
+            elif op.vtType == 'delete':
+                remove((op.db_what, op.db_objectId))
+        return set(term for term, present in touched.iteritems()
+                   if present != (counts.get(term, 0) > 0))
+
+    def _record(self, version, changed, counts):
+        for term in changed:
+            self._postings.setdefault(term, {})[version] = term in counts
+
+    def rebuild(self):
+        """rebuild() -> None
+        Indexes every version of the vistrail with a single depth-first
+        traversal of the version tree, undoing each action's operations
+        when leaving its subtree.
+
+        """
+        self.clear()
+        action_map = self.vistrail.actionMap
+        for action in action_map.itervalues():
+            self._children.setdefault(action.db_id, [])
+            self._children.setdefault(action.db_prevId, []).append(
+                action.db_id)
+
+        objects = {}
+        counts = {}
+        stack = [(0, None)]
+        while stack:
+            version, undo = stack.pop()
+            if undo is not None:
+                # leaving the subtree of a version, restore its parent
+                for key, terms in reversed(undo):
+                    for term in objects.get(key) or ():
+                        n = counts[term] - 1
+                        if n:
+                            counts[term] = n
+                        else:
+                            del counts[term]
+                    if terms is None:
+                        objects.pop(key, None)
+                    else:
+                        objects[key] = terms
+                        for term in terms:
+                            counts[term] = counts.get(term, 0) + 1
+                continue
+            if version != 0:
+                undo = []
+                changed = self.apply_action(action_map[version], objects,
+                                            counts, undo)
+                self._record(version, changed, counts)
+                stack.append((version, undo))
+            for child in self._children[version]:
+                stack.append((child, None))
+
+    def update(self):
+        """update() -> None
+        Indexes the actions added to the vistrail since the last update.
+
+        New actions are leaves of the version tree, so they are indexed by
+        replaying them on top of their parent's state; the state of the
+        last indexed version is kept since it is usually the parent of the
+        next action.
+
+        """
+        action_map = self.vistrail.actionMap
+        if len(action_map) + 1 == len(self._children):
+            return
+        new_ids = sorted(i for i in action_map if i not in self._children)
+        if (len(self._children) + len(new_ids) != len(action_map) + 1 or
+                (self._state is None and len(self._children) == 1)):
+            # Actions were removed or nothing was indexed yet
+            self.rebuild()
+            return
+        for version in new_ids:
+            action = action_map[version]
+            parent = action.db_prevId
+            if self._state is not None and self._state[0] == parent:
+                objects, counts = self._state[1:]
+            else:
+                objects, counts = {}, {}
+                for a in getActionChain(self.vistrail, parent):
+                    self.apply_action(a, objects, counts)
+            changed = self.apply_action(action, objects, counts)
+            self._record(version, changed, counts)
+            self._children[parent].append(version)
+            self._children[version] = []
+            self._state = (version, objects, counts)
+
+    def terms(self, kind=None):
+        """terms(kind: str) -> list
+        Returns the indexed terms, optionally only those of a given kind
+        ('module', 'descriptor', 'parameter' or 'annotation').
+
+        """
+        if kind is None:
+            return self._postings.keys()
+        return [t for t in self._postings if t[0] == kind]
+
+    def versions_with(self, term):
+        """versions_with(term: tuple) -> set
+        Returns the versions whose pipeline contains the given term.
+
+        """
+        postings = self._postings.get(term)
+        result = set()
+        if not postings:
+            return result
+        for version, present in postings.iteritems():
+            if not present:
+                continue
+            stack = [version]
+            while stack:
+                v = stack.pop()
+                result.add(v)
+                # a posting below a version containing the term can only
+                # be a removal
+                stack.extend(c for c in self._children[v]
+                             if c not in postings)
+        return result
+
+    def versions_with_any(self, terms):
+        """versions_with_any(terms: iterable) -> set
+        Returns the versions containing at least one of the terms.
+
+        """
+        result = set()
+        for term in terms:
+            result.update(self.versions_with(term))
+        return result
+
+    def versions_with_all(self, terms):
+        """versions_with_all(terms: iterable) -> set or None
+        Returns the versions containing every one of the terms, or None if
+        no terms are given.
+
+        """
+        result = None
+        for term in sorted(terms, key=lambda t: len(self._postings.get(t,
+                                                                      ()))):
+            versions = self.versions_with(term)
+            if result is None:
+                result = versions
+            else:
+                result.intersection_update(versions)
+            if not result:
+                break
+        return result
+
+################################################################################
+
+class TestVersionIndex(unittest.TestCase):
+    def check_index(self, vistrail, index):
+        names = index.terms('module')
+        for version in vistrail.actionMap.keys() + [0]:
+            pipeline = vistrail.getPipeline(version)
+            expected = set(m.name for m in pipeline.modules.itervalues())
+            found = set(name for (_, name) in names
+                        if version in index.versions_with(('module', name)))
+            self.assertEqual(found, expected)
+            expected = set(p.strValue
+                           for m in pipeline.modules.itervalues()
+                           for f in m.functions
+                           for p in f.params)
+            found = set(value for (_, value) in index.terms('parameter')
+                        if version in index.versions_with(('parameter',
+                                                           value)))
+            self.assertEqual(found, expected)
+
+    def test_rebuild(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.system import vistrails_root_directory
+        locator = XMLFileLocator(vistrails_root_directory() +
+                                 '/tests/resources/dummy.xml')
+        vistrail = locator.load()
+        index = VersionIndex(vistrail)
+        index.update()
+        self.assertEqual(len(index), len(vistrail.actionMap) + 1)
+        self.check_index(vistrail, index)
+
+    def test_incremental(self):
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        vistrail = controller.vistrail
+        index = vistrail.get_version_index()
+        m1 = controller.add_module(basic_pkg, 'String')
+        m2 = controller.add_module(basic_pkg, 'Integer')
+        controller.update_function(m1, 'value', ['abc'])
+        branch = controller.current_version
+        controller.delete_module(m2.id)
+        controller.change_selected_version(branch)
+        m3 = controller.add_module(basic_pkg, 'Float')
+
+        self.assertIs(vistrail.get_version_index(), index)
+        self.assertEqual(len(index), len(vistrail.actionMap) + 1)
+        self.assertEqual(index.versions_with(('module', 'Float')),
+                         set([controller.current_version]))
+        self.assertEqual(index.versions_with_all([('module', 'String'),
+                                                  ('module', 'Integer')]),
+                         set([2, 3, 5]))
+        self.check_index(vistrail, index)
+
+        rebuilt = VersionIndex(vistrail)
+        rebuilt.rebuild()
+        for term in rebuilt.terms():
+            self.assertEqual(rebuilt.versions_with(term),
+                             index.versions_with(term))
@@ -120,6 +120,7 @@ class Vistrail(DBVistrail):
             self.savedQueries = copy.copy(other.savedQueries)
             self.is_abstraction = other.is_abstraction
             self.locator = other.locator
+        self._version_index = None
 
         # object to keep explicit expanded 
         # version tree always updated
@@ -528,6 +529,18 @@ class Vistrail(DBVistrail):
             last_n = sorted_keys[num_actions-n:num_actions-1]
         return last_n
 
+    def get_version_index(self):
+        """ get_version_index() -> VersionIndex
+        Returns the inverted index of the contents of each version,
+        indexing the actions added since the last call.
+
+        """
+        if self._version_index is None:
+            from vistrails.core.vistrail.version_index import VersionIndex
+            self._version_index = VersionIndex(self)
+        self._version_index.update()
+        return self._version_index
+
     def hasVersion(self, version):
         """hasVersion(version:int) -> boolean
         Returns True if version with given timestamp exists
@@ -741,6 +754,13 @@ class Vistrail(DBVistrail):
         if root_level:
             return None
         return action_id
+    def get_next_upgrade(self, action_id):
+        """Returns the version action_id was directly upgraded to, or None.
+        """
+        a = self.get_action_annotation(action_id, Vistrail.UPGRADE_ANNOTATION)
+        if a is None:
+            return None
+        return long(a.value)
     def set_upgrade(self, action_id, value):
         return self.set_action_annotation(action_id, 
                                           Vistrail.UPGRADE_ANNOTATION,
@@ -1054,17 +1074,22 @@ class Vistrail(DBVistrail):
                     debug.unexpected_exception(e)
         return package_list
 
+    def get_upgraded_version(self, version):
+        """Returns the version that was upgraded to version, or None.
+        """
+        a = self.db_actionAnnotations_key_index.get(
+            (Vistrail.UPGRADE_ANNOTATION, str(version)))
+        if a is None:
+            return None
+        return a.action_id
+
     def get_base_upgrade_version(self, version):
         """Finds the base version in the upgrade chain.
         """
-        # TODO: use this in search_upgrade_versions(), once the map is cached
-        upgrade_rev_map = {}
-        for ann in self.action_annotations:
-            if ann.key == Vistrail.UPGRADE_ANNOTATION:
-                upgrade_rev_map[int(ann.value)] = ann.action_id
-
-        while version in upgrade_rev_map:
-            version = upgrade_rev_map[version]
+        base_version = self.get_upgraded_version(version)
+        while base_version is not None:
+            version = base_version
+            base_version = self.get_upgraded_version(version)
         return version
 
     def search_upgrade_versions(self, base_version, getter,
@@ -1081,17 +1106,8 @@ class Vistrail(DBVistrail):
         down from given version only.
         :returns: The result from getter, or None if all upgrades were exhausted
         """
-        # TODO: cache these maps somewhere
-        upgrade_map = {}
-        upgrade_rev_map = {}
-        for ann in self.action_annotations:
-            if ann.key == Vistrail.UPGRADE_ANNOTATION:
-                upgrade_map[ann.action_id] = int(ann.value)
-                upgrade_rev_map[int(ann.value)] = ann.action_id
-
         if start_at_base is True:
-            while base_version in upgrade_rev_map:
-                base_version = upgrade_rev_map[base_version]
+            base_version = self.get_base_upgrade_version(base_version)
 
         version = base_version
         walked_versions = set()
@@ -1100,12 +1116,10 @@ class Vistrail(DBVistrail):
             if ret is not None:
                 return ret
             walked_versions.add(version)
-            version = upgrade_map.get(version)
+            version = self.get_next_upgrade(version)
             if version is None and start_at_base is None:
                 start_at_base = True
-                version = base_version
-                while version in upgrade_rev_map:
-                    version = upgrade_rev_map[version]
+                version = self.get_base_upgrade_version(base_version)
         return None
 
     def get_upgrade_chain(self, base_version, start_at_base=False):
@@ -1117,16 +1131,8 @@ class Vistrail(DBVistrail):
         not an upgrade). If False, go down from given version only.
         :returns: The list version ids in the upgrade chain
         """
-        # TODO: cache these maps somewhere
-        upgrade_map = {}
-        upgrade_rev_map = {}
-        for ann in self.action_annotations:
-            if ann.key == Vistrail.UPGRADE_ANNOTATION:
-                upgrade_map[ann.action_id] = int(ann.value)
-                upgrade_rev_map[int(ann.value)] = ann.action_id
         if start_at_base is True:
-            while base_version in upgrade_rev_map:
-                base_version = upgrade_rev_map[base_version]
+            base_version = self.get_base_upgrade_version(base_version)
 
         chain = []
         version = base_version
@@ -1134,7 +1140,7 @@ class Vistrail(DBVistrail):
         while version is not None and version not in walked_versions:
             chain.append(version)
             walked_versions.add(version)
-            version = upgrade_map.get(version)
+            version = self.get_next_upgrade(version)
         return chain
 
 ##############################################################################
@@ -1339,6 +1345,34 @@ class TestVistrail(unittest.TestCase):
         p2 = workflow.plugin_datas[0]
         assert plugin_data_str == p2.data
 
+    def test_upgrade_chain(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        import vistrails.core.system
+        v = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                           '/tests/resources/upgrades1.xml').load()
+        upgrades = {}
+        for ann in v.action_annotations:
+            if ann.key == Vistrail.UPGRADE_ANNOTATION:
+                upgrades[ann.action_id] = int(ann.value)
+        self.assertTrue(upgrades)
+        bases = dict((upgrade, version)
+                     for version, upgrade in upgrades.iteritems())
+        for version in v.actionMap:
+            self.assertEqual(v.get_next_upgrade(version),
+                             upgrades.get(version))
+            self.assertEqual(v.get_upgraded_version(version),
+                             bases.get(version))
+            base = version
+            while base in bases:
+                base = bases[base]
+            self.assertEqual(v.get_base_upgrade_version(version), base)
+            chain = [base]
+            while chain[-1] in upgrades:
+                chain.append(upgrades[chain[-1]])
+            self.assertEqual(v.get_upgrade_chain(version, True), chain)
+            self.assertEqual(v.get_upgrade_chain(version),
+                             chain[chain.index(version):])
+
     def test_inverse(self):
         """Test if inverses and general_action_chain are working by
         doing a lot of action-based transformations on a pipeline and
@@ -36,7 +36,7 @@
 from __future__ import division
 
 from vistrails.db.domain import DBWorkflow, DBAdd, DBDelete, DBAction, DBAbstraction, \
-    DBModule, DBConnection, DBPort, DBFunction, DBParameter, DBGroup
+    DBModule, DBConnection, DBPort, DBFunction, DBParameter, DBGroup, DBVistrail
 from vistrails.db.services.action_chain import getActionChain, getCurrentOperationDict, \
     getCurrentOperations, simplify_ops
 from vistrails.db import VistrailsDBException
@@ -44,10 +44,10 @@ from vistrails.db import VistrailsDBException
 import copy
 import datetime
 import getpass
+from itertools import izip
 
 import unittest
 import vistrails.core.system
-from itertools import chain
 
 def update_id_scope(vistrail):
     if hasattr(vistrail, 'update_id_scope'):
@@ -131,11 +131,11 @@ def performActions(actions, workflow):
 
 def synchronize(old_vistrail, new_vistrail, current_action_id):
     id_remap = {}
+    new_actions = []
     for action in new_vistrail.db_actions:
         if action.is_new:
-            new_action = action.do_copy(True, old_vistrail.idScope, id_remap)
-            old_vistrail.db_add_action(new_action)
-        else:
+            new_actions.append(action)
+        elif action.is_dirty:
             # it must exist in the old vistrail, too
             old_action = old_vistrail.db_actions_id_index[action.db_id]
             # use knowledge that we replace old notes...
@@ -159,6 +159,11 @@ def synchronize(old_vistrail, new_vistrail, current_action_id):
                                                         old_vistrail.idScope,
                                                         id_remap)
                     old_action.db_add_annotation(new_annotation)
+    # parents are copied before their children so prevIds get remapped
+    new_actions.sort(key=lambda a: a.db_id)
+    for action in new_actions:
+        new_action = action.do_copy(True, old_vistrail.idScope, id_remap)
+        old_vistrail.db_add_action(new_action)
 
     for tag in new_vistrail.db_deleted_tags:
         if old_vistrail.db_has_tag_with_id(tag.db_id):
@@ -196,6 +201,68 @@ def synchronize(old_vistrail, new_vistrail, current_action_id):
     old_vistrail.db_currentVersion = new_action_id
     return new_action_id
 
+def pair_action_objects(action, vt_action, id_remap, type_remap={}):
+    """ pair_action_objects(action: DBAction, vt_action: DBAction,
+                            id_remap: dict, type_remap: dict) -> dict or None
+        Returns the id_remap entries mapping the objects created by action
+        to the ones created by vt_action, an identical action in another
+        vistrail, or None if the operations of the two actions do not
+        correspond: they must do the same thing (see
+        DBVistrail.op_content) to objects that are mapped to each other.
+        Objects referenced by action must already be mapped in id_remap,
+        or have the same id in both vistrails.
+        """
+    ops = action.db_operations
+    vt_ops = vt_action.db_operations
+    if len(ops) != len(vt_ops):
+        return None
+    pairs = {}
+    def mapped(what, obj_id):
+        key = (type_remap.get(what, what), obj_id)
+        return pairs.get(key, id_remap.get(key, obj_id))
+    def add_pair(what, obj_id, vt_obj_id):
+        pairs[(what, obj_id)] = vt_obj_id
+        pairs[(type_remap.get(what, what), obj_id)] = vt_obj_id
+    for op, vt_op in izip(ops, vt_ops):
+        if DBVistrail.op_content(op) != DBVistrail.op_content(vt_op):
+            return None
+        if (op.db_parentObjType is not None and
+                mapped(op.db_parentObjType, op.db_parentObjId) !=
+                vt_op.db_parentObjId):
+            return None
+        what = op.db_what
+        if op.vtType == 'delete':
+            if mapped(what, op.db_objectId) != vt_op.db_objectId:
+                return None
+            continue
+        if op.vtType == 'change':
+            if mapped(what, op.db_oldObjId) != vt_op.db_oldObjId:
+                return None
+            add_pair(what, op.db_newObjId, vt_op.db_newObjId)
+        else:
+            add_pair(what, op.db_objectId, vt_op.db_objectId)
+        # the data may carry children with ids of their own, like the
+        # ports of a connection
+        if op.db_data is None or vt_op.db_data is None:
+            if op.db_data is not vt_op.db_data:
+                return None
+            continue
+        children = op.db_data.db_children()
+        vt_children = vt_op.db_data.db_children()
+        if len(children) != len(vt_children):
+            return None
+        for (obj, _, _), (vt_obj, _, _) in izip(children, vt_children):
+            if obj.vtType != vt_obj.vtType:
+                return None
+            # ports refer to the modules they connect
+            module_id = getattr(obj, '_db_moduleId', None)
+            if (module_id is not None and
+                    mapped(DBModule.vtType, module_id) !=
+                    vt_obj._db_moduleId):
+                return None
+            add_pair(obj.vtType, obj.db_id, vt_obj.db_id)
+    return pairs
+
 def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir = ''):
     """ def merge(sb: SaveBundle, next_sb: SaveBundle, app: str,
                   interactive: bool, tmp_dir: str, next_tmp_dir: str) -> None
@@ -223,43 +290,39 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
     annotation_key = action_key + '_annotationhash'
     action_annotation_key = action_key + '_actionannotationhash'
 
-    # find the highest common checkin id
-    checkinId = 0
+    # map the ids of the actions next_vt shares with vt to their ids in vt
     if len(app) and next_vt.db_has_annotation_with_key(action_key):
         co = next_vt.db_get_annotation_by_key(action_key)
         #print "found checkin id annotation"
         checkinId = int(co._db_value)
+        common = dict((a._db_id, a._db_id) for a in next_vt.db_actions
+                      if a._db_id <= checkinId)
     else:
-        #print "calculating checkin id"
-        # create unique identifiers for all actions
-        actions = []
-        actionDict = {}
-        for action in vt.db_actions:
-            unique = action._db_user + str(action._db_date)
-            copy_no = 0
-            while (unique + str(copy_no)) in actionDict:
-                copy_no += 1
-            unique = unique + str(copy_no)
-            actions.append(unique)
-            actionDict[unique] = action
-        actionNexts = []
-        actionDictNext = {}
-        for action in next_vt.db_actions:
-            unique = action._db_user + str(action._db_date)
-            copy_no = 0
-            while (unique + str(copy_no)) in actionDictNext:
-                copy_no += 1
-            unique = unique + str(copy_no)
-            actionNexts.append(unique)
-            actionDictNext[unique] = action
-
-        # find last checkin action (only works for centralized syncs)
-        while checkinId < len(actions) and checkinId < len(actionNexts) and \
-            actions[checkinId] == actionNexts[checkinId]:
-                checkinId += 1
-        if checkinId > 0:
-            checkinId = actionDict[actions[checkinId-1]].db_id
-    #print "checkinId:", checkinId
+        # actions with the same digest have the same content and history,
+        # whatever id they were given in each copy
+        ids = dict((d, i) for i, d in vt.hashActions().iteritems())
+        candidates = dict((i, ids[d])
+                          for i, d in next_vt.hashActions().iteritems()
+                          if d in ids)
+        # the objects created by common actions may have other ids in vt,
+        # map them so the copied actions refer to the right objects.
+        # Parents are paired first; an action that cannot be paired is
+        # copied along with all its descendants.
+        common = {}
+        for next_id in sorted(candidates):
+            action = next_vt.db_actions_id_index[next_id]
+            if action.db_prevId != 0 and action.db_prevId not in common:
+                continue
+            vt_action = vt.db_actions_id_index[candidates[next_id]]
+            pairs = pair_action_objects(action, vt_action, id_remap,
+                                        vt.idScope.remap)
+            if pairs is None:
+                continue
+            id_remap.update(pairs)
+            common[next_id] = candidates[next_id]
+    for next_id, vt_id in common.iteritems():
+        if next_id != vt_id:
+            id_remap[(DBAction.vtType, next_id)] = vt_id
 
     # delete previous checkout annotations in vt
     deletekeys = [action_key,annotation_key,action_annotation_key]
@@ -287,11 +350,12 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
     #print "merge actionannotations:", mergeActionAnnotations
 
     ################## merge actions ######################
-    for action in next_vt.db_actions:
-        # check for identical actions
-        if action._db_id > checkinId:
-            new_action = action.do_copy(True, vt.idScope, id_remap)
-            vt.db_add_action(new_action)
+    # parents are copied before their children so prevIds get remapped
+    for action in sorted((a for a in next_vt.db_actions
+                          if a._db_id not in common),
+                         key=lambda a: a._db_id):
+        new_action = action.do_copy(True, vt.idScope, id_remap)
+        vt.db_add_action(new_action)
 
     ################## merge annotations ##################
     if not mergeAnnotations:
@@ -396,9 +460,10 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
                     new_annotation.db_value = str(id_remap[('action', value)])
                 annotation = new_annotation.do_copy(True, vt.idScope, id_remap)
                 vt.db_add_actionAnnotation(annotation)
-            elif new_annotation.db_action_id <= checkinId and \
-                    new_annotation.db_key in oas[new_annotation.db_action_id]:
-                old_action = oas[new_annotation.db_action_id]
+            elif new_annotation.db_action_id in common and \
+                    new_annotation.db_key in \
+                    oas.get(common[new_annotation.db_action_id], {}):
+                old_action = oas[common[new_annotation.db_action_id]]
                 # we have a conflict
                 # tags should be merged (the user need to resolve)
                 if new_annotation.db_key == '__tag__':
@@ -1252,181 +1317,91 @@ def setNewObjId(operation, id):
     else:
         operation.db_objectId = id
 
-def getWorkflowDiffCommon(vistrail, v1, v2, heuristic_match=True):
-    (sharedOps, vOnlyOps) = \
-        getVersionDifferences(vistrail, [v1, v2])
+def moduleContentKey(module):
+    """moduleContentKey(module: DBModule) -> tuple
+    Returns a hashable key of the descriptor, functions, control
+    parameters and annotations of a module. Modules with the same key are
+    exact matches for heuristicModuleMatch, except groups without a
+    description.
 
-    sharedWorkflow = DBWorkflow()
-    performAdds(sharedOps, sharedWorkflow)
-
-    # FIXME better to do additional ops (and do deletes) or do this?
-    v1Workflow = DBWorkflow()
-    v1Ops = vOnlyOps[0][2]
-    performAdds(v1Ops, v1Workflow)
+    """
+    functions = sorted((f.db_name,
+                        tuple(sorted((p.db_type, p.db_pos, p.db_val)
+                                     for p in f.db_get_parameters())))
+                       for f in module.db_get_functions())
+    cparams = sorted((cp.db_name, cp.db_value)
+                     for cp in module.db_get_controlParameters())
+    annotations = sorted((a.db_key, a.db_value)
+                         for a in module.db_get_annotations())
+    return (module.db_name, module.db_namespace, module.db_package,
+            tuple(functions), tuple(cparams), tuple(annotations))
+
+def connectionContentKey(connection):
+    """connectionContentKey(connection: DBConnection) -> tuple
+    Returns a hashable key of the ports of a connection.
 
-    v2Workflow = DBWorkflow()
-    v2Ops = vOnlyOps[1][2]
-    performAdds(v2Ops, v2Workflow)
+    """
+    return tuple(sorted((p.db_type, p.db_moduleId, p.db_name, p.db_signature)
+                        for p in connection.db_get_ports()))
+
+def getWorkflowDiffCommon(vistrail, v1, v2, heuristic_match=True,
+                          workflow_1=None, workflow_2=None):
+    """getWorkflowDiffCommon(vistrail: DBVistrail, v1: long, v2: long,
+                             heuristic_match: bool,
+                             workflow_1: DBWorkflow,
+                             workflow_2: DBWorkflow) -> tuple
+    Diffs two versions of the same vistrail. Objects keep their ids
+    across versions, so modules and connections are paired by id and
+    compared by content key; only modules whose key differs are checked
+    for parameter, control parameter and annotation changes.
+
+    workflow_1 and workflow_2 may be given if the versions have already
+    been materialized (e.g. from a pipeline cache); they are returned as
+    part of the diff so they should not be shared. Missing ones are
+    materialized by replaying the actions.
 
-    # FIXME connections do not check their ports
+    """
+    if workflow_1 is None:
+        workflow_1 = materializeWorkflow(vistrail, v1)
+    if workflow_2 is None:
+        workflow_2 = materializeWorkflow(vistrail, v2)
+    v1Workflow = workflow_1
+    v2Workflow = workflow_2
+
+    v1Modules = v1Workflow.db_modules_id_index
+    v2Modules = v2Workflow.db_modules_id_index
     sharedModuleIds = []
-    sharedConnectionIds = []
-    sharedFunctionIds = {}
-    sharedCParameterIds = {}
-    sharedAnnotationIds = {}
-    for op in sharedOps:
-        if op.what == 'module' or op.what == 'abstraction' or \
-                op.what == 'group':
-            sharedModuleIds.append(getNewObjId(op))
-        elif op.what == 'connection':
-            sharedConnectionIds.append(getNewObjId(op))
-        elif op.what == 'function':
-            sharedFunctionIds[getNewObjId(op)] = op.db_parentObjId
-        elif op.what == 'controlParameter':
-            sharedCParameterIds[getNewObjId(op)] = op.db_parentObjId
-        elif op.what == 'annotation':
-            sharedAnnotationIds[getNewObjId(op)] = op.db_parentObjId
-    
-    vOnlyModules = []
-    vOnlyConnections = []
-    paramChgModules = {}
-    cparamChgModules = {}
-    annotChgModules = {}
-    for (vAdds, vDeletes, _) in vOnlyOps:
-        moduleDeleteIds = []
-        connectionDeleteIds = []
-        for op in vDeletes:
-            if op.what == 'module' or op.what == 'abstraction' or \
-                    op.what == 'group':
-                moduleDeleteIds.append(getOldObjId(op))
-                if getOldObjId(op) in sharedModuleIds:
-                    sharedModuleIds.remove(getOldObjId(op))
-                if paramChgModules.has_key(getOldObjId(op)):
-                    del paramChgModules[getOldObjId(op)]
-                if cparamChgModules.has_key(getOldObjId(op)):
-                    del cparamChgModules[getOldObjId(op)]
-                if annotChgModules.has_key(getOldObjId(op)):
-                    del annotChgModules[getOldObjId(op)]
-            elif op.what == 'function' and \
-                    (op.db_parentObjType == 'module' or 
-                     op.db_parentObjType == 'abstraction' or 
-                     op.db_parentObjType == 'group') and \
-                     op.db_parentObjId in sharedModuleIds:
-                # have a function change
-                paramChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif op.what == 'parameter' and op.db_parentObjType == 'function' \
-                    and sharedFunctionIds.has_key(op.db_parentObjId):
-                # have a parameter change
-                moduleId = sharedFunctionIds[op.db_parentObjId]
-                if moduleId in sharedModuleIds:
-                    paramChgModules[moduleId] = None
-                    sharedModuleIds.remove(moduleId)
-            elif op.what == 'controlParameter' and \
-                    (op.db_parentObjType == 'module' or 
-                     op.db_parentObjType == 'abstraction' or 
-                     op.db_parentObjType == 'group') and \
-                    op.db_parentObjId in sharedCParameterIds and \
-                    op.db_parentObjId in sharedModuleIds:
-                # have a control parameter change
-                cparamChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif op.what == 'annotation' and \
-                    (op.db_parentObjType == 'module' or 
-                     op.db_parentObjType == 'abstraction' or 
-                     op.db_parentObjType == 'group') and \
-                    op.db_parentObjId in sharedAnnotationIds and \
-                    op.db_parentObjId in sharedModuleIds:
-                # have an annotation change
-                annotChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif op.what == 'connection':
-                connectionDeleteIds.append(getOldObjId(op))
-                if getOldObjId(op) in sharedConnectionIds:
-                    sharedConnectionIds.remove(getOldObjId(op))
-
-        moduleAddIds = []
-        connectionAddIds = []
-        for op in vAdds:
-            if op.what == 'module' or op.what == 'abstraction' or \
-                    op.what == 'group':
-                moduleAddIds.append(getNewObjId(op))
-            elif (op.what == 'function' and
-                  (op.db_parentObjType == 'module' or
-                   op.db_parentObjType == 'abstraction' or
-                   op.db_parentObjType == 'group') and
-                  op.db_parentObjId in sharedModuleIds):
-                # have a function change
-                paramChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif op.what == 'parameter' and op.db_parentObjType == 'function' \
-                    and sharedFunctionIds.has_key(op.db_parentObjId):
-                # have a parameter change
-                moduleId = sharedFunctionIds[op.db_parentObjId]
-                if moduleId in sharedModuleIds:
-                    paramChgModules[moduleId] = None
-                    sharedModuleIds.remove(moduleId)
-            elif (op.what == 'controlParameter' and
-                  (op.db_parentObjType == 'module' or
-                   op.db_parentObjType == 'abstraction' or
-                   op.db_parentObjType == 'group') and
-                  op.db_parentObjId in sharedCParameterIds and
-                  op.db_parentObjId in sharedModuleIds):
-                # have a control parameter change
-                cparamChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif (op.what == 'annotation' and
-                  (op.db_parentObjType == 'module' or
-                   op.db_parentObjType == 'abstraction' or
-                   op.db_parentObjType == 'group') and
-                  op.db_parentObjId in sharedAnnotationIds and
-                  op.db_parentObjId in sharedModuleIds):
-                # have an annotation change
-                annotChgModules[op.db_parentObjId] = None
-                sharedModuleIds.remove(op.db_parentObjId)
-            elif op.what == 'connection':
-                connectionAddIds.append(getOldObjId(op))
-
-        vOnlyModules.append((moduleAddIds, moduleDeleteIds))
-        vOnlyConnections.append((connectionAddIds, connectionDeleteIds))
-
-    sharedModulePairs = [(id, id) for id in sharedModuleIds]
-    v1Only = vOnlyModules[0][0]
-    v2Only = vOnlyModules[1][0]
-    for id in vOnlyModules[1][1]:
-        if id not in vOnlyModules[0][1]:
+    chgModuleIds = []
+    v1Only = []
+    for id in sorted(v1Modules):
+        if id not in v2Modules:
             v1Only.append(id)
-    for id in vOnlyModules[0][1]:
-        if id not in vOnlyModules[1][1]:
-            v2Only.append(id)
+        elif (moduleContentKey(v1Modules[id]) ==
+              moduleContentKey(v2Modules[id])):
+            sharedModuleIds.append(id)
+        else:
+            chgModuleIds.append(id)
+    v2Only = [id for id in sorted(v2Modules) if id not in v1Modules]
+
+    v1Connections = v1Workflow.db_connections_id_index
+    v2Connections = v2Workflow.db_connections_id_index
+    sharedConnectionIds = [
+        id for id in sorted(v1Connections)
+        if id in v2Connections and
+        (connectionContentKey(v1Connections[id]) ==
+         connectionContentKey(v2Connections[id]))]
 
+    sharedModulePairs = [(id, id) for id in sharedModuleIds]
     sharedConnectionPairs = [(id, id) for id in sharedConnectionIds]
-    c1Only = vOnlyConnections[0][0]
-    c2Only = vOnlyConnections[1][0]
-    for id in vOnlyConnections[1][1]:
-        if id not in vOnlyConnections[0][1]:
-            c1Only.append(id)
-    for id in vOnlyConnections[0][1]:
-        if id not in vOnlyConnections[1][1]:
-            c2Only.append(id)
-
-    paramChgModulePairs = [(id, id) for id in paramChgModules.keys()]
-    cparamChgModulePairs = [(id, id) for id in cparamChgModules.keys()]
-    annotChgModulePairs = [(id, id) for id in annotChgModules.keys()]
-    # print "^^^^ SHARED MODULE PAIRS:", sharedModulePairs
+    allChgModulePairs = [(id, id) for id in chgModuleIds]
     c1Only, c2Only, heuristicConnectionPairs = [], [], []
-    
+
     if heuristic_match:
         (heuristicModulePairs, heuristicConnectionPairs, v1Only, v2Only, \
              c1Only, c2Only) = do_heuristic_diff(v1Workflow, v2Workflow, \
                                                      v1Only, v2Only, \
                                                      c1Only, c2Only)
-        paramChgModulePairs.extend(heuristicModulePairs)
-        cparamChgModulePairs.extend(heuristicModulePairs)
-        annotChgModulePairs.extend(heuristicModulePairs)
-    allChgModulePairs = list(set(chain(paramChgModulePairs,
-                                       cparamChgModulePairs,
-                                       annotChgModulePairs)))
+        allChgModulePairs.extend(heuristicModulePairs)
 
     (heuristicModulePairs, paramChanges, cparam_changes, annot_changes) = \
         check_params_diff(v1Workflow, v2Workflow, allChgModulePairs, 
@@ -1459,22 +1434,42 @@ def do_heuristic_diff(v1Workflow, v2Workflow, v1_modules, v2_modules,
     #         # heuristicModulePairs.append((m1_id, m2_id))
     #         pass
 
+    # exact matches first, joining on the content key
+    v2ByKey = {}
+    for m2_id in v2Only:
+        m2 = v2Workflow.db_get_module(m2_id)
+        if m2.vtType != 'group' or \
+                '__desc__' in m2.db_annotations_key_index:
+            v2ByKey.setdefault(moduleContentKey(m2), []).append(m2_id)
     for m1_id in v1Only[:]:
         m1 = v1Workflow.db_get_module(m1_id)
-        match = None
-        for m2_id in v2Only:
-            m2 = v2Workflow.db_get_module(m2_id)
-            isMatch = heuristicModuleMatch(m1, m2)
-            if isMatch == 1:
-                match = (m1_id, m2_id)
-                break
-            elif isMatch == 0:
-                match = (m1_id, m2_id)
-        if match is not None:
-            v1Only.remove(match[0])
-            v2Only.remove(match[1])
+        if m1.vtType == 'group' and \
+                '__desc__' not in m1.db_annotations_key_index:
+            continue
+        m2_ids = v2ByKey.get(moduleContentKey(m1))
+        if m2_ids:
+            m2_id = m2_ids.pop(0)
+            v1Only.remove(m1_id)
+            v2Only.remove(m2_id)
+            heuristicModulePairs.append((m1_id, m2_id))
+
+    # then modules with the same descriptor, the last one being kept as
+    # heuristicModuleMatch can no longer find exact matches
+    v2ByDescriptor = {}
+    for m2_id in v2Only:
+        m2 = v2Workflow.db_get_module(m2_id)
+        v2ByDescriptor.setdefault((m2.db_name, m2.db_namespace,
+                                   m2.db_package), []).append(m2_id)
+    for m1_id in v1Only[:]:
+        m1 = v1Workflow.db_get_module(m1_id)
+        m2_ids = v2ByDescriptor.get((m1.db_name, m1.db_namespace,
+                                     m1.db_package))
+        if m2_ids:
+            m2_id = m2_ids.pop()
+            v1Only.remove(m1_id)
+            v2Only.remove(m2_id)
             # we now check all heuristic pairs for parameter changes
-            heuristicModulePairs.append(match)
+            heuristicModulePairs.append((m1_id, m2_id))
 
     # match connections
     for c1_id in c1Only[:]:
@@ -1524,15 +1519,19 @@ def check_params_diff(v1Workflow, v2Workflow, paramChgModulePairs,
             matched.append((m1_id, m2_id))
     return (matched, paramChanges, cparamChanges, annotChanges)
 
-def getWorkflowDiff(vt_pair_1, vt_pair_2, heuristic_match=True):
+def getWorkflowDiff(vt_pair_1, vt_pair_2, heuristic_match=True,
+                    workflow_1=None, workflow_2=None):
     (vistrail_1, v_1) = vt_pair_1
     (vistrail_2, v_2) = vt_pair_2
     
     if vistrail_1 == vistrail_2:
-        return getWorkflowDiffCommon(vistrail_1, v_1, v_2, heuristic_match)
+        return getWorkflowDiffCommon(vistrail_1, v_1, v_2, heuristic_match,
+                                     workflow_1, workflow_2)
     
-    workflow_1 = materializeWorkflow(vistrail_1, v_1)
-    workflow_2 = materializeWorkflow(vistrail_2, v_2)
+    if workflow_1 is None:
+        workflow_1 = materializeWorkflow(vistrail_1, v_1)
+    if workflow_2 is None:
+        workflow_2 = materializeWorkflow(vistrail_2, v_2)
     modules_1 = workflow_1.db_modules_id_index.keys()
     modules_2 = workflow_2.db_modules_id_index.keys()
     conns_1 = workflow_1.db_connections_id_index.keys()
@@ -1634,5 +1633,176 @@ class TestDBVistrailService(unittest.TestCase):
         # test parameter change inequality
         assert heuristicModuleMatch(module1, module5) == 0
 
+    def test_workflow_diff(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        m1 = controller.add_module(basic_pkg, 'String')
+        m2 = controller.add_module(basic_pkg, 'Integer')
+        m3 = controller.add_module(basic_pkg, 'Float')
+        base = controller.current_version
+        controller.update_function(m1, 'value', ['abc'])
+        controller.delete_module(m2.id)
+        v1 = controller.current_version
+        controller.change_selected_version(base)
+        m4 = controller.add_module(basic_pkg, 'Integer')
+        v2 = controller.current_version
+
+        vistrail = controller.vistrail
+        (_, _, shared, heuristic, v1Only, v2Only, paramChanges, _, _,
+         sharedConnections, _, _, _) = \
+            getWorkflowDiffCommon(vistrail, v1, v2)
+        self.assertEqual(shared, [(m3.id, m3.id)])
+        self.assertEqual(heuristic, [])
+        self.assertEqual((v1Only, v2Only), ([], [m2.id, m4.id]))
+        self.assertEqual(paramChanges,
+                         [((m1.id, m1.id),
+                           [(('value', [('%s:String' % basic_pkg, 'abc')]),
+                             (None, None))])])
+
+        # cached workflows are used as is
+        workflow_1 = materializeWorkflow(vistrail, v1)
+        result = getWorkflowDiffCommon(vistrail, v1, base, True, workflow_1)
+        self.assertIs(result[0], workflow_1)
+        self.assertEqual(result[2], [(m3.id, m3.id)])
+        self.assertEqual(result[5], [m2.id])
+
+    def test_merge(self):
+        import copy
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.db.services.io import SaveBundle
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        def module_names(vistrail, version):
+            pipeline = vistrail.getPipeline(version)
+            return sorted(m.name for m in pipeline.modules.itervalues())
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        controller.add_module(basic_pkg, 'String')
+        vt_1 = controller.vistrail
+        vt_2 = copy.copy(vt_1)
+        controller.add_module(basic_pkg, 'Integer')
+        controller_2 = VistrailController(vt_2, None, auto_save=False)
+        controller_2.change_selected_version(vt_2.get_latest_version())
+        controller_2.add_module(basic_pkg, 'Float')
+        controller_2.add_module(basic_pkg, 'List')
+        v2 = controller_2.current_version
+
+        merge(SaveBundle('vistrail', vt_1), SaveBundle('vistrail', vt_2))
+        self.assertEqual(len(vt_1.actionMap), 4)
+        merged = [v for v in vt_1.actionMap if v not in (1, 2)]
+        self.assertEqual(module_names(vt_1, max(merged)),
+                         module_names(vt_2, v2))
+        self.assertEqual(vt_1.actionMap[min(merged)].prevId, 1)
+
+        # the Float and List actions have other ids in vt_1 but are still
+        # recognized as common
+        merge(SaveBundle('vistrail', vt_2), SaveBundle('vistrail', vt_1))
+        self.assertEqual(len(vt_2.actionMap), 4)
+        self.assertEqual(sorted(vt_1.hashActions().itervalues()),
+                         sorted(vt_2.hashActions().itervalues()))
+
+    def test_merge_remapped_ids(self):
+        import datetime
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.db.services.io import SaveBundle
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        def make_controller(skip_ids):
+            controller = VistrailController(Vistrail(), None,
+                                            auto_save=False)
+            vistrail = controller.vistrail
+            for vt_type in ('action', 'operation', 'module', 'location'):
+                for i in xrange(skip_ids):
+                    vistrail.idScope.getNewId(vt_type)
+            m = controller.add_module(basic_pkg, 'String')
+            controller.add_module(basic_pkg, 'Integer')
+            # same history, recorded separately
+            for action in vistrail.db_actions:
+                action.db_user = 'test'
+                action.db_date = datetime.datetime(2016, 1, 1, 0, 0,
+                                                   action.db_id % 60)
+            return controller, m.id
+
+        controller_1, m_1 = make_controller(0)
+        controller_2, m_2 = make_controller(5)
+        vt_1 = controller_1.vistrail
+        vt_2 = controller_2.vistrail
+        self.assertNotEqual(m_1, m_2)
+        for action in vt_2.db_actions:
+            action.db_date = vt_1.db_actions_id_index[
+                action.db_id - 5].db_date
+        self.assertEqual(sorted(vt_1.hashActions().itervalues()),
+                         sorted(vt_2.hashActions().itervalues()))
+
+        controller_1.add_module(basic_pkg, 'Float')
+        module = controller_2.current_pipeline.modules[m_2]
+        controller_2.update_function(module, 'value', ['abc'])
+
+        merge(SaveBundle('vistrail', vt_1), SaveBundle('vistrail', vt_2))
+        self.assertEqual(len(vt_1.actionMap), 4)
+        pipeline = vt_1.getPipeline(max(vt_1.actionMap))
+        self.assertEqual(sorted(m.name for m in pipeline.modules.itervalues()),
+                         ['Integer', 'String'])
+        self.assertEqual([p.strValue
+                          for f in pipeline.modules[m_1].functions
+                          for p in f.params], ['abc'])
+
+    def test_merge_same_date(self):
+        """Different edits by the same user at the same time are kept.
+        """
+        import datetime
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.db.services.io import SaveBundle
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller_1 = VistrailController(Vistrail(), None, auto_save=False)
+        controller_1.add_module(basic_pkg, 'String')
+        vt_1 = controller_1.vistrail
+        vt_2 = copy.copy(vt_1)
+        controller_2 = VistrailController(vt_2, None, auto_save=False)
+        controller_2.change_selected_version(1)
+        controller_1.add_module(basic_pkg, 'Integer')
+        controller_2.add_module(basic_pkg, 'Float')
+        for vistrail in (vt_1, vt_2):
+            for action in vistrail.db_actions:
+                action.db_user = 'test'
+                action.db_date = datetime.datetime(2016, 1, 1)
+        self.assertNotEqual(vt_1.hashActions()[2], vt_2.hashActions()[2])
+
+        merge(SaveBundle('vistrail', vt_1), SaveBundle('vistrail', vt_2))
+        self.assertEqual(len(vt_1.actionMap), 3)
+        names = set()
+        for version in (2, 3):
+            pipeline = vt_1.getPipeline(version)
+            names.update(m.name for m in pipeline.modules.itervalues())
+        self.assertEqual(names, set(['String', 'Integer', 'Float']))
+
+    def test_hash_actions_edit(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        basic_pkg = get_vistrails_basic_pkg_id()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        controller.add_module(basic_pkg, 'String')
+        controller.add_module(basic_pkg, 'Integer')
+        vistrail = controller.vistrail
+        before = vistrail.hashActions()
+        vistrail.db_actions_id_index[1].db_user = 'someone else'
+        after = vistrail.hashActions()
+        # the edited action and its child changed
+        self.assertNotEqual(before[1], after[1])
+        self.assertNotEqual(before[2], after[2])
+
 if __name__ == '__main__':
     unittest.main()
@@ -38,11 +38,15 @@ from __future__ import division
 
 import copy
 import hashlib
+import re
 from auto_gen import DBVistrail as _DBVistrail
 from auto_gen import DBAdd, DBChange, DBDelete, DBAbstraction, DBGroup, \
     DBModule, DBAnnotation, DBActionAnnotation, DBParameterExploration
 from id_scope import IdScope
 
+# fields holding object ids, which differ between copies of a vistrail
+_id_field_re = re.compile(r'^_db_(id|vtid|vtmid|.*Id|.*_id)$')
+
 class DBVistrail(_DBVistrail):
     def __init__(self, *args, **kwargs):
         _DBVistrail.__init__(self, *args, **kwargs)
@@ -203,6 +207,81 @@ class DBVistrail(_DBVistrail):
                 m.update(str(v))
         return m.hexdigest()
 
+    def hashActions(self):
+        """hashActions() -> dict
+        Returns a digest for each action id. The digest of an action
+        covers its user, date and the content of its operations (see
+        op_content()), and the digest of its parent, so an action and its
+        history get the same digest in every copy of the vistrail,
+        whatever ids they were given. The digest of each action is cached along with the values
+        it was computed from, and only recomputed when the action was
+        replaced, edited or moved, or its parent's digest changed.
+
+        """
+        cache = getattr(self, '_action_digests', None)
+        if cache is None:
+            cache = self._action_digests = {}
+        digests = {}
+        used = set()
+        # parents always have smaller ids than their children
+        for action in sorted(self.db_actions, key=lambda a: a._db_id):
+            parent_digest = digests.get(action._db_prevId, '')
+            ops = tuple(self.op_content(op)
+                        for op in action._db_operations)
+            key = (parent_digest, action._db_user, action._db_date, ops)
+            cached = cache.get(action._db_id)
+            if cached is not None and cached[0] is action and \
+                    cached[1] == key:
+                base = cached[2]
+            else:
+                m = hashlib.sha1()
+                m.update(parent_digest)
+                m.update(str(action._db_user))
+                m.update(str(action._db_date))
+                for op in ops:
+                    m.update(repr(op))
+                base = m.hexdigest()
+                cache[action._db_id] = (action, key, base)
+            # identical siblings are told apart by their order
+            digest = base
+            copy_no = 0
+            while digest in used:
+                copy_no += 1
+                digest = hashlib.sha1(base + str(copy_no)).hexdigest()
+            used.add(digest)
+            digests[action._db_id] = digest
+        if len(cache) > len(digests):
+            for action_id in [i for i in cache if i not in digests]:
+                del cache[action_id]
+        return digests
+
+    @staticmethod
+    def op_content(op):
+        """op_content(op: DBAdd/DBChange/DBDelete) -> tuple
+        Returns what an operation does, leaving out object ids: the kind
+        of operation and the other fields of the object it adds and of
+        that object's children, like module names and packages, function
+        and port names, parameter types and values, and annotation keys
+        and values.
+
+        """
+        content = [op.vtType, op._db_what, op._db_parentObjType]
+        data = getattr(op, '_db_data', None)
+        if data is not None:
+            for (obj, _, _) in data.db_children():
+                fields = []
+                for (name, value) in sorted(vars(obj).iteritems()):
+                    if (not name.startswith('_db_') or
+                            _id_field_re.match(name) or
+                            isinstance(value, (list, dict)) or
+                            hasattr(value, 'vtType')):
+                        continue
+                    if isinstance(value, unicode):
+                        value = value.encode('utf-8')
+                    fields.append((name, value))
+                content.append((obj.vtType, tuple(fields)))
+        return tuple(content)
+
     def hashActionAnnotations(self):
         action_annotations = {}
         for action_id, key, value in [[aa.db_action_id, aa.db_key, 
@@ -658,7 +658,7 @@ class VistrailsApplicationSingleton(VistrailsApplicationInterface,
             ["%s %s %s" %(j.version,
                           j.start,
                           "FINISHED" if j.completed() else "RUNNING")
-             for i, j in controller.jobMonitor.workflows.iteritems()])
+             for i, j in controller.jobMonitor.findWorkflows().iteritems()])
         print text
         return text
 
@@ -668,7 +668,8 @@ class VistrailsApplicationSingleton(VistrailsApplicationInterface,
                                         mashups, auto_save=False)
         text = "### Jobs in workflow ###\n"
         text += "name | start date | status\n"
-        workflow = [wf for wf in controller.jobMonitor.workflows.itervalues()
+        workflow = [wf for wf in
+                    controller.jobMonitor.findWorkflows().itervalues()
                     if wf.version == int(version)]
         if len(workflow) < 1:
             text = "No job for workflow with id %s" % version
@@ -36,27 +36,33 @@
 """ This is the application for vistrails when running as a server. """
 from __future__ import division
 
-import Queue
 import base64
+import contextlib
 import hashlib
+import httplib
 import inspect
+import json
 import sys
 import logging
 import logging.handlers
 import os
 import re
 import shutil
+import socket
+import sqlite3
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
+import unittest
 import urllib
 import xmlrpclib
 import ConfigParser
 
 from PyQt4 import QtGui, QtCore
 import SocketServer
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, resolve_dotted_attribute
 from datetime import date, datetime
 
 from vistrails.core.application import VistrailsApplicationInterface
@@ -69,6 +75,7 @@ import vistrails.core.db.action
 
 from vistrails.core.vistrail.vistrail import Vistrail
 from vistrails.core import system
+from vistrails.core.cache.file_hash import sha1_hasher
 from vistrails.core.modules.module_registry import get_module_registry as module_registry
 from vistrails.core import interpreter
 from vistrails.core.packagemanager import get_package_manager
@@ -117,54 +124,467 @@ class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn,
     related objects because they won't be in the main thread."""
 ################################################################################
 
+class WorkerProxy(xmlrpclib.ServerProxy):
+    """A client for a worker instance, that knows the worker's URI.
+
+    `failed` is set when a call couldn't reach the worker.
+    """
+    def __init__(self, uri):
+        xmlrpclib.ServerProxy.__init__(self, uri)
+        self.uri = uri
+        self.failed = False
+
+    def _ServerProxy__request(self, methodname, params):
+        try:
+            return xmlrpclib.ServerProxy._ServerProxy__request(
+                    self, methodname, params)
+        except (socket.error, httplib.HTTPException):
+            self.failed = True
+            raise
+
+class WorkerPool(object):
+    """Dispatches requests to the other instances of VisTrails.
+
+    Each worker is a long-running server that keeps its packages loaded and
+    its interpreter cache warm between requests. A request is sent to the
+    least loaded worker that has room for it; requests with the same
+    affinity key (e.g. a vistrail version) go back to the worker that last
+    ran them, as long as it isn't busier than the others.
+    A worker that can't be reached is left out for `retry_delay` seconds,
+    unless no other worker is up.
+    """
+    def __init__(self, uris, logger, max_load=1, max_affinities=1024,
+                 retry_delay=60):
+        self.uris = list(uris)
+        self.logger = logger
+        self.max_load = max_load
+        self.max_affinities = max_affinities
+        self.retry_delay = retry_delay
+        self._load = dict((uri, 0) for uri in self.uris)
+        self._down = {}
+        # key -> (uri, last use)
+        self._affinity = {}
+        self._uses = 0
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.uris)
+
+    def _up(self):
+        now = time.time()
+        up = [uri for uri in self.uris
+              if now - self._down.get(uri, -self.retry_delay) >=
+                 self.retry_delay]
+        # If every worker is down, try them again rather than wait
+        return up or self.uris
+
+    def _choose(self, key):
+        free = [uri for uri in self._up() if self._load[uri] < self.max_load]
+        if not free:
+            return None
+        uri = min(free, key=lambda u: self._load[u])
+        if key is not None:
+            previous = self._affinity.get(key, (None,))[0]
+            if previous in free and self._load[previous] <= self._load[uri]:
+                uri = previous
+            self._uses += 1
+            self._affinity[key] = (uri, self._uses)
+            if len(self._affinity) > self.max_affinities:
+                oldest = min(self._affinity,
+                             key=lambda k: self._affinity[k][1])
+                del self._affinity[oldest]
+        return uri
+
+    def acquire(self, key=None):
+        """acquire(key: hashable) -> WorkerProxy
+        Waits for a worker to have room for a request and reserves it.
+        """
+        with self._condition:
+            uri = self._choose(key)
+            while uri is None:
+                # Times out so that workers that were down get retried
+                self._condition.wait(self.retry_delay)
+                uri = self._choose(key)
+            self._load[uri] += 1
+        if key is not None:
+            self.logger.info("Dispatching %s to %s" % (key, uri))
+        return WorkerProxy(uri)
+
+    def acquire_all(self):
+        """acquire_all() -> [WorkerProxy]
+        Reserves every worker that is up if they are all idle, else returns
+        None.
+        """
+        with self._condition:
+            if any(self._load.itervalues()):
+                return None
+            uris = self._up()
+            for uri in uris:
+                self._load[uri] += 1
+        return [WorkerProxy(uri) for uri in uris]
+
+    def release(self, proxy):
+        with self._condition:
+            self._load[proxy.uri] -= 1
+            if proxy.failed:
+                if proxy.uri not in self._down:
+                    self.logger.warning("Worker %s is unreachable" %
+                                        proxy.uri)
+                self._down[proxy.uri] = time.time()
+            else:
+                self._down.pop(proxy.uri, None)
+            self._condition.notify()
+
+class ResultCache(object):
+    """Content-addressed store of the figures produced by executions.
+
+    Each entry maps a request key to the files the execution produced;
+    files are stored once, under their SHA-1, and counted once per entry
+    referencing them. When the files take more than `max_size` bytes, the
+    least recently used entries are evicted.
+    Requests for the same key are serialized by lock(), so that when
+    identical requests arrive together only one of them executes.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(os.path.join(directory, 'blobs')):
+            os.makedirs(os.path.join(directory, 'blobs'))
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                     check_same_thread=False)
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(blobs)')]
+        if columns and 'refs' not in columns:
+            # index from before blobs were reference counted
+            self._conn.executescript('''
+                    DROP TABLE blobs;
+                    DROP TABLE IF EXISTS entries;
+                    ''')
+        self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS entries(
+                    key TEXT NOT NULL PRIMARY KEY,
+                    manifest TEXT NOT NULL,
+                    last_used REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS entries_last_used
+                    ON entries(last_used);
+                CREATE TABLE IF NOT EXISTS blobs(
+                    digest TEXT NOT NULL PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL);
+                ''')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(*args, **kwargs):
+        """make_key(*args, parameters: str, **kwargs) -> str
+        Makes a key from the request's arguments; the order of the
+        '$&$'-separated parameters doesn't matter.
+        """
+        parameters = kwargs.pop('parameters', '') or ''
+        parameters = '$&$'.join(sorted(p for p in parameters.split('$&$')
+                                       if p))
+        return hashlib.sha1(repr((tuple(str(a) for a in args), parameters,
+                                  sorted(kwargs.items())))).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Serializes the requests for a key."""
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest[2:])
+
+    def restore(self, key, destination):
+        """restore(key: str, destination: str) -> bool
+        Copies the cached files to destination, if any. Other files in
+        destination are left alone.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT manifest FROM entries '
+                                     'WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return False
+            manifest = json.loads(row[0])
+            if not all(os.path.exists(self._blob_path(d))
+                       for d in manifest.itervalues()):
+                self._conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                self._release(set(manifest.itervalues()))
+                self._conn.commit()
+                return False
+            for name, digest in manifest.iteritems():
+                filename = os.path.join(destination, name)
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                shutil.copyfile(self._blob_path(digest), filename)
+            self._conn.execute('UPDATE entries SET last_used=? WHERE key=?',
+                               (time.time(), key))
+            self._conn.commit()
+        return True
+
+    def store(self, key, source):
+        """store(key: str, source: str) -> None
+        Adds the files in the source directory under key, replacing what
+        was stored under it before.
+        """
+        manifest = {}
+        blobs = {}
+        for root, dirs, files in os.walk(source):
+            for f in files:
+                filename = os.path.join(root, f)
+                size = os.path.getsize(filename)
+                digest = sha1_hasher(filename, size)
+                manifest[os.path.relpath(filename, source)] = digest
+                blobs[digest] = (size, filename)
+        with self._lock:
+            for digest, (size, filename) in blobs.iteritems():
+                path = self._blob_path(digest)
+                if not os.path.exists(path):
+                    self._write_blob(filename, path)
+                self._conn.execute('INSERT OR IGNORE INTO blobs '
+                                   'VALUES (?, ?, 0)', (digest, size))
+                self._conn.execute('UPDATE blobs SET refs=refs+1 '
+                                   'WHERE digest=?', (digest,))
+            # the new references are taken first so that blobs shared with
+            # the replaced entry are kept
+            row = self._conn.execute('SELECT manifest FROM entries '
+                                     'WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                self._release(set(json.loads(row[0]).itervalues()))
+            self._conn.execute('INSERT OR REPLACE INTO entries '
+                               'VALUES (?, ?, ?)',
+                               (key, json.dumps(manifest), time.time()))
+            self._conn.commit()
+            self._evict(key)
+
+    def _write_blob(self, filename, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # the name has to be unique, other servers may share the directory
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            # fine if someone else stored it first
+            if not os.path.exists(path):
+                raise
+
+    def _release(self, digests):
+        """_release(digests: set) -> int
+        Drops a reference to each blob and deletes the blobs that are no
+        longer referenced. Returns the number of bytes freed.
+        """
+        freed = 0
+        for digest in digests:
+            self._conn.execute('UPDATE blobs SET refs=refs-1 '
+                               'WHERE digest=?', (digest,))
+            row = self._conn.execute('SELECT size, refs FROM blobs '
+                                     'WHERE digest=?', (digest,)).fetchone()
+            if row is not None and row[1] <= 0:
+                self._conn.execute('DELETE FROM blobs WHERE digest=?',
+                                   (digest,))
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+                freed += row[0]
+        return freed
+
+    def _evict(self, keep):
+        total = self._conn.execute('SELECT SUM(size) FROM blobs'
+                                   ).fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        entries = self._conn.execute('SELECT key, manifest FROM entries '
+                                     'ORDER BY last_used').fetchall()
+        for key, manifest in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self._conn.execute('DELETE FROM entries WHERE key=?', (key,))
+            total -= self._release(set(json.loads(manifest).itervalues()))
+        self._conn.commit()
+
+def memory_usage():
+    """memory_usage() -> dict
+    Memory usage of the current process in kilobytes.
+    I believe this works on Linux only.
+    """
+    status = None
+    result = {'peak': 0, 'rss': 0}
+    try:
+        # This will only work on systems with a /proc file system
+        # (like Linux).
+        status = open('/proc/self/status')
+        for line in status:
+            parts = line.split()
+            key = parts[0][2:-1].lower()
+            if key in result:
+                result[key] = int(parts[1])
+    finally:
+        if status is not None:
+            status.close()
+    return result
+
+class CacheGovernor(object):
+    """Keeps the memory use of the server in check.
+
+    The resident set size is sampled when no request is running, at most
+    every `interval` seconds, so that caches are never cleared under a
+    running execution. Above the soft limit, the least recently used part
+    of the interpreter cache is evicted; above the hard limit, the
+    interpreter is recycled, dropping everything it cached. Limits are in
+    megabytes, 0 disables them.
+    """
+    def __init__(self, logger, soft_limit=0, hard_limit=0, interval=30,
+                 fraction=0.5):
+        self.logger = logger
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.interval = interval
+        self.fraction = fraction
+        self.rss = 0
+        self.soft_events = 0
+        self.evicted_modules = 0
+        self.recycles = 0
+        self._active = 0
+        self._last_sample = 0
+        self._condition = threading.Condition()
+
+    def request_started(self):
+        with self._condition:
+            self._active += 1
+
+    def request_finished(self):
+        with self._condition:
+            self._active -= 1
+            if self._active == 0:
+                self.check()
+
+    def check(self, force=False):
+        """check(force: bool) -> None
+        Samples the memory use if it is due, and evicts from the caches if
+        it is above the limits. Should only be called between requests.
+        """
+        if not (self.soft_limit or self.hard_limit):
+            return
+        now = time.time()
+        if not force and now - self._last_sample < self.interval:
+            return
+        self._last_sample = now
+        try:
+            self.rss = memory_usage()['rss'] // 1024
+        except IOError, e:
+            self.logger.error("Can't read memory usage, disabling limits: "
+                              "%s" % e)
+            self.soft_limit = self.hard_limit = 0
+            return
+        if self.hard_limit and self.rss >= self.hard_limit:
+            self.logger.info("Memory usage %dMB above hard limit, "
+                             "recycling interpreter" % self.rss)
+            self.evicted_modules += \
+                    interpreter.cached.CachedInterpreter.evict(1.0)
+            interpreter.cached.CachedInterpreter.flush()
+            self.recycles += 1
+        elif self.soft_limit and self.rss >= self.soft_limit:
+            evicted = interpreter.cached.CachedInterpreter.evict(
+                                                                self.fraction)
+            self.logger.info("Memory usage %dMB above soft limit, evicted "
+                             "%d modules" % (self.rss, evicted))
+            self.evicted_modules += evicted
+            self.soft_events += 1
+        else:
+            return
+        self.rss = memory_usage()['rss'] // 1024
+
+    def status(self):
+        with self._condition:
+            return {'rss': self.rss,
+                    'soft_limit': self.soft_limit,
+                    'hard_limit': self.hard_limit,
+                    'soft_events': self.soft_events,
+                    'evicted_modules': self.evicted_modules,
+                    'recycles': self.recycles,
+                    'active_requests': self._active}
+
+def wait_for_server(host, port, timeout, process=None):
+    """wait_for_server(host: str, port: int, timeout: float,
+                       process: Popen) -> bool
+    Waits for a server to accept connections on its port, i.e. to be done
+    loading. Returns False if it didn't before timeout, or if the process
+    died.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.2)
+    return False
+
+################################################################################
+
 class RequestHandler(object):
     """This class will handle all the requests sent to the server.
     Add new methods here and they will be exposed through the XML-RPC interface
     """
-    def __init__(self, logger, instances):
+    def __init__(self, logger, instances, governor=None, result_cache=None):
         self.server_logger = logger
         self.instances = instances
-        self.proxies_queue = None
-        self.instantiate_proxies()
-
-    #proxies
-    def instantiate_proxies(self):
-        """instantiate_proxies() -> None
-        If this server started other instances of VisTrails, this will create
-        the client proxies to connect to them.
-        """
+        self.governor = governor
+        self.result_cache = result_cache
+        # If this server started other instances of VisTrails, requests
+        # are forwarded to them
+        self.workers = None
         if len(self.instances) > 0:
-            self.proxies_queue = Queue.Queue()
-            for uri in self.instances:
-                try:
-                    proxy = xmlrpclib.ServerProxy(uri)
-                    self.proxies_queue.put(proxy)
-                    self.server_logger.info("Instantiated client for %s" % uri)
-                except Exception, e:
-                    self.server_logger.error("Error when instantiating proxy %s" % uri)
-                    self.server_logger.error(str(e))
+            self.workers = WorkerPool(self.instances, self.server_logger)
+    def _dispatch(self, method, params):
+        """Calls the requested method, letting the cache governor act
+        between requests.
+        """
+        func = resolve_dotted_attribute(self, method, False)
+        if self.governor is None:
+            return func(*params)
+        self.governor.request_started()
+        try:
+            return func(*params)
+        finally:
+            self.governor.request_finished()
+
     #utils
     def memory_usage(self):
         """memory_usage() -> dict
-        Memory usage of the current process in kilobytes. We plan to
-        use this to clear cache on demand later.
-        I believe this works on Linux only.
+        Memory usage of the current process in kilobytes.
         """
-        status = None
-        result = {'peak': 0, 'rss': 0}
-        try:
-            # This will only work on systems with a /proc file system
-            # (like Linux).
-            status = open('/proc/self/status')
-            for line in status:
-                parts = line.split()
-                key = parts[0][2:-1].lower()
-                if key in result:
-                    result[key] = int(parts[1])
-        finally:
-            if status is not None:
-                status.close()
-        return result
+        return memory_usage()
+
+    def get_cache_status(self):
+        """get_cache_status() -> dict
+        Memory usage and eviction counts of the cache governor.
+        """
+        self.server_logger.info("Request: get_cache_status()")
+        if self.governor is None:
+            return ({'rss': memory_usage()['rss'] // 1024}, 1)
+        return (self.governor.status(), 1)
 
     def path_exists_and_not_empty(self, path):
         """path_exists_and_not_empty(path:str) -> boolean
@@ -333,17 +753,12 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_server_packages()")
 
         messages = []
-        if self.proxies_queue is not None:
+        if self.workers is not None:
             # collect all proxies:
-            proxies = []
-            while len(proxies) < len(self.instances):
-                self.server_logger.info("Proxies: %s Instances: %s" % (len(proxies), len(self.instances)))
-                if self.proxies_queue.empty():
-                    for p in  proxies:
-                        self.proxies_queue.put(p)
-                    return [[[],
-                        "Not all vistrail instances are free, please try again."], 1]
-                proxies.append(self.proxies_queue.get())
+            proxies = self.workers.acquire_all()
+            if proxies is None:
+                return [[[],
+                    "Not all vistrail instances are free, please try again."], 1]
             for proxy in proxies:
                 result, s = 'Please contact the server admin', 0
                 try:
@@ -360,7 +775,7 @@ class RequestHandler(object):
                                                  err.errcode, err.errmsg)
                     self.server_logger.error(err_msg)
                 finally:
-                    self.proxies_queue.put(proxy)
+                    self.workers.release(proxy)
                 if s == 0:
                     messages.append('An error occurred: %s' % result)
                 else:
@@ -726,21 +1141,22 @@ class RequestHandler(object):
             path_to_images = \
                os.path.join(media_dir, 'medleys/images', subdir)
             if (not self.path_exists_and_not_empty(path_to_images) and
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                proxy = self.workers.acquire(medley and (medley._vtid, medley._version))
                 try:
                     self.server_logger.info("Sending request to %s" % proxy)
                     if extra_info is not None:
                         result = proxy.executeMedley(xml_medley, extra_info)
                     else:
                         result = proxy.executeMedley(xml_medley)
-                    self.proxies_queue.put(proxy)
                     self.server_logger.info("returning %s"% result)
                     return result
                 except Exception, e:
                     self.server_logger.error(str(e))
                     return (str(e), 0)
+                finally:
+                    self.workers.release(proxy)
 
             if extra_info is None:
                 extra_info = {}
@@ -908,6 +1324,61 @@ class RequestHandler(object):
     def run_from_db(self, host, port, db_name, vt_id, path_to_figures,
                     version=None,  pdf=False, vt_tag='', build_always=False,
                     parameters='', is_local=True):
+        # Tags can be moved to other versions, so only requests for version
+        # numbers are cached
+        if self.result_cache is None or vt_tag or version is None:
+            return self._run_from_db(host, port, db_name, vt_id,
+                                     path_to_figures, version, pdf, vt_tag,
+                                     build_always, parameters, is_local)
+
+        if not is_local:
+            path_to_figures = self._remote_figures_path(host, port, db_name,
+                                                        vt_id, version)
+        key = self.result_cache.make_key(host, port, db_name, vt_id, version,
+                                         parameters=parameters, pdf=pdf)
+        with self.result_cache.lock(key):
+            if not build_always and self.result_cache.restore(
+                                                        key, path_to_figures):
+                self.server_logger.info("run_from_db: served from the "
+                                        "result cache")
+                return self._figures_result(path_to_figures, is_local)
+            # existing figures are reused as before, but as they might have
+            # been made with other parameters they are not cached
+            executes = (build_always or
+                        not self.path_exists_and_not_empty(path_to_figures))
+            result = self._run_from_db(host, port, db_name, vt_id,
+                                       path_to_figures, version, pdf, vt_tag,
+                                       build_always, parameters, is_local)
+            if executes and result[1] == 1:
+                try:
+                    self.result_cache.store(key, path_to_figures)
+                except Exception, e:
+                    self.server_logger.error("Couldn't cache results: %s" % e)
+            return result
+
+    def _remote_figures_path(self, host, port, db_name, vt_id, version):
+        # use same hashing as on crowdlabs webserver
+        dest_version = "%s_%s_%d_%d_%d" % (host, db_name, int(port), int(vt_id), int(version))
+        dest_version = hashlib.sha1(dest_version).hexdigest()
+        return os.path.join(media_dir, "photos", "wf_execution", dest_version)
+
+    def _figures_result(self, path_to_figures, is_local):
+        if is_local:
+            return (1, 1)
+        else:
+            # TODO pdf version
+            images = [im for im in os.listdir(path_to_figures) if im[-3:] == "png"]
+            results = {}
+            for image in images:
+                handler = open(os.path.join(path_to_figures, image), "rb")
+                image_data = handler.read()
+                handler.close()
+                results[image] = xmlrpclib.Binary(image_data)
+            return (results, 1)
+
+    def _run_from_db(self, host, port, db_name, vt_id, path_to_figures,
+                     version=None,  pdf=False, vt_tag='', build_always=False,
+                     parameters='', is_local=True):
         self.server_logger.info("Request: run_vistrail_from_db(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id,
                                  path_to_figures, version, pdf,
@@ -915,25 +1386,23 @@ class RequestHandler(object):
 
         self.server_logger.info("path_exists_and_not_empty? %s" % self.path_exists_and_not_empty(path_to_figures))
         self.server_logger.info("build_always? %s" % build_always)
-        self.server_logger.info(str(self.proxies_queue))
+        self.server_logger.info("workers: %s" % len(self.instances))
 
         if not is_local:
-            # use same hashing as on crowdlabs webserver
-            dest_version = "%s_%s_%d_%d_%d" % (host, db_name, int(port), int(vt_id), int(version))
-            dest_version = hashlib.sha1(dest_version).hexdigest()
-            path_to_figures = os.path.join(media_dir, "photos", "wf_execution", dest_version)
+            path_to_figures = self._remote_figures_path(host, port, db_name,
+                                                        vt_id, version)
 
         if ((not self.path_exists_and_not_empty(path_to_figures) or 
-             build_always) and self.proxies_queue is not None):
+             build_always) and self.workers is not None):
             self.server_logger.info("will forward request")
             #this server can send requests to other instances
-            proxy = self.proxies_queue.get()
+            proxy = self.workers.acquire((host, port, db_name, vt_id,
+                                          vt_tag or version))
             try:
                 self.server_logger.info("Sending request to %s" % proxy)
                 result = proxy.run_from_db(host, port, db_name, vt_id,
                                            path_to_figures, version, pdf, vt_tag,
                                            build_always, parameters, is_local)
-                self.proxies_queue.put(proxy)
                 self.server_logger.info("returning %s" % result)
                 return result
             except xmlrpclib.ProtocolError, err:
@@ -948,6 +1417,8 @@ class RequestHandler(object):
             except Exception, e:
                 self.server_logger.error(str(e))
                 return (str(e), 0)
+            finally:
+                self.workers.release(proxy)
 
         extra_info = {}
         extra_info['pathDumpCells'] = path_to_figures
@@ -1006,18 +1477,7 @@ class RequestHandler(object):
                 return (str(e), 0)
 
         if ok:
-            if is_local:
-                return (1, 1)
-            else:
-                # TODO pdf version
-                images = [im for im in os.listdir(path_to_figures) if im[-3:] == "png"]
-                results = {}
-                for image in images:
-                    handler = open(os.path.join(path_to_figures, image), "rb")
-                    image_data = handler.read()
-                    handler.close()
-                    results[image] = xmlrpclib.Binary(image_data)
-                return (results, 1)
+            return self._figures_result(path_to_figures, is_local)
         else:
             self.server_logger.error(result)
             return (result, 0)
@@ -1203,12 +1663,11 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                proxy = self.workers.acquire((host, port, db_name, vt_id))
                 try:
                     result = proxy.get_wf_graph_pdf(host,port,db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
                     self.server_logger.info("get_wf_graph_pdf returning %s"% result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1224,6 +1683,8 @@ class RequestHandler(object):
                     self.server_logger.error(str(e))
                     self.server_logger.error(traceback.format_exc())
                     return (str(e), 0)
+                finally:
+                    self.workers.release(proxy)
 
             if not os.path.exists(filepath):
                 os.mkdir(filepath)
@@ -1287,13 +1748,12 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                proxy = self.workers.acquire((host, port, db_name, vt_id))
                 try:
                     self.server_logger.info("Sending request to %s" % proxy)
                     result = proxy.get_wf_graph_png(host, port, db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1309,6 +1769,8 @@ class RequestHandler(object):
                     self.server_logger.error(str(e))
                     self.server_logger.error(traceback.format_exc())
                     return (str(e), 0)
+                finally:
+                    self.workers.release(proxy)
             #if it gets here, this means that we will execute on this instance
             if not os.path.exists(filepath):
                 os.mkdir(filepath)
@@ -1387,13 +1849,12 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                proxy = self.workers.acquire((host, port, db_name, vt_id))
                 try:
                     self.server_logger.info("Sending request to %s" % proxy)
                     result = proxy.get_vt_graph_png(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1409,6 +1870,8 @@ class RequestHandler(object):
                     self.server_logger.error(str(e))
                     self.server_logger.error(traceback.format_exc())
                     return (str(e), 0)
+                finally:
+                    self.workers.release(proxy)
 
             #if it gets here, this means that we will execute on this instance
             if (not os.path.exists(filepath) or
@@ -1476,13 +1939,12 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                proxy = self.workers.acquire((host, port, db_name, vt_id))
                 try:
                     self.server_logger.info("Sending request to %s" % proxy)
                     result = proxy.get_vt_graph_pdf(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1498,6 +1960,8 @@ class RequestHandler(object):
                     self.server_logger.error(str(e))
                     self.server_logger.error(traceback.format_exc())
                     return (str(e), 0)
+                finally:
+                    self.workers.release(proxy)
 
 
             #if it gets here, this means that we will execute on this instance
@@ -2118,6 +2582,8 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         If file doesn't exist, create one and raise error. """
 
         global accessList, db_host, db_read_user, db_read_pass, db_write_user, db_write_pass, media_dir, script_file, virtual_display
+        global memory_soft_limit, memory_hard_limit, memory_check_interval
+        global result_cache_dir, result_cache_size
         accessList = []
         db_host = ''
         db_read_user = ''
@@ -2127,6 +2593,11 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         media_dir = ''
         script_file = ''
         virtual_display = ''
+        memory_soft_limit = 0
+        memory_hard_limit = 0
+        memory_check_interval = 30
+        result_cache_dir = ''
+        result_cache_size = 1024
 
         config = ConfigParser.ConfigParser()
         file_opened = config.read(filename)
@@ -2209,6 +2680,20 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         if virtual_display == "":
             virtual_display = "0"
 
+        # optional memory limits, in megabytes
+        if config.has_option("memory", "soft_limit"):
+            memory_soft_limit = config.getint("memory", "soft_limit")
+        if config.has_option("memory", "hard_limit"):
+            memory_hard_limit = config.getint("memory", "hard_limit")
+        if config.has_option("memory", "check_interval"):
+            memory_check_interval = config.getint("memory", "check_interval")
+
+        # optional result cache, size in megabytes (0 disables it)
+        if config.has_option("cache", "result_dir"):
+            result_cache_dir = config.get("cache", "result_dir")
+        if config.has_option("cache", "result_size"):
+            result_cache_size = config.getint("cache", "result_size")
+
         # check if all required parameters are present
         missing_req_fields = [y for (x,y) in ((db_host,"host"),
                                               (db_read_user,"read_user"),
@@ -2257,35 +2742,54 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         self._initialized = True
         return True
 
+    # How long an instance can take to load its packages and start listening
+    INSTANCE_START_TIMEOUT = 300
+    INSTANCE_STOP_TIMEOUT = 30
+
     def start_other_instances(self, number):
+        """start_other_instances(number: int) -> None
+        Starts the worker instances, all at once, and waits for each of them
+        to accept connections before sending it requests.
+        """
         self.others = []
+        self.other_processes = []
         host = self.temp_configuration.check('rpcServer')
         port = self.temp_configuration.check('rpcPort')
         virt_disp = int(virtual_display)
+        started = []
         for x in xrange(number):
             port += 1   # each instance needs one port space for now
                         #later we might need 2 (normal requests and status requests)
             virt_disp += 1
             args = [script_file,":%s"%virt_disp,host,str(port),'0', '0']
             try:
-                subprocess.Popen(args)
-                time.sleep(20)
-                self.others.append("http://%s:%s"%(host,port))
+                started.append((port, subprocess.Popen(args)))
             except Exception, e:
                 self.server_logger.error(("Couldn't start the instance on display:"
-                                          "%s port: %s") % (virtual_display, port))
+                                          "%s port: %s") % (virt_disp, port))
                 self.server_logger.error(str(e))
+        deadline = time.time() + self.INSTANCE_START_TIMEOUT
+        for port, process in started:
+            if wait_for_server(host, port, max(0, deadline - time.time()),
+                               process):
+                self.others.append("http://%s:%s"%(host,port))
+                self.other_processes.append(process)
+                self.server_logger.info("Instance on port %s is ready" % port)
+            else:
+                self.server_logger.error("Instance on port %s didn't start" %
+                                         port)
 
     def stop_other_instances(self):
-        script = os.path.join(system.vistrails_root_directory(), "stop_vistrails_server.py")
         for o in self.others:
-            args = ['python', script, o]
             try:
-                subprocess.Popen(args)
-                time.sleep(15)
+                xmlrpclib.ServerProxy(o).quit()
             except Exception, e:
                 self.server_logger.error("Couldn't stop instance: %s" % o)
                 self.server_logger.error(str(e))
+        deadline = time.time() + self.INSTANCE_STOP_TIMEOUT
+        for process in self.other_processes:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.2)
 
     def run_server(self):
         """run_server() -> None
@@ -2315,8 +2819,22 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
             """
             self.server_logger.info("    singlethreaded instance")
         #self.rpcserver.register_introspection_functions()
+        governor = CacheGovernor(self.server_logger,
+                                 memory_soft_limit, memory_hard_limit,
+                                 memory_check_interval)
+        result_cache = None
+        if result_cache_size:
+            try:
+                result_cache = ResultCache(
+                        result_cache_dir or os.path.join(media_dir,
+                                                         'result_cache'),
+                        result_cache_size * 1024 * 1024)
+            except Exception, e:
+                self.server_logger.error("Couldn't open result cache: %s" % e)
         self.rpcserver.register_instance(RequestHandler(self.server_logger,
-                                                        self.others))
+                                                        self.others,
+                                                        governor,
+                                                        result_cache))
         if self.pingserver:
             self.pingserver.register_instance(RequestHandler(
                                                       self.server_logger, []))
@@ -2368,3 +2886,242 @@ def stop_server():
     VistrailsServer.save_configuration()
     VistrailsServer.destroy()
     VistrailsServer.deleteLater()
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_result_cache_')
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'), 100)
+
+    def tearDown(self):
+        self.cache._conn.close()
+        shutil.rmtree(self.directory)
+
+    def make_figures(self, name, files):
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        for filename, content in files.iteritems():
+            with open(os.path.join(path, filename), 'wb') as f:
+                f.write(content)
+        return path
+
+    def read_figures(self, path):
+        result = {}
+        for filename in os.listdir(path):
+            with open(os.path.join(path, filename), 'rb') as f:
+                result[filename] = f.read()
+        return result
+
+    def blob_count(self):
+        return sum(len(files) for _, _, files in
+                   os.walk(os.path.join(self.directory, 'cache', 'blobs')))
+
+    def test_store_restore(self):
+        files = {'a.png': 'a' * 10, 'b.png': 'b' * 10, 'c.png': 'a' * 10}
+        self.cache.store('key', self.make_figures('source', files))
+        self.assertEqual(self.blob_count(), 2)
+        self.assertFalse(self.cache.restore('other', os.path.join(
+                    self.directory, 'nothing')))
+        destination = self.make_figures('destination',
+                                        {'other.txt': 'kept'})
+        self.assertTrue(self.cache.restore('key', destination))
+        files['other.txt'] = 'kept'
+        self.assertEqual(self.read_figures(destination), files)
+
+    def test_restore_missing_blob(self):
+        self.cache.store('key', self.make_figures('source',
+                                                  {'a.png': 'a' * 10,
+                                                   'b.png': 'b' * 10}))
+        os.remove(self.cache._blob_path(hashlib.sha1('a' * 10).hexdigest()))
+        self.assertFalse(self.cache.restore('key', os.path.join(
+                    self.directory, 'destination')))
+        # the other blob of the dropped entry is released
+        self.assertEqual(self.blob_count(), 0)
+
+    def test_store_replaces(self):
+        self.cache.store('key', self.make_figures('first',
+                                                  {'a.pdf': 'first',
+                                                   'b.png': 'b' * 10}))
+        self.cache.store('key', self.make_figures('second',
+                                                  {'a.pdf': 'second',
+                                                   'b.png': 'b' * 10}))
+        # the blob only used by the replaced entry is deleted
+        self.assertEqual(self.blob_count(), 2)
+        self.assertEqual(self.cache._conn.execute(
+                'SELECT SUM(size) FROM blobs').fetchone()[0], 16)
+        destination = os.path.join(self.directory, 'destination')
+        self.assertTrue(self.cache.restore('key', destination))
+        self.assertEqual(self.read_figures(destination),
+                         {'a.pdf': 'second', 'b.png': 'b' * 10})
+
+    def test_evict(self):
+        for i in xrange(5):
+            self.cache.store('key%d' % i, self.make_figures(
+                    'source%d' % i, {'a.png': str(i) * 40,
+                                     'shared.png': 's' * 10}))
+        # 2 entries of 40 bytes plus the shared 10 bytes fit in 100 bytes
+        self.assertEqual(self.blob_count(), 3)
+        destination = os.path.join(self.directory, 'destination')
+        for i in xrange(3):
+            self.assertFalse(self.cache.restore('key%d' % i, destination))
+        for i in xrange(3, 5):
+            self.assertTrue(self.cache.restore('key%d' % i, destination))
+
+class TestCacheGovernor(unittest.TestCase):
+    def setUp(self):
+        global memory_usage
+        self.logger = logging.getLogger('vistrails.test.governor')
+        self.rss = 0 # megabytes
+        self._memory_usage = memory_usage
+        memory_usage = lambda: {'peak': 0, 'rss': self.rss * 1024}
+        self.interpreter = interpreter.cached.CachedInterpreter.get()
+        self.interpreter.clear()
+
+    def tearDown(self):
+        global memory_usage
+        memory_usage = self._memory_usage
+        interpreter.cached.CachedInterpreter.flush()
+
+    def execute(self, value):
+        from vistrails.core.modules.basic_modules import identifier, version
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        param = ModuleParam(id=1, pos=0, type='String', val=value)
+        function = ModuleFunction(id=1, pos=0, name='value',
+                                  parameters=[param])
+        pipeline = Pipeline()
+        pipeline.add_module(Module(id=1, name='String', package=identifier,
+                                   version=version, functions=[function]))
+        self.interpreter.execute(pipeline)
+        return pipeline
+
+    def is_cached(self, pipeline):
+        objects, _, _ = self.interpreter.find_persistent_entities(pipeline)
+        return objects[1] is not None
+
+    def test_limits(self):
+        governor = CacheGovernor(self.logger, soft_limit=100, hard_limit=200,
+                                 interval=3600, fraction=0.5)
+        pipelines = [self.execute(v) for v in ('a', 'b', 'c')]
+        # 'a' is used again, so 'b' and 'c' are the least recently used
+        self.execute('a')
+
+        self.rss = 99
+        governor.check(force=True)
+        self.assertEqual(governor.rss, 99)
+        self.assertEqual(len(self.interpreter._objects), 3)
+
+        # not sampled again before the interval is over
+        self.rss = 150
+        governor.check()
+        self.assertEqual(governor.rss, 99)
+
+        governor.check(force=True)
+        self.assertEqual((governor.soft_events, governor.evicted_modules,
+                          governor.recycles), (1, 2, 0))
+        self.assertEqual([self.is_cached(p) for p in pipelines],
+                         [True, False, False])
+
+        self.rss = 200
+        governor.check(force=True)
+        self.assertEqual((governor.soft_events, governor.evicted_modules,
+                          governor.recycles), (1, 3, 1))
+        self.assertEqual(self.interpreter._objects, {})
+
+    def test_disabled(self):
+        governor = CacheGovernor(self.logger, interval=0)
+        pipeline = self.execute('a')
+        self.rss = 1000
+        governor.check(force=True)
+        self.assertEqual(governor.rss, 0)
+        self.assertTrue(self.is_cached(pipeline))
+
+    def test_dispatch(self):
+        governor = CacheGovernor(self.logger, soft_limit=100, interval=0,
+                                 fraction=1.0)
+        handler = RequestHandler(self.logger, [], governor)
+        pipeline = self.execute('a')
+        self.rss = 150
+
+        # the governor doesn't act while a request is running
+        status, code = handler._dispatch('get_cache_status', ())
+        self.assertEqual(code, 1)
+        self.assertEqual(status['active_requests'], 1)
+        self.assertEqual(status['soft_events'], 0)
+        # but it does once it is over
+        self.assertEqual(governor.soft_events, 1)
+        self.assertFalse(self.is_cached(pipeline))
+        self.assertEqual(governor.status()['active_requests'], 0)
+
+        # private methods are not exposed
+        self.assertRaises(AttributeError, handler._dispatch, '_dispatch',
+                          ('get_cache_status', ()))
+        self.assertEqual(governor.status()['active_requests'], 0)
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('vistrails.test.workerpool')
+        self.uris = ['http://localhost:%d' % p for p in (8081, 8082, 8083)]
+
+    def test_load_balancing(self):
+        pool = WorkerPool(self.uris, self.logger, max_load=2)
+        proxies = [pool.acquire() for i in xrange(6)]
+        uris = [p.uri for p in proxies]
+        self.assertEqual(sorted(uris), sorted(self.uris * 2))
+        self.assertEqual(set(uris[:3]), set(self.uris))
+        self.assertIsNone(pool.acquire_all())
+        pool.release(proxies[0])
+        self.assertEqual(pool.acquire().uri, proxies[0].uri)
+        for proxy in proxies:
+            pool.release(proxy)
+        self.assertEqual(len(pool.acquire_all()), 3)
+
+    def test_affinity(self):
+        pool = WorkerPool(self.uris, self.logger, max_load=2,
+                          max_affinities=2)
+        first = pool.acquire('a')
+        pool.release(first)
+        for i in xrange(3):
+            proxy = pool.acquire('a')
+            self.assertEqual(proxy.uri, first.uri)
+            pool.release(proxy)
+        # A busier worker gives up the affinity
+        busy = pool.acquire('a')
+        proxy = pool.acquire('a')
+        self.assertNotEqual(proxy.uri, first.uri)
+        pool.release(busy)
+        pool.release(proxy)
+        # Least recently used keys are forgotten
+        pool.acquire('b')
+        pool.acquire('c')
+        self.assertEqual(sorted(pool._affinity), ['b', 'c'])
+
+    def test_failure(self):
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        dead = 'http://localhost:%d' % s.getsockname()[1]
+        s.close()
+        pool = WorkerPool([dead, self.uris[0]], self.logger)
+        proxy = pool.acquire('key')
+        self.assertEqual(proxy.uri, dead)
+        with self.assertRaises(socket.error):
+            proxy.get_server_packages()
+        self.assertTrue(proxy.failed)
+        pool.release(proxy)
+        # The dead worker is skipped, despite the affinity
+        for i in xrange(3):
+            proxy = pool.acquire('key')
+            self.assertEqual(proxy.uri, self.uris[0])
+            pool.release(proxy)
+        proxies = pool.acquire_all()
+        self.assertEqual([p.uri for p in proxies], [self.uris[0]])
+        pool.release(proxies[0])
+        # It is retried after a while
+        pool._down[dead] -= pool.retry_delay
+        proxy = pool.acquire()
+        self.assertEqual(proxy.uri, dead)
+        pool.release(proxy)
+        self.assertFalse(pool._down)
@@ -76,13 +76,20 @@ class QCollectionWidget(QtGui.QTreeWidget):
         """ Called from the collection when committed """
         self.setup_widget()
             
-    def run_search(self, search, items=None):
-        top_level = items is None
-        if top_level:
+    def run_search(self, search, items=None, matches=None):
+        if items is None:
             items = [self.topLevelItem(i)
                      for i in xrange(self.topLevelItemCount())]
+        if matches is None:
+            # query the collection index once instead of matching each item
+            matches = set(e.id for e in self.collection.search(search))
         for item in items:
-            if search.match(item.entity):
+            if self.collection.is_temp_entity(item.entity):
+                # unsaved vistrails are not in the index
+                found = search.match(item.entity)
+            else:
+                found = item.entity.id in matches
+            if found:
                 item.setHidden(False)
                 parent = item.parent()
                 while parent is not None:
@@ -93,8 +100,9 @@ class QCollectionWidget(QtGui.QTreeWidget):
                     parent = parent.parent()
             else:
                 item.setHidden(True)
-            self.run_search(search, [item.child(i) 
-                                     for i in xrange(item.childCount())])
+            self.run_search(search, [item.child(i)
+                                     for i in xrange(item.childCount())],
+                            matches)
 
     def reset_search(self, items=None):
         if items is None:
@@ -102,10 +102,7 @@ class QInteractiveGraphicsScene(QtGui.QGraphicsScene):
         the scene rect to be much wider for panning
         
         """
-        self.sceneBoundingRect = QtCore.QRectF()
-        for item in self.items():
-            rect = item.sceneBoundingRect()
-            self.sceneBoundingRect = self.sceneBoundingRect.united(rect)
+        self.sceneBoundingRect = self.contentsBoundingRect()
 
         # Keep a minimum size
         minWDiff = 0
@@ -139,6 +136,17 @@ class QInteractiveGraphicsScene(QtGui.QGraphicsScene):
             view.resetCachedContent()
 
 
+    def contentsBoundingRect(self):
+        """ contentsBoundingRect() -> QRectF
+        Compute the bounding rect of all shapes
+
+        """
+        boundingRect = QtCore.QRectF()
+        for item in self.items():
+            rect = item.sceneBoundingRect()
+            boundingRect = boundingRect.united(rect)
+        return boundingRect
+
     def fitToView(self, view, recompute_bounding_rect=False):
         """ fitToView(view: QGraphicsView,
                       recompute_bounding_rect=False) -> None
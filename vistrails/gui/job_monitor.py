@@ -134,12 +134,17 @@ class QJobTree(QtGui.QTreeWidget):
             menu.exec_(event.globalPos())
 
 class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
+    # emitted from the poller thread, delivered in the GUI thread
+    jobFinished = QtCore.pyqtSignal(object, object)
+
     def __init__(self, parent=None):
         QtGui.QWidget.__init__(self, parent)
 
         self.timer_id = None
         self.updating_now = False
         self.widgets = {}
+        self.listeners = {}
+        self.jobFinished.connect(self.job_finished)
 
         self.layout = QtGui.QVBoxLayout()
 
@@ -150,7 +155,7 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
         buttonsLayout.addWidget(run_now)
         run_all = QDockPushButton("Check all")
         run_all.setToolTip("Check all jobs now")
-        run_all.clicked.connect(self.timerEvent)
+        run_all.clicked.connect(lambda: self.check_jobs())
         buttonsLayout.addWidget(run_all)
         label = QtGui.QLabel('Refresh interval (seconds):')
         buttonsLayout.addWidget(label)
@@ -194,6 +199,7 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
             if c not in controllers:
                 self.jobView.takeTopLevelItem(self.jobView.indexOfTopLevelItem(self.widgets[c]))
                 del self.widgets[c]
+                c.jobMonitor.poller.remove_listener(self.listeners.pop(c))
 
         if not controller:
             return
@@ -204,6 +210,10 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
             self.jobView.addTopLevelItem(item)
             self.jobView.expandAll()
             self.widgets[controller] = item
+            jm = controller.jobMonitor
+            listener = lambda id, jm=jm: self.jobFinished.emit(jm, id)
+            jm.poller.add_listener(listener)
+            self.listeners[controller] = listener
             if item.childCount() > 0:
                 self.set_visible(True)
 
@@ -234,13 +244,18 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
                 self.timer_id = None
         get_vistrails_configuration().jobCheckInterval = refresh
         get_vistrails_persistent_configuration().jobCheckInterval = refresh
+        # pollers cap their backoff to the new interval
+        for controller in self.widgets:
+            controller.jobMonitor.poller.wake()
         self.updating_now = False
 
-    def update_job(self, job, force=True):
+    def update_job(self, job, force=True, check_now=True):
         """ Checks specified job
 
             force: bool - True means we should ask user to resume jobs
             that has been paused
+            check_now: bool - False means we rely on the poller to check the
+            jobs in the background
         """
         if isinstance(job, QJobItem):
             vistrail_item = job.vistrail()
@@ -251,7 +266,7 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
             job = None
         else:
             for workflow_item in job.workflowItems.values():
-                self.update_job(workflow_item, force)
+                self.update_job(workflow_item, force, check_now)
             return
         jm = vistrail_item.jobMonitor
         workflow = workflow_item.workflow
@@ -292,16 +307,16 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
             return
 
         job_items = workflow_item.jobs.values() if job is None else [job]
+        ids = []
         for job_item in job_items:
             if job_item.job.finished or job_item.job.ready:
                 continue
-            try:
-                # call monitor
-                if jm.isDone(job_item.handle):
-                    job_item.job.ready = True
-            except Exception, e:
-                debug.critical("Error checking job %s: %s" %
-                               (workflow_item.text(0), e))
+            if check_now or not jm.poller.watching(job_item.job.id):
+                jm.poller.watch(job_item.job.id, job_item.handle)
+            ids.append(job_item.job.id)
+        if check_now and ids:
+            # checks in batches, finished jobs are marked ready by the monitor
+            jm.poller.check(ids)
         if workflow_item.updateJobs():
             QJobView.instance().set_visible(True)
 
@@ -339,7 +354,7 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
                 workflow_item.execute()
                 self.updating_now = True
 
-    def check_jobs(self, job=None):
+    def check_jobs(self, job=None, check_now=True):
         if self.updating_now:
             return
         self.updating_now = True
@@ -347,12 +362,30 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
             if job is None:
                 for i in xrange(self.jobView.topLevelItemCount()):
                     vistrail_item = self.jobView.topLevelItem(i)
-                    self.update_job(vistrail_item, force=False)
+                    self.update_job(vistrail_item, force=False,
+                                    check_now=check_now)
             else:
-                self.update_job(job)
+                self.update_job(job, check_now=check_now)
         finally:
             self.updating_now = False
 
+    def job_finished(self, jobMonitor, id):
+        """Called when the poller of a vistrail sees a job complete.
+        """
+        if self.updating_now:
+            return
+        for vistrail_item in self.widgets.itervalues():
+            if vistrail_item.jobMonitor is not jobMonitor:
+                continue
+            for workflow_item in vistrail_item.workflowItems.values():
+                if id in workflow_item.jobs and not workflow_item.paused:
+                    self.updating_now = True
+                    try:
+                        self.update_job(workflow_item, force=False,
+                                        check_now=False)
+                    finally:
+                        self.updating_now = False
+
     def check_selected_job(self):
         items = self.jobView.selectedItems()
         if len(items) != 1:
@@ -360,7 +393,9 @@ class QJobView(QtGui.QWidget, QVistrailsPaletteInterface):
         self.check_jobs(items[0])
 
     def timerEvent(self, id=None):
-        self.check_jobs()
+        # running jobs are checked by the pollers, this picks up workflows
+        # that are not monitored yet
+        self.check_jobs(check_now=False)
 
     def keyPressEvent(self, event):
         if event.key() in [QtCore.Qt.Key_Delete, QtCore.Qt.Key_Backspace]:
@@ -583,38 +618,55 @@ class QVistrailItem(QtGui.QTreeWidgetItem):
                                           old_progress.value(),
                                           old_progress.maximum())
             progress.show()
-            while not is_done:
-                dieTime = QtCore.QDateTime.currentDateTime().addSecs(interval)
-                while QtCore.QDateTime.currentDateTime() < dieTime and not is_done:
-                    QtCore.QCoreApplication.processEvents(QtCore.QEventLoop.AllEvents, 100)
-                    if progress.was_checked:
-                        progress.check_now_button.setText('Checking')
-                        progress.check_now_button.setEnabled(False)
-                        progress.cancel_button.setEnabled(False)
-                        is_done = self.jobMonitor.isDone(handle)
-                        progress.check_now_button.setText('Check &Now')
-                        progress.check_now_button.setEnabled(True)
-                        progress.cancel_button.setEnabled(True)
-                        progress.was_checked = False
-                        progress.updateLabel()
-                    elif progress.was_cancelled:
-                        # this does not work, need to create a new progress dialog
-                        #old_progress.goOn()
-                        new_progress = old_progress.__class__(old_progress.parent())
-                        new_progress.setMaximum(old_progress.maximum())
-                        new_progress.setValue(old_progress.value())
-                        new_progress.setLabelText(old_progress.labelText())
-                        new_progress.setMinimumDuration(0)
-                        new_progress.suspended = True
-                        self.controller.progress = new_progress
-                        old_progress.deleteLater()
-                        progress.hide()
-                        new_progress.show()
-                        QtCore.QCoreApplication.processEvents()
-                        raise ModuleSuspended(module,
-                                   'Interrupted by user, job'
-                                   ' is still running', handle=handle)
-                is_done = is_done or self.jobMonitor.isDone(handle)
+            # sleep in an event loop until the poller sees the job complete
+            poller = self.jobMonitor.poller
+            loop = QtCore.QEventLoop()
+            def finished(jobMonitor, job_id):
+                if jobMonitor is self.jobMonitor and job_id == id:
+                    loop.quit()
+            def check_now():
+                progress.check_now_button.setText('Checking')
+                progress.check_now_button.setEnabled(False)
+                progress.cancel_button.setEnabled(False)
+                poller.check([id])
+                progress.check_now_button.setText('Check &Now')
+                progress.check_now_button.setEnabled(True)
+                progress.cancel_button.setEnabled(True)
+                progress.updateLabel()
+            view = QJobView.instance()
+            # the workflow is still executing, don't let the view resume it
+            updating_now, view.updating_now = view.updating_now, True
+            view.jobFinished.connect(finished)
+            progress.check_now_button.clicked.connect(check_now)
+            progress.cancel_button.clicked.connect(loop.quit)
+            try:
+                if not poller.is_done(id):
+                    loop.exec_()
+            finally:
+                view.updating_now = updating_now
+                # the handlers only live for this wait, don't let them
+                # accumulate over the checks of a workflow's jobs
+                view.jobFinished.disconnect(finished)
+                progress.check_now_button.clicked.disconnect(check_now)
+                progress.cancel_button.clicked.disconnect(loop.quit)
+                progress.hide()
+                progress.deleteLater()
+            if not poller.is_done(id):
+                # this does not work, need to create a new progress dialog
+                #old_progress.goOn()
+                new_progress = old_progress.__class__(old_progress.parent())
+                new_progress.setMaximum(old_progress.maximum())
+                new_progress.setValue(old_progress.value())
+                new_progress.setLabelText(old_progress.labelText())
+                new_progress.setMinimumDuration(0)
+                new_progress.suspended = True
+                self.controller.progress = new_progress
+                old_progress.deleteLater()
+                new_progress.show()
+                QtCore.QCoreApplication.processEvents()
+                raise ModuleSuspended(module,
+                           'Interrupted by user, job'
+                           ' is still running', handle=handle)
             # is_done!
             new_progress = old_progress.__class__(old_progress.parent())
             new_progress.setMaximum(old_progress.maximum())
@@ -624,7 +676,6 @@ class QVistrailItem(QtGui.QTreeWidgetItem):
             new_progress.suspended = True
             self.controller.progress = new_progress
             old_progress.deleteLater()
-            progress.hide()
             new_progress.show()
             QtCore.QCoreApplication.processEvents()
             return
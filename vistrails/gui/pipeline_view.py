@@ -88,6 +88,20 @@ import warnings
 import vistrails.api
 import vistrails.gui.utils
 
+# Ports are not drawn below this level of detail
+# TODO: Unlike the version tree (see version_view.VIRTUAL_SCENE_MIN_VERSIONS),
+# the pipeline scene still creates an item for every module, port and
+# connection, so large pipelines only save painting time through these
+# cutoffs. Virtualizing it means drawing the modules away from the viewport
+# as glyphs in drawBackground(), creating module items near the viewport
+# only, and giving the connections to modules without an item a lightweight
+# stand-in endpoint; QPipelineScene.modules is then no longer complete and
+# its users (selection, copy, layout, dragging) have to be moved to the
+# pipeline.
+PORT_MIN_LOD = 0.3
+# Module labels are not drawn below this level of detail
+MODULE_LABEL_MIN_LOD = 0.3
+
 ##############################################################################
 # 2008-06-24 cscheid
 #
@@ -234,6 +248,9 @@ class QAbstractGraphicsPortItem(QtGui.QAbstractGraphicsShapeItem):
         raise NotImplementedError("Must implement draw method")
 
     def paint(self, painter, option, widget=None):
+        if (option.levelOfDetailFromTransform(painter.worldTransform()) <
+                PORT_MIN_LOD):
+            return
         painter.setPen(self.pen())
         painter.setBrush(self.brush())
         self.draw(painter, option, widget)
@@ -1474,6 +1491,11 @@ class QGraphicsModuleItem(QGraphicsItemInterface, QtGui.QGraphicsItem):
                 painter.fillRect(progressRect, self.progressBrush)
             painter.setBrush(QtCore.Qt.NoBrush)
             painter.drawRect(self.paddedRect)
+
+        # labels are unreadable when zoomed out
+        if (option.levelOfDetailFromTransform(painter.worldTransform()) <
+                MODULE_LABEL_MIN_LOD):
+            return
     
         # draw module labels
         painter.setPen(self.labelPen)
@@ -2160,6 +2182,8 @@ class QPipelineScene(QInteractiveGraphicsScene):
         # faster when switching pipelines via setupScene()
         self._old_module_ids = set()
         self._old_connection_ids = set()
+        # (version, pipeline) the items were last set up from
+        self._scene_pipeline = None
         self._var_selected_port = None
         self.read_only_mode = False
         self.current_pipeline = None
@@ -2259,6 +2283,7 @@ class QPipelineScene(QInteractiveGraphicsScene):
         self.connections = {}
         self._old_module_ids = set()
         self._old_connection_ids = set()
+        self._scene_pipeline = None
         self.unselect_all()
         self.clearItems()
         
@@ -2330,9 +2355,17 @@ class QPipelineScene(QInteractiveGraphicsScene):
         if self.modules[m_id].moduleFunctionsHaveChanged(module):
             self.modules[m_id].update_function_ports(module)
 
-    def setupScene(self, pipeline):
-        """ setupScene(pipeline: Pipeline) -> None
+    def setupScene(self, pipeline, delta=None):
+        """ setupScene(pipeline: Pipeline, delta: tuple) -> None
         Construct the scene to view a pipeline
+
+        delta is the (old_version, old_pipeline, new_pipeline,
+        module_ids, connection_ids) tuple of
+        VistrailController.get_pipeline_delta. If the scene was last set
+        up from old_pipeline at old_version, only the items of the listed
+        modules and connections are checked for changes. Every module and
+        connection of the pipeline gets an item (see the TODO at
+        PORT_MIN_LOD).
         
         """
         old_pipeline = self.current_pipeline
@@ -2345,6 +2378,15 @@ class QPipelineScene(QInteractiveGraphicsScene):
             self.clear()
         if not pipeline: return 
 
+        if (delta is not None and self._scene_pipeline is not None and
+                delta[0] == self._scene_pipeline[0] and
+                delta[1] is self._scene_pipeline[1] and
+                delta[2] is pipeline and
+                not (self.controller and self.controller.search)):
+            changed_modules, changed_connections = delta[3:]
+        else:
+            changed_modules = changed_connections = None
+
         needReset = len(self.items())==0
         try:
             self.skip_update = True
@@ -2358,6 +2400,33 @@ class QPipelineScene(QInteractiveGraphicsScene):
             connections_to_be_deleted = self._old_connection_ids - new_connections
             common_connections = new_connections.intersection(self._old_connection_ids)
 
+            selected_modules = []
+            if changed_modules is not None:
+                changed_modules = set(changed_modules)
+                changed_connections = set(changed_connections)
+                # the optional ports shown on a module depend on its
+                # connections, so recheck the modules at both ends
+                scene_pipeline = self._scene_pipeline[1]
+                for c_id in changed_connections.union(
+                        connections_to_be_added, connections_to_be_deleted):
+                    for p in (pipeline, scene_pipeline):
+                        if c_id in p.connections:
+                            connection = p.connections[c_id]
+                            changed_modules.add(connection.source.moduleId)
+                            changed_modules.add(
+                                connection.destination.moduleId)
+                # the other items already show the new pipeline
+                selected_modules.extend(m_id for m_id in common_modules
+                                        if m_id not in changed_modules and
+                                        self.modules[m_id].isSelected())
+                common_modules.intersection_update(changed_modules)
+                for m_id in common_modules:
+                    changed_connections.update(
+                        c_id for (_, c_id) in pipeline.graph.edges_from(m_id))
+                    changed_connections.update(
+                        c_id for (_, c_id) in pipeline.graph.edges_to(m_id))
+                common_connections.intersection_update(changed_connections)
+
 
             # Check if connections to be added require
             # optional ports in modules to be visible
@@ -2383,7 +2452,6 @@ class QPipelineScene(QInteractiveGraphicsScene):
             for m_id in modules_to_be_deleted:
                 self.remove_module(m_id)
 
-            selected_modules = []
             # create new module shapes
             for m_id in modules_to_be_added:
                 self.addModule(pipeline.modules[m_id])
@@ -2426,6 +2494,7 @@ class QPipelineScene(QInteractiveGraphicsScene):
 
             self._old_module_ids = new_modules
             self._old_connection_ids = new_connections
+            self._scene_pipeline = (self.current_version, pipeline)
             self.unselect_all()
             self.reset_module_colors()
             for m_id in selected_modules:
@@ -3832,7 +3901,8 @@ class QPipelineView(QInteractiveGraphicsView, BaseView):
         return self.controller
 
     def version_changed(self):
-        self.scene().setupScene(self.controller.current_pipeline)
+        self.scene().setupScene(self.controller.current_pipeline,
+                                self.controller.current_pipeline_delta)
 
     def run_control_flow_assist(self):
         currentScene = self.scene()
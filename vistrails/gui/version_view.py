@@ -50,6 +50,7 @@ from __future__ import division
 from PyQt4 import QtCore, QtGui
 from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core import debug
+from vistrails.core.data_structures.spatial_index import SpatialIndex
 from vistrails.core.system import systemType
 from vistrails.core.thumbnails import ThumbnailCache
 from vistrails.core.vistrail.controller import custom_color_key, \
@@ -65,6 +66,45 @@ from vistrails.gui.version_prop import QVersionPropOverlay
 from vistrails.gui.collection.workspace import QParamExplorationEntityItem
 import vistrails.gui.utils
 
+import copy
+import unittest
+
+# Version trees with more versions than this only get graphics items for
+# the versions around the visible area
+VIRTUAL_SCENE_MIN_VERSIONS = 2000
+# Below this view scale no version items are created, versions and links
+# are drawn as simple glyphs
+VIRTUAL_SCENE_MIN_SCALE = 0.3
+# Part of the visible area added on each side when creating items
+VIRTUAL_SCENE_MARGIN = 0.5
+# Labels are not drawn below this level of detail
+VERSION_LABEL_MIN_LOD = 0.3
+
+def versions_in_rect(index, version_nodes, bounds, scale, pinned=[]):
+    """ versions_in_rect(index: SpatialIndex, version_nodes: dict,
+                         bounds: tuple, scale: float,
+                         pinned: list) -> (dict, set)
+    Return the layout nodes of the versions that need an item in a
+    virtual scene, by id, and the links that need an item. bounds is the
+    (x0, y0, x1, y1) area shown by the views and scale their largest
+    scale. Pinned versions always get an item.
+
+    """
+    nodes = {}
+    edges = set()
+    for v in pinned:
+        if v in version_nodes:
+            nodes[v] = version_nodes[v]
+    if scale < VIRTUAL_SCENE_MIN_SCALE:
+        return (nodes, edges)
+    for (kind, key) in index.query(*bounds):
+        if kind == 'version':
+            nodes[key] = version_nodes[key]
+        else:
+            edges.add(key)
+            for v in key:
+                nodes[v] = version_nodes[v]
+    return (nodes, edges)
 
 ################################################################################
 # QGraphicsLinkItem
@@ -348,6 +388,17 @@ class QGraphicsVersionTextItem(QGraphicsItemInterface, QtGui.QGraphicsTextItem):
         self.updatePos()
         self.parentItem().updateWidthFromLabel()
 
+    def paint(self, painter, option, widget=None):
+        """ paint(painter: QPainter, option: QStyleOptionGraphicsItem,
+                  widget: QWidget) -> None
+        Skip the label when it is too small to be read
+
+        """
+        if (option.levelOfDetailFromTransform(painter.worldTransform()) <
+                VERSION_LABEL_MIN_LOD and not self.hasFocus()):
+            return
+        QtGui.QGraphicsTextItem.paint(self, painter, option, widget)
+
     def updatePos(self):
         """ updatePos() -> None
         Center the text, by default it uses the upper left corner
@@ -789,6 +840,19 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         self.fullGraph = None
         self.emit_selection = True
         self.select_by_click = True
+
+        # When virtual, items only exist for the versions around the
+        # visible area; the layout of the whole tree is kept in
+        # version_index and the other versions are drawn as glyphs
+        self.virtualize = True
+        self.virtual = False
+        self.tree = None
+        self.version_nodes = {}
+        self.version_edges = {}
+        self.version_colors = {}
+        self.version_index = SpatialIndex()
+        self.version_bounds = QtCore.QRectF()
+        self._visible_update_pending = False
         self.connect(self, QtCore.SIGNAL("selectionChanged()"),
                      self.selectionChanged)
 
@@ -850,7 +914,11 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         ourMaxRank = 0
         otherMaxRank = 0
         am = controller.vistrail.actionMap
-        for nodeId in sorted(self.versions.keys()):
+        if self.virtual:
+            versions = self.version_nodes.keys()
+        else:
+            versions = self.versions.keys()
+        for nodeId in sorted(versions):
             if nodeId!=0:
                 nodeUser = am[nodeId].user
                 if nodeUser==currentUser:
@@ -859,9 +927,10 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
                 else:
                     ranks[nodeId] = otherMaxRank
                     otherMaxRank += 1
-        for (nodeId, item) in self.versions.iteritems():
+        self.version_colors = {}
+        for nodeId in versions:
             if nodeId == 0:
-                item.setGhosted(True)
+                self.version_colors[nodeId] = None
                 continue
             nodeUser = am[nodeId].user
             if controller.search and nodeId!=0:
@@ -896,9 +965,11 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
             else:
                 custom_color = None
             ####
-            item.update_color(nodeUser==currentUser,
-                              ranks[nodeId],
-                              max_rank, ghosted, custom_color)
+            self.version_colors[nodeId] = (nodeUser==currentUser,
+                                           ranks[nodeId],
+                                           max_rank, ghosted, custom_color)
+        for (nodeId, item) in self.versions.iteritems():
+            self.update_version_color(nodeId, item)
         for (version_from, version_to), link in self.edges.iteritems():
             if self.versions[version_from].ghosted and \
                     self.versions[version_to].ghosted:
@@ -906,6 +977,18 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
             else:
                 link.setGhosted(False)
 
+    def update_version_color(self, nodeId, item):
+        """ update_version_color(nodeId: int,
+                                 item: QGraphicsVersionItem) -> None
+        Set the colors computed by adjust_version_colors on a version item
+
+        """
+        colors = self.version_colors.get(nodeId)
+        if colors is None:
+            item.setGhosted(True)
+        else:
+            item.update_color(*colors)
+
     def update_scene_single_node_change(self, controller, old_version, new_version):
         """ update_scene_single_node_change(controller: VistrailController,
         old_version, new_version: int) -> None
@@ -922,6 +1005,12 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         # change
         self.adjust_version_colors(controller)
 
+        if self.virtual:
+            self.rename_virtual_version(old_version, new_version)
+            if old_version not in self.versions:
+                # the version has no item
+                return
+
         # update version item
         v = self.versions[old_version]
         old_desc = controller.vistrail.get_description(old_version)
@@ -937,6 +1026,8 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         # update link items
         dst = controller._current_terse_graph.edges_from(new_version)
         for eto, (expand, collapse) in dst:
+            if (old_version, eto) not in self.edges:
+                continue
             edge = self.edges[(old_version, eto)]
             edge.setupLink(self.versions[new_version],
                            self.versions[eto],
@@ -947,6 +1038,8 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
 
         src = controller._current_terse_graph.edges_to(new_version)
         for efrom, (expand, collapse) in src:
+            if (efrom, old_version) not in self.edges:
+                continue
             edge = self.edges[(efrom, old_version)]
             edge.setupLink(self.versions[efrom],
                            self.versions[new_version],
@@ -966,12 +1059,28 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         # perform graph layout
         (tree, self.fullGraph, layout) = controller.refine_graph()
 
+        self.tree = tree
+        self.virtual = (self.virtualize and
+                        len(layout.nodes) > VIRTUAL_SCENE_MIN_VERSIONS)
+        if self.virtual:
+            self.build_version_index(tree, layout)
+            pinned = [v.id for v in self.selectedItems()
+                      if isinstance(v, QGraphicsVersionItem)]
+            if select_node:
+                pinned.append(controller.current_base_version)
+            (nodes, edges) = self.versions_in_view(pinned)
+        else:
+            self.version_nodes = {}
+            self.version_edges = {}
+            self.version_index.clear()
+            nodes = layout.nodes
+
         # compute nodes that should be removed
         # O(n  * (hashmap query key time)) on 
         # where n is the number of current 
         # nodes in the scene
         removeNodeSet = set(i for i in self.versions
-                            if not i in tree.vertices)
+                            if not i in nodes)
 
         # compute edges to be removed
         # O(n * (hashmap query key time)) 
@@ -980,7 +1089,8 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         removeEdgeSet = set((s, t) for (s, t) in self.edges
                             if (s in removeNodeSet or
                                 t in removeNodeSet or
-                                not tree.has_edge(s, t)))
+                                not tree.has_edge(s, t) or
+                                (self.virtual and (s, t) not in edges)))
 
         # loop on the nodes of the tree
         vistrail = controller.vistrail
@@ -988,7 +1098,7 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         last_n = vistrail.getLastActions(controller.num_versions_always_shown)
 
         self.emit_selection = False
-        for node in layout.nodes.itervalues():
+        for node in nodes.itervalues():
             # version id
             v = node.id
 
@@ -1021,24 +1131,228 @@ class QVersionTreeScene(QInteractiveGraphicsScene):
         self.adjust_version_colors(controller)
 
         # Add or update links
-        for source, source_tag in tree.vertices.iteritems():
-            eFrom = tree.edges_from(source)
-            for target, (expand, collapse) in eFrom:
-                guiSource = self.versions[source]
-                guiTarget = self.versions[target]
-                if self.edges.has_key((source,target)):
-                    linkShape = self.edges[(source,target)]
-                    linkShape.setupLink(guiSource, guiTarget,
-                                        expand, collapse)
-                else:
-                    self.addLink(guiSource, guiTarget, 
-                                 expand, collapse)
+        if self.virtual:
+            links = ((source, target, self.version_edges[(source, target)])
+                     for (source, target) in edges)
+        else:
+            links = ((source, target, data)
+                     for source in tree.vertices
+                     for target, data in tree.edges_from(source))
+        for source, target, (expand, collapse) in links:
+            guiSource = self.versions[source]
+            guiTarget = self.versions[target]
+            if self.edges.has_key((source,target)):
+                linkShape = self.edges[(source,target)]
+                linkShape.setupLink(guiSource, guiTarget,
+                                    expand, collapse)
+            else:
+                self.addLink(guiSource, guiTarget, 
+                             expand, collapse)
 
         # Update bounding rects and fit to all view
         self.updateSceneBoundingRect()
 
         self.select_by_click = True
 
+    def build_version_index(self, tree, layout):
+        """ build_version_index(tree: Graph,
+                                layout: VistrailsTreeLayoutLW) -> None
+        Index the boxes of the versions and links of the laid out tree
+
+        """
+        self.version_nodes = dict(layout.nodes)
+        self.version_edges = {}
+        self.version_index.clear()
+        self.version_bounds = QtCore.QRectF()
+        for v, node in self.version_nodes.iteritems():
+            x0 = node.p.x - node.width/2.0
+            y0 = node.p.y - node.height/2.0
+            self.version_index.add(('version', v), x0, y0,
+                                   x0 + node.width, y0 + node.height)
+            self.version_bounds = self.version_bounds.united(
+                QtCore.QRectF(x0, y0, node.width, node.height))
+        for source in tree.vertices:
+            p1 = self.version_nodes[source].p
+            for target, data in tree.edges_from(source):
+                p2 = self.version_nodes[target].p
+                self.version_edges[(source, target)] = data
+                self.version_index.add(('link', (source, target)),
+                                       min(p1.x, p2.x), min(p1.y, p2.y),
+                                       max(p1.x, p2.x), max(p1.y, p2.y))
+
+    def rename_virtual_version(self, old_version, new_version):
+        """ rename_virtual_version(old_version, new_version: int) -> None
+        Move the layout of a version to a new id, see
+        update_scene_single_node_change
+
+        """
+        node = copy.copy(self.version_nodes.pop(old_version))
+        node.id = new_version
+        self.version_nodes[new_version] = node
+        box = self.version_index.box(('version', old_version))
+        self.version_index.remove(('version', old_version))
+        self.version_index.add(('version', new_version), *box)
+        for (source, target) in self.version_edges.keys():
+            if old_version in (source, target):
+                data = self.version_edges.pop((source, target))
+                box = self.version_index.box(('link', (source, target)))
+                self.version_index.remove(('link', (source, target)))
+                if source == old_version:
+                    source = new_version
+                else:
+                    target = new_version
+                self.version_edges[(source, target)] = data
+                self.version_index.add(('link', (source, target)), *box)
+        if old_version in self.version_colors:
+            self.version_colors[new_version] = \
+                self.version_colors.pop(old_version)
+
+    def visible_rect(self):
+        """ visible_rect() -> (QRectF, float)
+        Return the area of the scene shown by the views, with a margin,
+        and the largest scale of the views
+
+        """
+        rect = QtCore.QRectF()
+        scale = 0.0
+        for view in self.views():
+            rect = rect.united(
+                view.mapToScene(view.viewport().rect()).boundingRect())
+            scale = max(scale, abs(view.matrix().m11()))
+        margin = max(rect.width(), rect.height()) * VIRTUAL_SCENE_MARGIN
+        return (rect.adjusted(-margin, -margin, margin, margin), scale)
+
+    def versions_in_view(self, pinned=[]):
+        """ versions_in_view(pinned: list) -> (dict, set)
+        Return the layout nodes of the versions that need an item, by
+        id, and the links that need an item. These are the versions
+        and links around the visible area, unless the views are zoomed
+        out, plus the pinned versions.
+
+        """
+        (rect, scale) = self.visible_rect()
+        return versions_in_rect(self.version_index, self.version_nodes,
+                                (rect.left(), rect.top(),
+                                 rect.right(), rect.bottom()),
+                                scale, pinned)
+
+    def schedule_visible_update(self):
+        """ schedule_visible_update() -> None
+        Update the items of a virtual scene once control returns to the
+        event loop
+
+        """
+        if self.virtual and not self._visible_update_pending:
+            self._visible_update_pending = True
+            QtCore.QTimer.singleShot(0, self.update_visible_versions)
+
+    def update_visible_versions(self):
+        """ update_visible_versions() -> None
+        Create the items of a virtual scene around the visible area and
+        remove the ones that are far from it
+
+        """
+        self._visible_update_pending = False
+        if not self.virtual or self.controller is None:
+            return
+        pinned = [v.id for v in self.selectedItems()
+                  if isinstance(v, QGraphicsVersionItem)]
+        pinned.extend(v.id for v in self.versions.itervalues()
+                      if v.text.hasFocus())
+        (nodes, edges) = self.versions_in_view(pinned)
+
+        self.emit_selection = False
+        for (v1, v2) in [e for e in self.edges if e not in edges]:
+            self.removeLink(v1, v2)
+        for v in [v for v in self.versions if v not in nodes]:
+            self.removeVersion(v)
+        vistrail = self.controller.vistrail
+        am = vistrail.actionMap
+        for v, node in nodes.iteritems():
+            if v not in self.versions:
+                self.addVersion(node, am.get(v, None),
+                                self.tree.vertices.get(v, None),
+                                vistrail.get_description(v))
+                self.update_version_color(v, self.versions[v])
+        for (source, target) in edges:
+            if (source, target) not in self.edges:
+                (expand, collapse) = self.version_edges[(source, target)]
+                self.addLink(self.versions[source], self.versions[target],
+                             expand, collapse)
+        self.emit_selection = True
+
+    def drawBackground(self, painter, rect):
+        """ drawBackground(painter: QPainter, rect: QRectF) -> None
+        Draw the versions and links that have no item as simple glyphs
+
+        """
+        QInteractiveGraphicsScene.drawBackground(self, painter, rect)
+        if not self.virtual:
+            return
+        ellipses = []
+        lines = []
+        nodes = self.version_nodes
+        for (kind, key) in self.version_index.query(rect.left(), rect.top(),
+                                                    rect.right(),
+                                                    rect.bottom()):
+            if kind == 'version':
+                if key not in self.versions:
+                    node = nodes[key]
+                    ellipses.append(QtCore.QRectF(
+                            node.p.x - node.width/2.0,
+                            node.p.y - node.height/2.0,
+                            node.width, node.height))
+            elif key not in self.edges:
+                (p1, p2) = (nodes[key[0]].p, nodes[key[1]].p)
+                lines.append(QtCore.QLineF(p1.x, p1.y, p2.x, p2.y))
+        painter.save()
+        painter.setPen(CurrentTheme.LINK_PEN)
+        painter.drawLines(lines)
+        painter.setPen(CurrentTheme.VERSION_PEN)
+        painter.setBrush(CurrentTheme.VERSION_USER_BRUSH)
+        for ellipse in ellipses:
+            painter.drawEllipse(ellipse)
+        painter.restore()
+
+    def contentsBoundingRect(self):
+        """ contentsBoundingRect() -> QRectF
+        Compute the bounding rect of the whole tree, including the
+        versions that have no item
+
+        """
+        rect = QInteractiveGraphicsScene.contentsBoundingRect(self)
+        if self.virtual:
+            rect = rect.united(self.version_bounds)
+        return rect
+
+    def fitToView(self, view, recompute_bounding_rect=False):
+        QInteractiveGraphicsScene.fitToView(self, view,
+                                            recompute_bounding_rect)
+        self.schedule_visible_update()
+
+    def saveToPDF(self, filename):
+        self.save_all_versions(QInteractiveGraphicsScene.saveToPDF, filename)
+
+    def saveToPNG(self, filename, width=None):
+        self.save_all_versions(QInteractiveGraphicsScene.saveToPNG, filename,
+                               width)
+
+    def save_all_versions(self, save, *args):
+        """ save_all_versions(save: method, *args) -> None
+        Call save with an item for every version
+
+        """
+        if not self.virtual:
+            save(self, *args)
+            return
+        self.virtualize = False
+        try:
+            self.setupScene(self.controller, False)
+            save(self, *args)
+        finally:
+            self.virtualize = True
+            self.setupScene(self.controller, False)
+
     def keyPressEvent(self, event):
         """ keyPressEvent(event: QKeyEvent) -> None
         Capture 'Del', 'Backspace' for pruning versions when not editing a tag
@@ -1194,6 +1508,19 @@ class QVersionTreeView(QInteractiveGraphicsView, BaseView):
                     item.text.clearFocus()
         qt_super(QVersionTreeView, self).selectModules()
                 
+    def scrollContentsBy(self, dx, dy):
+        QInteractiveGraphicsView.scrollContentsBy(self, dx, dy)
+        self.scene().schedule_visible_update()
+
+    def resizeEvent(self, event):
+        result = QInteractiveGraphicsView.resizeEvent(self, event)
+        self.scene().schedule_visible_update()
+        return result
+
+    def updateMatrix(self):
+        QInteractiveGraphicsView.updateMatrix(self)
+        self.scene().schedule_visible_update()
+
     def set_title(self, title):
         BaseView.set_title(self, title)
         self.setWindowTitle(title)
@@ -1272,3 +1599,49 @@ class QVersionTreeView(QInteractiveGraphicsView, BaseView):
 
     def select_current_version(self):
         self.scene().setupScene(self.controller)
+
+
+################################################################################
+# Testing
+
+
+class TestVersionsInRect(unittest.TestCase):
+
+    def make_index(self, n):
+        # a chain of n versions, 100 units apart
+        index = SpatialIndex()
+        nodes = {}
+        for v in xrange(n):
+            nodes[v] = 'node%d' % v
+            index.add(('version', v), v*100.0, 0.0, v*100.0 + 50.0, 20.0)
+            if v > 0:
+                index.add(('link', (v - 1, v)), (v - 1)*100.0 + 25.0, 10.0,
+                          v*100.0 + 25.0, 10.0)
+        return (index, nodes)
+
+    def test_visible(self):
+        (index, nodes) = self.make_index(5000)
+        (vnodes, edges) = versions_in_rect(index, nodes,
+                                           (1060.0, -10.0, 1290.0, 30.0),
+                                           1.0)
+        # versions 11 and 12 are visible, 10 and 13 through their links
+        self.assertEqual(sorted(vnodes), [10, 11, 12, 13])
+        self.assertEqual(vnodes[11], 'node11')
+        self.assertEqual(edges, set([(10, 11), (11, 12), (12, 13)]))
+
+    def test_pinned(self):
+        (index, nodes) = self.make_index(100)
+        (vnodes, edges) = versions_in_rect(index, nodes,
+                                           (0.0, 0.0, 60.0, 20.0),
+                                           1.0, [0, 99, 1000])
+        self.assertEqual(sorted(vnodes), [0, 1, 99])
+        self.assertEqual(edges, set([(0, 1)]))
+
+    def test_zoomed_out(self):
+        (index, nodes) = self.make_index(100)
+        (vnodes, edges) = versions_in_rect(index, nodes,
+                                           (0.0, 0.0, 10000.0, 20.0),
+                                           VIRTUAL_SCENE_MIN_SCALE / 2.0,
+                                           [42])
+        self.assertEqual(vnodes.keys(), [42])
+        self.assertEqual(edges, set())
@@ -555,7 +555,17 @@ class QDiffView(QPipelineView):
         self.diff_versions = ((vistrail_a, version_a), 
                               (vistrail_b, version_b))
         self.set_diff_version_names()
-        self.diff = vistrails.core.db.io.get_workflow_diff(*self.diff_versions)
+        # Reuse the controller's cached pipelines instead of replaying
+        # the actions from the root
+        pipeline_a = self.controller.get_pipeline(version_a,
+                                                  do_validate=False)
+        pipeline_b = None
+        if vistrail_b is vistrail_a:
+            pipeline_b = self.controller.get_pipeline(version_b,
+                                                      do_validate=False)
+        self.diff = vistrails.core.db.io.get_workflow_diff(*self.diff_versions,
+                                                           pipeline_1=pipeline_a,
+                                                           pipeline_2=pipeline_b)
             # self.controller.vistrail.get_pipeline_diff(version_a, version_b)
         (p1, p2, v1Andv2, heuristicMatch, v1Only, v2Only, paramChanged,
          cparamChanged, annotChanged) = self.diff
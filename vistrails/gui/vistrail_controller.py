@@ -55,7 +55,7 @@ from vistrails.core.log.opm_graph import OpmGraph
 from vistrails.core.log.prov_document import ProvDocument
 from vistrails.core.modules.abstraction import identifier as abstraction_pkg
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.param_explore import ActionBasedParameterExploration
+from vistrails.core.param_explore import ParameterExplorationExecutor
 from vistrails.core.query.version import TrueSearch
 from vistrails.core.query.visual import VisualQuery
 from vistrails.core.utils import DummyView, VistrailsInternalError, InvalidPipeline
@@ -1254,30 +1254,16 @@ class VistrailController(QtCore.QObject, BaseController):
 
         if self.current_pipeline and actions:
             pe_log_id = uuid.uuid1()
-            explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
-                self.current_pipeline, actions, pre_actions)
-            
-            dim = [max(1, len(a)) for a in actions]
+            # The pipelines are generated one at a time as they get executed
+            executor = ParameterExplorationExecutor(self.current_pipeline,
+                                                    actions, pre_actions)
+            dim = executor.dims
             if use_spreadsheet:
-                from vistrails.gui.paramexplore.virtual_cell import positionPipelines, assembleThumbnails
+                from vistrails.gui.paramexplore.virtual_cell import positionPipeline, assembleThumbnails
                 from vistrails.gui.paramexplore.pe_view import QParamExploreView
-                modifiedPipelines, pipelinePositions = positionPipelines(
-                    'PE#%d %s' % (QParamExploreView.explorationId, self.name),
-                    dim[2], dim[1], dim[0], pipelines, pe.layout, self)
+                sheetPrefix = 'PE#%d %s' % (QParamExploreView.explorationId,
+                                            self.name)
                 QParamExploreView.explorationId += 1
-            else:
-                from vistrails.core.param_explore import _pipelinePositions
-                modifiedPipelines = pipelines
-                pipelinePositions = _pipelinePositions(
-                    dim[2], dim[1], dim[0], pipelines)
-
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount)==0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
 
             from vistrails.gui.job_monitor import QJobView
             jobView = QJobView.instance()
@@ -1287,21 +1273,35 @@ class VistrailController(QtCore.QObject, BaseController):
                 return
             jobView.updating_now = True
 
+            pinned = None
             try:
                 # Now execute the pipelines
 
                 if showProgress:
-                    totalProgress = sum([len(p.modules) for p in modifiedPipelines])
+                    totalProgress = (executor.cell_count *
+                                     len(self.current_pipeline.modules))
                     self.progress = PEProgressDialog(self.vistrail_view, totalProgress)
                     self.progress.show()
 
                 interpreter = get_default_interpreter()
+                # modules not affected by the exploration are computed by
+                # the first cell and kept until the end
+                invariant = executor.plan().invariant
 
                 images = {}
                 errors = []
-                for pi in xrange(len(modifiedPipelines)):
+                pipelinePositions = {}
+                for cell in executor.cells():
+                    pi = cell.index
+                    if use_spreadsheet:
+                        cell.pipeline, pipelinePositions[pi] = \
+                            positionPipeline(sheetPrefix, dim[2], dim[1],
+                                             dim[0], pi, cell.pipeline,
+                                             pe.layout, self)
+                    else:
+                        pipelinePositions[pi] = cell.position
                     if showProgress:
-                        self.progress.setValue(mCount[pi])
+                        self.progress.setValue(pi * len(cell.pipeline.modules))
                         QtCore.QCoreApplication.processEvents()
                         if self.progress.wasCanceled():
                             break
@@ -1322,7 +1322,7 @@ class VistrailController(QtCore.QObject, BaseController):
                               'current_version': self.current_version,
                               'reason': 'Parameter Exploration %s %s_%s_%s' % pe_cell_id,
                               'logger': self.get_logger(),
-                              'actions': performedActions[pi],
+                              'actions': cell.actions,
                               'extra_info': extra_info
                               }
                     if view:
@@ -1349,9 +1349,12 @@ class VistrailController(QtCore.QObject, BaseController):
                         current_workflow = JobWorkflow(job_id)
                         self.jobMonitor.startWorkflow(current_workflow)
                     try:
-                        result = interpreter.execute(modifiedPipelines[pi], **kwargs)
+                        result = interpreter.execute(cell.pipeline, **kwargs)
                     finally:
                         self.jobMonitor.finishWorkflow()
+                    if pinned is None:
+                        pinned = interpreter.pin_modules(cell.pipeline,
+                                                         invariant)
 
                     for error in result.errors.itervalues():
                         if use_spreadsheet:
@@ -1362,6 +1365,8 @@ class VistrailController(QtCore.QObject, BaseController):
 
             finally:
                 jobView.updating_now = False
+                if pinned:
+                    interpreter.unpin_modules(pinned)
                 if showProgress:
                     self.progress.setValue(totalProgress)
                     self.progress.hide()
@@ -41,4 +41,5 @@ from vistrails.core.configuration import ConfigurationObject
 
 from identifiers import *
 
-configuration = ConfigurationObject(env=(None, str))
+configuration = ConfigurationObject(env=(None, str),
+                                    cache_dir=(None, str))
@@ -0,0 +1,271 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Persistent cache of command-line tool invocations.
+
+Tools that have the 'cache' option get their results stored here, keyed on
+the tool description, the command-line (with the paths of input files
+replaced by the hash of their content, and the temporary output files by
+placeholders), stdin and the environment. The return code, stdout, stderr and
+output files are kept in a content-addressed store, so that identical
+invocations, even from another session, can be replayed without running the
+tool.
+"""
+
+from __future__ import division
+
+import json
+import os
+import shutil
+import tempfile
+
+from vistrails.core.cache.file_hash import get_file_hash_cache
+
+try:
+    import hashlib
+    sha_hash = hashlib.sha1
+except ImportError:
+    import sha
+    sha_hash = sha.new
+
+
+def hash_path(path):
+    """Hashes the content of a file, or of a directory recursively.
+    """
+    return get_file_hash_cache().path_hash(path)
+
+
+class InputPath(object):
+    """Stands for an input path on the command-line.
+
+    The cache key will use the content of the file instead of its name.
+    """
+    def __init__(self, path, prefix=''):
+        self.path = path
+        self.prefix = prefix
+
+
+class OutputPath(object):
+    """Stands for an output file allocated in the file pool.
+    """
+    def __init__(self, name, prefix=''):
+        self.name = name
+        self.prefix = prefix
+
+
+class ToolCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._objects = os.path.join(directory, 'objects')
+        self._entries = os.path.join(directory, 'entries')
+        for d in (self._objects, self._entries):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    @staticmethod
+    def make_key(conf, key_args, stdin=None, env=None, cwd=None):
+        """Computes the cache key for an invocation.
+
+        key_args is the command-line, where InputPath and OutputPath
+        instances stand for the arguments that are file paths. stdin is
+        either None, a string, or an InputPath.
+        """
+        def token(arg):
+            if isinstance(arg, InputPath):
+                return ['in', arg.prefix, hash_path(arg.path)]
+            elif isinstance(arg, OutputPath):
+                return ['out', arg.prefix, arg.name]
+            else:
+                return arg
+        key = {'conf': conf,
+               'args': [token(a) for a in key_args],
+               'stdin': token(stdin),
+               'env': env or {},
+               'cwd': cwd}
+        return sha_hash(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    def _entry_path(self, key):
+        return os.path.join(self._entries, key + '.json')
+
+    def _add_object(self, filename=None, data=None):
+        if filename is not None:
+            digest = hash_path(filename)
+        else:
+            digest = sha_hash(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Write to a temporary file then rename it, so that a concurrent
+        # reader never sees a partial object
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            if filename is not None:
+                os.close(fd)
+                shutil.copyfile(filename, tmp)
+            else:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(data)
+            os.rename(tmp, path)
+        except OSError:
+            # Another process stored the same object
+            if not os.path.exists(path):
+                raise
+            os.remove(tmp)
+        return digest
+
+    def lookup(self, key):
+        """Returns the stored result for this key, or None.
+        """
+        try:
+            with open(self._entry_path(key), 'rb') as fp:
+                entry = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        digests = entry['files'].values()
+        digests.extend(d for d in (entry['stdout'], entry['stderr'])
+                       if d is not None)
+        if not all(os.path.isfile(self._object_path(d)) for d in digests):
+            return None
+        return entry
+
+    def restore(self, entry, output_files):
+        """Replays a stored result.
+
+        output_files is a list of (name, filename) pairs; the stored files
+        are copied to those filenames.
+
+        Returns (return_code, stdout, stderr).
+        """
+        for name, filename in output_files:
+            if name in entry['files']:
+                shutil.copyfile(self._object_path(entry['files'][name]),
+                                filename)
+        results = [entry['return_code']]
+        for stream in ('stdout', 'stderr'):
+            if entry[stream] is None:
+                results.append(None)
+            else:
+                with open(self._object_path(entry[stream]), 'rb') as fp:
+                    results.append(fp.read())
+        return tuple(results)
+
+    def store(self, key, return_code, stdout, stderr, output_files):
+        """Stores the result of an invocation.
+        """
+        entry = {'return_code': return_code,
+                 'stdout': None,
+                 'stderr': None,
+                 'files': {}}
+        if stdout is not None:
+            entry['stdout'] = self._add_object(data=stdout)
+        if stderr is not None:
+            entry['stderr'] = self._add_object(data=stderr)
+        for name, filename in output_files:
+            if os.path.isfile(filename):
+                entry['files'][name] = self._add_object(filename=filename)
+        fd, tmp = tempfile.mkstemp(dir=self._entries, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            json.dump(entry, fp)
+        if os.name == 'nt' and os.path.exists(self._entry_path(key)):
+            os.remove(self._entry_path(key))
+        os.rename(tmp, self._entry_path(key))
+
+    def clear(self):
+        shutil.rmtree(self._objects, ignore_errors=True)
+        shutil.rmtree(self._entries, ignore_errors=True)
+        os.makedirs(self._objects)
+        os.makedirs(self._entries)
+
+
+###############################################################################
+
+import unittest
+
+
+class TestToolCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='vt_test_cltools_')
+        self.cache = ToolCache(os.path.join(self.tmp, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tmp, name)
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        return filename
+
+    def test_key_uses_content(self):
+        conf = {'command': 'cat'}
+        a = self.write('a', 'data')
+        b = self.write('b', 'data')
+        c = self.write('c', 'other')
+        key_a = ToolCache.make_key(conf, ['cat', InputPath(a),
+                                          OutputPath('out')])
+        key_b = ToolCache.make_key(conf, ['cat', InputPath(b),
+                                          OutputPath('out')])
+        key_c = ToolCache.make_key(conf, ['cat', InputPath(c),
+                                          OutputPath('out')])
+        self.assertEqual(key_a, key_b)
+        self.assertNotEqual(key_a, key_c)
+        self.assertNotEqual(key_a,
+                            ToolCache.make_key(conf, ['cat', InputPath(a),
+                                                      OutputPath('out')],
+                                               env={'A': '1'}))
+
+    def test_store_restore(self):
+        out = self.write('out', 'result')
+        self.assertIsNone(self.cache.lookup('k'))
+        self.cache.store('k', 0, 'stdout', None, [('out', out)])
+        os.remove(out)
+
+        entry = self.cache.lookup('k')
+        self.assertIsNotNone(entry)
+        target = os.path.join(self.tmp, 'target')
+        self.assertEqual(self.cache.restore(entry, [('out', target)]),
+                         (0, 'stdout', None))
+        with open(target, 'rb') as fp:
+            self.assertEqual(fp.read(), 'result')
+
+        self.cache.clear()
+        self.assertIsNone(self.cache.lookup('k'))
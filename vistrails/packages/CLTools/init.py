@@ -43,17 +43,20 @@ import shutil
 import subprocess
 import sys
 
+from vistrails.core.interpreter.launcher import get_launcher
 from vistrails.core.modules.vistrails_module import Module, ModuleError, IncompleteImplementation, new_module
 import vistrails.core.modules.module_registry
 from vistrails.core import debug
 from vistrails.core.packagemanager import get_package_manager
 import vistrails.core.system
 from vistrails.core.system import packages_directory, vistrails_root_directory
+from vistrails.packages.CLTools.cache import InputPath, OutputPath, ToolCache
 
 import identifiers
 
 
 cl_tools = {}
+tool_cache = None
 
 
 class CLTools(Module):
@@ -85,6 +88,52 @@ def _eintr_retry_call(func, *args):
             raise
 
 
+class ToolInvocation(object):
+    """A prepared run of a command-line tool.
+
+    run() doesn't touch the module, so it can be called from a background
+    thread.
+    """
+    def __init__(self, args, kwargs, stdin, open_files, output_files,
+                 file_std, return_code, cache_key, setOutput, annotations):
+        self.args = args
+        self.kwargs = kwargs
+        self.stdin = stdin
+        self.open_files = open_files
+        self.output_files = output_files
+        self.file_std = file_std
+        self.return_code = return_code
+        self.cache_key = cache_key
+        self.setOutput = setOutput
+        self.annotations = annotations
+
+    def run(self):
+        """Runs the tool, or gets its results from the cache.
+
+        Returns (returncode, stdout, stderr, cache_hit).
+        """
+        try:
+            entry = None
+            if self.cache_key is not None:
+                entry = tool_cache.lookup(self.cache_key)
+            if entry is not None:
+                returncode, stdout, stderr = tool_cache.restore(
+                        entry, self.output_files)
+                return returncode, stdout, stderr, True
+
+            process = subprocess.Popen(self.args, **self.kwargs)
+            if self.file_std:
+                process.wait()
+                stdout = stderr = None
+            else:
+                stdout, stderr = _eintr_retry_call(process.communicate,
+                                                   self.stdin)
+            return process.returncode, stdout, stderr, False
+        finally:
+            for f in self.open_files:
+                f.close()
+
+
 def _add_tool(path):
     # first create classes
     tool_name = os.path.basename(path)
@@ -102,18 +151,24 @@ def _add_tool(path):
         debug.critical("Package CLTools could not parse '%s'" % path, exc)
         return
 
-    def compute(self):
+    def prepare(self):
         """ 1. read inputs
-            2. call with inputs
-            3. set outputs
+            2. build the command-line
+
+        Returns a ToolInvocation.
         """
         # add all arguments as an unordered list
         args = [self.conf['command']]
+        # same as args, but with paths abstracted away for the cache key
+        key_args = list(args)
         file_std = 'options' in self.conf and 'std_using_files' in self.conf['options']
         fail_with_cmd = 'options' in self.conf and 'fail_with_cmd' in self.conf['options']
+        use_cache = 'options' in self.conf and 'cache' in self.conf['options']
         setOutput = [] # (name, File) - set File contents as output for name
+        output_files = [] # (name, filename) - files written by the tool
         open_files = []
         stdin = None
+        key_stdin = None
         kwargs = {}
         for type, name, klass, options in self.conf['args']:
             type = type.lower()
@@ -122,10 +177,12 @@ def _add_tool(path):
                 flag = 'flag' in options and options['flag']
                 if flag:
                     args.append(flag)
+                    key_args.append(flag)
                 if name:
                     # if flag==name we assume user tried to name a constant
                     if not name == flag:
                         args.append('%s%s' % (options.get('prefix', ''), name))
+                        key_args.append(args[-1])
             elif "input" == type:
                 # handle multiple inputs
                 values = self.force_get_input_list(name)
@@ -134,6 +191,7 @@ def _add_tool(path):
                     klass = options['type'].lower() \
                       if 'type' in options else 'string'
                 for value in values:
+                    key_value = None
                     if 'flag' == klass:
                         if not value:
                             continue
@@ -144,12 +202,16 @@ def _add_tool(path):
                             value = name
                     elif klass in ('file', 'directory', 'path'):
                         value = value.name
+                        key_value = InputPath(value,
+                                              options.get('prefix', ''))
                     # check for flag and append file name
                     if not 'flag' == klass and 'flag' in options:
                         args.append(options['flag'])
+                        key_args.append(options['flag'])
                     value = '%s%s' % (options.get('prefix', ''),
                                       value)
                     args.append(value)
+                    key_args.append(key_value or value)
             elif "output" == type:
                 # output must be a filename but we may convert the result to a string
                 # create new file
@@ -160,7 +222,10 @@ def _add_tool(path):
                     fname = options['prefix'] + fname
                 if 'flag' in options:
                     args.append(options['flag'])
+                    key_args.append(options['flag'])
                 args.append(fname)
+                key_args.append(OutputPath(name, options.get('prefix', '')))
+                output_files.append((name, file.name))
                 if "file" == klass:
                     self.set_output(name, file)
                 elif "string" == klass:
@@ -184,7 +249,13 @@ def _add_tool(path):
                 # check for flag and append file name
                 if 'flag' in options:
                     args.append(options['flag'])
+                    key_args.append(options['flag'])
                 args.append(value)
+                # the tool gets a copy of the input, so the cache key only
+                # depends on the content
+                key_args.append(InputPath(outfile.name,
+                                          options.get('prefix', '')))
+                output_files.append((name, outfile.name))
                 self.set_output(name, outfile)
         if "stdin" in self.conf:
             name, type, options = self.conf["stdin"]
@@ -192,6 +263,7 @@ def _add_tool(path):
             if self.has_input(name):
                 value = self.get_input(name)
                 if "file" == type:
+                    key_stdin = InputPath(value.name)
                     if file_std:
                         f = open(value.name, 'rb')
                     else:
@@ -199,6 +271,7 @@ def _add_tool(path):
                         stdin = f.read()
                         f.close()
                 elif "string" == type:
+                    key_stdin = value
                     if file_std:
                         file = self.interpreter.filePool.create_file()
                         f = open(file.name, 'wb')
@@ -226,6 +299,7 @@ def _add_tool(path):
                     setOutput.append((name, file))
                 else: # pragma: no cover
                     raise ValueError
+                output_files.append(('<stdout>', file.name))
                 f = open(file.name, 'wb')
                 open_files.append(f)
                 kwargs['stdout'] = f.fileno()
@@ -243,6 +317,7 @@ def _add_tool(path):
                     setOutput.append((name, file))
                 else: # pragma: no cover
                     raise ValueError
+                output_files.append(('<stderr>', file.name))
                 f = open(file.name, 'wb')
                 open_files.append(f)
                 kwargs['stderr'] = f.fileno()
@@ -254,6 +329,8 @@ def _add_tool(path):
         else:
             return_code = self.conf.get('return_code', None)
 
+        annotations = {}
+
         env = {}
         # 0. add defaults
         # 1. add from configuration
@@ -301,39 +378,51 @@ def _add_tool(path):
                                       "Error parsing env port: %s" % (
                                       debug.format_exception(e)))
 
+        cache_key = None
+        if use_cache and tool_cache is not None:
+            try:
+                cache_key = tool_cache.make_key(self.conf, key_args,
+                                                key_stdin, env,
+                                                self.conf.get('dir'))
+            except (IOError, OSError), e:
+                debug.warning("Can't compute cache key for %s" %
+                              self.tool_name, e)
+
         if env:
             kwargs['env'] = dict(os.environ)
             kwargs['env'].update(env)
             # write to execution provenance
             env = ';'.join(['%s=%s'%(k,v) for k,v in env.iteritems()])
-            self.annotate({'execution_env': env})
+            annotations['execution_env'] = env
 
         if 'dir' in self.conf:
             kwargs['cwd'] = self.conf['dir']
 
-        process = subprocess.Popen(args, **kwargs)
-        if file_std:
-            process.wait()
-        else:
-            #if stdin:
-            #    print "stdin:", len(stdin), stdin[:30]
-            stdout, stderr = _eintr_retry_call(process.communicate, stdin)
-            #stdout, stderr = process.communicate(stdin)
-            #if stdout:
-            #    print "stdout:", len(stdout), stdout[:30]
-            #if stderr:
-            #    print "stderr:", len(stderr), stderr[:30]
+        return ToolInvocation(args, kwargs, stdin, open_files, output_files,
+                              file_std, return_code, cache_key, setOutput,
+                              annotations)
+
+    def finish(self, invocation, result):
+        """ 4. check the result
+            5. set outputs
+        """
+        returncode, stdout, stderr, cache_hit = result
+        file_std = invocation.file_std
+        return_code = invocation.return_code
+        cache_key = invocation.cache_key
+
+        if invocation.annotations:
+            self.annotate(invocation.annotations)
+        if cache_hit:
+            self.annotate({'cltools_cache_hit': cache_key})
 
         if return_code is not None:
-            if process.returncode != return_code:
+            if returncode != return_code:
                 raise ModuleError(self, "Command returned %d (!= %d)" % (
-                                  process.returncode, return_code))
-        self.set_output('return_code', process.returncode)
-
-        for f in open_files:
-            f.close()
+                                  returncode, return_code))
+        self.set_output('return_code', returncode)
 
-        for name, file in setOutput:
+        for name, file in invocation.setOutput:
             f = open(file.name, 'rb')
             self.set_output(name, f.read())
             f.close()
@@ -368,12 +457,44 @@ def _add_tool(path):
                 else: # pragma: no cover
                     raise ValueError
 
+        # Only successful runs are cached, even if the tool doesn't check
+        # the return code
+        if (cache_key is not None and not cache_hit and
+                returncode == (return_code or 0)):
+            try:
+                tool_cache.store(cache_key, returncode, stdout, stderr,
+                                 invocation.output_files)
+            except (IOError, OSError), e:
+                debug.warning("Couldn't store %s results in the cache" %
+                              self.tool_name, e)
+
+    def start_compute(self):
+        # Run the process in the background, so that other tools can be
+        # started meanwhile
+        invocation = self.prepare()
+        self._invocation = invocation
+        options = self.conf.get('options', {})
+        return get_launcher().submit(invocation.run,
+                                     cpus=int(options.get('cpus', 1)),
+                                     memory=int(options.get('memory', 0)))
+
+    def compute(self):
+        if self.launched is not None:
+            invocation, self._invocation = self._invocation, None
+            result = self.launched.result()
+        else:
+            invocation = self.prepare()
+            result = invocation.run()
+        self.finish(invocation, result)
 
     # create docstring
     d = """This module is a wrapper for the command line tool '%s'""" % \
         conf['command']
     # create module
     M = new_module(CLTools, tool_name, {"compute": compute,
+                                        "start_compute": start_compute,
+                                        "prepare": prepare,
+                                        "finish": finish,
                                         "conf": conf,
                                         "tool_name": tool_name,
                                         "__doc__": d})
@@ -427,6 +548,17 @@ def add_tool(path):
 
 
 def initialize(*args, **keywords):
+    global tool_cache
+    if configuration.check('cache_dir'):
+        cache_dir = configuration.cache_dir
+    else:
+        cache_dir = os.path.join(vistrails.core.system.current_dot_vistrails(),
+                                 "CLToolsCache")
+    try:
+        tool_cache = ToolCache(cache_dir)
+    except OSError, e: # pragma: no cover
+        debug.warning("Could not create CLTools cache directory '%s', "
+                      "caching is disabled" % cache_dir, e)
     reload_scripts(initial=True)
 
 
@@ -586,3 +718,63 @@ class TestCLTools(unittest.TestCase):
         """With std_using_files: use files instead of pipes.
         """
         self.do_the_test('intern_cltools_2')
+
+    def test_cached(self):
+        """With cache: the second run is replayed without running the tool.
+        """
+        import tempfile
+        global tool_cache
+        old_cache = tool_cache
+        cache_dir = tempfile.mkdtemp(prefix='vt_test_cltools_cache_')
+        tool_cache = ToolCache(cache_dir)
+        try:
+            self.do_the_test('intern_cltools_3')
+            def popen(*args, **kwargs):
+                raise AssertionError("tool was run despite cache")
+            old_popen = subprocess.Popen
+            subprocess.Popen = popen
+            try:
+                self.do_the_test('intern_cltools_3')
+            finally:
+                subprocess.Popen = old_popen
+        finally:
+            tool_cache = old_cache
+            shutil.rmtree(cache_dir)
+
+    def test_cached_error(self):
+        """With cache: a run returning an error status is not cached.
+        """
+        import tempfile
+        global tool_cache
+        old_cache = tool_cache
+        cache_dir = tempfile.mkdtemp(prefix='vt_test_cltools_cache_')
+        tool_cache = ToolCache(cache_dir)
+        runs = []
+        old_popen = subprocess.Popen
+        def popen(*args, **kwargs):
+            runs.append(args)
+            return old_popen(*args, **kwargs)
+        subprocess.Popen = popen
+        try:
+            for i in xrange(2):
+                with intercept_results(self._tools['intern_cltools_3'],
+                                       'return_code') as (return_code,):
+                    self.assertFalse(execute([
+                            ('intern_cltools_3',
+                             'org.vistrails.vistrails.cltools', [
+                                ('f_in', [('File', self.testdir +
+                                                   '/test_1.cltest')]),
+                                ('chars', [('List', '["a", "b", "c"]')]),
+                                ('false', [('Boolean', 'False')]),
+                                ('true', [('Boolean', 'True')]),
+                                # the script fails with this number
+                                ('nb', [('Integer', '41')]),
+                                ('stdin', [('String', 'some line\n')]),
+                            ]),
+                        ]))
+                self.assertEqual(return_code, [1])
+            self.assertEqual(len(runs), 2)
+        finally:
+            subprocess.Popen = old_popen
+            tool_cache = old_cache
+            shutil.rmtree(cache_dir)
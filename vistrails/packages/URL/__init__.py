@@ -46,4 +46,9 @@ check is performed efficiently using HTTP headers.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 from identifiers import *
+
+configuration = ConfigurationObject(maxConcurrentDownloads=4,
+                                    cacheMaxSize=2048)
@@ -0,0 +1,550 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Download helpers for the URL package.
+
+This provides the pieces used by DownloadFile and HTTPDirectory: streaming a
+response to disk through a temporary file (so that an interrupted transfer
+never leaves a truncated file in the cache), resuming partial transfers with
+HTTP range requests, running several transfers concurrently, and keeping the
+local cache under a size budget.
+"""
+
+from __future__ import division
+
+import errno
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+import urllib2
+
+try:
+    import hashlib
+    sha_hash = hashlib.sha1
+except ImportError:
+    import sha
+    sha_hash = sha.new
+
+from vistrails.core import debug
+
+
+MIN_CHUNKSIZE = 16 * 1024
+MAX_CHUNKSIZE = 4 * 1024 * 1024
+
+
+def partial_filename(filename):
+    return filename + '.part'
+
+
+def _replace(src, dst):
+    """Renames src to dst, overwriting dst.
+
+    os.rename() is atomic on POSIX but refuses to overwrite on Windows.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if os.name != 'nt' or not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def hash_file(filename, chunksize=MAX_CHUNKSIZE):
+    hasher = sha_hash()
+    with open(filename, 'rb') as fp:
+        chunk = fp.read(chunksize)
+        while chunk:
+            hasher.update(chunk)
+            chunk = fp.read(chunksize)
+    return hasher.hexdigest()
+
+
+def stream_to_file(response, filename, resume_from=0, total_size=None,
+                   progress=None):
+    """Downloads the body of response into filename.
+
+    The data is written to a '.part' file which is renamed to filename once
+    the transfer completes. If resume_from is not 0, response is assumed to
+    contain the file starting at that offset (a 206 response) and the data is
+    appended to the existing '.part' file.
+
+    The read size adapts to the speed of the connection, between
+    MIN_CHUNKSIZE and MAX_CHUNKSIZE. If given, progress is called with the
+    fraction downloaded so far.
+
+    On error, the '.part' file is left behind so the transfer can be resumed.
+
+    Returns the SHA-1 of the whole file.
+    """
+    part = partial_filename(filename)
+    hasher = sha_hash()
+    if resume_from:
+        with open(part, 'rb') as fp:
+            remaining = resume_from
+            while remaining > 0:
+                chunk = fp.read(min(remaining, MAX_CHUNKSIZE))
+                if not chunk:
+                    raise IOError("Partial file is shorter than expected")
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        fp = open(part, 'r+b')
+        fp.seek(resume_from)
+        fp.truncate()
+    else:
+        fp = open(part, 'wb')
+    try:
+        dl_size = resume_from
+        chunksize = 64 * 1024
+        while True:
+            if progress is not None and total_size:
+                progress(dl_size * 1.0 / total_size)
+            start = time.time()
+            chunk = response.read(chunksize)
+            if not chunk:
+                break
+            elapsed = time.time() - start
+            # Grow the reads on fast connections, shrink them if a read
+            # blocks for long so that progress keeps being reported
+            if len(chunk) == chunksize and elapsed < 0.1:
+                chunksize = min(chunksize * 2, MAX_CHUNKSIZE)
+            elif elapsed > 1.0:
+                chunksize = max(chunksize // 2, MIN_CHUNKSIZE)
+            dl_size += len(chunk)
+            hasher.update(chunk)
+            fp.write(chunk)
+    finally:
+        fp.close()
+        response.close()
+    if total_size is not None and dl_size < total_size:
+        raise IOError("Connection closed after %d of %d bytes" % (
+                      dl_size, total_size))
+    _replace(part, filename)
+    return hasher.hexdigest()
+
+
+def open_range(opener, url, offset, validator=None):
+    """Requests the part of url starting at offset.
+
+    validator is the ETag or Last-Modified value the partial data was
+    received with; it is sent as If-Range so that the server sends the whole
+    file if it changed since.
+
+    Returns the response, and whether it contains only the requested range
+    (206) or the whole file (200).
+    """
+    request = urllib2.Request(url)
+    request.add_header('Range', 'bytes=%d-' % offset)
+    if validator is not None:
+        request.add_header('If-Range', validator)
+    response = opener.open(request)
+    return response, response.getcode() == 206
+
+
+class DownloadManager(object):
+    """Runs download tasks on a fixed number of threads.
+
+    A task is a callable; it can return an iterable of new tasks, which are
+    queued as well (this is how HTTPDirectory walks a directory listing while
+    already downloading the files it found).
+    """
+    def __init__(self, concurrency=1):
+        self.concurrency = max(1, concurrency)
+
+    def run(self, tasks):
+        """Runs the tasks and all the tasks they spawn.
+
+        If a task raises, no new task is started; the first exception is
+        re-raised once the running tasks are done.
+        """
+        queue = Queue.Queue()
+        errors = []
+        for task in tasks:
+            queue.put(task)
+
+        if self.concurrency == 1:
+            while not queue.empty():
+                self._run_task(queue, queue.get(), errors)
+                if errors:
+                    break
+        else:
+            def worker():
+                while True:
+                    task = queue.get()
+                    if task is None:
+                        queue.task_done()
+                        break
+                    try:
+                        if not errors:
+                            self._run_task(queue, task, errors)
+                    finally:
+                        queue.task_done()
+
+            threads = [threading.Thread(target=worker)
+                       for _ in xrange(self.concurrency)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            queue.join()
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @staticmethod
+    def _run_task(queue, task, errors):
+        try:
+            new_tasks = task()
+        except Exception:
+            errors.append(sys.exc_info())
+        else:
+            if new_tasks:
+                for new_task in new_tasks:
+                    queue.put(new_task)
+
+    def map(self, function, items):
+        """Calls function on each item, returning the results in order.
+        """
+        items = list(items)
+        results = [None] * len(items)
+
+        def make_task(i, item):
+            def task():
+                results[i] = function(item)
+            return task
+        self.run([make_task(i, item) for i, item in enumerate(items)])
+        return results
+
+
+class ContentCache(object):
+    """Index of the files in the download cache directory.
+
+    Records the size, modification time, SHA-1 and last access time of each
+    file, so that cached files can be checked for corruption and that the
+    least recently used ones can be evicted once the cache gets over
+    max_size bytes. Files that are not in the index (downloaded by an older
+    version, or by SSH) are left alone.
+    """
+    INDEX_FILENAME = 'cache_index.json'
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._index_file = os.path.join(directory, self.INDEX_FILENAME)
+        self._lock = threading.RLock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self._index_file, 'rb') as fp:
+                    self._entries = json.load(fp)
+            except (IOError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        tmp = self._index_file + '.tmp'
+        with open(tmp, 'wb') as fp:
+            json.dump(self._entries, fp)
+        _replace(tmp, self._index_file)
+
+    def __contains__(self, filename):
+        with self._lock:
+            return os.path.basename(filename) in self._load()
+
+    def total_size(self):
+        with self._lock:
+            return sum(e['size'] for e in self._load().itervalues())
+
+    def add(self, filename, digest):
+        """Records a newly downloaded file, and evicts old files if needed.
+        """
+        name = os.path.basename(filename)
+        st = os.stat(filename)
+        with self._lock:
+            self._load()[name] = {'size': st.st_size,
+                                  'mtime': st.st_mtime,
+                                  'sha1': digest,
+                                  'atime': time.time()}
+            self._evict(keep=name)
+            self._save()
+
+    def touch(self, filename):
+        """Marks a file as used, for the LRU policy.
+        """
+        name = os.path.basename(filename)
+        with self._lock:
+            entry = self._load().get(name)
+            if entry is not None:
+                entry['atime'] = time.time()
+                self._save()
+
+    def verify(self, filename):
+        """Checks that a cached file is still what was downloaded.
+
+        The file is only re-hashed if its size or mtime changed. Returns
+        False if the file is missing or corrupted; files that are not in the
+        index are assumed to be valid.
+        """
+        name = os.path.basename(filename)
+        with self._lock:
+            entry = self._load().get(name)
+        if entry is None:
+            return os.path.isfile(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if st.st_size != entry['size']:
+            return False
+        if st.st_mtime == entry['mtime']:
+            return True
+        if hash_file(filename) != entry['sha1']:
+            return False
+        with self._lock:
+            entry['mtime'] = st.st_mtime
+            self._save()
+        return True
+
+    def remove(self, filename):
+        name = os.path.basename(filename)
+        with self._lock:
+            self._remove(name)
+            self._save()
+
+    def _remove(self, name):
+        self._load().pop(name, None)
+        for fname in (name, name + '.etag'):
+            try:
+                os.remove(os.path.join(self.directory, fname))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    debug.warning("Couldn't remove cached file %s" % fname,
+                                  e)
+
+    def _evict(self, keep=None):
+        if not self.max_size:
+            return
+        entries = self._load()
+        total = sum(e['size'] for e in entries.itervalues())
+        if total <= self.max_size:
+            return
+        lru = sorted(entries.iteritems(), key=lambda (n, e): e['atime'])
+        for name, entry in lru:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            total -= entry['size']
+            self._remove(name)
+            debug.log("Evicted %s from the download cache" % name)
+
+
+###############################################################################
+
+import unittest
+
+
+def make_test_server(directory):
+    """Starts an HTTP server serving directory, that supports Range requests.
+    """
+    import BaseHTTPServer
+    import SimpleHTTPServer
+
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = path.split('?', 1)[0].split('#', 1)[0]
+            return os.path.join(directory, *filter(None, path.split('/')))
+
+        def do_GET(self):
+            path = self.translate_path(self.path)
+            range_header = self.headers.get('Range')
+            if range_header is None or not os.path.isfile(path):
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            offset = int(range_header[6:].split('-', 1)[0])
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            self.send_response(206)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data) - offset))
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                             offset, len(data) - 1, len(data)))
+            self.end_headers()
+            self.wfile.write(data[offset:])
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+class TestDownloadManager(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        cls.served = tempfile.mkdtemp(prefix='vt_test_http_served_')
+        with open(os.path.join(cls.served, 'big'), 'wb') as fp:
+            fp.write(''.join(chr(i % 256) for i in xrange(300000)))
+        cls.server, cls.url = make_test_server(cls.served)
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.served)
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp(prefix='vt_test_http_')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_stream(self):
+        target = os.path.join(self.tmp, 'big')
+        response = urllib2.urlopen(self.url + '/big')
+        digest = stream_to_file(response, target, total_size=300000)
+        self.assertEqual(digest, hash_file(os.path.join(self.served, 'big')))
+        self.assertEqual(os.path.getsize(target), 300000)
+        self.assertFalse(os.path.exists(partial_filename(target)))
+
+    def test_resume(self):
+        target = os.path.join(self.tmp, 'big')
+        with open(os.path.join(self.served, 'big'), 'rb') as fp:
+            data = fp.read()
+        with open(partial_filename(target), 'wb') as fp:
+            fp.write(data[:1000])
+        response, partial = open_range(urllib2.build_opener(),
+                                       self.url + '/big', 1000)
+        self.assertTrue(partial)
+        digest = stream_to_file(response, target, resume_from=1000)
+        self.assertEqual(digest, hash_file(os.path.join(self.served, 'big')))
+        with open(target, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+
+    def test_interrupted(self):
+        class Broken(object):
+            def __init__(self):
+                self.calls = 0
+            def read(self, size):
+                self.calls += 1
+                if self.calls > 2:
+                    raise IOError("connection reset")
+                return 'a' * size
+            def close(self):
+                pass
+        target = os.path.join(self.tmp, 'file')
+        with self.assertRaises(IOError):
+            stream_to_file(Broken(), target)
+        self.assertFalse(os.path.exists(target))
+        self.assertTrue(os.path.exists(partial_filename(target)))
+
+    def test_map(self):
+        for concurrency in (1, 4):
+            manager = DownloadManager(concurrency)
+            self.assertEqual(manager.map(lambda x: x * 2, xrange(20)),
+                             range(0, 40, 2))
+
+    def test_map_error(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError("expected")
+            return x
+        with self.assertRaises(ValueError):
+            DownloadManager(3).map(fail, xrange(10))
+
+    def test_spawned_tasks(self):
+        seen = []
+        lock = threading.Lock()
+
+        def task(depth):
+            def run():
+                with lock:
+                    seen.append(depth)
+                if depth < 3:
+                    return [task(depth + 1), task(depth + 1)]
+            return run
+        DownloadManager(4).run([task(0)])
+        self.assertEqual(sorted(seen), [0, 1, 1, 2, 2, 2, 2,
+                                        3, 3, 3, 3, 3, 3, 3, 3])
+
+    def test_cache_eviction(self):
+        cache = ContentCache(self.tmp, max_size=250)
+        for i, name in enumerate('abc'):
+            filename = os.path.join(self.tmp, name)
+            with open(filename, 'wb') as fp:
+                fp.write(name * 100)
+            cache.touch(os.path.join(self.tmp, 'a'))
+            cache.add(filename, hash_file(filename))
+        # 'b' was the least recently used
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'b')))
+        self.assertEqual(cache.total_size(), 200)
+
+        # Index is persisted
+        cache = ContentCache(self.tmp, max_size=250)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_cache_verify(self):
+        cache = ContentCache(self.tmp)
+        filename = os.path.join(self.tmp, 'file')
+        with open(filename, 'wb') as fp:
+            fp.write('hello')
+        cache.add(filename, hash_file(filename))
+        self.assertTrue(cache.verify(filename))
+        with open(filename, 'wb') as fp:
+            fp.write('jello')
+        os.utime(filename, (0, 0))
+        self.assertFalse(cache.verify(filename))
+        self.assertTrue(cache.verify(os.path.join(self.tmp, 'unknown')) is
+                        False)
@@ -38,10 +38,12 @@
 
 from __future__ import division
 
+import functools
 from HTMLParser import HTMLParser
 import os
 import re
 
+from .download_manager import DownloadManager, stream_to_file
 from .https_if_available import build_opener
 
 
@@ -92,24 +94,30 @@ class ListingParser(HTMLParser):
                     break
 
 
-def download_directory(url, target, insecure=False):
-    def mkdir():
-        if not mkdir.done:
-            try:
-                os.mkdir(target)
-            except OSError:
-                pass
-            mkdir.done = True
-    mkdir.done = False
+def download_directory(url, target, insecure=False, concurrency=1):
+    """Downloads a directory listing recursively.
 
+    Up to `concurrency` files and listings are fetched at the same time.
+    """
     opener = build_opener(insecure=insecure)
+    manager = DownloadManager(concurrency)
+    manager.run([functools.partial(_download_entry, opener, url, target)])
+
+
+def _download_entry(opener, url, target):
+    """Downloads a single URL.
+
+    If it's a directory listing, returns the tasks downloading its entries.
+    """
     response = opener.open(url)
 
     if response.info().type == 'text/html':
         contents = response.read()
+        response.close()
 
         parser = ListingParser(url)
         parser.feed(contents)
+        tasks = []
         for link in parser.links:
             link = resolve_link(link, url)
             if link[-1] == '/':
@@ -119,9 +127,14 @@ def download_directory(url, target, insecure=False):
             name = link.rsplit('/', 1)[1]
             if '?' in name:
                 continue
-            mkdir()
-            download_directory(link, os.path.join(target, name), insecure)
-        if not mkdir.done:
+            if not tasks:
+                try:
+                    os.mkdir(target)
+                except OSError:
+                    pass
+            tasks.append(functools.partial(_download_entry, opener,
+                                           link, os.path.join(target, name)))
+        if not tasks:
             # We didn't find anything to write inside this directory
             # Maybe it's a HTML file?
             if url[-1] != '/':
@@ -130,13 +143,10 @@ def download_directory(url, target, insecure=False):
                     target = target + '.html'
                 with open(target, 'wb') as fp:
                     fp.write(contents)
+        return tasks
     else:
-        buffer_size = 4096
-        with open(target, 'wb') as fp:
-            chunk = response.read(buffer_size)
-            while chunk:
-                fp.write(chunk)
-                chunk = response.read(buffer_size)
+        stream_to_file(response, target)
+        return None
 
 
 ###############################################################################
@@ -213,3 +223,39 @@ Index of /test</title></head><body><h1>Index of /test</h1><table><tr><th>
                 'http://a.remram.fr/cc/',
                 'http://a.remram.fr/dd',
         ]))
+
+
+class TestLocalDirectory(unittest.TestCase):
+    def test_download_concurrent(self):
+        import shutil
+        import tempfile
+        from .download_manager import make_test_server
+
+        served = tempfile.mkdtemp(prefix='vt_test_http_served_')
+        testdir = tempfile.mkdtemp(prefix='vt_test_http_')
+        server = None
+        try:
+            os.mkdir(os.path.join(served, 'sub'))
+            expected = {}
+            for i in xrange(10):
+                name = 'sub/f%d' % i if i % 2 else 'f%d' % i
+                with open(os.path.join(served, *name.split('/')), 'wb') as fp:
+                    fp.write(name * 1000)
+                expected[name] = name * 1000
+            server, url = make_test_server(served)
+            target = os.path.join(testdir, 'out')
+            download_directory(url + '/', target, concurrency=4)
+            files = {}
+            for dirpath, dirnames, filenames in os.walk(target):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    with open(filename, 'rb') as fp:
+                        rel = os.path.relpath(filename, target)
+                        files[rel.replace(os.sep, '/')] = fp.read()
+            self.assertEqual(files, expected)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(served)
+            shutil.rmtree(testdir)
@@ -41,7 +41,9 @@ without its associated data.
 
 This package uses a local cache, inside the per-user VisTrails directory. This
 way, files that haven't been changed do not need to be downloaded again. The
-check is performed efficiently using HTTP headers.
+check is performed efficiently using HTTP headers. The cache is kept under the
+size set by the 'cacheMaxSize' configuration option (in megabytes), by evicting
+the least recently used files.
 """
 
 from __future__ import division
@@ -70,11 +72,14 @@ from vistrails.core.system import current_dot_vistrails, strptime
 from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
 
 from .identifiers import identifier
+from .download_manager import ContentCache, DownloadManager, open_range, \
+    partial_filename, stream_to_file
 from .http_directory import download_directory
 from .https_if_available import build_opener
 
 
 package_directory = None
+content_cache = None
 
 MAX_CACHE_FILENAME = 100
 
@@ -94,10 +99,11 @@ def cache_filename(url):
 ###############################################################################
 
 class Downloader(object):
-    def __init__(self, url, module, insecure):
+    def __init__(self, url, module, insecure, report_progress=True):
         self.url = url
         self.module = module
         self.opener = build_opener(insecure=insecure)
+        self.report_progress = report_progress
 
     def execute(self):
         """ Tries to download a file from url.
@@ -107,6 +113,13 @@ class Downloader(object):
         self.local_filename = os.path.join(package_directory,
                                            cache_filename(self.url))
 
+        # Drop the cached copy if it got corrupted
+        if (self.is_in_local_cache and
+                not content_cache.verify(self.local_filename)):
+            debug.warning("Cached file for %s is corrupted, downloading it "
+                          "again" % self.url)
+            content_cache.remove(self.local_filename)
+
         # Before download
         self.pre_download()
 
@@ -117,17 +130,20 @@ class Downloader(object):
             if self.is_in_local_cache:
                 debug.warning("A network error occurred. DownloadFile will "
                               "use a cached version of the file")
+                content_cache.touch(self.local_filename)
                 return self.local_filename
             else:
                 raise ModuleError(
                         self.module,
                         "Network error: %s" % debug.format_exception(e))
         if response is None:
+            content_cache.touch(self.local_filename)
             return self.local_filename
 
         # Read response headers
         self.size_header = None
         if not self.read_headers(response):
+            content_cache.touch(self.local_filename)
             return self.local_filename
 
         # Download
@@ -147,32 +163,26 @@ class Downloader(object):
     def read_headers(self, response):
         return True
 
-    def download(self, response):
-        try:
-            dl_size = 0
-            CHUNKSIZE = 4096
-            f2 = open(self.local_filename, 'wb')
-            while True:
-                if self.size_header is not None:
-                    self.module.logging.update_progress(
-                            self.module,
-                            dl_size * 1.0/self.size_header)
-                chunk = response.read(CHUNKSIZE)
-                if not chunk:
-                    break
-                dl_size += len(chunk)
-                f2.write(chunk)
-            f2.close()
-            response.close()
+    def progress(self, fraction):
+        if self.report_progress:
+            self.module.logging.update_progress(self.module, fraction)
 
+    def download(self, response, resume_from=0):
+        """Writes the response to the cache.
+
+        The file is replaced atomically once the transfer is complete, so the
+        previous version stays available if it fails.
+        """
+        try:
+            digest = stream_to_file(response, self.local_filename,
+                                    resume_from=resume_from,
+                                    total_size=self.size_header,
+                                    progress=self.progress)
         except Exception, e:
-            try:
-                os.unlink(self.local_filename)
-            except OSError:
-                pass
             raise ModuleError(
                     self.module,
                     "Error retrieving URL: %s" % debug.format_exception(e))
+        content_cache.add(self.local_filename, digest)
 
     def post_download(self, response):
         pass
@@ -245,10 +255,63 @@ class HTTPDownloader(Downloader):
                 return True
         return remote_time > local_time
 
+    def _read_validator(self, response):
+        return (response.headers.get('ETag') or
+                response.headers.get('Last-Modified'))
+
+    def _resume(self, response):
+        """Resumes a previously interrupted transfer, if possible.
+
+        Returns the response to read from, and the offset it starts at.
+        """
+        part = partial_filename(self.local_filename)
+        validator_file = part + '.validator'
+        validator = self._read_validator(response)
+        try:
+            with open(validator_file) as fp:
+                part_validator = fp.read()
+            offset = os.path.getsize(part)
+        except (IOError, OSError):
+            part_validator = None
+            offset = 0
+        if (offset and validator is not None and
+                part_validator == validator and
+                response.headers.get('Accept-Ranges') == 'bytes'):
+            response.close()
+            response, partial = open_range(self.opener, self.url,
+                                           offset, validator)
+            if partial:
+                debug.log("Resuming download of %s at %d bytes" % (
+                          self.url, offset))
+                return response, offset
+            validator = self._read_validator(response)
+
+        # Remember what the partial data will belong to
+        if validator is not None:
+            with open(validator_file, 'w') as fp:
+                fp.write(validator)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+        return response, 0
+
     def download(self, response):
         if (not self.is_in_local_cache or
                 not self.mod_header or self._is_outdated()):
-            Downloader.download(self, response)
+            try:
+                response, offset = self._resume(response)
+            except (urllib2.URLError, IOError, OSError), e:
+                raise ModuleError(
+                        self.module,
+                        "Error retrieving URL: %s" %
+                        debug.format_exception(e))
+            Downloader.download(self, response, offset)
+            try:
+                os.remove(partial_filename(self.local_filename) +
+                          '.validator')
+            except OSError:
+                pass
+        else:
+            content_cache.touch(self.local_filename)
 
     def post_download(self, response):
         try:
@@ -298,7 +361,7 @@ class SSHDownloader(object):
             '$'
             )
 
-    def __init__(self, url, module, insecure):
+    def __init__(self, url, module, insecure, report_progress=True):
         self.url = url
         self.module = module
 
@@ -392,6 +455,9 @@ class DownloadFile(Module):
         be specified
 
     If `insecure` is set, an invalid TLS certificate will not cause an error.
+
+    When looping over a list of URLs, the files are first fetched
+    concurrently (see the 'maxConcurrentDownloads' configuration option).
     """
 
     def compute(self):
@@ -403,6 +469,33 @@ class DownloadFile(Module):
         result = PathObject(local_filename)
         self.set_output('file', result)
 
+    def compute_all(self):
+        # Only the url port is iterated: warm up the cache concurrently, the
+        # iterations will then only need to revalidate
+        iterated = [port_name
+                    for port_name, depth, _ in self.iterated_ports
+                    if depth == self.list_depth]
+        if (self.list_depth == 1 and iterated == ['url'] and
+                configuration.maxConcurrentDownloads > 1):
+            self.prefetch(self.get_input('url'), self.get_input('insecure'))
+        Module.compute_all(self)
+
+    def prefetch(self, urls, insecure):
+        def fetch(url):
+            scheme = urllib2.splittype(url)[0]
+            if scheme not in ('http', 'https'):
+                return
+            try:
+                HTTPDownloader(url, self, insecure,
+                               report_progress=False).execute()
+            except Exception, e:
+                # The error will be reported by the iteration
+                debug.log("Prefetching %s failed: %s" % (url, e))
+
+        # Don't fetch the same file from two threads
+        urls = list(set(urls))
+        DownloadManager(configuration.maxConcurrentDownloads).map(fetch, urls)
+
     def download(self, url, insecure):
         """ Tries to download a file from url.
 
@@ -431,7 +524,8 @@ class HTTPDirectory(Module):
     def download(self, url, insecure):
         local_path = self.interpreter.filePool.create_directory(
                 prefix='vt_http').name
-        download_directory(url, local_path, insecure)
+        download_directory(url, local_path, insecure,
+                           concurrency=configuration.maxConcurrentDownloads)
         return local_path
 
 
@@ -499,7 +593,7 @@ def initialize(*args, **keywords):
     reg.add_input_port(URLDecode, "encoded", basic.String)
     reg.add_output_port(URLDecode, "string", basic.String)
 
-    global package_directory
+    global package_directory, content_cache
     dotVistrails = current_dot_vistrails()
     package_directory = os.path.join(dotVistrails, "HTTP")
 
@@ -559,9 +653,16 @@ def initialize(*args, **keywords):
                 renamed += 1
         else:
             handled.add(old_filename + '.etag')
+            handled.add(old_filename + '.part')
+            handled.add(old_filename + '.part.validator')
     if renamed:
         debug.warning("Renamed %d downloaded cache files" % renamed)
 
+    max_size = configuration.cacheMaxSize
+    content_cache = ContentCache(package_directory,
+                                 max_size * 1024 * 1024 if max_size > 0
+                                 else None)
+
 
 def handle_module_upgrade_request(controller, module_id, pipeline):
     module_remap = {
@@ -77,7 +77,9 @@ def compute_hash(persistent_path, is_dir=None):
             sha_hasher.update(fname)
             hash_file(os.path.join(base_dir, fname), sha_hasher)
     else:
-        hash_file(persistent_path, sha_hasher)
+        # The SHA-1 of a single file is kept in the file hash cache
+        from vistrails.core.cache.file_hash import get_file_hash_cache
+        return get_file_hash_cache().file_hash(persistent_path)
     return sha_hasher.hexdigest()
 
 if __name__ == '__main__':
@@ -43,13 +43,12 @@ py_import('dulwich', {
         'linux-ubuntu': 'python-dulwich',
         'linux-fedora': 'python-dulwich'})
 from vistrails.core import debug
+from vistrails.core.cache.file_hash import get_file_hash_cache, list_files
 
 from dulwich.errors import NotCommitError, NotGitRepository
 from dulwich.repo import Repo
-from dulwich.objects import Commit, Blob, Tree, object_header
-from dulwich.pack import iter_sha1
+from dulwich.objects import Commit, Tree
 from dulwich.walk import Walker
-from itertools import chain
 import os
 import shutil
 import stat
@@ -155,25 +154,29 @@ class GitRepo(object):
 
     @staticmethod
     def compute_blob_hash(fname, chunk_size=1<<16):
-        obj_len = os.path.getsize(fname)
-        head = object_header(Blob.type_num, obj_len)
-        with open(fname, "rb") as f:
-            def read_chunk():
-                return f.read(chunk_size)
-            my_iter = chain([head], iter(read_chunk,''))
-            return iter_sha1(my_iter)
+        # Only reads the file if it changed since it was last hashed
+        return get_file_hash_cache().file_hash(fname, 'git-blob')
 
     @staticmethod
-    def compute_tree_hash(dirname):
+    def compute_tree_hash(dirname, blob_hashes=None):
+        if blob_hashes is None:
+            # Hash all the files first, so that they are read in parallel
+            fnames = [os.path.join(dirname, name)
+                      for name in list_files(dirname)]
+            fnames = [fname for fname in fnames if os.path.isfile(fname)]
+            blob_hashes = get_file_hash_cache().hash_files(fnames,
+                                                           'git-blob')
         tree = Tree()
         for entry in sorted(os.listdir(dirname)):
             fname = os.path.join(dirname, entry)
             if os.path.isdir(fname):
-                thash = GitRepo.compute_tree_hash(fname)
+                thash = GitRepo.compute_tree_hash(fname, blob_hashes)
                 mode = stat.S_IFDIR # os.stat(fname)[stat.ST_MODE]
                 tree.add(entry, mode, thash)
             elif os.path.isfile(fname):
-                bhash = GitRepo.compute_blob_hash(fname)
+                bhash = blob_hashes.get(fname)
+                if bhash is None:
+                    bhash = GitRepo.compute_blob_hash(fname)
                 mode = os.stat(fname)[stat.ST_MODE]
                 tree.add(entry, mode, bhash)
         return tree.id
@@ -41,10 +41,15 @@ Uses SQLAlchemy to access a variety of database software.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 identifier = 'org.vistrails.vistrails.sql'
 name = 'SQL'
-version = '0.1.0'
+version = '0.1.1'
 old_identifiers = ['edu.utah.sci.vistrails.sql']
+configuration = ConfigurationObject(poolSize=5,
+                                    poolRecycle=3600,
+                                    poolPrePing=True)
 
 def package_dependencies():
     return ['org.vistrails.vistrails.tabledata']
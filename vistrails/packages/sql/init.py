@@ -36,7 +36,6 @@
 
 from __future__ import division
 
-from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import SQLAlchemyError
 import urllib
@@ -52,12 +51,18 @@ from vistrails.core.utils import versions_increasing
 
 from vistrails.packages.tabledata.common import TableObject
 
+from .pool import get_engine_registry
+
 
 class DBConnection(Module):
     """Connects to a database.
 
     If the URI you enter uses a driver which is not currently installed,
     VisTrails will try to set it up.
+
+    Engines are shared by all the DBConnection modules using the same URL and
+    pool settings, so that connections get reused across executions. The
+    pool settings default to the package configuration.
     """
     _input_ports = [('protocol', '(basic:String)'),
                     ('user', '(basic:String)',
@@ -68,9 +73,32 @@ class DBConnection(Module):
                      {'optional': True}),
                     ('port', '(basic:Integer)',
                      {'optional': True}),
-                    ('db_name', '(basic:String)')]
+                    ('db_name', '(basic:String)'),
+                    ('poolSize', '(basic:Integer)',
+                     {'optional': True}),
+                    ('poolRecycle', '(basic:Integer)',
+                     {'optional': True}),
+                    ('poolPrePing', '(basic:Boolean)',
+                     {'optional': True})]
     _output_ports = [('connection', '(DBConnection)')]
 
+    def __init__(self):
+        Module.__init__(self)
+        self._connection = None
+
+    def get_engine(self, url):
+        pool_size = self.force_get_input('poolSize', configuration.poolSize)
+        pool_recycle = self.force_get_input('poolRecycle',
+                                            configuration.poolRecycle)
+        pool_pre_ping = self.force_get_input('poolPrePing',
+                                             configuration.poolPrePing)
+        if pool_recycle is not None and pool_recycle < 0:
+            pool_recycle = None
+        return get_engine_registry().get_engine(url,
+                                                pool_size=pool_size,
+                                                pool_recycle=pool_recycle,
+                                                pool_pre_ping=pool_pre_ping)
+
     def compute(self):
         url = URL(drivername=self.get_input('protocol'),
                   username=self.force_get_input('user', None),
@@ -80,7 +108,7 @@ class DBConnection(Module):
                   database=self.get_input('db_name'))
 
         try:
-            engine = create_engine(url)
+            engine = self.get_engine(url)
         except ImportError, e:
             driver = url.drivername
             installed = False
@@ -122,7 +150,7 @@ class DBConnection(Module):
                 raise ModuleError(self,
                                   "Failed to install required driver")
             try:
-                engine = create_engine(url)
+                engine = self.get_engine(url)
             except Exception, e:
                 raise ModuleError(self,
                                   "Couldn't connect to the database: %s" %
@@ -135,7 +163,19 @@ class DBConnection(Module):
                     "SQLAlchemy has no support for protocol %r -- are you "
                     "sure you spelled that correctly?" % url.drivername)
 
-        self.set_output('connection', engine.connect())
+        self._connection = engine.connect()
+        self.set_output('connection', self._connection)
+
+    def clear(self):
+        # Gives the connection back to the pool when the interpreter drops
+        # this module
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except SQLAlchemyError:
+                pass
+            self._connection = None
+        Module.clear(self)
 
 
 class SQLSource(Module):
@@ -185,6 +225,10 @@ class SQLSource(Module):
 _modules = [DBConnection, SQLSource]
 
 
+def finalize():
+    get_engine_registry().dispose()
+
+
 def handle_module_upgrade_request(controller, module_id, pipeline):
     # Before 0.0.3, SQLSource's resultSet output was type ListOfElements (which
     #   doesn't exist anymore)
@@ -0,0 +1,153 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Process-wide registry of SQLAlchemy engines.
+
+Creating an engine is expensive and each engine owns its own connection pool,
+so the DBConnection module shares them between executions: engines are keyed
+on the connection URL and the pool options, and are only disposed of when the
+package is finalized.
+"""
+
+from __future__ import division
+
+import threading
+
+from sqlalchemy.engine import create_engine
+
+
+class EngineRegistry(object):
+    """Keeps one engine per (URL, pool options) for the whole process.
+    """
+    def __init__(self):
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(url, pool_size, pool_recycle, pool_pre_ping):
+        return (str(url), pool_size, pool_recycle, bool(pool_pre_ping))
+
+    def get_engine(self, url, pool_size=None, pool_recycle=None,
+                   pool_pre_ping=False):
+        """get_engine(url: URL, ...) -> Engine
+
+        Returns the engine for this URL, creating it if necessary. Errors
+        from create_engine() (such as ImportError for a missing driver) are
+        propagated to the caller.
+        """
+        key = self.make_key(url, pool_size, pool_recycle, pool_pre_ping)
+        with self._lock:
+            try:
+                return self._engines[key]
+            except KeyError:
+                pass
+            engine = self._create_engine(url, pool_size, pool_recycle,
+                                         pool_pre_ping)
+            self._engines[key] = engine
+            return engine
+
+    @staticmethod
+    def _create_engine(url, pool_size, pool_recycle, pool_pre_ping):
+        kwargs = {}
+        # SQLite uses a NullPool or SingletonThreadPool that don't accept a
+        # size
+        if pool_size is not None and \
+                url.drivername.split('+', 1)[0] != 'sqlite':
+            kwargs['pool_size'] = pool_size
+        if pool_recycle is not None:
+            kwargs['pool_recycle'] = pool_recycle
+        if pool_pre_ping:
+            kwargs['pool_pre_ping'] = True
+        try:
+            return create_engine(url, **kwargs)
+        except TypeError:
+            # pool_pre_ping only exists since SQLAlchemy 1.2
+            if not kwargs.pop('pool_pre_ping', False):
+                raise
+            return create_engine(url, **kwargs)
+
+    def __len__(self):
+        return len(self._engines)
+
+    def dispose(self):
+        """Closes all pooled connections and forgets the engines.
+        """
+        with self._lock:
+            engines, self._engines = self._engines, {}
+        for engine in engines.itervalues():
+            engine.dispose()
+
+
+_registry = EngineRegistry()
+
+
+def get_engine_registry():
+    return _registry
+
+
+###############################################################################
+
+import unittest
+
+
+class TestEngineRegistry(unittest.TestCase):
+    def test_shared_engine(self):
+        import os
+        import tempfile
+        from sqlalchemy.engine.url import URL
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        registry = EngineRegistry()
+        try:
+            url = URL(drivername='sqlite', database=test_db)
+            engine = registry.get_engine(url, pool_size=2, pool_recycle=60)
+            self.assertIs(engine,
+                          registry.get_engine(URL(drivername='sqlite',
+                                                  database=test_db),
+                                              pool_size=2, pool_recycle=60))
+            self.assertIsNot(engine,
+                             registry.get_engine(url, pool_size=3,
+                                                 pool_recycle=60))
+            self.assertEqual(len(registry), 2)
+            conn = engine.connect()
+            conn.execute('CREATE TABLE test(a INTEGER)')
+            conn.close()
+            registry.dispose()
+            self.assertEqual(len(registry), 0)
+        finally:
+            registry.dispose()
+            os.remove(test_db)